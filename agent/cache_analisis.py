@@ -0,0 +1,77 @@
+"""
+Cache en disco de los resultados de Gemini por contenido.
+
+La clave es el hash de los bytes originales de las imágenes más el del
+prompt (que incluye el mensaje del operario y las acciones autorizadas): la
+misma foto analizada con el mismo contexto devuelve el resultado guardado sin
+llamar al modelo. Se guarda en un SQLite local con desalojo LRU al superar
+GEMINI_CACHE_MAX_ENTRIES. Los errores del modelo no se guardan.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from services.shared_state import conectar_sqlite
+
+
+def clave_analisis(imagenes: Iterable[bytes], prompt: str) -> str:
+    """Hash SHA-256 de las imágenes (en orden) y del prompt."""
+    digest = hashlib.sha256()
+    for imagen in imagenes:
+        digest.update(hashlib.sha256(imagen).digest())
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CacheAnalisis:
+    """Resultados JSON por clave de contenido, con desalojo LRU."""
+
+    def __init__(self, ruta: str = "./analisis_gemini.db", max_entradas: int = 5000):
+        self.ruta = ruta
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+
+        self._conn = conectar_sqlite(ruta)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analisis (
+                clave TEXT PRIMARY KEY,
+                resultado TEXT NOT NULL,
+                creado_en REAL NOT NULL,
+                usado_en REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analisis_usado ON analisis (usado_en)")
+
+    def obtener(self, clave: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            fila = self._conn.execute("SELECT resultado FROM analisis WHERE clave = ?", (clave,)).fetchone()
+            if fila is not None:
+                self._conn.execute("UPDATE analisis SET usado_en = ? WHERE clave = ?", (time.time(), clave))
+        return json.loads(fila[0]) if fila is not None else None
+
+    def guardar(self, clave: str, resultado: Dict[str, Any]):
+        ahora = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO analisis (clave, resultado, creado_en, usado_en)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(clave) DO UPDATE SET
+                    resultado = excluded.resultado,
+                    creado_en = excluded.creado_en,
+                    usado_en = excluded.usado_en
+                """,
+                (clave, json.dumps(resultado, ensure_ascii=False), ahora, ahora)
+            )
+            sobrantes = self._conn.execute("SELECT COUNT(*) FROM analisis").fetchone()[0] - self.max_entradas
+            if sobrantes > 0:
+                self._conn.execute(
+                    "DELETE FROM analisis WHERE clave IN "
+                    "(SELECT clave FROM analisis ORDER BY usado_en ASC LIMIT ?)",
+                    (sobrantes,)
+                )
@@ -1,54 +1,41 @@
-import google.generativeai as genai
+import asyncio
+import hashlib
+import json
 import os
-from typing import Optional, Dict, Any
-from PIL import Image
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, NamedTuple
 import io
 import base64
 from dotenv import load_dotenv
 
+from agent.cache_analisis import CacheAnalisis, clave_analisis
+from agent.imagenes import preparar_imagen
+from services import metrics
+from services.acciones import ReglasAutorizacion, crear_reglas
+
 load_dotenv()
 
+# Veredictos posibles de la comparación ANTES/DESPUÉS
+VEREDICTOS = ("aprobado", "revisar", "rechazado")
 
-class GeminiAgent:
-    def __init__(self):
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY no está configurada")
-        
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-pro')
-        
-    async def analizar_cartel(
-        self, 
-        image_data: bytes, 
-        texto_mensaje: str,
-        acciones_autorizadas: list,
-        tipos_carteles: list = None
-    ) -> Dict[str, Any]:
-        """
-        Analiza la imagen de un cartel de señalización de gasoducto y determina la acción.
-        
-        Args:
-            image_data: Bytes de la imagen
-            texto_mensaje: Mensaje del operario
-            acciones_autorizadas: Lista de acciones autorizadas
-            tipos_carteles: Lista de tipos de carteles disponibles
-        
-        Returns:
-            Diccionario con la decisión del agente
-        """
-        try:
-            # Convertir imagen
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Crear lista de acciones para el prompt
-            acciones_str = "\n".join([f"- {accion}" for accion in acciones_autorizadas])
-            
-            tipos_str = ""
-            if tipos_carteles:
-                tipos_str = "\n\nTIPOS DE CARTELES DISPONIBLES:\n" + "\n".join([f"- {tipo}" for tipo in tipos_carteles])
-            
-            prompt = f"""Eres un agente experto en señalización de redes de gas natural para el distribuidor ECOGAS. 
+# Versiones de reglas cuyo prompt fijo se conserva armado
+_MAX_VERSIONES_PROMPT = 4
+
+
+def prompt_fijo_analisis(acciones: List[str], tipos: List[str]) -> str:
+    """
+    Parte fija del prompt de analizar_cartel: solo depende de las reglas de
+    autorización, así que se arma una vez por versión. El mensaje del operario
+    y la imagen van después.
+    """
+    acciones_str = "\n".join([f"- {accion}" for accion in acciones])
+    
+    tipos_str = ""
+    if tipos:
+        tipos_str = "\n\nTIPOS DE CARTELES DISPONIBLES:\n" + "\n".join([f"- {tipo}" for tipo in tipos])
+    
+    return f"""Eres un agente experto en señalización de redes de gas natural para el distribuidor ECOGAS. 
 
 Tu tarea es analizar la imagen de un cartel de señalización de gasoducto y determinar:
 
@@ -60,8 +47,6 @@ ACCIONES AUTORIZADAS:
 {acciones_str}
 {tipos_str}
 
-MENSAJE DEL OPERARIO: {texto_mensaje}
-
 CONTEXTO: Estos carteles señalizan la red de distribución de gas natural de ECOGAS. 
 Incluyen señalización de gasoductos, ramales, válvulas, estaciones reguladoras, etc.
 
@@ -70,6 +55,7 @@ INSTRUCCIONES:
 - Evalúa si el estado del cartel justifica su reemplazo (deterioro, visibilidad reducida, daños estructurales)
 - Verifica si la acción está en la lista de autorizadas
 - Sé estricto: solo autoriza si hay certeza y necesidad real de reemplazo
+- El mensaje del operario y la imagen vienen a continuación
 
 Responde en formato JSON:
 {{
@@ -84,20 +70,145 @@ Responde en formato JSON:
     "observaciones": "detalles adicionales sobre el estado del cartel"
 }}"""
 
+
+class _PrefijoAnalisis(NamedTuple):
+    modelo: Any        # GenerativeModel con el prompt fijo como system_instruction
+    huella: str        # hash del prompt fijo (clave del cache de resultados)
+    vence_en: float    # monotonic; inf salvo con cache de contexto
+
+
+class GeminiAgent:
+    def __init__(self):
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY no está configurada")
+        
+        # google.generativeai (grpc, protobuf) solo se carga al construir el agente
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self.nombre_modelo = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
+        self.model = genai.GenerativeModel(self.nombre_modelo)
+
+        # Prompt fijo de analizar_cartel por versión de las reglas de autorización.
+        # Con GEMINI_CONTEXT_CACHE_MINUTES > 0 se sube como cache de contexto de
+        # la API (requiere un modelo versionado y el mínimo de tokens del API).
+        self._prefijos: "OrderedDict[str, _PrefijoAnalisis]" = OrderedDict()
+        self.cache_contexto_minutos = float(os.getenv("GEMINI_CONTEXT_CACHE_MINUTES", "0"))
+
+        # Llamadas al modelo: API async de la librería (no bloquea el event loop),
+        # como mucho GEMINI_MAX_CONCURRENCY a la vez y con deadline por llamada
+        self.timeout = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+        self._semaforo = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")))
+
+        self.lado_max_imagen = int(os.getenv("GEMINI_IMAGE_MAX_SIDE", "1536"))
+        self.calidad_jpeg = int(os.getenv("GEMINI_IMAGE_JPEG_QUALITY", "85"))
+        self.cache = CacheAnalisis(
+            os.getenv("GEMINI_CACHE_PATH", "./analisis_gemini.db"),
+            max_entradas=int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "5000"))
+        )
+        
+    async def _generar(self, operacion: str, contenido: Any, respuesta_json: bool = True, modelo: Any = None):
+        """
+        Llamada al modelo con el límite de concurrencia y el deadline. Con
+        respuesta_json el modelo responde JSON puro (sin bloques ```json).
+        """
+        config = {"response_mime_type": "application/json"} if respuesta_json else None
+        async with self._semaforo:
+            with metrics.medir_llamada("gemini", operacion):
+                response = await asyncio.wait_for(
+                    (modelo or self.model).generate_content_async(
+                        contenido,
+                        generation_config=config,
+                        request_options={"timeout": self.timeout}
+                    ),
+                    timeout=self.timeout
+                )
+        metrics.registrar_tokens_gemini(operacion, getattr(response, "usage_metadata", None))
+        return response
+
+    def _crear_prefijo(self, prompt_fijo: str) -> _PrefijoAnalisis:
+        huella = hashlib.sha256(prompt_fijo.encode("utf-8")).hexdigest()[:16]
+        if self.cache_contexto_minutos > 0:
+            try:
+                from datetime import timedelta
+                from google.generativeai import caching
+
+                contenido = caching.CachedContent.create(
+                    model=self.nombre_modelo,
+                    system_instruction=prompt_fijo,
+                    ttl=timedelta(minutes=self.cache_contexto_minutos)
+                )
+                modelo = self._genai.GenerativeModel.from_cached_content(contenido)
+                # Renovar un poco antes de que venza en el API
+                return _PrefijoAnalisis(modelo, huella, time.monotonic() + self.cache_contexto_minutos * 60 * 0.9)
+            except Exception as e:
+                print(f"⚠️ Cache de contexto de Gemini no disponible ({e}); se envía el prompt fijo en cada llamada")
+        modelo = self._genai.GenerativeModel(self.nombre_modelo, system_instruction=prompt_fijo)
+        return _PrefijoAnalisis(modelo, huella, float("inf"))
+
+    async def _prefijo_analisis(self, reglas: ReglasAutorizacion) -> _PrefijoAnalisis:
+        """Prompt fijo ya armado para la versión de las reglas (se arma al cambiar la versión)."""
+        prefijo = self._prefijos.get(reglas.version)
+        if prefijo is not None and prefijo.vence_en > time.monotonic():
+            self._prefijos.move_to_end(reglas.version)
+            metrics.registrar_cache("prompt_analisis", True)
+            return prefijo
+
+        metrics.registrar_cache("prompt_analisis", False)
+        # Con cache de contexto, crearlo es una llamada de red
+        prefijo = await asyncio.to_thread(self._crear_prefijo, prompt_fijo_analisis(reglas.acciones, reglas.tipos))
+        self._prefijos[reglas.version] = prefijo
+        self._prefijos.move_to_end(reglas.version)
+        while len(self._prefijos) > _MAX_VERSIONES_PROMPT:
+            self._prefijos.popitem(last=False)
+        return prefijo
+
+    async def analizar_cartel(
+        self, 
+        image_data: bytes, 
+        texto_mensaje: str,
+        acciones_autorizadas: list = None,
+        tipos_carteles: list = None,
+        reglas: Optional[ReglasAutorizacion] = None
+    ) -> Dict[str, Any]:
+        """
+        Analiza la imagen de un cartel de señalización de gasoducto y determina la acción.
+        
+        Args:
+            image_data: Bytes de la imagen
+            texto_mensaje: Mensaje del operario
+            acciones_autorizadas: Lista de acciones autorizadas
+            tipos_carteles: Lista de tipos de carteles disponibles
+            reglas: Acciones y tipos ya versionados (sheets_service.reglas_autorizacion());
+                si se pasan, se ignoran las dos listas anteriores
+        
+        Returns:
+            Diccionario con la decisión del agente
+        """
+        try:
+            if reglas is None:
+                reglas = crear_reglas(acciones_autorizadas or [], tipos_carteles or [])
+            prefijo = await self._prefijo_analisis(reglas)
+            consulta = f"MENSAJE DEL OPERARIO: {texto_mensaje}"
+
+            # Misma foto con el mismo contexto: resultado ya analizado
+            clave = clave_analisis([image_data], f"{prefijo.huella}\n{consulta}")
+            en_cache = self.cache.obtener(clave)
+            metrics.registrar_cache("analisis_gemini", en_cache is not None)
+            if en_cache is not None:
+                return en_cache
+
+            # Decodificar y redimensionar es CPU: fuera del event loop
+            imagen, mime = await asyncio.to_thread(preparar_imagen, image_data, self.lado_max_imagen, self.calidad_jpeg)
+
             # Generar respuesta
-            response = self.model.generate_content([prompt, image])
+            response = await self._generar(
+                "analizar_cartel", [consulta, {"mime_type": mime, "data": imagen}], modelo=prefijo.modelo
+            )
+            resultado = json.loads(response.text)
             
-            # Parsear respuesta
-            response_text = response.text.strip()
-            
-            # Limpiar la respuesta si viene con markdown
-            if response_text.startswith("```json"):
-                response_text = response_text.replace("```json", "").replace("```", "").strip()
-            
-            import json
-            resultado = json.loads(response_text)
-            
-            return {
+            decision = {
                 "autorizado": resultado.get("autorizado", False),
                 "accion": resultado.get("accion_autorizada"),
                 "tipo_cartel": resultado.get("tipo_cartel"),
@@ -110,19 +221,119 @@ Responde en formato JSON:
                     "observaciones": resultado.get("observaciones")
                 }
             }
+            self.cache.guardar(clave, decision)
+            return decision
             
+        except asyncio.TimeoutError:
+            return self._decision_error(f"Gemini no respondió en {self.timeout:.0f} s")
         except Exception as e:
-            return {
-                "autorizado": False,
-                "accion": None,
-                "tipo_cartel": None,
-                "gasoducto": None,
-                "confianza": 0.0,
-                "razon": f"Error al analizar la imagen: {str(e)}",
-                "requiere_stock": False,
-                "detalles": {}
-            }
+            return self._decision_error(f"Error al analizar la imagen: {str(e)}")
+
+    @staticmethod
+    def _decision_error(razon: str) -> Dict[str, Any]:
+        return {
+            "autorizado": False,
+            "accion": None,
+            "tipo_cartel": None,
+            "gasoducto": None,
+            "confianza": 0.0,
+            "razon": razon,
+            "requiere_stock": False,
+            "detalles": {}
+        }
     
+    async def comparar_antes_despues(
+        self,
+        imagenes_antes: List[bytes],
+        imagenes_despues: List[bytes],
+        cartel_info: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Compara en una sola llamada las fotos ANTES y DESPUÉS de un trabajo y
+        dictamina si el cartel quedó reparado/reemplazado.
+
+        Returns:
+            Veredicto estructurado, o None si falló el análisis
+        """
+        try:
+            cartel_info = cartel_info or {}
+            contexto = "\n".join(
+                f"- {etiqueta}: {cartel_info[clave]}"
+                for clave, etiqueta in (
+                    ('numero', 'Cartel'),
+                    ('tipo', 'Tipo'),
+                    ('gasoducto_ramal', 'Gasoducto/Ramal'),
+                    ('ubicacion', 'Ubicación'),
+                    ('tipo_trabajo', 'Trabajo solicitado')
+                )
+                if cartel_info.get(clave) not in (None, '', '-')
+            )
+
+            prompt = f"""Eres un inspector de señalización de gasoductos de ECOGAS.
+
+Recibes {len(imagenes_antes)} fotos ANTES y {len(imagenes_despues)} fotos DESPUÉS de un trabajo de un operario sobre un cartel de señalización.
+
+DATOS DEL CARTEL:
+{contexto or "- Sin datos"}
+
+Compara ambas tandas y determina:
+1. ¿Las fotos ANTES y DESPUÉS muestran el mismo cartel y el mismo lugar?
+2. ¿El estado DESPUÉS muestra el cartel reparado o reemplazado (legible, limpio, firme, sin daños)?
+3. ¿Hay problemas visibles después del trabajo?
+
+Responde en formato JSON:
+{{
+    "mismo_cartel": true/false,
+    "trabajo_realizado": true/false,
+    "estado_antes": "descripción breve del estado antes",
+    "estado_despues": "descripción breve del estado después",
+    "problemas": ["problemas visibles después del trabajo"],
+    "veredicto": "aprobado" | "revisar" | "rechazado",
+    "confianza": 0.0-1.0,
+    "razon": "explicación de la decisión"
+}}"""
+
+            clave = clave_analisis([*imagenes_antes, *imagenes_despues], prompt)
+            en_cache = self.cache.obtener(clave)
+            metrics.registrar_cache("analisis_gemini", en_cache is not None)
+            if en_cache is not None:
+                return en_cache
+
+            preparadas = await asyncio.gather(*(
+                asyncio.to_thread(preparar_imagen, imagen, self.lado_max_imagen, self.calidad_jpeg)
+                for imagen in [*imagenes_antes, *imagenes_despues]
+            ))
+            contenido: List[Any] = [prompt]
+            for indice, (imagen, mime) in enumerate(preparadas):
+                momento, numero = ("ANTES", indice + 1) if indice < len(imagenes_antes) else ("DESPUÉS", indice - len(imagenes_antes) + 1)
+                contenido.append(f"Foto {momento} {numero}:")
+                contenido.append({"mime_type": mime, "data": imagen})
+
+            response = await self._generar("comparar_antes_despues", contenido)
+            resultado = json.loads(response.text)
+
+            veredicto = {
+                "mismo_cartel": bool(resultado.get("mismo_cartel", False)),
+                "trabajo_realizado": bool(resultado.get("trabajo_realizado", False)),
+                "veredicto": resultado.get("veredicto") if resultado.get("veredicto") in VEREDICTOS else "revisar",
+                "confianza": float(resultado.get("confianza", 0.0) or 0.0),
+                "razon": resultado.get("razon", ""),
+                "detalles": {
+                    "estado_antes": resultado.get("estado_antes"),
+                    "estado_despues": resultado.get("estado_despues"),
+                    "problemas": resultado.get("problemas") or []
+                }
+            }
+            self.cache.guardar(clave, veredicto)
+            return veredicto
+
+        except asyncio.TimeoutError:
+            print(f"⚠️ Comparación ANTES/DESPUÉS: Gemini no respondió en {self.timeout:.0f} s")
+            return None
+        except Exception as e:
+            print(f"⚠️ Error en la comparación ANTES/DESPUÉS: {e}")
+            return None
+
     async def extraer_ubicacion_texto(self, texto: str) -> Optional[Dict[str, float]]:
         """
         Intenta extraer información de ubicación del texto usando Gemini.
@@ -143,14 +354,8 @@ Si NO hay información de ubicación clara, responde:
     "tiene_ubicacion": false
 }}"""
 
-            response = self.model.generate_content(prompt)
-            response_text = response.text.strip()
-            
-            if response_text.startswith("```json"):
-                response_text = response_text.replace("```json", "").replace("```", "").strip()
-            
-            import json
-            resultado = json.loads(response_text)
+            response = await self._generar("extraer_ubicacion", prompt)
+            resultado = json.loads(response.text)
             
             return resultado if resultado.get("tiene_ubicacion") else None
             
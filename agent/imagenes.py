@@ -0,0 +1,35 @@
+"""
+Preparación de las fotos antes de enviarlas a Gemini.
+
+Las fotos de los celulares llegan a 12+ MP y varios MB. Gemini las reduce
+de todas formas a su resolución de trabajo, así que enviarlas completas solo
+agrega tiempo de subida y tokens. Se corrige la orientación EXIF, se reduce
+el lado mayor a GEMINI_IMAGE_MAX_SIDE y se recodifica en JPEG.
+"""
+
+import io
+from typing import Tuple
+
+MIME_JPEG = "image/jpeg"
+
+
+def preparar_imagen(image_data: bytes, lado_max: int = 1536, calidad: int = 85) -> Tuple[bytes, str]:
+    """
+    Imagen reducida y recodificada (bytes, mime). Si la imagen ya es un JPEG
+    chico se devuelve tal cual.
+    """
+    # PIL solo se carga al analizar imágenes
+    from PIL import Image, ImageOps
+
+    imagen = Image.open(io.BytesIO(image_data))
+    if imagen.format == "JPEG" and max(imagen.size) <= lado_max:
+        return image_data, MIME_JPEG
+
+    imagen = ImageOps.exif_transpose(imagen)
+    if imagen.mode != "RGB":
+        imagen = imagen.convert("RGB")
+    imagen.thumbnail((lado_max, lado_max), Image.LANCZOS)
+
+    salida = io.BytesIO()
+    imagen.save(salida, format="JPEG", quality=calidad, optimize=True)
+    return salida.getvalue(), MIME_JPEG
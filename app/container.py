@@ -0,0 +1,180 @@
+"""
+Contenedor de servicios con construcción perezosa.
+
+Construir GoogleSheetsService (refresh de OAuth, autorización de gspread),
+WhatsAppService (cliente de Twilio) o GeminiAgent hace llamadas de red. Si se
+hiciera al importar app.main, uvicorn no abriría el puerto hasta terminar, y
+en Render cada arranque en frío espera todo eso.
+
+Cada servicio se registra con una fábrica y se construye la primera vez que
+se usa (una sola vez, aunque lo pidan varios threads a la vez). Al arrancar,
+calentar() los construye en paralelo en segundo plano; /health/ready informa
+cuándo terminaron y /health/live solo indica que el proceso responde.
+
+Los módulos usan los servicios a través de proxies (container.proxy(nombre)),
+que se ven como el servicio pero lo resuelven recién en el primer acceso.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class _ServicioPerezoso:
+    """Proxy que construye el servicio en el primer acceso a un atributo."""
+
+    __slots__ = ("_container", "_nombre")
+
+    def __init__(self, container: "Container", nombre: str):
+        object.__setattr__(self, "_container", container)
+        object.__setattr__(self, "_nombre", nombre)
+
+    def __getattr__(self, atributo: str) -> Any:
+        return getattr(self._container.obtener(self._nombre), atributo)
+
+    def __setattr__(self, atributo: str, valor: Any):
+        setattr(self._container.obtener(self._nombre), atributo, valor)
+
+    def __repr__(self) -> str:
+        return f"<servicio perezoso {self._nombre}>"
+
+
+class Container:
+    """Registro de servicios construidos a demanda."""
+
+    def __init__(self):
+        self._fabricas: Dict[str, Callable[[], Any]] = {}
+        self._instancias: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._errores: Dict[str, str] = {}
+        self._fallo_en: Dict[str, float] = {}
+        self._segundos: Dict[str, float] = {}
+        self._al_inicializar: Dict[str, List[Callable[[Any], None]]] = {}
+        # Tras un error de inicialización no se reintenta en cada request
+        self.espera_reintento = float(os.getenv("SERVICE_INIT_RETRY_SECONDS", "30"))
+
+    def registrar(self, nombre: str, fabrica: Callable[[], Any]):
+        self._fabricas[nombre] = fabrica
+        self._locks[nombre] = threading.Lock()
+
+    def al_inicializar(self, nombre: str, funcion: Callable[[Any], None]):
+        """Registra una función que recibe la instancia apenas se construye."""
+        self._al_inicializar.setdefault(nombre, []).append(funcion)
+
+    def proxy(self, nombre: str) -> Any:
+        return _ServicioPerezoso(self, nombre)
+
+    def listo(self, nombre: str) -> bool:
+        return nombre in self._instancias
+
+    def todos_listos(self) -> bool:
+        return len(self._instancias) == len(self._fabricas)
+
+    def obtener(self, nombre: str) -> Any:
+        """Instancia del servicio; la construye si todavía no existe."""
+        instancia = self._instancias.get(nombre)
+        if instancia is not None:
+            return instancia
+
+        with self._locks[nombre]:
+            instancia = self._instancias.get(nombre)
+            if instancia is not None:
+                return instancia
+
+            fallo_en = self._fallo_en.get(nombre)
+            if fallo_en is not None and time.monotonic() - fallo_en < self.espera_reintento:
+                raise RuntimeError(f"{nombre} no disponible: {self._errores.get(nombre)}")
+
+            inicio = time.perf_counter()
+            try:
+                instancia = self._fabricas[nombre]()
+                for funcion in self._al_inicializar.get(nombre, []):
+                    funcion(instancia)
+            except Exception as e:
+                self._errores[nombre] = str(e)[:300]
+                self._fallo_en[nombre] = time.monotonic()
+                print(f"❌ Error al inicializar {nombre}: {e}")
+                raise
+            self._fallo_en.pop(nombre, None)
+            self._segundos[nombre] = time.perf_counter() - inicio
+            self._errores.pop(nombre, None)
+            self._instancias[nombre] = instancia
+            print(f"✅ {nombre} inicializado en {self._segundos[nombre]:.2f}s")
+            return instancia
+
+    def calentar(self, nombres: Optional[List[str]] = None):
+        """Construye en paralelo los servicios pendientes (los errores quedan en estado())."""
+        pendientes = [n for n in (nombres or list(self._fabricas)) if not self.listo(n)]
+
+        def construir(nombre: str):
+            try:
+                self.obtener(nombre)
+            except Exception:
+                pass
+
+        hilos = [threading.Thread(target=construir, args=(n,), name=f"init-{n}", daemon=True) for n in pendientes]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+    async def asegurar(self, nombres: Optional[List[str]] = None):
+        """
+        Versión async de calentar(): espera los servicios en un thread para no
+        bloquear el event loop (y con él /health/live) durante un arranque en frío.
+        """
+        if all(self.listo(n) for n in (nombres or self._fabricas)):
+            return
+        await asyncio.to_thread(self.calentar, nombres)
+
+    def estado(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            nombre: {
+                "listo": self.listo(nombre),
+                "segundos_inicializacion": round(self._segundos[nombre], 2) if nombre in self._segundos else None,
+                "error": self._errores.get(nombre),
+            }
+            for nombre in self._fabricas
+        }
+
+
+def _crear_sheets():
+    from services.google_sheets import GoogleSheetsService
+    return GoogleSheetsService()
+
+
+def _crear_whatsapp():
+    from services.whatsapp import WhatsAppService
+    return WhatsAppService()
+
+
+def _crear_gemini():
+    from agent.gemini_agent import GeminiAgent
+    return GeminiAgent()
+
+
+def _crear_geo():
+    from services.geolocation import GeolocationService
+    return GeolocationService()
+
+
+def _crear_conversaciones():
+    from services.conversation_store import crear_conversation_store
+    return crear_conversation_store()
+
+
+def _crear_database():
+    from app.database import init_db
+    init_db()
+    return True
+
+
+container = Container()
+container.registrar("sheets", _crear_sheets)
+container.registrar("whatsapp", _crear_whatsapp)
+container.registrar("gemini", _crear_gemini)
+container.registrar("geo", _crear_geo)
+container.registrar("conversaciones", _crear_conversaciones)
+container.registrar("database", _crear_database)
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Enum
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Enum, Boolean, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -51,10 +51,60 @@ class MovimientoStock(Base):
     registro_cartel_id = Column(Integer)
     fecha = Column(DateTime, default=datetime.utcnow)
     notas = Column(String)
+    aplicado = Column(Boolean, nullable=False, default=False, index=True)  # ya volcado a la planilla de stock
+    intentos = Column(Integer, nullable=False, default=0)  # flushes en los que la planilla no lo aceptó
+    descartado = Column(Boolean, nullable=False, default=False)  # sin ubicación en la planilla tras varios intentos
+
+
+class VerificacionTrabajo(Base):
+    """Comparación ANTES/DESPUÉS de un trabajo hecha por Gemini en segundo plano."""
+    __tablename__ = "verificaciones_trabajo"
+
+    id = Column(Integer, primary_key=True, index=True)
+    numero_item = Column(String, nullable=False, index=True)
+    whatsapp_number = Column(String)
+    media_antes = Column(String, nullable=False)  # JSON con las URLs de Twilio
+    media_despues = Column(String, nullable=False)
+    estado = Column(String, nullable=False, default="pendiente", index=True)  # pendiente, hecho, error
+    veredicto = Column(String)  # aprobado, revisar, rechazado
+    trabajo_realizado = Column(Boolean)
+    confianza = Column(Float)
+    razon = Column(String)
+    resultado = Column(String)  # JSON completo devuelto por el agente
+    intentos = Column(Integer, nullable=False, default=0)  # análisis iniciados (el barrido reintenta hasta el máximo)
+    fecha_creacion = Column(DateTime, default=datetime.utcnow)
+    fecha_intento = Column(DateTime)  # inicio del último análisis
+    fecha_analisis = Column(DateTime)
+
+
+def _migrar_columnas():
+    """Agrega columnas nuevas a tablas existentes (create_all no altera tablas)."""
+    inspector = inspect(engine)
+    if "movimientos_stock" in inspector.get_table_names():
+        columnas = {c["name"] for c in inspector.get_columns("movimientos_stock")}
+        if "aplicado" not in columnas:
+            with engine.begin() as conn:
+                # Los movimientos previos al libro local ya estaban reflejados en la planilla
+                conn.execute(text("ALTER TABLE movimientos_stock ADD COLUMN aplicado BOOLEAN NOT NULL DEFAULT 1"))
+        if "intentos" not in columnas:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE movimientos_stock ADD COLUMN intentos INTEGER NOT NULL DEFAULT 0"))
+        if "descartado" not in columnas:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE movimientos_stock ADD COLUMN descartado BOOLEAN NOT NULL DEFAULT 0"))
+    if "verificaciones_trabajo" in inspector.get_table_names():
+        columnas = {c["name"] for c in inspector.get_columns("verificaciones_trabajo")}
+        if "intentos" not in columnas:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE verificaciones_trabajo ADD COLUMN intentos INTEGER NOT NULL DEFAULT 0"))
+        if "fecha_intento" not in columnas:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE verificaciones_trabajo ADD COLUMN fecha_intento DATETIME"))
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _migrar_columnas()
 
 
 def get_db():
@@ -1,17 +1,43 @@
-from fastapi import FastAPI, Depends, HTTPException, Form, File, UploadFile, BackgroundTasks
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, Depends, HTTPException, Form, File, UploadFile, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import json
 import time
+import asyncio
+import threading
 
-from app.database import init_db, get_db, RegistroCartel, MovimientoStock
+from app.container import container
+from app.database import get_db, SessionLocal, RegistroCartel, MovimientoStock, VerificacionTrabajo
 from app.models import CartelCreate, CartelResponse, WhatsAppMessage, StockAlert
-from agent.gemini_agent import GeminiAgent
-from services.whatsapp import WhatsAppService
-from services.google_sheets import GoogleSheetsService
-from services.geolocation import GeolocationService
+from app.state_machine import (
+    AFIRMATIVO,
+    ESTADO_CUALQUIERA,
+    ESTADOS_EN_CURSO,
+    LISTO,
+    LISTO_ITEM,
+    NEGATIVO,
+    OBSERVACION,
+    MaquinaEstados,
+    Mensaje,
+    Transicion,
+    crear_mensaje,
+)
+from services import metrics
+from services.conversation_state import (
+    agregar_foto_pendiente,
+    estado_multiple,
+    estado_simple,
+    fotos_pendientes,
+    quitar_fotos_pendientes,
+    resolver_cartel,
+)
+from services.message_queue import MessageQueue
+from services.quota_gateway import CuotaExcedida, Prioridad
+from services.shared_state import cantidad_workers, modo_multiworker
 
 # Configurar ID de planilla OUTPUT
 os.environ["OUTPUT_SHEET_ID"] = "1qKQxWRcN1bjbavw2BgYPjh0rA0VaoaDfTHt_8COAVKw"
@@ -26,18 +52,197 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Inicializar servicios
-gemini_agent = GeminiAgent()
-whatsapp_service = WhatsAppService()
-sheets_service = GoogleSheetsService()
-geo_service = GeolocationService()
+# Servicios: se construyen en el primer uso o en el calentamiento de startup (ver app/container.py)
+gemini_agent = container.proxy("gemini")
+whatsapp_service = container.proxy("whatsapp")
+sheets_service = container.proxy("sheets")
+geo_service = container.proxy("geo")
 
-# Sistema de estados de conversación
+# Alertas de stock bajo al admin (una vez por cruce del umbral)
+container.al_inicializar(
+    "sheets",
+    lambda sheets: setattr(
+        sheets.stock_balance, "on_alerta",
+        lambda alerta: whatsapp_service.enviar_alerta_admin(alerta["mensaje"])
+    )
+)
+
+# Sistema de estados de conversación (persistente, con TTL; ver services/conversation_store.py)
 # Estados: 'esperando_imagenes_antes', 'en_trabajo', 'esperando_imagenes_despues'
-conversation_states = {}
+# Esquema compacto (números de ítem + versión del catálogo): ver services/conversation_state.py
+# Se crea en el primer uso (importar app.main no abre la base SQLite)
+conversation_store = container.proxy("conversaciones")
+
+# Modo multi-worker: los mensajes se encolan por remitente y cada partición la consume un solo worker
+_modo_cola = os.getenv("WEBHOOK_QUEUE", "auto").lower()
+if _modo_cola in ("1", "true") or (_modo_cola == "auto" and modo_multiworker()):
+    message_queue = MessageQueue(
+        particiones=cantidad_workers(),
+        lease_segundos=float(os.getenv("WEBHOOK_QUEUE_LEASE_SECONDS", "60"))
+    )
+else:
+    message_queue = None
+_particiones_propias = []
+
+# Antigüedad máxima de la ubicación compartida para usarla como origen del recorrido
+_UBICACION_OPERARIO_MAX_SEGUNDOS = float(os.getenv("OPERATOR_LOCATION_MAX_MINUTES", "60")) * 60
+
+# Rutas que responden sin esperar a que los servicios terminen de inicializarse
+_RUTAS_SIN_SERVICIOS = {"/", "/health", "/health/live", "/health/ready", "/metrics"}
+_calentamiento: Optional[asyncio.Task] = None
+
+
+@app.middleware("http")
+async def esperar_servicios(request: Request, call_next):
+    """
+    El puerto abre antes de que los servicios estén construidos: las requests
+    que los usan esperan el calentamiento en un thread, sin bloquear el event loop.
+    """
+    if request.url.path not in _RUTAS_SIN_SERVICIOS:
+        await container.asegurar()
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def medir_requests(request: Request, call_next):
+    """Latencia y estado de cada request HTTP (etiquetada por ruta, no por URL)."""
+    inicio = time.perf_counter()
+    estado = 500
+    try:
+        response = await call_next(request)
+        estado = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        ruta = getattr(route, "path", "sin_ruta")
+        metrics.HTTP_LATENCIA.labels(request.method, ruta).observe(time.perf_counter() - inicio)
+        metrics.HTTP_REQUESTS.labels(request.method, ruta, str(estado)).inc()
+
+
+@app.exception_handler(CuotaExcedida)
+async def cuota_excedida(request: Request, error: CuotaExcedida):
+    """Consulta a Google descartada por cuota: 503 con Retry-After en lugar de datos vacíos."""
+    return JSONResponse(status_code=503, content={"detail": str(error)}, headers={"Retry-After": "30"})
+
+
+@app.on_event("shutdown")
+def cerrar_metricas():
+    metrics.marcar_proceso_terminado()
+
+
+def _mantener_particiones(detener: threading.Event):
+    """
+    Renueva los leases de la cola en un thread aparte: el procesamiento de un
+    mensaje puede bloquear el event loop (subidas a Drive) más que el lease.
+    """
+    global _particiones_propias
+    ultima_purga = 0.0
+    while not detener.is_set():
+        try:
+            propias = message_queue.reclamar_particiones()
+            if propias != _particiones_propias:
+                print(f"📬 Worker {message_queue.worker_id} consume particiones {propias}")
+            _particiones_propias = propias
+            metrics.PROFUNDIDAD_COLA.labels("webhook").set(message_queue.pendientes())
+            
+            if time.monotonic() - ultima_purga > 3600:
+                message_queue.purgar()
+                ultima_purga = time.monotonic()
+        except Exception as e:
+            print(f"⚠️ Error renovando particiones de la cola: {e}")
+        detener.wait(message_queue.lease_segundos / 3)
+
+
+async def consumir_cola_mensajes():
+    """Procesa en orden los mensajes de las particiones que posee este worker."""
+    await container.asegurar()
+    while True:
+        try:
+            procesados = 0
+            for particion in list(_particiones_propias):
+                siguiente = message_queue.siguiente(particion)
+                if siguiente is None:
+                    continue
+                mensaje_id, payload = siguiente
+                try:
+                    await procesar_mensaje_whatsapp(**payload)
+                    message_queue.marcar_hecho(mensaje_id)
+                except Exception as e:
+                    print(f"❌ Error procesando mensaje encolado {mensaje_id}: {e}")
+                    message_queue.marcar_error(mensaje_id)
+                procesados += 1
+            
+            if not procesados:
+                await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Error en consumidor de la cola de mensajes: {e}")
+            await asyncio.sleep(1)
 
-# Inicializar BD
-init_db()
+
+_detener_particiones = threading.Event()
+
+
+@app.on_event("startup")
+async def calentar_servicios():
+    """Construye los servicios en segundo plano: el startup no espera a Google ni a Twilio."""
+    _iniciar_calentamiento()
+
+
+def _iniciar_calentamiento():
+    global _calentamiento
+    _calentamiento = asyncio.create_task(container.asegurar())
+
+
+@app.on_event("startup")
+async def iniciar_cola_mensajes():
+    if message_queue is None:
+        return
+    threading.Thread(target=_mantener_particiones, args=(_detener_particiones,), daemon=True).start()
+    asyncio.create_task(consumir_cola_mensajes())
+
+
+@app.on_event("shutdown")
+def detener_cola_mensajes():
+    if message_queue is None:
+        return
+    _detener_particiones.set()
+    message_queue.liberar_particiones()
+
+
+async def refrescar_snapshots():
+    """
+    Refresco programado de los snapshots stale-while-revalidate (catálogo, stock,
+    OUTPUT): relee los vencidos o los que cambiaron en Drive fuera del camino de
+    las requests, con prioridad baja de cuota para no competir con el webhook.
+    """
+    intervalo = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "15"))
+    await container.asegurar(["sheets"])
+    while True:
+        await asyncio.sleep(intervalo)
+        for nombre, cache in sheets_service.snapshots().items():
+            try:
+                with sheets_service.quota.prioridad(Prioridad.BAJA):
+                    await asyncio.to_thread(cache.refrescar_si_corresponde)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Error en refresco programado del snapshot {nombre}: {e}")
+
+
+@app.on_event("startup")
+async def iniciar_refresco_snapshots():
+    asyncio.create_task(refrescar_snapshots())
+
+
+@app.get("/metrics")
+async def exportar_metricas():
+    """
+    Métricas en formato Prometheus (agregadas entre workers con PROMETHEUS_MULTIPROC_DIR).
+    """
+    contenido, content_type = metrics.exportar()
+    return Response(content=contenido, media_type=content_type)
 
 
 @app.get("/")
@@ -68,6 +273,31 @@ async def health_check():
     }
 
 
+@app.get("/health/live")
+async def health_live():
+    """
+    Liveness: el proceso responde. No depende de servicios externos.
+    """
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """
+    Readiness: 200 cuando todos los servicios terminaron de inicializarse, 503 mientras tanto.
+    """
+    listo = container.todos_listos()
+    if not listo and (_calentamiento is None or _calentamiento.done()):
+        # Reintenta en segundo plano los servicios que fallaron al inicializarse
+        _iniciar_calentamiento()
+    contenido = {
+        "status": "ready" if listo else "starting",
+        "servicios": container.estado(),
+        "timestamp": datetime.now().isoformat()
+    }
+    return JSONResponse(content=contenido, status_code=200 if listo else 503)
+
+
 @app.get("/health/whatsapp")
 async def health_whatsapp():
     """
@@ -83,1169 +313,1303 @@ async def health_whatsapp():
     }
 
 
-@app.get("/stats")
-async def estadisticas_sistema():
+@app.get("/stats")
+async def estadisticas_sistema():
+    """
+    Retorna estadísticas generales del sistema.
+    """
+    return {
+        "whatsapp": whatsapp_service.obtener_estadisticas(),
+        "cuota_google": sheets_service.quota.headroom(),
+        "snapshots": {nombre: cache.estado() for nombre, cache in sheets_service.snapshots().items()},
+        "servicios": container.estado(),
+        "timestamp": datetime.now().isoformat(),
+        "environment": os.getenv("ENVIRONMENT", "development")
+    }
+
+
+@app.get("/stats/cuota-google")
+async def cuota_google():
+    """
+    Margen de cuota de Sheets y Drive por clase de operación (último minuto).
+    """
+    return {
+        "cuota": sheets_service.quota.headroom(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+def crear_enlace_google_maps(coordenadas: str) -> str:
+    """
+    Crea un enlace de Google Maps a partir de coordenadas.
+    
+    Args:
+        coordenadas: String con formato "lat, lon", "lat,lon" o "lat lon"
+    
+    Returns:
+        URL de Google Maps o None si las coordenadas son inválidas
+    """
+    if not coordenadas or coordenadas in ['-', 'N/A', 'No disponibles', '']:
+        return None
+    
+    try:
+        # Limpiar coordenadas
+        coords_limpio = coordenadas.strip()
+        
+        # Intentar separar por coma primero
+        if ',' in coords_limpio:
+            partes = coords_limpio.split(',')
+        else:
+            # Si no hay coma, separar por espacios
+            partes = coords_limpio.split()
+        
+        if len(partes) >= 2:
+            lat = partes[0].strip()
+            lon = partes[1].strip()
+            # Crear enlace de Google Maps
+            return f"https://maps.google.com/?q={lat},{lon}"
+        return None
+    except:
+        return None
+
+
+async def cartel_de(estado: dict, numero_item) -> dict:
+    """
+    Información completa de un ítem de la sesión (el estado guarda solo el número).
+    Se resuelve en un thread: con el catálogo frío o vencido, leerlo relee la planilla.
+    """
+    return await asyncio.to_thread(resolver_cartel, sheets_service.catalogo, estado, numero_item)
+
+
+def _buscar_items(numeros: list) -> tuple:
+    """Versión del catálogo y cartel (o None) de cada número. Bloquea: llamar con asyncio.to_thread."""
+    catalogo_version = sheets_service.catalogo.version
+    return catalogo_version, [sheets_service.buscar_cartel_por_item(num) for num in numeros]
+
+
+async def descargar_media(media_urls: List[str]) -> List[Optional[bytes]]:
+    """Descarga en paralelo imágenes de Twilio (None en las que fallan)."""
+    auth = (os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+    return await asyncio.gather(*(whatsapp_service.descargar_imagen(url, auth) for url in media_urls))
+
+
+async def descargar_fotos_pendientes(whatsapp_number: str, media_urls: List[str]) -> Optional[List[bytes]]:
+    """
+    Descarga de Twilio las fotos pendientes (el estado guarda solo sus URLs).
+    Si alguna falla, la quita del estado, pide reenviarla y devuelve None.
+    """
+    imagenes = await descargar_media(media_urls)
+    
+    fallidas = [url for url, imagen in zip(media_urls, imagenes) if not imagen]
+    if fallidas:
+        conversation_store.actualizar(whatsapp_number, quitar_fotos_pendientes(fallidas))
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"❌ Error al descargar {len(fallidas)} imagen(es). Envíala(s) nuevamente."
+        )
+        return None
+    return list(imagenes)
+
+
+@app.post("/webhook/whatsapp", response_class=PlainTextResponse)
+async def webhook_whatsapp(
+    background_tasks: BackgroundTasks,
+    From: str = Form(...),
+    Body: str = Form(""),
+    MediaUrl0: Optional[str] = Form(None),
+    Latitude: Optional[str] = Form(None),
+    Longitude: Optional[str] = Form(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Webhook para recibir mensajes de WhatsApp desde Twilio.
+    FLUJO PRINCIPAL: Usuario envía número de item para trabajar en ese cartel.
+    
+    En modo multi-worker el mensaje se encola y lo procesa el worker dueño de
+    la partición del remitente, en orden de llegada.
+    """
+    if message_queue is not None:
+        message_queue.encolar(From, {
+            'From': From,
+            'Body': Body,
+            'MediaUrl0': MediaUrl0,
+            'Latitude': Latitude,
+            'Longitude': Longitude
+        })
+        return "OK"
+    
+    return await procesar_mensaje_whatsapp(From, Body, MediaUrl0, Latitude, Longitude)
+
+
+async def procesar_mensaje_whatsapp(
+    From: str,
+    Body: str = "",
+    MediaUrl0: Optional[str] = None,
+    Latitude: Optional[str] = None,
+    Longitude: Optional[str] = None
+) -> str:
+    """
+    Procesa un mensaje de WhatsApp según el estado de conversación del operario
+    (transiciones declaradas abajo con @maquina.transicion, ver app/state_machine.py).
+    """
+    Body = Body or ""
+    try:
+        whatsapp_number = From
+        
+        if MediaUrl0:
+            metrics.WEBHOOK_MENSAJES.labels("imagen").inc()
+        elif Latitude and Longitude:
+            metrics.WEBHOOK_MENSAJES.labels("ubicacion").inc()
+        else:
+            metrics.WEBHOOK_MENSAJES.labels("texto").inc()
+        metrics.CONVERSACIONES_ACTIVAS.set(conversation_store.cantidad())
+        
+        estado_actual = conversation_store.obtener(whatsapp_number)
+        
+        # 📋 LOG: Registrar mensaje recibido
+        await asyncio.to_thread(
+            sheets_service.registrar_log_whatsapp,
+            numero_telefono=whatsapp_number,
+            tipo_mensaje="recibido",
+            contenido=Body if Body else "[Sin texto]",
+            tiene_media=bool(MediaUrl0),
+            media_url=MediaUrl0 if MediaUrl0 else "",
+            item_relacionado="",
+            estado_flujo=estado_actual.get('estado', 'inicial'),
+            respuesta_bot=""
+        )
+        
+        ubicacion = None
+        if Latitude and Longitude:
+            from services.indice_espacial import coordenadas_validas
+            ubicacion = coordenadas_validas(Latitude, Longitude)
+        
+        await maquina.despachar(crear_mensaje(whatsapp_number, Body, MediaUrl0, estado_actual, ubicacion))
+        return "OK"
+        
+    except CuotaExcedida as e:
+        # Google descartó la consulta por cuota: no es un error del operario, puede reenviar el mensaje
+        print(f"⏳ Mensaje de {From} sin procesar por cuota de Google: {e}")
+        whatsapp_service.enviar_mensaje(
+            From,
+            "⏳ El sistema está saturado en este momento. Reenvía tu último mensaje en un minuto."
+        )
+        return "OK"
+    except Exception as e:
+        print(f"Error en webhook: {e}")
+        return "OK"
+
+
+# ===== MENSAJES COMUNES =====
+
+def mensaje_info_cartel(numero_item, cartel: dict) -> str:
+    """Ficha del cartel que se envía al confirmar la llegada al lugar."""
+    tipo_info = cartel.get('tipo_completo', cartel.get('tipo_raw', 'No especificado'))
+    
+    respuesta = f"""
+📋 *INFORMACIÓN DEL CARTEL #{numero_item}*
+
+🛣️ Gasoducto/Ramal: {cartel.get('gasoducto_ramal', 'No especificado')}
+📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}
+📌 Coordenadas: {cartel.get('coordenadas', 'No disponibles')}
+
+⚠️ *━━━━━━━━━━━━━━━━━━━*
+🔴 *TIPO DE CARTEL:*
+*{tipo_info}*
+⚠️ *━━━━━━━━━━━━━━━━━━━*
+
+📏 Tamaño: {cartel.get('tamanio', 'No especificado')}
+"""
+    
+    if cartel.get('tapada_caneria') and cartel.get('tapada_caneria') not in ['-', '']:
+        respuesta += f"🔧 Tapada cañería: {cartel.get('tapada_caneria')}\n"
+    
+    respuesta += f"""📝 Observaciones: {cartel.get('observaciones', 'Sin observaciones')}
+📅 Estado: {cartel.get('estado', 'No especificado')}
+"""
+    
+    if cartel.get('tipo_trabajo'):
+        respuesta += f"\n🔨 *Tipo de trabajo:*\n{cartel.get('tipo_trabajo')}\n"
+        if cartel.get('detalles_instalacion'):
+            respuesta += "\n📦 *Detalles de instalación:*\n"
+            for detalle in cartel.get('detalles_instalacion', []):
+                respuesta += f"  • {detalle}\n"
+    
+    respuesta += f"\n🌍 Zona: {cartel.get('zona', 'No especificada')}"
+    return respuesta.strip()
+
+
+def mensaje_ubicacion(cartel: dict, titulo_mapa: str, titulo_sin_mapa: str) -> str:
+    """Coordenadas (con enlace a Google Maps si se pueden interpretar) y pregunta de llegada."""
+    coordenadas = cartel.get('coordenadas', '')
+    enlace_maps = crear_enlace_google_maps(coordenadas)
+    
+    if enlace_maps:
+        mensaje = f"📍 *{titulo_mapa}*\n\n"
+        mensaje += f"📌 Coordenadas: {coordenadas}\n"
+        mensaje += f"🗺️ Ver en Google Maps:\n{enlace_maps}\n\n"
+    else:
+        mensaje = f"📍 *{titulo_sin_mapa}*\n\n"
+        mensaje += f"📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}\n"
+        mensaje += f"📌 Coordenadas: {coordenadas if coordenadas else 'No disponibles'}\n\n"
+    mensaje += f"❓ *¿Has llegado al lugar?*\n\n"
+    mensaje += f"Responde *'sí'* cuando estés en el lugar."
+    return mensaje
+
+
+def mensaje_pedir_observacion(numero_item) -> str:
+    return (
+        f"📝 *REGISTRAR OBSERVACIÓN - ITEM #{numero_item}*\n\n"
+        f"El trabajo no se completó.\n\n"
+        f"Escribe el motivo o situación:\n"
+        f"Ejemplo: 'Tormenta, sin acceso al predio'\n"
+        f"Ejemplo: 'Falta material, retomar próxima semana'"
+    )
+
+
+def subir_fotos(imagenes: List[bytes], numero_item, tipo: str) -> List[str]:
+    """Sube las fotos a Drive como XXX-001..003 (antes) o XXX-004..006 (después)."""
+    urls_guardadas = []
+    item_formateado = str(numero_item).zfill(3)
+    desplazamiento = 0 if tipo == 'antes' else 3
+    for idx, img_data in enumerate(imagenes, 1):
+        filename = f"{item_formateado}-{str(idx + desplazamiento).zfill(3)}.jpg"
+        url = sheets_service.subir_imagen_antes_despues(img_data, filename, numero_item, tipo)
+        if url:
+            urls_guardadas.append(url)
+    return urls_guardadas
+
+
+async def recibir_foto(mensaje: Mensaje, numero_item) -> Optional[List[bytes]]:
+    """
+    Agrega la foto a las pendientes. Devuelve las 3 imágenes descargadas al
+    completarse la tanda, o None mientras falten (o si falló la descarga).
+    """
+    whatsapp_number = mensaje.numero
+    # Las fotos llegan en webhooks concurrentes: agregar con compare-and-set.
+    # Se guarda solo la URL de Twilio; la imagen se descarga al subirla a Drive.
+    estado_actual = conversation_store.actualizar(whatsapp_number, agregar_foto_pendiente(mensaje.media_url))
+    num_recibidas = len(fotos_pendientes(estado_actual))
+    
+    if num_recibidas < 3:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"✅ Imagen {num_recibidas}/3 recibida para item #{numero_item}.\n\n📸 Envía la imagen {num_recibidas + 1} de 3."
+        )
+        return None
+    
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        f"✅ 3 imágenes recibidas.\n\n⏳ Guardando en Drive..."
+    )
+    return await descargar_fotos_pendientes(whatsapp_number, fotos_pendientes(estado_actual))
+
+
+def ordenar_recorrido(items: List[dict], estado: dict):
+    """
+    Items [{'numero', 'info'}] en el orden de recorrido más corto, partiendo de
+    la última ubicación compartida por el operario si no es muy vieja.
+    """
+    from services.planificador_rutas import ordenar_items
+    
+    origen = None
+    ubicacion = estado.get('ubicacion_operario')
+    if ubicacion and time.time() - ubicacion[2] <= _UBICACION_OPERARIO_MAX_SEGUNDOS:
+        origen = (ubicacion[0], ubicacion[1])
+    
+    inicio = time.perf_counter()
+    ordenados, plan = ordenar_items(items, origen)
+    if plan.km_ahorrados > 0:
+        metrics.RUTA_KM_AHORRADOS.inc(plan.km_ahorrados)
+    print(
+        f"🧭 Recorrido de {len(items)} items en {(time.perf_counter() - inicio) * 1000:.0f} ms"
+        f"{' desde la ubicación del operario' if origen else ''}: "
+        f"{plan.km_original:.1f} km -> {plan.km_optimizado:.1f} km"
+    )
+    return ordenados, plan
+
+
+# ===== TRANSICIONES: INICIO DE SESIÓN (MODO SIMPLE) =====
+
+maquina = MaquinaEstados()
+
+
+def _inicia_sesion(mensaje: Mensaje) -> bool:
+    # No interrumpir flujos activos con la detección de un número nuevo
+    return mensaje.tiene_numero and mensaje.estado.get('estado') not in ESTADOS_EN_CURSO
+
+
+@maquina.transicion(
+    "simple", "observado", "texto",
+    condicion=lambda m: (
+        len(m.numeros) == 1
+        and str(m.estado.get('numero_item')) == m.numeros[0]
+        and 'observacion_registrada' in m.estado
+    )
+)
+async def _retomar_observado(mensaje: Mensaje):
+    """El operario completa un trabajo que antes registró como observación."""
+    whatsapp_number = mensaje.numero
+    estado_previo = mensaje.estado
+    item_number = mensaje.numeros[0]
+    print(f"✅ Detectado completar trabajo con observación previa - Item {item_number}")
+    
+    if estado_previo.get('fotos_antes'):
+        # Ya tiene fotos ANTES, ir directo a DESPUÉS
+        estado_previo['estado'] = 'esperando_imagenes_despues'
+        conversation_store.guardar(whatsapp_number, estado_previo)
+        
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"✅ *COMPLETAR TRABAJO - ITEM #{item_number}*\n\n"
+            f"📸 *FOTOS DESPUÉS DEL TRABAJO*\n\n"
+            f"Envía 3 fotos del estado DESPUÉS de finalizar el cartel #{item_number}.\n\n"
+            f"📷📷📷 Envía las 3 imágenes ahora."
+        )
+    else:
+        # No tiene fotos ANTES, solicitarlas primero
+        estado_previo['estado'] = 'esperando_imagenes_antes'
+        estado_previo['fotos_pendientes'] = []
+        conversation_store.guardar(whatsapp_number, estado_previo)
+        
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"✅ *COMPLETAR TRABAJO - ITEM #{item_number}*\n\n"
+            f"📸 *ANTES DE FINALIZAR EL TRABAJO*\n\n"
+            f"Envía 3 fotos del estado ANTES del cartel #{item_number}.\n\n"
+            f"📷📷📷 Envía las 3 imágenes ahora."
+        )
+
+
+@maquina.transicion("simple", ESTADO_CUALQUIERA, "texto", condicion=lambda m: _inicia_sesion(m) and len(m.numeros) > 1)
+async def _iniciar_multiple(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    numeros = mensaje.numeros
+    print(f"🔢 MODO MÚLTIPLE: {len(numeros)} items detectados: {numeros}")
+    
+    items_validos = []
+    items_invalidos = []
+    
+    catalogo_version, carteles = await asyncio.to_thread(_buscar_items, numeros)
+    for num, cartel in zip(numeros, carteles):
+        if cartel:
+            items_validos.append({
+                'numero': cartel.get('numero', num),
+                'info': cartel
+            })
+        else:
+            items_invalidos.append(num)
+    
+    if not items_validos:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"❌ No se encontró ningún ítem válido en la planilla."
+        )
+        return
+    
+    # Avisar sobre items inválidos si los hay
+    if items_invalidos:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"⚠️ Items no encontrados: {', '.join(items_invalidos)}"
+        )
+    
+    # Ordenar el recorrido (desde la ubicación compartida si es reciente)
+    items_validos, plan = ordenar_recorrido(items_validos, mensaje.estado)
+    
+    # Enviar resumen de items a trabajar
+    resumen = f"✅ *{len(items_validos)} ITEMS PARA TRABAJAR*\n\n"
+    for item in items_validos:
+        info = item['info']
+        tipo_info = info.get('tipo_completo', info.get('tipo_raw', '?'))
+        resumen += f"📋 #{item['numero']} - {info.get('ubicacion', 'Sin ubicación')}\n"
+        resumen += f"   🔴 Tipo: {tipo_info}\n\n"
+    
+    if plan.km_ahorrados >= 0.1:
+        resumen += f"🧭 Orden optimizado del recorrido: ~{plan.km_optimizado:.1f} km (ahorro estimado {plan.km_ahorrados:.1f} km)\n\n"
+    
+    resumen += f"� Te enviaré la ubicación de cada uno.\n"
+    resumen += f"📸 Confirma tu llegada a cada lugar antes de recibir la info e imágenes.\n\n"
+    resumen += f"💡 Al terminar cada trabajo, envía *'listo [numero]'*"
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, resumen)
+    
+    # Inicializar estado múltiple (solo números de ítem; la info se resuelve del catálogo)
+    primer_item = str(items_validos[0]['numero'])
+    conversation_store.guardar(
+        whatsapp_number,
+        estado_multiple([str(item['numero']) for item in items_validos], catalogo_version)
+    )
+    
+    # Enviar coordenadas del primer item y pedir confirmación
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        mensaje_ubicacion(items_validos[0]['info'], f"ITEM #{primer_item} - UBICACIÓN", f"ITEM #{primer_item}")
+    )
+
+
+@maquina.transicion("simple", ESTADO_CUALQUIERA, "texto", condicion=lambda m: _inicia_sesion(m) and len(m.numeros) == 1)
+async def _iniciar_simple(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    item_number = mensaje.numeros[0]
+    print(f"📊 Buscando ítem: {item_number}")
+    
+    catalogo_version, (cartel,) = await asyncio.to_thread(_buscar_items, [item_number])
+    if not cartel:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"❌ No se encontró el ítem {item_number} en la planilla."
+        )
+        return
+    
+    # Enviar coordenadas y preguntar si llegó al lugar
+    numero = cartel.get('numero', item_number)
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        mensaje_ubicacion(cartel, f"UBICACIÓN DEL CARTEL #{numero}", f"CARTEL #{numero}")
+    )
+    
+    conversation_store.guardar(
+        whatsapp_number,
+        estado_simple('esperando_confirmacion_llegada', numero, catalogo_version)
+    )
+    
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"Item {numero} solicitado - Esperando confirmación de llegada",
+        tiene_media=False,
+        media_url="",
+        item_relacionado=str(numero),
+        estado_flujo="esperando_confirmacion_llegada",
+        respuesta_bot="Coordenadas enviadas - Esperando confirmación"
+    )
+
+
+@maquina.transicion("simple", ESTADO_CUALQUIERA, "texto", condicion=lambda m: not m.tiene_numero)
+async def _ayuda(mensaje: Mensaje):
+    whatsapp_service.enviar_mensaje(
+        mensaje.numero,
+        "👋 ¡Hola! Para trabajar en carteles:\n\n"
+        "📝 *UN CARTEL:* Envía el número\n"
+        "   Ejemplo: '190' o 'item 190'\n\n"
+        "📝 *MÚLTIPLES CARTELES:* Envía varios números\n"
+        "   Ejemplo: '277, 278, 279, 290'\n\n"
+        "💡 Cuando tengas las fotos ANTES:\n\n"
+        "✅ Si completaste el trabajo:\n"
+        "   Envía *'listo [numero]'* o *'finalizado [numero]'*\n\n"
+        "📝 Si NO pudiste completarlo:\n"
+        "   Envía *'observacion [numero]'* o *'obs [numero]'*\n"
+        "   Te pediré el motivo (ej: tormenta, sin acceso)"
+    )
+
+
+@maquina.transicion("simple", ESTADO_CUALQUIERA, "ubicacion")
+async def _guardar_ubicacion(mensaje: Mensaje):
+    """Ubicación compartida: origen para ordenar los ítems de la próxima sesión múltiple."""
+    latitud, longitud = mensaje.ubicacion
+    estado_actual = mensaje.estado
+    estado_actual['ubicacion_operario'] = [latitud, longitud, time.time()]
+    conversation_store.guardar(mensaje.numero, estado_actual)
+    
+    if estado_actual.get('estado') in ESTADOS_EN_CURSO:
+        return
+    
+    # Referencia con los carteles cercanos del catálogo (sin consultar Nominatim)
+    catalogo = await asyncio.to_thread(sheets_service.catalogo.snapshot)
+    referencia = geo_service.referencia_en_catalogo(latitud, longitud, catalogo.carteles, catalogo.version)
+    respuesta = "📍 Ubicación recibida."
+    if referencia is not None:
+        respuesta += f"\n\n🗺️ {referencia.descripcion()}"
+    respuesta += (
+        "\n\nEnvía los números de los ítems (ej: '277, 278, 279') y te los ordenaré "
+        "para recorrerlos desde donde estás."
+    )
+    whatsapp_service.enviar_mensaje(mensaje.numero, respuesta)
+
+
+# ===== TRANSICIONES: MODO SIMPLE =====
+
+async def _recordar_confirmacion(mensaje: Mensaje):
+    whatsapp_service.enviar_mensaje(
+        mensaje.numero,
+        "👍 Entendido. Cuando llegues al lugar, envía *'sí'* o *'llegué'* para continuar."
+    )
+
+
+@maquina.transicion("simple", "esperando_confirmacion_llegada", "texto", intencion=AFIRMATIVO)
+async def _confirmar_llegada(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    estado_actual = mensaje.estado
+    numero_item = estado_actual['numero_item']
+    cartel = await cartel_de(estado_actual, numero_item)
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_info_cartel(numero_item, cartel))
+    
+    # Enviar imágenes de referencia desde el Drive (carpeta INPUT)
+    imagenes = await asyncio.to_thread(sheets_service.obtener_imagenes_cartel, numero_item)
+    if imagenes:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"📸 Enviando {len(imagenes)} imagen(es) de referencia del INPUT..."
+        )
+        
+        for idx, imagen in enumerate(imagenes, 1):
+            caption = f"🖼️ Imagen {idx}/{len(imagenes)}: {imagen['name']}"
+            success = whatsapp_service.enviar_imagen(
+                whatsapp_number,
+                imagen['url'],
+                caption
+            )
+            if not success:
+                whatsapp_service.enviar_mensaje(
+                    whatsapp_number,
+                    f"{caption}\n{imagen['web_view']}"
+                )
+            await asyncio.sleep(1)
+        await asyncio.sleep(2)
+    else:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            "ℹ️ No se encontraron imágenes de referencia para este cartel en Drive."
+        )
+    
+    # Ahora pedir fotos ANTES
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        f"\n📸 *ANTES DE COMENZAR EL TRABAJO*\n\n"
+        f"Por favor, envía 3 fotos del estado actual del cartel #{numero_item} ANTES de realizar cualquier trabajo.\n\n"
+        f"Envía las 3 imágenes ahora. 📷📷📷"
+    )
+    
+    estado_actual['estado'] = 'esperando_imagenes_antes'
+    estado_actual['fotos_pendientes'] = []
+    conversation_store.guardar(whatsapp_number, estado_actual)
+    
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"Confirmación de llegada - Item {numero_item} - Enviando info e imágenes",
+        tiene_media=bool(imagenes),
+        media_url="",
+        item_relacionado=str(numero_item),
+        estado_flujo="esperando_imagenes_antes",
+        respuesta_bot="Solicitando 3 fotos ANTES del trabajo"
+    )
+
+
+maquina.agregar(Transicion(
+    "recordar_confirmacion", "simple", "esperando_confirmacion_llegada", "texto",
+    _recordar_confirmacion, intencion=NEGATIVO
+))
+
+
+@maquina.transicion("simple", "esperando_imagenes_antes", "imagen")
+async def _foto_antes(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    numero_item = mensaje.estado['numero_item']
+    print(f"📸 Recibiendo imagen ANTES del trabajo de {whatsapp_number}")
+    
+    imagenes = await recibir_foto(mensaje, numero_item)
+    if imagenes is None:
+        return
+    
+    urls_guardadas = await asyncio.to_thread(subir_fotos, imagenes, numero_item, 'antes')
+    
+    estado_actual = conversation_store.obtener(whatsapp_number)
+    estado_actual['estado'] = 'en_trabajo'
+    estado_actual['fotos_antes'] = len(urls_guardadas)
+    estado_actual['media_antes'] = fotos_pendientes(estado_actual)
+    estado_actual['fotos_pendientes'] = []
+    conversation_store.guardar(whatsapp_number, estado_actual)
+    
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        f"✅ *IMÁGENES GUARDADAS*\n\n"
+        f"Las 3 imágenes del estado ANTES se han guardado correctamente en Drive.\n\n"
+        f"🔧 Ahora puedes proceder con el trabajo en el cartel #{numero_item}.\n\n"
+        f"💡 Cuando termines:\n\n"
+        f"✅ Si completaste el trabajo:\n"
+        f"   Envía *'listo'* o *'finalizado'*\n\n"
+        f"📝 Si NO pudiste completarlo:\n"
+        f"   Envía *'observacion'* o *'obs'*"
+    )
+    
+    # 📋 LOG: Registrar imágenes ANTES guardadas
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"3 imágenes ANTES guardadas para item #{numero_item}",
+        tiene_media=True,
+        media_url=f"{len(urls_guardadas)} imágenes en Drive",
+        item_relacionado=str(numero_item),
+        estado_flujo="en_trabajo",
+        respuesta_bot="Esperando finalización del trabajo"
+    )
+
+
+@maquina.transicion("simple", "esperando_imagenes_despues", "imagen")
+async def _foto_despues(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    numero_item = mensaje.estado['numero_item']
+    print(f"📸 Recibiendo imagen DESPUÉS del trabajo de {whatsapp_number}")
+    
+    imagenes = await recibir_foto(mensaje, numero_item)
+    if imagenes is None:
+        return
+    
+    urls_guardadas = await asyncio.to_thread(subir_fotos, imagenes, numero_item, 'despues')
+    
+    # Registrar trabajo completado en planilla OUTPUT
+    estado_actual = conversation_store.obtener(whatsapp_number)
+    cartel_info = await cartel_de(estado_actual, numero_item)
+    registro_exitoso = await asyncio.to_thread(sheets_service.registrar_trabajo_ecogas, {
+        'numero_item': numero_item,
+        'cartel_info': cartel_info
+    })
+    encolar_verificacion(
+        numero_item, whatsapp_number, cartel_info,
+        estado_actual.get('media_antes'), fotos_pendientes(estado_actual), imagenes
+    )
+    
+    mensaje_final = (
+        f"✅ *TRABAJO COMPLETADO*\n\n"
+        f"Las 3 imágenes del estado DESPUÉS se han guardado correctamente en Drive.\n\n"
+    )
+    
+    if registro_exitoso:
+        mensaje_final += f"📊 *Instalación EJECUTADA* registrada en planilla OUTPUT\n\n"
+    else:
+        mensaje_final += f"⚠️ Advertencia: Error al registrar en planilla OUTPUT\n\n"
+    
+    mensaje_final += (
+        f"📋 Cartel #{numero_item} - Trabajo finalizado\n"
+        f"📸 Imágenes antes: {estado_actual.get('fotos_antes', 0)}\n"
+        f"📸 Imágenes después: {len(urls_guardadas)}\n"
+        f"\n¡Excelente trabajo! 🎉"
+    )
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
+    
+    # 📋 LOG: Registrar trabajo completado
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"✅ Trabajo completado - Item #{numero_item}",
+        tiene_media=True,
+        media_url=f"Total: {len(urls_guardadas)} imágenes DESPUÉS guardadas",
+        item_relacionado=str(numero_item),
+        estado_flujo="completado",
+        respuesta_bot=f"Registrado en OUTPUT: {'SÍ' if registro_exitoso else 'NO'}"
+    )
+    
+    conversation_store.eliminar(whatsapp_number)
+
+
+@maquina.transicion("simple", "en_trabajo", "texto", intencion=OBSERVACION)
+async def _pedir_observacion(mensaje: Mensaje):
+    estado_actual = mensaje.estado
+    estado_actual['estado'] = 'esperando_observacion'
+    conversation_store.guardar(mensaje.numero, estado_actual)
+    
+    whatsapp_service.enviar_mensaje(mensaje.numero, mensaje_pedir_observacion(estado_actual['numero_item']))
+
+
+@maquina.transicion("simple", "en_trabajo", "texto", intencion=LISTO)
+async def _pedir_fotos_despues(mensaje: Mensaje):
+    estado_actual = mensaje.estado
+    numero_item = estado_actual['numero_item']
+    estado_actual['estado'] = 'esperando_imagenes_despues'
+    conversation_store.guardar(mensaje.numero, estado_actual)
+    
+    whatsapp_service.enviar_mensaje(
+        mensaje.numero,
+        f"📸 *DESPUÉS DE FINALIZAR EL TRABAJO*\n\n"
+        f"Por favor, envía 3 fotos del estado del cartel #{numero_item} DESPUÉS de realizar el trabajo.\n\n"
+        f"Envía las 3 imágenes ahora. 📷📷📷"
+    )
+
+
+@maquina.transicion("simple", "esperando_observacion", "texto")
+async def _registrar_observacion(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    estado_actual = mensaje.estado
+    observacion_texto = mensaje.texto.strip()
+    numero_item = estado_actual['numero_item']
+    cartel_info = await cartel_de(estado_actual, numero_item)
+    
+    registro_exitoso = await asyncio.to_thread(sheets_service.registrar_trabajo_ecogas, {
+        'numero_item': numero_item,
+        'cartel_info': cartel_info,
+        'observacion': observacion_texto
+    })
+    
+    mensaje_final = (
+        f"📝 *OBSERVACIÓN REGISTRADA*\n\n"
+        f"📋 Item #{numero_item}\n"
+        f"📝 Observación: {observacion_texto}\n\n"
+    )
+    
+    if registro_exitoso:
+        mensaje_final += f"📊 Registrado en planilla OUTPUT\n"
+    else:
+        mensaje_final += f"⚠️ Error al registrar en OUTPUT\n"
+    
+    mensaje_final += f"\nPuedes continuar con otro cartel enviando el número."
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
+    
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"📝 Observación registrada - Item #{numero_item}",
+        tiene_media=False,
+        media_url="",
+        item_relacionado=str(numero_item),
+        estado_flujo="observado",
+        respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'} | Obs: {observacion_texto[:50]}"
+    )
+    
+    # Mantener estado para permitir completar el trabajo después
+    estado_actual['estado'] = 'observado'
+    estado_actual['observacion_registrada'] = observacion_texto
+    conversation_store.guardar(whatsapp_number, estado_actual)
+
+
+# ===== TRANSICIONES: MODO MÚLTIPLE =====
+
+@maquina.transicion("multiple", "esperando_confirmacion", "texto", intencion=AFIRMATIVO)
+async def _confirmar_llegada_item(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    estado_actual = mensaje.estado
+    item_actual = estado_actual['item_confirmacion_pendiente']
+    cartel = await cartel_de(estado_actual, item_actual)
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_info_cartel(item_actual, cartel))
+    
+    # Enviar imágenes de referencia desde el Drive
+    imagenes = await asyncio.to_thread(sheets_service.obtener_imagenes_cartel, item_actual)
+    if imagenes:
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"📸 Enviando {len(imagenes)} imagen(es) de referencia del INPUT..."
+        )
+        
+        for idx, imagen in enumerate(imagenes, 1):
+            caption = f"🖼️ Item #{item_actual} - Imagen {idx}/{len(imagenes)}"
+            success = whatsapp_service.enviar_imagen(
+                whatsapp_number,
+                imagen['url'],
+                caption
+            )
+            if not success:
+                whatsapp_service.enviar_mensaje(
+                    whatsapp_number,
+                    f"{caption}\n{imagen['web_view']}"
+                )
+            await asyncio.sleep(1)
+        await asyncio.sleep(1)
+    
+    # Pedir fotos ANTES
+    whatsapp_service.enviar_mensaje(
+        whatsapp_number,
+        f"\n📸 *FOTOS ANTES - ITEM #{item_actual}*\n\n"
+        f"Envía 3 fotos del estado ANTES del cartel #{item_actual}.\n\n"
+        f"📷📷📷 Envía las 3 imágenes ahora."
+    )
+    
+    estado_actual['estado_confirmacion'] = None
+    estado_actual['item_confirmacion_pendiente'] = None
+    estado_actual['items_activos'][str(item_actual)]['estado'] = 'recibiendo_antes'
+    conversation_store.guardar(whatsapp_number, estado_actual)
+
+
+maquina.agregar(Transicion(
+    "recordar_confirmacion_item", "multiple", "esperando_confirmacion", "texto",
+    _recordar_confirmacion, intencion=NEGATIVO
+))
+
+
+@maquina.transicion("multiple", "recibiendo_antes", "imagen")
+async def _foto_antes_item(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    item_actual_antes = mensaje.estado['item_actual_antes']
+    
+    imagenes = await recibir_foto(mensaje, item_actual_antes)
+    if imagenes is None:
+        return
+    
+    urls_guardadas = await asyncio.to_thread(subir_fotos, imagenes, item_actual_antes, 'antes')
+    
+    estado_actual = conversation_store.obtener(whatsapp_number)
+    items_activos = estado_actual.get('items_activos', {})
+    items_activos[str(item_actual_antes)]['estado'] = 'en_espera'
+    items_activos[str(item_actual_antes)]['fotos_antes'] = len(urls_guardadas)
+    items_activos[str(item_actual_antes)]['media_antes'] = fotos_pendientes(estado_actual)
+    estado_actual['fotos_pendientes'] = []
+    
+    # Buscar siguiente item pendiente de confirmación
+    siguiente_item = next(
+        (num_item for num_item, info in items_activos.items() if info['estado'] == 'pendiente_confirmacion'),
+        None
+    )
+    
+    if siguiente_item:
+        # Hay más items para procesar - Pedir confirmación de llegada
+        estado_actual['item_actual_antes'] = siguiente_item
+        estado_actual['estado_confirmacion'] = 'esperando'
+        estado_actual['item_confirmacion_pendiente'] = siguiente_item
+        
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"✅ *IMÁGENES GUARDADAS - Item #{item_actual_antes}*\n\n"
+        )
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            mensaje_ubicacion(
+                await cartel_de(estado_actual, siguiente_item),
+                f"ITEM #{siguiente_item} - UBICACIÓN",
+                f"ITEM #{siguiente_item}"
+            )
+        )
+    else:
+        # Todos los ANTES completados
+        estado_actual['item_actual_antes'] = None
+        
+        items_en_espera = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
+        
+        whatsapp_service.enviar_mensaje(
+            whatsapp_number,
+            f"✅ *TODOS LOS ANTES COMPLETADOS*\n\n"
+            f"📋 Items listos para trabajar: {', '.join(items_en_espera)}\n\n"
+            f"🔧 Procede con los trabajos.\n\n"
+            f"💡 Al terminar cada trabajo:\n\n"
+            f"✅ Si completaste el trabajo:\n"
+            f"   *'listo [numero]'* o *'finalizado [numero]'*\n"
+            f"   Ejemplo: 'listo {items_en_espera[0]}'\n\n"
+            f"📝 Si NO pudiste completarlo:\n"
+            f"   *'observacion [numero]'* o *'obs [numero]'*\n"
+            f"   Ejemplo: 'observacion {items_en_espera[0]}'"
+        )
+    
+    conversation_store.guardar(whatsapp_number, estado_actual)
+
+
+@maquina.transicion("multiple", "recibiendo_despues", "imagen")
+async def _foto_despues_item(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    item_actual_despues = mensaje.estado['item_actual_despues']
+    
+    imagenes = await recibir_foto(mensaje, item_actual_despues)
+    if imagenes is None:
+        return
+    
+    urls_guardadas = await asyncio.to_thread(subir_fotos, imagenes, item_actual_despues, 'despues')
+    
+    # Registrar en OUTPUT
+    estado_actual = conversation_store.obtener(whatsapp_number)
+    cartel_info = await cartel_de(estado_actual, item_actual_despues)
+    registro_exitoso = await asyncio.to_thread(sheets_service.registrar_trabajo_ecogas, {
+        'numero_item': item_actual_despues,
+        'cartel_info': cartel_info
+    })
+    
+    items_activos = estado_actual.get('items_activos', {})
+    encolar_verificacion(
+        item_actual_despues, whatsapp_number, cartel_info,
+        items_activos[str(item_actual_despues)].get('media_antes'), fotos_pendientes(estado_actual), imagenes
+    )
+    items_activos[str(item_actual_despues)]['estado'] = 'completado'
+    items_activos[str(item_actual_despues)]['fotos_despues'] = len(urls_guardadas)
+    estado_actual['fotos_pendientes'] = []
+    estado_actual['item_actual_despues'] = None
+    
+    items_pendientes = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
+    items_completados = [num for num, info in items_activos.items() if info['estado'] == 'completado']
+    
+    mensaje_final = (
+        f"✅ *TRABAJO COMPLETADO - Item #{item_actual_despues}*\n\n"
+        f"📸 Imágenes DESPUÉS guardadas en Drive\n"
+    )
+    
+    if registro_exitoso:
+        mensaje_final += f"📊 Registrado en planilla OUTPUT\n\n"
+    else:
+        mensaje_final += f"⚠️ Error al registrar en OUTPUT\n\n"
+    
+    mensaje_final += f"📊 *ESTADO GENERAL:*\n"
+    mensaje_final += f"   ✅ Completados: {len(items_completados)}\n"
+    mensaje_final += f"   ⏳ Pendientes: {len(items_pendientes)}\n\n"
+    
+    if items_pendientes:
+        mensaje_final += f"💡 Items pendientes: {', '.join(items_pendientes)}\n"
+        mensaje_final += f"Envía 'listo [numero]' al terminar el siguiente."
+    else:
+        mensaje_final += f"🎉 *¡TODOS LOS TRABAJOS COMPLETADOS!*\n\nExcelente trabajo."
+        conversation_store.eliminar(whatsapp_number)
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
+    
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"✅ Trabajo completado - Item #{item_actual_despues}",
+        tiene_media=True,
+        media_url=f"{len(urls_guardadas)} imágenes DESPUÉS",
+        item_relacionado=str(item_actual_despues),
+        estado_flujo="completado" if not items_pendientes else "multiple_en_progreso",
+        respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'}"
+    )
+    
+    if items_pendientes:
+        conversation_store.guardar(whatsapp_number, estado_actual)
+
+
+def _item_del_comando(mensaje: Mensaje) -> Optional[str]:
+    """
+    Número de ítem de un comando 'listo N' / 'obs N' si el ítem ya tiene las
+    fotos ANTES. Si no, avisa al operario por qué no se puede y devuelve None.
+    """
+    numero_solicitado = mensaje.numeros[0]
+    items_activos = mensaje.estado.get('items_activos', {})
+    
+    if str(numero_solicitado) not in items_activos:
+        whatsapp_service.enviar_mensaje(
+            mensaje.numero,
+            f"❌ El item #{numero_solicitado} no está en tu lista actual.\n\n"
+            f"Items activos: {', '.join(items_activos.keys())}"
+        )
+        return None
+    
+    estado_item = items_activos[str(numero_solicitado)]['estado']
+    if estado_item == 'en_espera':
+        return numero_solicitado
+    if estado_item == 'completado':
+        whatsapp_service.enviar_mensaje(mensaje.numero, f"ℹ️ El item #{numero_solicitado} ya está completado.")
+    else:
+        whatsapp_service.enviar_mensaje(mensaje.numero, f"⚠️ El item #{numero_solicitado} aún no tiene fotos ANTES.")
+    return None
+
+
+@maquina.transicion("multiple", "en_progreso", "texto", intencion=OBSERVACION, condicion=lambda m: m.tiene_numero)
+async def _pedir_observacion_item(mensaje: Mensaje):
+    """Comando 'observacion N' para ítems que no se pueden completar."""
+    numero_solicitado = _item_del_comando(mensaje)
+    if numero_solicitado is None:
+        return
+    
+    estado_actual = mensaje.estado
+    estado_actual['estado_observacion'] = 'esperando_texto'
+    estado_actual['item_observacion'] = numero_solicitado
+    conversation_store.guardar(mensaje.numero, estado_actual)
+    
+    whatsapp_service.enviar_mensaje(mensaje.numero, mensaje_pedir_observacion(numero_solicitado))
+
+
+@maquina.transicion("multiple", "en_progreso", "texto", intencion=LISTO_ITEM, condicion=lambda m: m.tiene_numero)
+async def _pedir_fotos_despues_item(mensaje: Mensaje):
+    """Comando 'listo N': pedir las fotos DESPUÉS del ítem."""
+    numero_solicitado = _item_del_comando(mensaje)
+    if numero_solicitado is None:
+        return
+    
+    estado_actual = mensaje.estado
+    estado_actual['item_actual_despues'] = numero_solicitado
+    estado_actual['items_activos'][str(numero_solicitado)]['estado'] = 'recibiendo_despues'
+    conversation_store.guardar(mensaje.numero, estado_actual)
+    
+    whatsapp_service.enviar_mensaje(
+        mensaje.numero,
+        f"📸 *FOTOS DESPUÉS - ITEM #{numero_solicitado}*\n\n"
+        f"Envía 3 fotos del estado DESPUÉS del cartel #{numero_solicitado}.\n\n"
+        f"📷📷📷 Envía las 3 imágenes ahora."
+    )
+
+
+@maquina.transicion(
+    "multiple", "esperando_observacion", "texto",
+    condicion=lambda m: str(m.estado.get('item_observacion')) in m.estado.get('items_activos', {})
+)
+async def _registrar_observacion_item(mensaje: Mensaje):
+    whatsapp_number = mensaje.numero
+    estado_actual = mensaje.estado
+    numero_item_obs = estado_actual['item_observacion']
+    items_activos = estado_actual['items_activos']
+    observacion_texto = mensaje.texto.strip()
+    
+    # Registrar en OUTPUT con la observación
+    cartel_info = await cartel_de(estado_actual, numero_item_obs)
+    registro_exitoso = await asyncio.to_thread(sheets_service.registrar_trabajo_ecogas, {
+        'numero_item': numero_item_obs,
+        'cartel_info': cartel_info,
+        'observacion': observacion_texto
+    })
+    
+    items_activos[str(numero_item_obs)]['estado'] = 'observado'
+    items_activos[str(numero_item_obs)]['observacion'] = observacion_texto
+    estado_actual['estado_observacion'] = None
+    estado_actual['item_observacion'] = None
+    
+    items_pendientes = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
+    items_completados = [num for num, info in items_activos.items() if info['estado'] in ['completado', 'observado']]
+    
+    mensaje_final = (
+        f"📝 *OBSERVACIÓN REGISTRADA - Item #{numero_item_obs}*\n\n"
+        f"📋 Observación: {observacion_texto}\n\n"
+    )
+    
+    if registro_exitoso:
+        mensaje_final += f"📊 Registrado en planilla OUTPUT\n\n"
+    else:
+        mensaje_final += f"⚠️ Error al registrar en OUTPUT\n\n"
+    
+    mensaje_final += f"📊 *ESTADO GENERAL:*\n"
+    mensaje_final += f"   ✅ Procesados: {len(items_completados)}\n"
+    mensaje_final += f"   ⏳ Pendientes: {len(items_pendientes)}\n\n"
+    
+    if items_pendientes:
+        mensaje_final += f"💡 Items pendientes: {', '.join(items_pendientes)}\n"
+        mensaje_final += f"Envía:\n"
+        mensaje_final += f"• *'listo [numero]'* si completaste el trabajo\n"
+        mensaje_final += f"• *'observacion [numero]'* si no pudiste completarlo"
+    else:
+        mensaje_final += f"🎉 *TODOS LOS ITEMS PROCESADOS*\n\nExcelente trabajo."
+        conversation_store.eliminar(whatsapp_number)
+    
+    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
+    
+    await asyncio.to_thread(
+        sheets_service.registrar_log_whatsapp,
+        numero_telefono=whatsapp_number,
+        tipo_mensaje="enviado",
+        contenido=f"📝 Observación registrada - Item #{numero_item_obs}",
+        tiene_media=False,
+        media_url="",
+        item_relacionado=str(numero_item_obs),
+        estado_flujo="observado" if not items_pendientes else "multiple_en_progreso",
+        respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'} | Obs: {observacion_texto[:50]}"
+    )
+    
+    if items_pendientes:
+        conversation_store.guardar(whatsapp_number, estado_actual)
+
+
+# Tareas en segundo plano (dirección de un registro, verificación ANTES/DESPUÉS)
+_tareas_segundo_plano = set()
+
+
+def en_segundo_plano(corrutina):
     """
-    Retorna estadísticas generales del sistema.
+    Lanza la corrutina sin esperarla. Se guarda una referencia fuerte hasta
+    que termine (asyncio solo guarda referencias débiles a las tareas).
     """
-    return {
-        "whatsapp": whatsapp_service.obtener_estadisticas(),
-        "timestamp": datetime.now().isoformat(),
-        "environment": os.getenv("ENVIRONMENT", "development")
-    }
+    tarea = asyncio.create_task(corrutina)
+    _tareas_segundo_plano.add(tarea)
+    tarea.add_done_callback(_tareas_segundo_plano.discard)
 
 
-def crear_enlace_google_maps(coordenadas: str) -> str:
+def completar_direccion(registro_id: int, latitud: float, longitud: float):
     """
-    Crea un enlace de Google Maps a partir de coordenadas.
-    
-    Args:
-        coordenadas: String con formato "lat, lon", "lat,lon" o "lat lon"
+    Geocodifica en segundo plano (fuera del camino de la respuesta al operario)
+    y guarda la dirección en el registro. Las consultas a Nominatim respetan
+    1 request/s y quedan en cache para las próximas visitas al mismo lugar.
+    """
+    async def completar():
+        try:
+            # Solo llega acá si no había carteles cerca ni dirección en cache: consulta Nominatim
+            direccion = await geo_service.obtener_direccion_async(latitud, longitud)
+            if not direccion:
+                return
+            db = SessionLocal()
+            try:
+                db.query(RegistroCartel).filter(RegistroCartel.id == registro_id).update({"direccion": direccion})
+                db.commit()
+            finally:
+                db.close()
+        except Exception as e:
+            print(f"⚠️ No se pudo completar la dirección del registro {registro_id}: {e}")
     
-    Returns:
-        URL de Google Maps o None si las coordenadas son inválidas
+    en_segundo_plano(completar())
+
+
+_VERIFICACION_ACTIVA = os.getenv("WORK_VERIFICATION_ENABLED", "1") == "1"
+_VERIFICACION_MAX_INTENTOS = int(os.getenv("WORK_VERIFICATION_MAX_ATTEMPTS", "3"))
+# Segundos desde el último intento (o desde la creación) antes de que el barrido retome una verificación
+_VERIFICACION_REINTENTO_SEGUNDOS = float(os.getenv("WORK_VERIFICATION_RETRY_SECONDS", "300"))
+
+
+def encolar_verificacion(
+    numero_item,
+    whatsapp_number: str,
+    cartel_info: dict,
+    media_antes: Optional[List[str]],
+    media_despues: List[str],
+    imagenes_despues: Optional[List[bytes]] = None
+):
     """
-    if not coordenadas or coordenadas in ['-', 'N/A', 'No disponibles', '']:
-        return None
+    Registra la verificación ANTES/DESPUÉS del trabajo como pendiente y la
+    analiza en segundo plano: el operario no espera al modelo. Las fotos
+    DESPUÉS ya descargadas se reutilizan; las ANTES se vuelven a bajar de Twilio.
+    """
+    if not _VERIFICACION_ACTIVA:
+        return
+    if not media_antes or not media_despues:
+        print(f"ℹ️ Item #{numero_item}: sin URLs de fotos ANTES/DESPUÉS, no se verifica el trabajo")
+        return
     
+    db = SessionLocal()
     try:
-        # Limpiar coordenadas
-        coords_limpio = coordenadas.strip()
-        
-        # Intentar separar por coma primero
-        if ',' in coords_limpio:
-            partes = coords_limpio.split(',')
-        else:
-            # Si no hay coma, separar por espacios
-            partes = coords_limpio.split()
-        
-        if len(partes) >= 2:
-            lat = partes[0].strip()
-            lon = partes[1].strip()
-            # Crear enlace de Google Maps
-            return f"https://maps.google.com/?q={lat},{lon}"
-        return None
-    except:
-        return None
+        verificacion = VerificacionTrabajo(
+            numero_item=str(numero_item),
+            whatsapp_number=whatsapp_number,
+            media_antes=json.dumps(media_antes),
+            media_despues=json.dumps(media_despues)
+        )
+        db.add(verificacion)
+        db.commit()
+        verificacion_id = verificacion.id
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar la verificación del item #{numero_item}: {e}")
+        return
+    finally:
+        db.close()
+    
+    en_segundo_plano(verificar_trabajo(verificacion_id, cartel_info, imagenes_despues))
 
 
-@app.post("/webhook/whatsapp", response_class=PlainTextResponse)
-async def webhook_whatsapp(
-    background_tasks: BackgroundTasks,
-    From: str = Form(...),
-    Body: str = Form(""),
-    MediaUrl0: Optional[str] = Form(None),
-    Latitude: Optional[str] = Form(None),
-    Longitude: Optional[str] = Form(None),
-    db: Session = Depends(get_db)
+async def verificar_trabajo(
+    verificacion_id: int,
+    cartel_info: Optional[dict] = None,
+    imagenes_despues: Optional[List[bytes]] = None
 ):
     """
-    Webhook para recibir mensajes de WhatsApp desde Twilio.
-    FLUJO PRINCIPAL: Usuario envía número de item para trabajar en ese cartel.
+    Compara las fotos ANTES y DESPUÉS con una sola llamada a Gemini y guarda el veredicto.
+    Cada llamada cuenta un intento; si otro worker ya tomó ese intento, no hace nada.
     """
+    db = SessionLocal()
     try:
-        # Extraer número del operario
-        whatsapp_number = From
-        operario = Body.split()[0] if Body else "Operario"
+        verificacion = db.query(VerificacionTrabajo).filter(VerificacionTrabajo.id == verificacion_id).first()
+        if verificacion is None or verificacion.estado == "hecho":
+            return
         
-        # 📋 LOG: Registrar mensaje recibido
-        sheets_service.registrar_log_whatsapp(
-            numero_telefono=whatsapp_number,
-            tipo_mensaje="recibido",
-            contenido=Body if Body else "[Sin texto]",
-            tiene_media=bool(MediaUrl0),
-            media_url=MediaUrl0 if MediaUrl0 else "",
-            item_relacionado="",
-            estado_flujo=conversation_states.get(whatsapp_number, {}).get('estado', 'inicial'),
-            respuesta_bot=""
+        # Reclamar el intento con compare-and-set sobre el contador (tarea del webhook vs. barrido de otro
+        # worker); un intento iniciado hace menos de WORK_VERIFICATION_RETRY_SECONDS sigue en curso
+        en_curso_desde = datetime.utcnow() - timedelta(seconds=_VERIFICACION_REINTENTO_SEGUNDOS)
+        reclamada = (
+            db.query(VerificacionTrabajo)
+            .filter(
+                VerificacionTrabajo.id == verificacion_id,
+                VerificacionTrabajo.intentos == verificacion.intentos,
+                or_(VerificacionTrabajo.fecha_intento.is_(None), VerificacionTrabajo.fecha_intento < en_curso_desde)
+            )
+            .update(
+                {VerificacionTrabajo.intentos: VerificacionTrabajo.intentos + 1,
+                 VerificacionTrabajo.fecha_intento: datetime.utcnow()},
+                synchronize_session=False
+            )
         )
+        db.commit()
+        if not reclamada:
+            return
+        db.refresh(verificacion)
         
-        # MANEJO DE CONFIRMACIÓN DE LLEGADA AL LUGAR
-        estado_actual = conversation_states.get(whatsapp_number, {})
-        
-        # MODO MÚLTIPLE - Confirmación de llegada
-        if estado_actual.get('modo') == 'multiple' and estado_actual.get('estado_confirmacion') == 'esperando':
-            if Body:
-                respuesta_lower = Body.lower().strip()
-                # Detectar respuestas afirmativas
-                if any(word in respuesta_lower for word in ['si', 'sí', 'yes', 'si', 'ok', 'dale', 'llegue', 'llegué', 'estoy']):
-                    # Usuario confirmó llegada
-                    item_actual = estado_actual['item_confirmacion_pendiente']
-                    items_activos = estado_actual.get('items_activos', {})
-                    cartel = items_activos[str(item_actual)]['cartel_info']
-                    
-                    # Enviar información detallada del cartel
-                    tipo_info = cartel.get('tipo_completo', cartel.get('tipo_raw', 'No especificado'))
-                    
-                    respuesta = f"""
-📋 *INFORMACIÓN DEL CARTEL #{item_actual}*
-
-🛣️ Gasoducto/Ramal: {cartel.get('gasoducto_ramal', 'No especificado')}
-📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}
-📌 Coordenadas: {cartel.get('coordenadas', 'No disponibles')}
-
-⚠️ *━━━━━━━━━━━━━━━━━━━*
-🔴 *TIPO DE CARTEL:*
-*{tipo_info}*
-⚠️ *━━━━━━━━━━━━━━━━━━━*
-
-📏 Tamaño: {cartel.get('tamanio', 'No especificado')}
-"""
-                    
-                    if cartel.get('tapada_caneria') and cartel.get('tapada_caneria') not in ['-', '']:
-                        respuesta += f"🔧 Tapada cañería: {cartel.get('tapada_caneria')}\n"
-                    
-                    respuesta += f"""📝 Observaciones: {cartel.get('observaciones', 'Sin observaciones')}
-📅 Estado: {cartel.get('estado', 'No especificado')}
-"""
-                    
-                    if cartel.get('tipo_trabajo'):
-                        respuesta += f"\n🔨 *Tipo de trabajo:*\n{cartel.get('tipo_trabajo')}\n"
-                        if cartel.get('detalles_instalacion'):
-                            respuesta += "\n📦 *Detalles de instalación:*\n"
-                            for detalle in cartel.get('detalles_instalacion', []):
-                                respuesta += f"  • {detalle}\n"
-                    
-                    respuesta += f"\n🌍 Zona: {cartel.get('zona', 'No especificada')}"
-                    
-                    whatsapp_service.enviar_mensaje(whatsapp_number, respuesta.strip())
-                    
-                    # Enviar imágenes de referencia desde el Drive
-                    imagenes = sheets_service.obtener_imagenes_cartel(item_actual)
-                    if imagenes:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"📸 Enviando {len(imagenes)} imagen(es) de referencia del INPUT..."
-                        )
-                        
-                        for idx, imagen in enumerate(imagenes, 1):
-                            caption = f"🖼️ Item #{item_actual} - Imagen {idx}/{len(imagenes)}"
-                            success = whatsapp_service.enviar_imagen(
-                                whatsapp_number,
-                                imagen['url'],
-                                caption
-                            )
-                            if not success:
-                                whatsapp_service.enviar_mensaje(
-                                    whatsapp_number,
-                                    f"{caption}\n{imagen['web_view']}"
-                                )
-                            time.sleep(1)
-                        time.sleep(1)
-                    
-                    # Pedir fotos ANTES
-                    whatsapp_service.enviar_mensaje(
-                        whatsapp_number,
-                        f"\n📸 *FOTOS ANTES - ITEM #{item_actual}*\n\n"
-                        f"Envía 3 fotos del estado ANTES del cartel #{item_actual}.\n\n"
-                        f"📷📷📷 Envía las 3 imágenes ahora."
-                    )
-                    
-                    # Actualizar estado
-                    estado_actual['estado_confirmacion'] = None
-                    estado_actual['item_confirmacion_pendiente'] = None
-                    estado_actual['items_activos'][str(item_actual)]['estado'] = 'recibiendo_antes'
-                    conversation_states[whatsapp_number] = estado_actual
-                    
-                    return "OK"
-                    
-                elif any(word in respuesta_lower for word in ['no', 'aun no', 'todavia no', 'todavía no', 'negativo']):
-                    whatsapp_service.enviar_mensaje(
-                        whatsapp_number,
-                        "👍 Entendido. Cuando llegues al lugar, envía *'sí'* o *'llegué'* para continuar."
-                    )
-                    return "OK"
-        
-        # MODO SIMPLE - Confirmación de llegada
-        if estado_actual.get('estado') == 'esperando_confirmacion_llegada':
-            if Body:
-                respuesta_lower = Body.lower().strip()
-                # Detectar respuestas afirmativas
-                if any(word in respuesta_lower for word in ['si', 'sí', 'yes', 'si', 'ok', 'dale', 'llegue', 'llegué', 'estoy']):
-                    # Usuario confirmó que llegó al lugar
-                    numero_item = estado_actual['numero_item']
-                    cartel = estado_actual['cartel_info']
-                    
-                    # Enviar información detallada del cartel
-                    tipo_info = cartel.get('tipo_completo', cartel.get('tipo_raw', 'No especificado'))
-                    
-                    respuesta = f"""
-📋 *INFORMACIÓN DEL CARTEL #{numero_item}*
-
-🛣️ Gasoducto/Ramal: {cartel.get('gasoducto_ramal', 'No especificado')}
-📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}
-📌 Coordenadas: {cartel.get('coordenadas', 'No disponibles')}
-
-⚠️ *━━━━━━━━━━━━━━━━━━━*
-🔴 *TIPO DE CARTEL:*
-*{tipo_info}*
-⚠️ *━━━━━━━━━━━━━━━━━━━*
-
-📏 Tamaño: {cartel.get('tamanio', 'No especificado')}
-"""
-                    
-                    if cartel.get('tapada_caneria') and cartel.get('tapada_caneria') not in ['-', '']:
-                        respuesta += f"🔧 Tapada cañería: {cartel.get('tapada_caneria')}\n"
-                    
-                    respuesta += f"""📝 Observaciones: {cartel.get('observaciones', 'Sin observaciones')}
-📅 Estado: {cartel.get('estado', 'No especificado')}
-"""
-                    
-                    if cartel.get('tipo_trabajo'):
-                        respuesta += f"\n🔨 *Tipo de trabajo:*\n{cartel.get('tipo_trabajo')}\n"
-                        if cartel.get('detalles_instalacion'):
-                            respuesta += "\n📦 *Detalles de instalación:*\n"
-                            for detalle in cartel.get('detalles_instalacion', []):
-                                respuesta += f"  • {detalle}\n"
-                    
-                    respuesta += f"\n🌍 Zona: {cartel.get('zona', 'No especificada')}"
-                    
-                    whatsapp_service.enviar_mensaje(whatsapp_number, respuesta.strip())
-                    
-                    # Enviar imágenes de referencia desde el Drive (carpeta INPUT)
-                    imagenes = sheets_service.obtener_imagenes_cartel(numero_item)
-                    if imagenes:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"📸 Enviando {len(imagenes)} imagen(es) de referencia del INPUT..."
-                        )
-                        
-                        for idx, imagen in enumerate(imagenes, 1):
-                            caption = f"🖼️ Imagen {idx}/{len(imagenes)}: {imagen['name']}"
-                            success = whatsapp_service.enviar_imagen(
-                                whatsapp_number,
-                                imagen['url'],
-                                caption
-                            )
-                            if not success:
-                                whatsapp_service.enviar_mensaje(
-                                    whatsapp_number,
-                                    f"{caption}\n{imagen['web_view']}"
-                                )
-                            time.sleep(1)
-                        time.sleep(2)
-                    else:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            "ℹ️ No se encontraron imágenes de referencia para este cartel en Drive."
-                        )
-                    
-                    # Ahora pedir fotos ANTES
-                    whatsapp_service.enviar_mensaje(
-                        whatsapp_number,
-                        f"\n📸 *ANTES DE COMENZAR EL TRABAJO*\n\n"
-                        f"Por favor, envía 3 fotos del estado actual del cartel #{numero_item} ANTES de realizar cualquier trabajo.\n\n"
-                        f"Envía las 3 imágenes ahora. 📷📷📷"
-                    )
-                    
-                    # Actualizar estado
-                    conversation_states[whatsapp_number] = {
-                        'estado': 'esperando_imagenes_antes',
-                        'numero_item': numero_item,
-                        'imagenes_antes': [],
-                        'cartel_info': cartel
-                    }
-                    
-                    sheets_service.registrar_log_whatsapp(
-                        numero_telefono=whatsapp_number,
-                        tipo_mensaje="enviado",
-                        contenido=f"Confirmación de llegada - Item {numero_item} - Enviando info e imágenes",
-                        tiene_media=bool(imagenes),
-                        media_url="",
-                        item_relacionado=str(numero_item),
-                        estado_flujo="esperando_imagenes_antes",
-                        respuesta_bot="Solicitando 3 fotos ANTES del trabajo"
-                    )
-                    
-                    return "OK"
-                    
-                elif any(word in respuesta_lower for word in ['no', 'aun no', 'todavia no', 'todavía no', 'negativo']):
-                    # Usuario no llegó aún
-                    whatsapp_service.enviar_mensaje(
-                        whatsapp_number,
-                        "👍 Entendido. Cuando llegues al lugar, envía *'sí'* o *'llegué'* para continuar."
-                    )
-                    return "OK"
+        if cartel_info is None:
+            # Reintento del barrido: la info del cartel no se guarda en la fila, se resuelve del catálogo
+            cartel_info = await asyncio.to_thread(sheets_service.buscar_cartel_por_item, verificacion.numero_item)
+            cartel_info = cartel_info or {'numero': verificacion.numero_item}
         
-        # FLUJO PRINCIPAL: Detectar número(s) de ítem en el mensaje
-        # GUARDA: No interrumpir flujos activos con detección de número nuevo
-        import re
-        _estados_activos_no_interrumpir = [
-            'esperando_imagenes_antes',
-            'en_trabajo',
-            'esperando_imagenes_despues',
-            'esperando_observacion',
-        ]
-        _estado_check = conversation_states.get(whatsapp_number, {})
-        _en_flujo_activo = (
-            _estado_check.get('modo') == 'multiple' or
-            _estado_check.get('estado') in _estados_activos_no_interrumpir
-        )
-        if Body and re.search(r'\d+', Body) and not _en_flujo_activo:
-            print(f"🔍 Detectado número(s) de ítem en mensaje: {Body}")
-            
-            # Extraer TODOS los números del mensaje
-            numeros = re.findall(r'\d+', Body)
-            print(f"📊 Números encontrados: {numeros}")
-            
-            # DEBUG: Ver estado actual
-            print(f"🔵 DEBUG: Estado actual en conversation_states:")
-            if whatsapp_number in conversation_states:
-                estado_debug = conversation_states[whatsapp_number]
-                print(f"   - Existe estado: SÍ")
-                print(f"   - estado: {estado_debug.get('estado')}")
-                print(f"   - numero_item: {estado_debug.get('numero_item')}")
-                print(f"   - observacion_registrada: {'observacion_registrada' in estado_debug}")
-            else:
-                print(f"   - Existe estado: NO")
-            
-            if numeros:
-                # Modo múltiple: si hay más de un número
-                if len(numeros) > 1:
-                    print(f"🔢 MODO MÚLTIPLE: {len(numeros)} items detectados")
-                    
-                    # Buscar información de todos los items
-                    items_validos = []
-                    items_invalidos = []
-                    
-                    for num in numeros:
-                        cartel = sheets_service.buscar_cartel_por_item(num)
-                        if cartel:
-                            items_validos.append({
-                                'numero': cartel.get('numero', num),
-                                'info': cartel
-                            })
-                        else:
-                            items_invalidos.append(num)
-                    
-                    if not items_validos:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"❌ No se encontró ningún ítem válido en la planilla."
-                        )
-                        return "OK"
-                    
-                    # Avisar sobre items inválidos si los hay
-                    if items_invalidos:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"⚠️ Items no encontrados: {', '.join(items_invalidos)}"
-                        )
-                    
-                    # Enviar resumen de items a trabajar
-                    resumen = f"✅ *{len(items_validos)} ITEMS PARA TRABAJAR*\n\n"
-                    for item in items_validos:
-                        info = item['info']
-                        tipo_info = info.get('tipo_completo', info.get('tipo_raw', '?'))
-                        resumen += f"📋 #{item['numero']} - {info.get('ubicacion', 'Sin ubicación')}\n"
-                        resumen += f"   🔴 Tipo: {tipo_info}\n\n"
-                    
-                    resumen += f"� Te enviaré la ubicación de cada uno.\n"
-                    resumen += f"📸 Confirma tu llegada a cada lugar antes de recibir la info e imágenes.\n\n"
-                    resumen += f"💡 Al terminar cada trabajo, envía *'listo [numero]'*"
-                    
-                    whatsapp_service.enviar_mensaje(whatsapp_number, resumen)
-                    
-                    # Inicializar estado múltiple
-                    primer_item = items_validos[0]['numero']
-                    items_dict = {}
-                    for item in items_validos:
-                        items_dict[str(item['numero'])] = {
-                            'estado': 'pendiente_confirmacion',
-                            'cartel_info': item['info'],
-                            'imagenes_antes': [],
-                            'urls_imagenes_antes': []
-                        }
-                    
-                    conversation_states[whatsapp_number] = {
-                        'modo': 'multiple',
-                        'items_activos': items_dict,
-                        'item_actual_antes': primer_item,
-                        'item_actual_despues': None,
-                        'imagenes_temp': [],
-                        'estado_confirmacion': 'esperando',
-                        'item_confirmacion_pendiente': primer_item
-                    }
-                    
-                    # Enviar coordenadas del primer item y pedir confirmación
-                    primer_cartel = items_dict[str(primer_item)]['cartel_info']
-                    coordenadas = primer_cartel.get('coordenadas', '')
-                    enlace_maps = crear_enlace_google_maps(coordenadas)
-                    
-                    if enlace_maps:
-                        mensaje_ubicacion = f"📍 *ITEM #{primer_item} - UBICACIÓN*\n\n"
-                        mensaje_ubicacion += f"📌 Coordenadas: {coordenadas}\n"
-                        mensaje_ubicacion += f"🗺️ Ver en Google Maps:\n{enlace_maps}\n\n"
-                        mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                        mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                    else:
-                        mensaje_ubicacion = f"📍 *ITEM #{primer_item}*\n\n"
-                        mensaje_ubicacion += f"📍 Ubicación: {primer_cartel.get('ubicacion', 'No especificada')}\n"
-                        mensaje_ubicacion += f"📌 Coordenadas: {coordenadas if coordenadas else 'No disponibles'}\n\n"
-                        mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                        mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                    
-                    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_ubicacion)
-                    
-                    return "OK"
-                    
-                # Modo simple: un solo número
-                item_number = numeros[0]
-                print(f"📊 Buscando ítem: {item_number}")
-                
-                # VERIFICAR SI HAY UN ESTADO PREVIO CON OBSERVACIÓN REGISTRADA
-                estado_previo = conversation_states.get(whatsapp_number, {})
-                print(f"🔵 DEBUG: Verificando observación previa:")
-                print(f"   - estado_previo.get('estado'): {estado_previo.get('estado')}")
-                print(f"   - str(estado_previo.get('numero_item')): {str(estado_previo.get('numero_item'))}")
-                print(f"   - item_number: {item_number}")
-                print(f"   - 'observacion_registrada' in estado_previo: {'observacion_registrada' in estado_previo}")
-                print(f"   - ¿Cumple todas las condiciones? {estado_previo.get('estado') == 'observado' and str(estado_previo.get('numero_item')) == item_number and 'observacion_registrada' in estado_previo}")
-                
-                if (estado_previo.get('estado') == 'observado' and 
-                    str(estado_previo.get('numero_item')) == item_number and
-                    'observacion_registrada' in estado_previo):
-                    
-                    # El usuario está completando un trabajo que previamente registró como observación
-                    print(f"✅ Detectado completar trabajo con observación previa - Item {item_number}")
-                    
-                    # Verificar si ya tiene fotos ANTES
-                    if estado_previo.get('urls_imagenes_antes'):
-                        # Ya tiene fotos ANTES, ir directo a DESPUÉS
-                        estado_previo['estado'] = 'esperando_imagenes_despues'
-                        conversation_states[whatsapp_number] = estado_previo
-                        
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ *COMPLETAR TRABAJO - ITEM #{item_number}*\n\n"
-                            f"📸 *FOTOS DESPUÉS DEL TRABAJO*\n\n"
-                            f"Envía 3 fotos del estado DESPUÉS de finalizar el cartel #{item_number}.\n\n"
-                            f"📷📷📷 Envía las 3 imágenes ahora."
-                        )
-                    else:
-                        # No tiene fotos ANTES, solicitarlas primero
-                        estado_previo['estado'] = 'esperando_imagenes_antes'
-                        estado_previo['imagenes_antes'] = []
-                        conversation_states[whatsapp_number] = estado_previo
-                        
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ *COMPLETAR TRABAJO - ITEM #{item_number}*\n\n"
-                            f"📸 *ANTES DE FINALIZAR EL TRABAJO*\n\n"
-                            f"Envía 3 fotos del estado ANTES del cartel #{item_number}.\n\n"
-                            f"📷📷📷 Envía las 3 imágenes ahora."
-                        )
-                    
-                    return "OK"
-                
-                # Buscar información en la planilla
-                cartel = sheets_service.buscar_cartel_por_item(item_number)
-                
-                if not cartel:
-                    whatsapp_service.enviar_mensaje(
-                        whatsapp_number,
-                        f"❌ No se encontró el ítem {item_number} en la planilla."
-                    )
-                    return "OK"
-                
-                # NUEVO FLUJO: Enviar coordenadas y preguntar si llegó al lugar
-                coordenadas = cartel.get('coordenadas', '')
-                enlace_maps = crear_enlace_google_maps(coordenadas)
-                numero = cartel.get('numero', item_number)
-                
-                if enlace_maps:
-                    mensaje_ubicacion = f"📍 *UBICACIÓN DEL CARTEL #{numero}*\n\n"
-                    mensaje_ubicacion += f"📌 Coordenadas: {coordenadas}\n"
-                    mensaje_ubicacion += f"🗺️ Ver en Google Maps:\n{enlace_maps}\n\n"
-                    mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                    mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                else:
-                    mensaje_ubicacion = f"📍 *CARTEL #{numero}*\n\n"
-                    mensaje_ubicacion += f"📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}\n"
-                    mensaje_ubicacion += f"📌 Coordenadas: {coordenadas if coordenadas else 'No disponibles'}\n\n"
-                    mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                    mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                
-                whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_ubicacion)
-                
-                # Guardar estado esperando confirmación
-                conversation_states[whatsapp_number] = {
-                    'estado': 'esperando_confirmacion_llegada',
-                    'numero_item': numero,
-                    'cartel_info': cartel
-                }
-                
-                sheets_service.registrar_log_whatsapp(
-                    numero_telefono=whatsapp_number,
-                    tipo_mensaje="enviado",
-                    contenido=f"Item {numero} solicitado - Esperando confirmación de llegada",
-                    tiene_media=False,
-                    media_url="",
-                    item_relacionado=str(numero),
-                    estado_flujo="esperando_confirmacion_llegada",
-                    respuesta_bot="Coordenadas enviadas - Esperando confirmación"
-                )
-                
-                return "OK"
+        antes = await descargar_media(json.loads(verificacion.media_antes))
+        despues = imagenes_despues or await descargar_media(json.loads(verificacion.media_despues))
         
-        # MANEJO DE IMÁGENES SEGÚN ESTADO DE CONVERSACIÓN (movido más abajo)
-        estado_actual = conversation_states.get(whatsapp_number, {})
+        resultado = None
+        if not (all(antes) and all(despues)):
+            print(f"⚠️ Verificación {verificacion_id}: no se pudieron descargar las fotos de Twilio")
+        else:
+            try:
+                resultado = await gemini_agent.comparar_antes_despues(antes, despues, cartel_info)
+            except Exception as e:
+                # Gemini no configurado o no disponible
+                print(f"⚠️ Verificación {verificacion_id}: {e}")
         
-        # CÓDIGO LEGACY - Ya no se usa este flujo directo
-        # Solo mantener comentado por referencia
-        if False:  # Deshabilitar flujo antiguo
-                tipo_info = cartel.get('tipo_completo', cartel.get('tipo_raw', 'No especificado'))
-                
-                respuesta = f"""
-📋 *INFORMACIÓN DEL CARTEL #{cartel.get('numero', 'N/A')}*
+        verificacion.fecha_analisis = datetime.utcnow()
+        if resultado is None:
+            verificacion.estado = "error"
+            metrics.VERIFICACIONES_TRABAJO.labels("error").inc()
+            if verificacion.intentos >= _VERIFICACION_MAX_INTENTOS:
+                print(f"⚠️ Verificación {verificacion_id}: sin veredicto tras {verificacion.intentos} intentos, no se reintenta")
+        else:
+            verificacion.estado = "hecho"
+            verificacion.veredicto = resultado["veredicto"]
+            verificacion.trabajo_realizado = resultado["trabajo_realizado"]
+            verificacion.confianza = resultado["confianza"]
+            verificacion.razon = resultado["razon"]
+            verificacion.resultado = json.dumps(resultado, ensure_ascii=False)
+            metrics.VERIFICACIONES_TRABAJO.labels(resultado["veredicto"]).inc()
+            print(f"🔍 Verificación item #{verificacion.numero_item}: {resultado['veredicto']} ({resultado['confianza']:.0%})")
+        db.commit()
+    except Exception as e:
+        print(f"⚠️ Error en la verificación {verificacion_id}: {e}")
+    finally:
+        db.close()
 
-🛣️ Gasoducto/Ramal: {cartel.get('gasoducto_ramal', 'No especificado')}
-📍 Ubicación: {cartel.get('ubicacion', 'No especificada')}
-📌 Coordenadas: {cartel.get('coordenadas', 'No disponibles')}
 
-⚠️ *━━━━━━━━━━━━━━━━━━━*
-"""
-                pass  # Código legacy deshabilitado
-        
-        # ===== MODO MÚLTIPLE =====
-        if estado_actual.get('modo') == 'multiple':
-            if MediaUrl0:
-                items_activos = estado_actual.get('items_activos', {})
-                item_actual_antes = estado_actual.get('item_actual_antes')
-                item_actual_despues = estado_actual.get('item_actual_despues')
-                
-                # Descarga la imagen
-                auth = (os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
-                image_data = await whatsapp_service.descargar_imagen(MediaUrl0, auth)
-                
-                if not image_data:
-                    whatsapp_service.enviar_mensaje(whatsapp_number, "❌ Error al descargar la imagen. Intenta nuevamente.")
-                    return "OK"
-                
-                # Recibiendo fotos ANTES
-                if item_actual_antes and items_activos.get(str(item_actual_antes), {}).get('estado') == 'recibiendo_antes':
-                    estado_actual['imagenes_temp'].append(image_data)
-                    num_recibidas = len(estado_actual['imagenes_temp'])
-                    
-                    if num_recibidas < 3:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ Imagen {num_recibidas}/3 recibida para item #{item_actual_antes}.\n\n📸 Envía la imagen {num_recibidas + 1} de 3."
-                        )
-                    else:
-                        # 3 fotos ANTES completadas
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ 3 imágenes recibidas.\n\n⏳ Guardando en Drive..."
-                        )
-                        
-                        # Subir a Drive
-                        urls_guardadas = []
-                        item_formateado = str(item_actual_antes).zfill(3)
-                        for idx, img_data in enumerate(estado_actual['imagenes_temp'], 1):
-                            filename = f"{item_formateado}-{str(idx).zfill(3)}.jpg"
-                            url = sheets_service.subir_imagen_antes_despues(
-                                img_data, 
-                                filename, 
-                                item_actual_antes, 
-                                'antes'
-                            )
-                            if url:
-                                urls_guardadas.append(url)
-                        
-                        # Actualizar estado del item
-                        items_activos[str(item_actual_antes)]['estado'] = 'en_espera'
-                        items_activos[str(item_actual_antes)]['urls_imagenes_antes'] = urls_guardadas
-                        items_activos[str(item_actual_antes)]['imagenes_antes'] = estado_actual['imagenes_temp'].copy()
-                        estado_actual['imagenes_temp'] = []
-                        
-                        # Buscar siguiente item pendiente de confirmación
-                        siguiente_item = None
-                        for num_item, info in items_activos.items():
-                            if info['estado'] == 'pendiente_confirmacion':
-                                siguiente_item = num_item
-                                break
-                        
-                        if siguiente_item:
-                            # Hay más items para procesar - Pedir confirmación de llegada
-                            estado_actual['item_actual_antes'] = siguiente_item
-                            estado_actual['estado_confirmacion'] = 'esperando'
-                            estado_actual['item_confirmacion_pendiente'] = siguiente_item
-                            
-                            # Enviar coordenadas del siguiente item
-                            siguiente_cartel = items_activos[siguiente_item]['cartel_info']
-                            coordenadas = siguiente_cartel.get('coordenadas', '')
-                            enlace_maps = crear_enlace_google_maps(coordenadas)
-                            
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"✅ *IMÁGENES GUARDADAS - Item #{item_actual_antes}*\n\n"
-                            )
-                            
-                            if enlace_maps:
-                                mensaje_ubicacion = f"📍 *ITEM #{siguiente_item} - UBICACIÓN*\n\n"
-                                mensaje_ubicacion += f"📌 Coordenadas: {coordenadas}\n"
-                                mensaje_ubicacion += f"🗺️ Ver en Google Maps:\n{enlace_maps}\n\n"
-                                mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                                mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                            else:
-                                mensaje_ubicacion = f"📍 *ITEM #{siguiente_item}*\n\n"
-                                mensaje_ubicacion += f"📍 Ubicación: {siguiente_cartel.get('ubicacion', 'No especificada')}\n"
-                                mensaje_ubicacion += f"📌 Coordenadas: {coordenadas if coordenadas else 'No disponibles'}\n\n"
-                                mensaje_ubicacion += f"❓ *¿Has llegado al lugar?*\n\n"
-                                mensaje_ubicacion += f"Responde *'sí'* cuando estés en el lugar."
-                            
-                            whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_ubicacion)
-                        else:
-                            # Todos los ANTES completados
-                            estado_actual['item_actual_antes'] = None
-                            
-                            items_en_espera = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
-                            
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"✅ *TODOS LOS ANTES COMPLETADOS*\n\n"
-                                f"📋 Items listos para trabajar: {', '.join(items_en_espera)}\n\n"
-                                f"🔧 Procede con los trabajos.\n\n"
-                                f"💡 Al terminar cada trabajo:\n\n"
-                                f"✅ Si completaste el trabajo:\n"
-                                f"   *'listo [numero]'* o *'finalizado [numero]'*\n"
-                                f"   Ejemplo: 'listo {items_en_espera[0]}'\n\n"
-                                f"📝 Si NO pudiste completarlo:\n"
-                                f"   *'observacion [numero]'* o *'obs [numero]'*\n"
-                                f"   Ejemplo: 'observacion {items_en_espera[0]}'"
-                            )
-                        
-                        conversation_states[whatsapp_number] = estado_actual
-                    
-                    return "OK"
-                
-                # Recibiendo fotos DESPUÉS
-                if item_actual_despues and items_activos.get(str(item_actual_despues), {}).get('estado') == 'recibiendo_despues':
-                    estado_actual['imagenes_temp'].append(image_data)
-                    num_recibidas = len(estado_actual['imagenes_temp'])
-                    
-                    if num_recibidas < 3:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ Imagen {num_recibidas}/3 recibida para item #{item_actual_despues}.\n\n📸 Envía la imagen {num_recibidas + 1} de 3."
-                        )
-                    else:
-                        # 3 fotos DESPUÉS completadas
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"✅ 3 imágenes recibidas.\n\n⏳ Guardando en Drive..."
-                        )
-                        
-                        # Subir a Drive
-                        urls_guardadas = []
-                        item_formateado = str(item_actual_despues).zfill(3)
-                        for idx, img_data in enumerate(estado_actual['imagenes_temp'], 1):
-                            filename = f"{item_formateado}-{str(idx + 3).zfill(3)}.jpg"
-                            url = sheets_service.subir_imagen_antes_despues(
-                                img_data, 
-                                filename, 
-                                item_actual_despues, 
-                                'despues'
-                            )
-                            if url:
-                                urls_guardadas.append(url)
-                        
-                        # Registrar en OUTPUT
-                        cartel_info = items_activos[str(item_actual_despues)].get('cartel_info', {})
-                        registro_exitoso = sheets_service.registrar_trabajo_ecogas({
-                            'numero_item': item_actual_despues,
-                            'cartel_info': cartel_info
-                        })
-                        
-                        # Actualizar estado del item
-                        items_activos[str(item_actual_despues)]['estado'] = 'completado'
-                        items_activos[str(item_actual_despues)]['urls_imagenes_despues'] = urls_guardadas
-                        estado_actual['imagenes_temp'] = []
-                        estado_actual['item_actual_despues'] = None
-                        
-                        # Contar items pendientes
-                        items_pendientes = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
-                        items_completados = [num for num, info in items_activos.items() if info['estado'] == 'completado']
-                        
-                        mensaje_final = (
-                            f"✅ *TRABAJO COMPLETADO - Item #{item_actual_despues}*\n\n"
-                            f"📸 Imágenes DESPUÉS guardadas en Drive\n"
-                        )
-                        
-                        if registro_exitoso:
-                            mensaje_final += f"📊 Registrado en planilla OUTPUT\n\n"
-                        else:
-                            mensaje_final += f"⚠️ Error al registrar en OUTPUT\n\n"
-                        
-                        mensaje_final += f"📊 *ESTADO GENERAL:*\n"
-                        mensaje_final += f"   ✅ Completados: {len(items_completados)}\n"
-                        mensaje_final += f"   ⏳ Pendientes: {len(items_pendientes)}\n\n"
-                        
-                        if items_pendientes:
-                            mensaje_final += f"💡 Items pendientes: {', '.join(items_pendientes)}\n"
-                            mensaje_final += f"Envía 'listo [numero]' al terminar el siguiente."
-                        else:
-                            mensaje_final += f"🎉 *¡TODOS LOS TRABAJOS COMPLETADOS!*\n\nExcelente trabajo."
-                            # Limpiar estado
-                            del conversation_states[whatsapp_number]
-                        
-                        whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
-                        
-                        # LOG
-                        sheets_service.registrar_log_whatsapp(
-                            numero_telefono=whatsapp_number,
-                            tipo_mensaje="enviado",
-                            contenido=f"✅ Trabajo completado - Item #{item_actual_despues}",
-                            tiene_media=True,
-                            media_url=f"{len(urls_guardadas)} imágenes DESPUÉS",
-                            item_relacionado=str(item_actual_despues),
-                            estado_flujo="completado" if not items_pendientes else "multiple_en_progreso",
-                            respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'}"
-                        )
-                        
-                        if whatsapp_number in conversation_states:
-                            conversation_states[whatsapp_number] = estado_actual
-                    
-                    return "OK"
-            
-            # Detectar comando "observacion [numero]" para marcar como pendiente/incompleto
-            if Body:
-                body_lower = Body.lower().strip()
-                numeros_en_mensaje = re.findall(r'\d+', Body)
-                
-                # Comando OBSERVACIÓN para items que no se pueden completar
-                if numeros_en_mensaje and any(word in body_lower for word in ['observacion', 'observación', 'obs', 'pendiente', 'incompleto']):
-                    numero_solicitado = numeros_en_mensaje[0]
-                    items_activos = estado_actual.get('items_activos', {})
-                    
-                    if str(numero_solicitado) in items_activos:
-                        item_info = items_activos[str(numero_solicitado)]
-                        
-                        if item_info['estado'] == 'en_espera':
-                            # Item válido con fotos ANTES, pedir observación
-                            estado_actual['estado_observacion'] = 'esperando_texto'
-                            estado_actual['item_observacion'] = numero_solicitado
-                            conversation_states[whatsapp_number] = estado_actual
-                            
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"📝 *REGISTRAR OBSERVACIÓN - ITEM #{numero_solicitado}*\n\n"
-                                f"El trabajo no se completó.\n\n"
-                                f"Escribe el motivo o situación:\n"
-                                f"Ejemplo: 'Tormenta, sin acceso al predio'\n"
-                                f"Ejemplo: 'Falta material, retomar próxima semana'"
-                            )
-                            return "OK"
-                        elif item_info['estado'] == 'completado':
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"ℹ️ El item #{numero_solicitado} ya está completado."
-                            )
-                            return "OK"
-                        else:
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"⚠️ El item #{numero_solicitado} aún no tiene fotos ANTES."
-                            )
-                            return "OK"
-                    else:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"❌ El item #{numero_solicitado} no está en tu lista actual.\n\n"
-                            f"Items activos: {', '.join(items_activos.keys())}"
-                        )
-                        return "OK"
-                
-                # Comando LISTO/FINALIZADO para completar el trabajo
-                if numeros_en_mensaje and any(word in body_lower for word in ['listo', 'finalizado', 'terminado', 'complete', 'completado']):
-                    numero_solicitado = numeros_en_mensaje[0]
-                    items_activos = estado_actual.get('items_activos', {})
-                    
-                    if str(numero_solicitado) in items_activos:
-                        item_info = items_activos[str(numero_solicitado)]
-                        
-                        if item_info['estado'] == 'en_espera':
-                            # Item válido, pedir fotos DESPUÉS
-                            estado_actual['item_actual_despues'] = numero_solicitado
-                            items_activos[str(numero_solicitado)]['estado'] = 'recibiendo_despues'
-                            conversation_states[whatsapp_number] = estado_actual
-                            
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"📸 *FOTOS DESPUÉS - ITEM #{numero_solicitado}*\n\n"
-                                f"Envía 3 fotos del estado DESPUÉS del cartel #{numero_solicitado}.\n\n"
-                                f"📷📷📷 Envía las 3 imágenes ahora."
-                            )
-                            return "OK"
-                        elif item_info['estado'] == 'completado':
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"ℹ️ El item #{numero_solicitado} ya está completado."
-                            )
-                            return "OK"
-                        else:
-                            whatsapp_service.enviar_mensaje(
-                                whatsapp_number,
-                                f"⚠️ El item #{numero_solicitado} aún no tiene fotos ANTES."
-                            )
-                            return "OK"
-                    else:
-                        whatsapp_service.enviar_mensaje(
-                            whatsapp_number,
-                            f"❌ El item #{numero_solicitado} no está en tu lista actual.\n\n"
-                            f"Items activos: {', '.join(items_activos.keys())}"
-                        )
-                        return "OK"
-            
-            # Capturar texto de observación cuando está en ese estado
-            if estado_actual.get('estado_observacion') == 'esperando_texto' and Body:
-                numero_item_obs = estado_actual.get('item_observacion')
-                items_activos = estado_actual.get('items_activos', {})
-                
-                if numero_item_obs and str(numero_item_obs) in items_activos:
-                    observacion_texto = Body.strip()
-                    
-                    # Registrar en OUTPUT con la observación
-                    cartel_info = items_activos[str(numero_item_obs)].get('cartel_info', {})
-                    registro_exitoso = sheets_service.registrar_trabajo_ecogas({
-                        'numero_item': numero_item_obs,
-                        'cartel_info': cartel_info,
-                        'observacion': observacion_texto
-                    })
-                    
-                    # Actualizar estado del item
-                    items_activos[str(numero_item_obs)]['estado'] = 'observado'
-                    items_activos[str(numero_item_obs)]['observacion'] = observacion_texto
-                    estado_actual['estado_observacion'] = None
-                    estado_actual['item_observacion'] = None
-                    
-                    # Contar items pendientes
-                    items_pendientes = [num for num, info in items_activos.items() if info['estado'] == 'en_espera']
-                    items_completados = [num for num, info in items_activos.items() if info['estado'] in ['completado', 'observado']]
-                    
-                    mensaje_final = (
-                        f"📝 *OBSERVACIÓN REGISTRADA - Item #{numero_item_obs}*\n\n"
-                        f"📋 Observación: {observacion_texto}\n\n"
-                    )
-                    
-                    if registro_exitoso:
-                        mensaje_final += f"📊 Registrado en planilla OUTPUT\n\n"
-                    else:
-                        mensaje_final += f"⚠️ Error al registrar en OUTPUT\n\n"
-                    
-                    mensaje_final += f"📊 *ESTADO GENERAL:*\n"
-                    mensaje_final += f"   ✅ Procesados: {len(items_completados)}\n"
-                    mensaje_final += f"   ⏳ Pendientes: {len(items_pendientes)}\n\n"
-                    
-                    if items_pendientes:
-                        mensaje_final += f"💡 Items pendientes: {', '.join(items_pendientes)}\n"
-                        mensaje_final += f"Envía:\n"
-                        mensaje_final += f"• *'listo [numero]'* si completaste el trabajo\n"
-                        mensaje_final += f"• *'observacion [numero]'* si no pudiste completarlo"
-                    else:
-                        mensaje_final += f"🎉 *TODOS LOS ITEMS PROCESADOS*\n\nExcelente trabajo."
-                        # Limpiar estado
-                        del conversation_states[whatsapp_number]
-                    
-                    whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
-                    
-                    # LOG
-                    sheets_service.registrar_log_whatsapp(
-                        numero_telefono=whatsapp_number,
-                        tipo_mensaje="enviado",
-                        contenido=f"📝 Observación registrada - Item #{numero_item_obs}",
-                        tiene_media=False,
-                        media_url="",
-                        item_relacionado=str(numero_item_obs),
-                        estado_flujo="observado" if not items_pendientes else "multiple_en_progreso",
-                        respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'} | Obs: {observacion_texto[:50]}"
-                    )
-                    
-                    if whatsapp_number in conversation_states:
-                        conversation_states[whatsapp_number] = estado_actual
-                    
-                    return "OK"
-            
-            return "OK"
-        
-        # ===== MODO SIMPLE (LEGACY) =====
-        if MediaUrl0 and estado_actual.get('estado') == 'esperando_imagenes_antes':
-            # Usuario está enviando imágenes ANTES del trabajo
-            print(f"📸 Recibiendo imagen ANTES del trabajo de {whatsapp_number}")
-            
-            # Descargar imagen
-            auth = (os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
-            image_data = await whatsapp_service.descargar_imagen(MediaUrl0, auth)
-            
-            if not image_data:
-                whatsapp_service.enviar_mensaje(whatsapp_number, "❌ Error al descargar la imagen. Intenta nuevamente.")
-                return "OK"
-            
-            # Agregar imagen a la lista
-            estado_actual['imagenes_antes'].append(image_data)
-            num_recibidas = len(estado_actual['imagenes_antes'])
-            numero_item = estado_actual['numero_item']
-            
-            if num_recibidas < 3:
-                # Pedir más imágenes
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"✅ Imagen {num_recibidas}/3 recibida para item #{numero_item}.\n\n📸 Envía la imagen {num_recibidas + 1} de 3."
-                )
-            else:
-                # Tenemos las 3 imágenes, guardarlas en Drive
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"✅ 3 imágenes recibidas.\n\n⏳ Guardando en Drive..."
-                )
-                
-                # Subir imágenes a carpeta Antes
-                urls_guardadas = []
-                item_formateado = str(numero_item).zfill(3)  # Formatear como 001, 002, etc.
-                for idx, img_data in enumerate(estado_actual['imagenes_antes'], 1):
-                    # Formato: XXX-001.jpg, XXX-002.jpg, XXX-003.jpg
-                    filename = f"{item_formateado}-{str(idx).zfill(3)}.jpg"
-                    url = sheets_service.subir_imagen_antes_despues(
-                        img_data, 
-                        filename, 
-                        numero_item, 
-                        'antes'
-                    )
-                    if url:
-                        urls_guardadas.append(url)
-                
-                # Actualizar estado
-                estado_actual['estado'] = 'en_trabajo'
-                estado_actual['urls_imagenes_antes'] = urls_guardadas
-                conversation_states[whatsapp_number] = estado_actual
-                
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"✅ *IMÁGENES GUARDADAS*\n\n"
-                    f"Las 3 imágenes del estado ANTES se han guardado correctamente en Drive.\n\n"
-                    f"🔧 Ahora puedes proceder con el trabajo en el cartel #{numero_item}.\n\n"
-                    f"💡 Cuando termines:\n\n"
-                    f"✅ Si completaste el trabajo:\n"
-                    f"   Envía *'listo'* o *'finalizado'*\n\n"
-                    f"📝 Si NO pudiste completarlo:\n"
-                    f"   Envía *'observacion'* o *'obs'*"
-                )
-                
-                # 📋 LOG: Registrar imágenes ANTES guardadas
-                sheets_service.registrar_log_whatsapp(
-                    numero_telefono=whatsapp_number,
-                    tipo_mensaje="enviado",
-                    contenido=f"3 imágenes ANTES guardadas para item #{numero_item}",
-                    tiene_media=True,
-                    media_url=f"{len(urls_guardadas)} imágenes en Drive",
-                    item_relacionado=str(numero_item),
-                    estado_flujo="en_trabajo",
-                    respuesta_bot="Esperando finalización del trabajo"
-                )
-            
-            return "OK"
-        
-        if MediaUrl0 and estado_actual.get('estado') == 'esperando_imagenes_despues':
-            # Usuario está enviando imágenes DESPUÉS del trabajo
-            print(f"📸 Recibiendo imagen DESPUÉS del trabajo de {whatsapp_number}")
-            
-            # Descargar imagen
-            auth = (os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
-            image_data = await whatsapp_service.descargar_imagen(MediaUrl0, auth)
-            
-            if not image_data:
-                whatsapp_service.enviar_mensaje(whatsapp_number, "❌ Error al descargar la imagen. Intenta nuevamente.")
-                return "OK"
-            
-            # Agregar imagen a la lista
-            if 'imagenes_despues' not in estado_actual:
-                estado_actual['imagenes_despues'] = []
-            
-            estado_actual['imagenes_despues'].append(image_data)
-            num_recibidas = len(estado_actual['imagenes_despues'])
-            numero_item = estado_actual['numero_item']
-            
-            if num_recibidas < 3:
-                # Pedir más imágenes
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"✅ Imagen {num_recibidas}/3 recibida para item #{numero_item}.\n\n📸 Envía la imagen {num_recibidas + 1} de 3."
-                )
-            else:
-                # Tenemos las 3 imágenes, guardarlas en Drive
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"✅ 3 imágenes recibidas.\n\n⏳ Guardando en Drive..."
-                )
-                
-                # Subir imágenes a carpeta Despues
-                urls_guardadas = []
-                item_formateado = str(numero_item).zfill(3)  # Formatear como 001, 002, etc.
-                for idx, img_data in enumerate(estado_actual['imagenes_despues'], 1):
-                    # Formato: XXX-004.jpg, XXX-005.jpg, XXX-006.jpg (idx+3 porque DESPUÉS es 004-006)
-                    filename = f"{item_formateado}-{str(idx + 3).zfill(3)}.jpg"
-                    url = sheets_service.subir_imagen_antes_despues(
-                        img_data, 
-                        filename, 
-                        numero_item, 
-                        'despues'
-                    )
-                    if url:
-                        urls_guardadas.append(url)
-                
-                # 🆕 REGISTRAR TRABAJO COMPLETADO EN PLANILLA OUTPUT
-                cartel_info = estado_actual.get('cartel_info', {})
-                registro_exitoso = sheets_service.registrar_trabajo_ecogas({
-                    'numero_item': numero_item,
-                    'cartel_info': cartel_info
-                })
-                
-                # Mensaje de confirmación
-                mensaje_final = (
-                    f"✅ *TRABAJO COMPLETADO*\n\n"
-                    f"Las 3 imágenes del estado DESPUÉS se han guardado correctamente en Drive.\n\n"
-                )
-                
-                if registro_exitoso:
-                    mensaje_final += f"📊 *Instalación EJECUTADA* registrada en planilla OUTPUT\n\n"
-                else:
-                    mensaje_final += f"⚠️ Advertencia: Error al registrar en planilla OUTPUT\n\n"
-                
-                mensaje_final += (
-                    f"📋 Cartel #{numero_item} - Trabajo finalizado\n"
-                    f"📸 Imágenes antes: {len(estado_actual.get('urls_imagenes_antes', []))}\n"
-                    f"📸 Imágenes después: {len(urls_guardadas)}\n"
-                    f"\n¡Excelente trabajo! 🎉"
-                )
-                
-                whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
-                
-                # 📋 LOG: Registrar trabajo completado
-                sheets_service.registrar_log_whatsapp(
-                    numero_telefono=whatsapp_number,
-                    tipo_mensaje="enviado",
-                    contenido=f"✅ Trabajo completado - Item #{numero_item}",
-                    tiene_media=True,
-                    media_url=f"Total: {len(urls_guardadas)} imágenes DESPUÉS guardadas",
-                    item_relacionado=str(numero_item),
-                    estado_flujo="completado",
-                    respuesta_bot=f"Registrado en OUTPUT: {'SÍ' if registro_exitoso else 'NO'}"
-                )
-                
-                # Limpiar estado
-                del conversation_states[whatsapp_number]
-            
-            return "OK"
-        
-        # Detectar comandos cuando hay fotos ANTES (en_trabajo)
-        if Body and estado_actual.get('estado') == 'en_trabajo':
-            body_lower = Body.lower().strip()
-            numero_item = estado_actual['numero_item']
-            
-            # Comando OBSERVACIÓN para trabajo incompleto
-            if any(word in body_lower for word in ['observacion', 'observación', 'obs', 'pendiente', 'incompleto']):
-                estado_actual['estado'] = 'esperando_observacion'
-                conversation_states[whatsapp_number] = estado_actual
-                
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"📝 *REGISTRAR OBSERVACIÓN - ITEM #{numero_item}*\n\n"
-                    f"El trabajo no se completó.\n\n"
-                    f"Escribe el motivo o situación:\n"
-                    f"Ejemplo: 'Tormenta, sin acceso al predio'\n"
-                    f"Ejemplo: 'Falta material, retomar próxima semana'"
-                )
-                return "OK"
-            
-            # Comando LISTO/FINALIZADO para completar el trabajo
-            elif any(word in body_lower for word in ['listo', 'finalizado', 'terminado', 'termine', 'completado']):
-                estado_actual['estado'] = 'esperando_imagenes_despues'
-                conversation_states[whatsapp_number] = estado_actual
-                
-                whatsapp_service.enviar_mensaje(
-                    whatsapp_number,
-                    f"📸 *DESPUÉS DE FINALIZAR EL TRABAJO*\n\n"
-                    f"Por favor, envía 3 fotos del estado del cartel #{numero_item} DESPUÉS de realizar el trabajo.\n\n"
-                    f"Envía las 3 imágenes ahora. 📷📷📷"
+def verificaciones_a_reintentar(limite: int = 20) -> List[int]:
+    """
+    IDs de verificaciones pendientes o con error que no agotaron los intentos y
+    cuyo último intento (o su creación, si nunca empezó) ya tiene
+    WORK_VERIFICATION_RETRY_SECONDS: las que quedaron a medias por un reinicio
+    o fallaron por Twilio/Gemini.
+    """
+    antes_de = datetime.utcnow() - timedelta(seconds=_VERIFICACION_REINTENTO_SEGUNDOS)
+    db = SessionLocal()
+    try:
+        filas = (
+            db.query(VerificacionTrabajo.id)
+            .filter(
+                VerificacionTrabajo.estado.in_(("pendiente", "error")),
+                VerificacionTrabajo.intentos < _VERIFICACION_MAX_INTENTOS,
+                or_(
+                    VerificacionTrabajo.fecha_intento < antes_de,
+                    VerificacionTrabajo.fecha_intento.is_(None) & (VerificacionTrabajo.fecha_creacion < antes_de)
                 )
-                return "OK"
-        
-        # Capturar texto de observación en modo simple
-        if Body and estado_actual.get('estado') == 'esperando_observacion':
-            observacion_texto = Body.strip()
-            numero_item = estado_actual['numero_item']
-            cartel_info = estado_actual.get('cartel_info', {})
-            
-            # Registrar en OUTPUT con la observación
-            registro_exitoso = sheets_service.registrar_trabajo_ecogas({
-                'numero_item': numero_item,
-                'cartel_info': cartel_info,
-                'observacion': observacion_texto
-            })
-            
-            # Mensaje de confirmación
-            mensaje_final = (
-                f"📝 *OBSERVACIÓN REGISTRADA*\n\n"
-                f"📋 Item #{numero_item}\n"
-                f"📝 Observación: {observacion_texto}\n\n"
-            )
-            
-            if registro_exitoso:
-                mensaje_final += f"📊 Registrado en planilla OUTPUT\n"
-            else:
-                mensaje_final += f"⚠️ Error al registrar en OUTPUT\n"
-            
-            mensaje_final += f"\nPuedes continuar con otro cartel enviando el número."
-            
-            whatsapp_service.enviar_mensaje(whatsapp_number, mensaje_final)
-            
-            # LOG
-            sheets_service.registrar_log_whatsapp(
-                numero_telefono=whatsapp_number,
-                tipo_mensaje="enviado",
-                contenido=f"📝 Observación registrada - Item #{numero_item}",
-                tiene_media=False,
-                media_url="",
-                item_relacionado=str(numero_item),
-                estado_flujo="observado",
-                respuesta_bot=f"OUTPUT: {'SÍ' if registro_exitoso else 'NO'} | Obs: {observacion_texto[:50]}"
-            )
-            
-            # Mantener estado para permitir completar el trabajo después
-            estado_actual['estado'] = 'observado'
-            estado_actual['observacion_registrada'] = observacion_texto
-            conversation_states[whatsapp_number] = estado_actual
-            
-            print(f"🔵 DEBUG: Estado guardado después de observación:")
-            print(f"   - numero_item: {numero_item}")
-            print(f"   - estado: {estado_actual['estado']}")
-            print(f"   - observacion_registrada: {observacion_texto}")
-            print(f"   - Todas las claves: {estado_actual.keys()}")
-            
-            return "OK"
-        
-        # Si el mensaje no tiene número de item, dar instrucciones
-        if Body and not re.search(r'\d+', Body):
-            whatsapp_service.enviar_mensaje(
-                whatsapp_number,
-                "👋 ¡Hola! Para trabajar en carteles:\n\n"
-                "📝 *UN CARTEL:* Envía el número\n"
-                "   Ejemplo: '190' o 'item 190'\n\n"
-                "📝 *MÚLTIPLES CARTELES:* Envía varios números\n"
-                "   Ejemplo: '277, 278, 279, 290'\n\n"
-                "💡 Cuando tengas las fotos ANTES:\n\n"
-                "✅ Si completaste el trabajo:\n"
-                "   Envía *'listo [numero]'* o *'finalizado [numero]'*\n\n"
-                "📝 Si NO pudiste completarlo:\n"
-                "   Envía *'observacion [numero]'* o *'obs [numero]'*\n"
-                "   Te pediré el motivo (ej: tormenta, sin acceso)"
             )
-        return "OK"
-        
-    except Exception as e:
-        print(f"Error en webhook: {e}")
-        return "OK"
+            .order_by(VerificacionTrabajo.id)
+            .limit(limite)
+            .all()
+        )
+        return [fila.id for fila in filas]
+    finally:
+        db.close()
+
+
+async def barrer_verificaciones():
+    """
+    Retoma las verificaciones que la tarea en segundo plano no terminó (reinicio
+    del worker, error de descarga o de Gemini). Corre al arrancar y luego cada
+    WORK_VERIFICATION_RETRY_SECONDS.
+    """
+    await container.asegurar()
+    while True:
+        try:
+            for verificacion_id in await asyncio.to_thread(verificaciones_a_reintentar):
+                await verificar_trabajo(verificacion_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Error en el barrido de verificaciones: {e}")
+        await asyncio.sleep(_VERIFICACION_REINTENTO_SEGUNDOS)
+
+
+@app.on_event("startup")
+async def iniciar_barrido_verificaciones():
+    if _VERIFICACION_ACTIVA:
+        asyncio.create_task(barrer_verificaciones())
 
 
 async def procesar_solicitud_cartel(
@@ -1264,14 +1628,17 @@ async def procesar_solicitud_cartel(
     try:
         
         # Obtener todos los carteles primero para encontrar el más cercano
-        carteles_ecogas = sheets_service.obtener_carteles_ecogas()
+        # (carteles y versión de la misma lectura del catálogo)
+        catalogo = await asyncio.to_thread(sheets_service.catalogo.snapshot)
+        carteles_ecogas = catalogo.carteles
         
         # Buscar el cartel más cercano según la ubicación
         cartel_cercano = geo_service.encontrar_cartel_mas_cercano(
             latitud, 
             longitud, 
             carteles_ecogas,
-            radio_max_km=5.0
+            radio_max_km=5.0,
+            version=catalogo.version
         )
         
         # Subir imagen a Google Drive en carpeta del item
@@ -1280,12 +1647,12 @@ async def procesar_solicitud_cartel(
             numero_item = cartel_cercano.get('numero', '0')
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"cartel_{numero_item}_{operario}_{timestamp}.jpg"
-            drive_url = sheets_service.subir_imagen_a_drive(image_data, filename, numero_item)
+            drive_url = await asyncio.to_thread(sheets_service.subir_imagen_a_drive, image_data, filename, numero_item)
             
             if drive_url:
                 print(f"✅ Imagen subida a Drive: {drive_url}")
                 # Actualizar enlace de carpeta en sheet
-                sheets_service.actualizar_enlace_carpeta_item(numero_item)
+                await asyncio.to_thread(sheets_service.actualizar_enlace_carpeta_item, numero_item)
             else:
                 print("⚠️ No se pudo subir la imagen a Drive")
         
@@ -1315,7 +1682,7 @@ async def procesar_solicitud_cartel(
             whatsapp_service.enviar_mensaje(whatsapp_number, respuesta)
             
             # Obtener y enviar las imágenes del cartel desde Drive
-            imagenes = sheets_service.obtener_imagenes_cartel(numero)
+            imagenes = await asyncio.to_thread(sheets_service.obtener_imagenes_cartel, numero)
             if imagenes:
                 whatsapp_service.enviar_mensaje(
                     whatsapp_number,
@@ -1326,10 +1693,10 @@ async def procesar_solicitud_cartel(
                     nombre = imagen.get('nombre', f'imagen_{idx}')
                     if url:
                         whatsapp_service.enviar_imagen(whatsapp_number, url, f"📷 {nombre}")
-                        time.sleep(1)  # Pequeña pausa entre imágenes
+                        await asyncio.sleep(1)  # Pequeña pausa entre imágenes
                 
                 # Pausa adicional para asegurar que todas las imágenes se envíen
-                time.sleep(2)
+                await asyncio.sleep(2)
             else:
                 whatsapp_service.enviar_mensaje(
                     whatsapp_number,
@@ -1345,12 +1712,15 @@ async def procesar_solicitud_cartel(
             )
             
             # Actualizar estado de conversación
-            conversation_states[whatsapp_number] = {
-                'estado': 'esperando_imagenes_antes',
-                'numero_item': numero,
-                'imagenes_antes': [],
-                'cartel_info': cartel_cercano
-            }
+            conversation_store.guardar(
+                whatsapp_number,
+                estado_simple(
+                    'esperando_imagenes_antes',
+                    numero,
+                    catalogo.version,
+                    distancia_km=distancia
+                )
+            )
             
             # Registrar en la base de datos
             registro = RegistroCartel(
@@ -1361,16 +1731,18 @@ async def procesar_solicitud_cartel(
                 estado="en_proceso",
                 latitud=latitud,
                 longitud=longitud,
-                direccion=geo_service.obtener_direccion(latitud, longitud),
+                direccion=geo_service.direccion_local(latitud, longitud, carteles_ecogas, catalogo.version),
                 foto_url=drive_url,
                 whatsapp_number=whatsapp_number,
                 notas=f"Cartel #{numero}, Distancia: {distancia} km"
             )
             db.add(registro)
             db.commit()
+            if registro.direccion is None:
+                completar_direccion(registro.id, latitud, longitud)
             
             # Registrar en planilla ECOGAS
-            sheets_service.registrar_trabajo_ecogas({
+            await asyncio.to_thread(sheets_service.registrar_trabajo_ecogas, {
                 'operario': operario,
                 'tipo_cartel': tipo,
                 'gasoducto': gasoducto,
@@ -1400,13 +1772,15 @@ async def procesar_solicitud_cartel(
                 estado="requiere_revision",
                 latitud=latitud,
                 longitud=longitud,
-                direccion=geo_service.obtener_direccion(latitud, longitud),
+                direccion=geo_service.direccion_local(latitud, longitud, carteles_ecogas, catalogo.version),
                 foto_url=drive_url,
                 whatsapp_number=whatsapp_number,
                 notas="No se encontró cartel cercano - Requiere revisión manual"
             )
             db.add(registro)
             db.commit()
+            if registro.direccion is None:
+                completar_direccion(registro.id, latitud, longitud)
             
             # Alertar al administrador
             whatsapp_service.enviar_alerta_admin(
@@ -1472,27 +1846,101 @@ async def actualizar_estado_cartel(
 @app.get("/stock")
 async def obtener_stock():
     """
-    Obtiene el stock actual desde Google Sheets.
+    Obtiene el stock actual (saldo materializado desde Google Sheets + movimientos locales).
     """
-    stock = sheets_service.obtener_stock()
+    stock = await asyncio.to_thread(sheets_service.obtener_balance_stock)
     return {"stock": stock, "total_items": len(stock)}
 
 
 @app.get("/stock/alertas", response_model=List[StockAlert])
 async def obtener_alertas_stock(threshold: int = 10):
     """
-    Obtiene alertas de stock bajo.
+    Obtiene alertas de stock bajo (lectura en memoria del saldo materializado).
     """
-    return sheets_service.verificar_stock_bajo(threshold)
+    return await asyncio.to_thread(sheets_service.verificar_stock_bajo, threshold)
 
 
 @app.get("/acciones-autorizadas")
 async def obtener_acciones_autorizadas():
     """
-    Obtiene la lista de acciones viales autorizadas.
+    Obtiene la lista de acciones viales autorizadas (snapshot en memoria; la
+    planilla se relee en segundo plano cuando vence o cambia en Drive).
+    """
+    reglas = await asyncio.to_thread(sheets_service.reglas_autorizacion)
+    return {"acciones": reglas.acciones, "total": len(reglas.acciones), "version": reglas.version}
+
+
+@app.get("/zonas")
+async def obtener_zonas():
+    """
+    Zonas de la pestaña de polígonos y cantidad de carteles del catálogo en
+    cada una (asignación de todo el catálogo en una sola pasada).
+    """
+    poligonos, version = await asyncio.to_thread(sheets_service.obtener_poligonos_con_version)
+    catalogo = await asyncio.to_thread(sheets_service.catalogo.snapshot)
+    asignacion = geo_service.asignar_zonas(catalogo.carteles, poligonos, version)
+    
+    por_zona = {zona.nombre: 0 for zona in geo_service.indice_zonas(poligonos, version).zonas}
+    for zona in asignacion.values():
+        if zona is not None:
+            por_zona[zona] += 1
+    return {
+        "zonas": por_zona,
+        "total_zonas": len(por_zona),
+        "carteles_con_coordenadas": len(asignacion),
+        "carteles_sin_zona": sum(1 for zona in asignacion.values() if zona is None)
+    }
+
+
+@app.get("/zonas/ubicar")
+async def ubicar_en_zona(latitud: float, longitud: float):
+    """
+    Zona que contiene las coordenadas (None si no cae en ninguna).
+    """
+    poligonos, version = await asyncio.to_thread(sheets_service.obtener_poligonos_con_version)
+    return {
+        "latitud": latitud,
+        "longitud": longitud,
+        "zona": geo_service.zona_de(latitud, longitud, poligonos, version),
+        "en_region": geo_service.validar_en_region_ecogas(latitud, longitud, poligonos, version)
+    }
+
+
+@app.get("/verificaciones")
+async def obtener_verificaciones(
+    numero_item: Optional[str] = None,
+    veredicto: Optional[str] = None,
+    limite: int = 100,
+    db: Session = Depends(get_db)
+):
+    """
+    Verificaciones ANTES/DESPUÉS de los trabajos, las más recientes primero.
     """
-    acciones = sheets_service.obtener_acciones_autorizadas()
-    return {"acciones": acciones, "total": len(acciones)}
+    query = db.query(VerificacionTrabajo)
+    
+    if numero_item:
+        query = query.filter(VerificacionTrabajo.numero_item == numero_item)
+    
+    if veredicto:
+        query = query.filter(VerificacionTrabajo.veredicto == veredicto)
+    
+    return [
+        {
+            "id": v.id,
+            "numero_item": v.numero_item,
+            "whatsapp_number": v.whatsapp_number,
+            "estado": v.estado,
+            "intentos": v.intentos,
+            "veredicto": v.veredicto,
+            "trabajo_realizado": v.trabajo_realizado,
+            "confianza": v.confianza,
+            "razon": v.razon,
+            "detalles": json.loads(v.resultado).get("detalles") if v.resultado else None,
+            "fecha_creacion": v.fecha_creacion,
+            "fecha_analisis": v.fecha_analisis
+        }
+        for v in query.order_by(VerificacionTrabajo.fecha_creacion.desc()).limit(limite).all()
+    ]
 
 
 @app.get("/health")
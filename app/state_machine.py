@@ -0,0 +1,206 @@
+"""
+Máquina de estados de las conversaciones de WhatsApp.
+
+Cada transición se declara con la clave (modo, estado, evento) y opcionalmente
+una intención (palabras clave) o una condición; el webhook solo arma el
+Mensaje y llama a despachar(). Las acciones (enviar mensajes, subir fotos,
+registrar en OUTPUT) viven en app/main.py.
+
+Modos y estados:
+- simple: el valor de estado['estado'] ('inicial' si no hay conversación).
+- multiple: varios sub-estados pueden estar activos a la vez (por ejemplo,
+  recibiendo las fotos DESPUÉS de un ítem mientras se espera la confirmación
+  de llegada a otro); estados_candidatos() los devuelve en orden de prioridad.
+  'en_progreso' está siempre activo.
+
+Eventos: 'imagen' (MediaUrl0), 'ubicacion' (Latitude/Longitude de una
+ubicación compartida) y 'texto' (Body no vacío). Un mensaje con foto y texto
+genera los dos eventos.
+
+Para cada estado candidato, en orden, se prueban los eventos del mensaje y las
+transiciones registradas para (modo, estado, evento) en orden de registro: se
+ejecuta la primera cuya intención y condición se cumplen. ESTADO_CUALQUIERA
+registra transiciones que aplican en todos los estados del modo (se prueban
+al final).
+"""
+
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from services import metrics
+
+ESTADO_CUALQUIERA = "*"
+
+# Estados del modo simple en los que un número no inicia una sesión nueva
+ESTADOS_EN_CURSO = frozenset({
+    'esperando_imagenes_antes',
+    'en_trabajo',
+    'esperando_imagenes_despues',
+    'esperando_observacion',
+})
+
+_NUMEROS = re.compile(r'\d+')
+
+
+class Intencion:
+    """
+    Palabras clave compiladas en una sola expresión regular. Coincide si
+    alguna aparece en cualquier parte del texto (misma semántica que
+    `any(palabra in texto for palabra in palabras)`).
+    """
+
+    def __init__(self, nombre: str, palabras: Iterable[str]):
+        self.nombre = nombre
+        self.palabras = tuple(palabras)
+        self._patron = re.compile("|".join(re.escape(p) for p in sorted(set(self.palabras), key=len, reverse=True)))
+
+    def coincide(self, texto: str) -> bool:
+        return bool(texto) and self._patron.search(texto) is not None
+
+    def __repr__(self) -> str:
+        return f"Intencion({self.nombre})"
+
+
+AFIRMATIVO = Intencion("afirmativo", ['si', 'sí', 'yes', 'ok', 'dale', 'llegue', 'llegué', 'estoy'])
+NEGATIVO = Intencion("negativo", ['no', 'aun no', 'todavia no', 'todavía no', 'negativo'])
+OBSERVACION = Intencion("observacion", ['observacion', 'observación', 'obs', 'pendiente', 'incompleto'])
+LISTO = Intencion("listo", ['listo', 'finalizado', 'terminado', 'termine', 'completado'])
+# En modo múltiple el comando lleva número de ítem ("listo 278")
+LISTO_ITEM = Intencion("listo_item", ['listo', 'finalizado', 'terminado', 'complete', 'completado'])
+
+
+class Mensaje(NamedTuple):
+    """Mensaje entrante junto con el estado de la conversación al recibirlo."""
+    numero: str                    # remitente (whatsapp:+549...)
+    texto: str                     # Body sin modificar
+    texto_normalizado: str         # Body en minúsculas y sin espacios extremos
+    numeros: List[str]             # números presentes en el texto, en orden
+    media_url: Optional[str]
+    estado: Dict[str, Any]
+    ubicacion: Optional[Tuple[float, float]] = None   # (lat, lon) si compartió su ubicación
+
+    @property
+    def tiene_numero(self) -> bool:
+        return bool(self.numeros)
+
+
+def crear_mensaje(
+    numero: str,
+    texto: str,
+    media_url: Optional[str],
+    estado: Dict[str, Any],
+    ubicacion: Optional[Tuple[float, float]] = None
+) -> Mensaje:
+    texto = texto or ""
+    return Mensaje(numero, texto, texto.lower().strip(), _NUMEROS.findall(texto), media_url, estado, ubicacion)
+
+
+def eventos_de(mensaje: Mensaje) -> List[str]:
+    eventos = []
+    if mensaje.media_url:
+        eventos.append('imagen')
+    if mensaje.ubicacion:
+        eventos.append('ubicacion')
+    if mensaje.texto:
+        eventos.append('texto')
+    return eventos
+
+
+def estados_candidatos(estado: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """Modo de la conversación y sus estados activos, en orden de prioridad."""
+    if estado.get('modo') != 'multiple':
+        return 'simple', [estado.get('estado') or 'inicial', ESTADO_CUALQUIERA]
+
+    items_activos = estado.get('items_activos', {})
+
+    def item_en(clave: str, estado_item: str) -> bool:
+        numero = estado.get(clave)
+        return bool(numero) and items_activos.get(str(numero), {}).get('estado') == estado_item
+
+    estados = []
+    if estado.get('estado_confirmacion') == 'esperando':
+        estados.append('esperando_confirmacion')
+    if item_en('item_actual_antes', 'recibiendo_antes'):
+        estados.append('recibiendo_antes')
+    if item_en('item_actual_despues', 'recibiendo_despues'):
+        estados.append('recibiendo_despues')
+    estados.append('en_progreso')
+    if estado.get('estado_observacion') == 'esperando_texto':
+        estados.append('esperando_observacion')
+    estados.append(ESTADO_CUALQUIERA)
+    return 'multiple', estados
+
+
+Accion = Callable[[Mensaje], Awaitable[Any]]
+
+
+class Transicion(NamedTuple):
+    nombre: str
+    modo: str
+    estado: str
+    evento: str
+    accion: Accion
+    intencion: Optional[Intencion] = None
+    condicion: Optional[Callable[[Mensaje], bool]] = None
+
+    def aplica(self, mensaje: Mensaje) -> bool:
+        if self.intencion is not None and not self.intencion.coincide(mensaje.texto_normalizado):
+            return False
+        return self.condicion is None or self.condicion(mensaje)
+
+
+class MaquinaEstados:
+    """Tabla (modo, estado, evento) -> transiciones, con latencia por transición."""
+
+    def __init__(self):
+        self._tabla: Dict[Tuple[str, str, str], List[Transicion]] = {}
+
+    def agregar(self, transicion: Transicion):
+        if any(t.nombre == transicion.nombre for t in self.transiciones()):
+            raise ValueError(f"Transición duplicada: {transicion.nombre}")
+        self._tabla.setdefault((transicion.modo, transicion.estado, transicion.evento), []).append(transicion)
+
+    def transicion(
+        self,
+        modo: str,
+        estado: str,
+        evento: str,
+        intencion: Optional[Intencion] = None,
+        condicion: Optional[Callable[[Mensaje], bool]] = None,
+        nombre: Optional[str] = None
+    ):
+        """Decorador que registra la acción como transición de (modo, estado, evento)."""
+        def registrar(accion: Accion) -> Accion:
+            self.agregar(Transicion(nombre or accion.__name__.lstrip('_'), modo, estado, evento, accion, intencion, condicion))
+            return accion
+        return registrar
+
+    def resolver(self, mensaje: Mensaje) -> Optional[Transicion]:
+        """Transición que corresponde al mensaje, o None si ninguna aplica."""
+        modo, estados = estados_candidatos(mensaje.estado)
+        eventos = eventos_de(mensaje)
+        for estado in estados:
+            for evento in eventos:
+                for transicion in self._tabla.get((modo, estado, evento), ()):
+                    if transicion.aplica(mensaje):
+                        return transicion
+        return None
+
+    async def despachar(self, mensaje: Mensaje) -> Optional[str]:
+        """Ejecuta la transición del mensaje. Devuelve su nombre (None si el mensaje se ignora)."""
+        transicion = self.resolver(mensaje)
+        if transicion is None:
+            metrics.TRANSICIONES.labels("sin_transicion").inc()
+            return None
+
+        inicio = time.perf_counter()
+        try:
+            await transicion.accion(mensaje)
+        finally:
+            metrics.TRANSICION_LATENCIA.labels(transicion.nombre).observe(time.perf_counter() - inicio)
+            metrics.TRANSICIONES.labels(transicion.nombre).inc()
+        return transicion.nombre
+
+    def transiciones(self) -> List[Transicion]:
+        return [t for lista in self._tabla.values() for t in lista]
@@ -0,0 +1,95 @@
+"""
+Haversine escalar vs. vectorizado (services/geolocation.py).
+
+Compara, con puntos aleatorios sobre la zona de los gasoductos:
+- uno a muchos: un bucle con haversine_km contra distancias_desde
+- matriz: doble bucle con haversine_km contra matriz_distancias
+- más cercano: recorrido lineal con haversine_km contra IndiceEspacial.cercanos
+
+Uso (desde la raíz del repo):
+    python benchmarks/haversine.py
+    python benchmarks/haversine.py --puntos 1000 100000 --matriz 300 --repeticiones 3
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.geolocation import distancias_desde, haversine_km, matriz_distancias
+from services.indice_espacial import IndiceEspacial
+
+# Caja aproximada de Córdoba, donde están los carteles del catálogo
+LATITUDES = (-35.0, -29.5)
+LONGITUDES = (-65.8, -62.0)
+
+
+def puntos_aleatorios(n: int, semilla: int) -> List[tuple]:
+    generador = random.Random(semilla)
+    return [(generador.uniform(*LATITUDES), generador.uniform(*LONGITUDES)) for _ in range(n)]
+
+
+def medir(funcion: Callable[[], object], repeticiones: int) -> float:
+    """Mejor tiempo (segundos) de `repeticiones` corridas."""
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor
+
+
+def imprimir(nombre: str, escalar: float, vectorizado: float):
+    print(
+        f"   {nombre:<28} escalar {escalar * 1000:>9.2f} ms   "
+        f"numpy {vectorizado * 1000:>8.2f} ms   x{escalar / vectorizado:,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de haversine escalar vs. NumPy")
+    parser.add_argument("--puntos", type=int, nargs="*", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--matriz", type=int, default=500, help="Lado de la matriz de distancias")
+    parser.add_argument("--consultas", type=int, default=200, help="Consultas de más cercano por tamaño")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    lat, lon = -31.42, -64.18
+
+    print("📏 Uno a muchos (distancia de un punto a todo el catálogo)")
+    for n in args.puntos:
+        puntos = puntos_aleatorios(n, semilla=n)
+        lats = [p[0] for p in puntos]
+        lons = [p[1] for p in puntos]
+        escalar = medir(lambda: [haversine_km(lat, lon, a, b) for a, b in puntos], args.repeticiones)
+        vectorizado = medir(lambda: distancias_desde(lat, lon, lats, lons), args.repeticiones)
+        imprimir(f"n={n:,}", escalar, vectorizado)
+
+    print(f"🧮 Matriz de distancias {args.matriz}x{args.matriz}")
+    puntos = puntos_aleatorios(args.matriz, semilla=1)
+    lats = [p[0] for p in puntos]
+    lons = [p[1] for p in puntos]
+    escalar = medir(lambda: [[haversine_km(a, b, c, d) for c, d in puntos] for a, b in puntos], 1)
+    vectorizado = medir(lambda: matriz_distancias(lats, lons), args.repeticiones)
+    imprimir(f"{args.matriz}x{args.matriz}", escalar, vectorizado)
+
+    print(f"📍 Cartel más cercano ({args.consultas} consultas)")
+    for n in args.puntos:
+        puntos = puntos_aleatorios(n, semilla=n)
+        consultas = puntos_aleatorios(args.consultas, semilla=-n)
+        indice = IndiceEspacial([(a, b, i) for i, (a, b) in enumerate(puntos)])
+        # El recorrido lineal se mide sobre pocas consultas y se escala
+        muestra = consultas[:max(1, min(len(consultas), 2_000_000 // n))]
+        escalar = medir(
+            lambda: [min(haversine_km(a, b, c, d) for c, d in puntos) for a, b in muestra], 1
+        ) * len(consultas) / len(muestra)
+        vectorizado = medir(lambda: [indice.cercanos(a, b) for a, b in consultas], args.repeticiones)
+        imprimir(f"n={n:,}", escalar, vectorizado)
+
+
+if __name__ == "__main__":
+    main()
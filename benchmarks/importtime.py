@@ -0,0 +1,125 @@
+"""
+Perfil de arranque: tiempo de importación y memoria de los módulos de entrada.
+
+Cada módulo se importa en un intérprete nuevo con `python -X importtime`, y
+se reporta:
+- tiempo total de la importación (wall clock)
+- RSS máximo del proceso después de importar
+- los paquetes con mayor tiempo acumulado (cumulative de -X importtime)
+
+Uso (desde la raíz del repo):
+    python benchmarks/importtime.py                        # API y capa de servicios del dashboard
+    python benchmarks/importtime.py app.main --top 30
+    python benchmarks/importtime.py --json > arranque.json
+
+Para comparar antes/después de un cambio, correrlo en ambos commits con el
+mismo entorno: la primera corrida tras instalar dependencias incluye la
+compilación de .pyc y no es representativa.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# API (uvicorn app.main:app) y lo que importan los dashboards de Streamlit además de streamlit/pandas
+MODULOS_POR_DEFECTO = [
+    "app.main",
+    "services.google_sheets",
+    "agent.gemini_agent",
+    "services.whatsapp",
+]
+
+_LINEA = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+_SCRIPT = """
+import json, resource, sys, time
+inicio = time.perf_counter()
+import {modulo}
+segundos = time.perf_counter() - inicio
+sys.stdout.write(json.dumps({{
+    "segundos": segundos,
+    "rss_max_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modulos_cargados": len(sys.modules),
+}}))
+"""
+
+
+def perfilar(modulo: str) -> Dict[str, Any]:
+    """Importa `modulo` en un proceso aparte y devuelve el perfil."""
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SCRIPT.format(modulo=modulo)],
+        cwd=RAIZ,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [RAIZ, os.getenv("PYTHONPATH")]))},
+    )
+    if resultado.returncode != 0:
+        error = resultado.stderr.strip().splitlines()[-1] if resultado.stderr.strip() else "sin salida"
+        return {"modulo": modulo, "error": error}
+
+    importaciones = []
+    for linea in resultado.stderr.splitlines():
+        match = _LINEA.match(linea)
+        if match:
+            propio, acumulado, sangria, nombre = match.groups()
+            importaciones.append({
+                "paquete": nombre,
+                "propio_ms": int(propio) / 1000,
+                "acumulado_ms": int(acumulado) / 1000,
+                # -X importtime indenta dos espacios por nivel de anidamiento
+                "nivel": (len(sangria) - 1) // 2,
+            })
+
+    perfil = json.loads(resultado.stdout)
+    perfil["modulo"] = modulo
+    perfil["importaciones"] = importaciones
+    return perfil
+
+
+def mas_costosos(importaciones: List[Dict[str, Any]], top: int) -> List[Dict[str, Any]]:
+    """
+    Paquetes raíz (gspread, twilio, google, ...) por tiempo acumulado. Se toma
+    la importación más costosa de cada raíz, que es la que cargó el paquete.
+    """
+    raices: Dict[str, float] = {}
+    for imp in importaciones:
+        raiz = imp["paquete"].split(".")[0]
+        raices[raiz] = max(raices.get(raiz, 0.0), imp["acumulado_ms"])
+    ordenados = sorted(raices.items(), key=lambda par: par[1], reverse=True)
+    return [{"paquete": nombre, "acumulado_ms": round(ms, 1)} for nombre, ms in ordenados[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perfil de importación de los módulos de entrada")
+    parser.add_argument("modulos", nargs="*", default=MODULOS_POR_DEFECTO)
+    parser.add_argument("--top", type=int, default=15, help="Paquetes más costosos a listar por módulo")
+    parser.add_argument("--json", action="store_true", help="Salida en JSON (incluye el detalle completo)")
+    args = parser.parse_args()
+
+    perfiles = [perfilar(modulo) for modulo in args.modulos]
+
+    if args.json:
+        print(json.dumps(perfiles, indent=2, ensure_ascii=False))
+        return
+
+    for perfil in perfiles:
+        print("=" * 70)
+        if "error" in perfil:
+            print(f"❌ {perfil['modulo']}: {perfil['error']}")
+            continue
+        print(
+            f"📦 {perfil['modulo']}: {perfil['segundos'] * 1000:.0f} ms, "
+            f"RSS máx {perfil['rss_max_mb']:.1f} MB, {perfil['modulos_cargados']} módulos"
+        )
+        for fila in mas_costosos(perfil["importaciones"], args.top):
+            print(f"   {fila['acumulado_ms']:>9.1f} ms  {fila['paquete']}")
+
+
+if __name__ == "__main__":
+    main()
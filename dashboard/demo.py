@@ -11,6 +11,8 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))
 
 from services.google_sheets import GoogleSheetsService
+from services.quota_gateway import Prioridad
+from services.geolocation import distancias_desde
 
 # Configuración de la página
 st.set_page_config(
@@ -96,6 +98,8 @@ def init_services():
     """Inicializa el servicio de Google Sheets"""
     try:
         sheets_service = GoogleSheetsService()
+        # Los refrescos del dashboard ceden la cuota de Google a las escrituras del API
+        sheets_service.quota.prioridad_lecturas = Prioridad.BAJA
         return sheets_service
     except Exception as e:
         st.sidebar.error(f"Error al inicializar Google Sheets: {str(e)}")
@@ -642,18 +646,21 @@ elif modo == "💬 WhatsApp Demo":
                 lat_operario = float(coords[0].strip())
                 lon_operario = float(coords[1].strip())
                 
-                # Encontrar cartel más cercano
+                # Encontrar cartel más cercano (haversine vectorizado sobre todo el catálogo)
                 cartel_cercano = None
                 distancia_min = float('inf')
                 
-                for cartel in carteles:
-                    if cartel.get('latitud') and cartel.get('longitud'):
-                        lat_c = cartel['latitud']
-                        lon_c = cartel['longitud']
-                        distancia = ((lat_c - lat_operario)**2 + (lon_c - lon_operario)**2)**0.5
-                        if distancia < distancia_min:
-                            distancia_min = distancia
-                            cartel_cercano = cartel
+                con_coordenadas = [c for c in carteles if c.get('latitud') and c.get('longitud')]
+                if con_coordenadas:
+                    distancias = distancias_desde(
+                        lat_operario,
+                        lon_operario,
+                        [c['latitud'] for c in con_coordenadas],
+                        [c['longitud'] for c in con_coordenadas]
+                    )
+                    indice_min = int(distancias.argmin())
+                    cartel_cercano = con_coordenadas[indice_min]
+                    distancia_min = float(distancias[indice_min])
                 
                 if cartel_cercano:
                     from datetime import datetime
@@ -662,7 +669,7 @@ elif modo == "💬 WhatsApp Demo":
                     numero = cartel_cercano.get('numero', 'N/A')
                     tipo = cartel_cercano.get('tipo_cartel', 'N/A')
                     ramal = cartel_cercano.get('gasoducto_ramal', 'N/A')
-                    distancia_km = round(distancia_min * 111, 1)  # Aproximación a km
+                    distancia_km = round(distancia_min, 1)
                     
                     st.session_state.historial_chat.append(f"""
                     <div class='message-bot'>
@@ -727,7 +734,7 @@ elif modo == "💬 WhatsApp Demo":
             **3️⃣ Geolocalización**
             - Procesa coordenadas GPS
             - Busca cartel más cercano en planilla
-            - Calcula distancia euclidiana
+            - Calcula distancia real (haversine)
             
             **4️⃣ Registro Automático**
             - Actualiza estado en Google Sheets
@@ -15,6 +15,7 @@ sys.path.append(str(Path(__file__).parent.parent))
 sys.path.append(str(Path(__file__).parent))
 
 from services.google_sheets import GoogleSheetsService
+from services.quota_gateway import Prioridad
 from i18n import t, language_selector
 
 # ==================== SISTEMA DE AUTENTICACIÓN ====================
@@ -383,6 +384,8 @@ def init_services():
     """Inicializa el servicio de Google Sheets"""
     try:
         sheets_service = GoogleSheetsService()
+        # Los refrescos del dashboard ceden la cuota de Google a las escrituras del API
+        sheets_service.quota.prioridad_lecturas = Prioridad.BAJA
         return sheets_service
     except Exception as e:
         st.error(t("init_sheets_error", error=str(e)))
@@ -526,12 +529,12 @@ def get_empleados_cached():
             return []
     return []
 
-@st.cache_data(ttl=180)
+@st.cache_data(ttl=30)  # Lectura en memoria del saldo materializado del servicio
 def get_stock_cached():
     """Obtiene stock con cache"""
     if sheets_service:
         try:
-            return sheets_service.obtener_stock()
+            return sheets_service.obtener_balance_stock()
         except Exception as e:
             st.error(t("error_get_stock", error=str(e)))
             return {}
@@ -557,11 +560,8 @@ def get_items_ejecutados_cached():
     """
     if sheets_service:
         try:
-            output_sheet = sheets_service._get_output_sheet()
-            if output_sheet:
-                worksheet = output_sheet.get_worksheet(0)
-                all_values = worksheet.get_all_values()
-                
+            all_values = sheets_service.obtener_output()
+            if all_values:
                 items_ejecutados = {}  # Diccionario: {num_item: fecha}
                 # Procesar filas con datos (después de fila 10)
                 for i, row in enumerate(all_values[10:], start=11):
@@ -599,11 +599,8 @@ def get_items_en_proceso_cached():
             
             # PARTE 1: Items con observaciones personalizadas en OUTPUT (no completados)
             try:
-                output_sheet = sheets_service._get_output_sheet()
-                if output_sheet:
-                    worksheet = output_sheet.get_worksheet(0)
-                    all_values = worksheet.get_all_values()
-                    
+                all_values = sheets_service.obtener_output()
+                if all_values:
                     # Procesar filas con datos (después de fila 10)
                     for i, row in enumerate(all_values[10:], start=11):
                         if len(row) > 12:
@@ -626,16 +623,7 @@ def get_items_en_proceso_cached():
                 return items_en_proceso
             
             # Buscar todas las carpetas de items en Drive
-            query = f"'{output_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-            results = sheets_service.drive_service.files().list(
-                q=query,
-                spaces='drive',
-                fields='files(id, name)',
-                pageSize=1000,
-                orderBy='name'
-            ).execute()
-            
-            all_folders = results.get('files', [])
+            all_folders = sheets_service.listar_carpetas_drive(output_folder_id)
             
             # Limitar a 50 carpetas para evitar exceder límites de API
             import re
@@ -682,15 +670,10 @@ def get_trabajos_output():
     """Lee trabajos completados desde la planilla OUTPUT (pestaña: Insta Señalizaciones Anexo 2)"""
     if sheets_service:
         try:
-            # Abrir sheet directamente sin caché para siempre obtener datos frescos
-            output_sheet = sheets_service.client.open_by_key(sheets_service.output_sheet_id)
-            if output_sheet:
-                worksheet = output_sheet.get_worksheet(0)
-                
-                # Leer rango fijo amplio para asegurar que capturamos todas las filas
-                # Leer desde fila 11 hasta fila 1000 (más que suficiente)
-                rango = "A11:AA1000"
-                all_values = worksheet.get_values(rango)
+            # Leer rango fijo amplio para asegurar que capturamos todas las filas
+            # Leer desde fila 11 hasta fila 1000 (más que suficiente); cada llamada lee datos frescos
+            all_values = sheets_service.leer_valores_output("A11:AA1000")
+            if all_values:
                 
                 trabajos = []
                 ultima_fila_leida = 0
@@ -0,0 +1,46 @@
+"""
+Reglas de autorización: acciones autorizadas (planilla ACCIONES) y tipos de
+cartel del catálogo INPUT, con una versión por contenido.
+
+Las acciones viven en un SWRCache que relee la planilla solo cuando vence o
+cuando cambia su modifiedTime en Drive; los tipos salen del catálogo en
+memoria. La versión (hash de ambas listas) identifica el prefijo fijo del
+prompt de Gemini: mientras no cambie, el agente reutiliza el mismo prefijo ya
+armado (y su cache de contexto si está activa).
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List, NamedTuple
+
+# Se usan solo si la planilla de acciones nunca se pudo leer
+ACCIONES_POR_DEFECTO = [
+    "Reemplazo de señal de tránsito deteriorada",
+    "Instalación de señal de prohibido estacionar",
+    "Reemplazo de señal de zona de carga",
+    "Instalación de señal de velocidad máxima"
+]
+
+_COLUMNAS_ACCION = ('Acción', 'Accion', 'ACCION', 'accion', 'Descripción', 'Descripcion')
+
+
+class ReglasAutorizacion(NamedTuple):
+    acciones: List[str]
+    tipos: List[str]
+    version: str
+
+
+def extraer_acciones(registros: List[Dict[str, Any]]) -> List[str]:
+    """Acciones de las filas de la planilla (primera columna de acción con valor)."""
+    acciones = []
+    for registro in registros:
+        accion = next((registro.get(columna) for columna in _COLUMNAS_ACCION if registro.get(columna)), None)
+        if accion and str(accion).strip():
+            acciones.append(str(accion).strip())
+    return acciones
+
+
+def crear_reglas(acciones: List[str], tipos: List[str]) -> ReglasAutorizacion:
+    contenido = json.dumps([acciones, tipos], ensure_ascii=False)
+    version = hashlib.sha1(contenido.encode("utf-8")).hexdigest()[:12]
+    return ReglasAutorizacion(list(acciones), list(tipos), version)
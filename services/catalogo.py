@@ -0,0 +1,115 @@
+"""
+Catálogo de carteles de ECOGAS (planilla INPUT) indexado por número de ítem.
+
+Las conversaciones guardan solo el número de ítem y la versión del catálogo;
+la información completa del cartel se resuelve acá cuando se necesita. La
+versión es un hash del contenido: todos los workers que leyeron la misma
+planilla calculan la misma versión, y cambia solo si cambió algún cartel.
+
+El índice vive en un SWRCache (services/swr_cache.py): las consultas nunca
+esperan la descarga de la hoja salvo con el cache frío o demasiado viejo.
+"""
+
+import hashlib
+import json
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from services.swr_cache import SWRCache
+
+
+def normalizar_numero_item(item_number: Any) -> Optional[int]:
+    """Acepta "2", "02", "002", "item 2", etc. Devuelve el número o None."""
+    match = re.search(r'\d+', str(item_number))
+    return int(match.group()) if match else None
+
+
+class _Indice(NamedTuple):
+    carteles: List[Dict[str, Any]]
+    por_numero: Dict[int, Dict[str, Any]]
+    version: str
+
+
+_INDICE_VACIO = _Indice([], {}, "")
+
+
+class CatalogoCarteles:
+    """Copia en memoria del INPUT con índice por número y versión por contenido."""
+
+    def __init__(
+        self,
+        cargar: Callable[[], List[Dict[str, Any]]],
+        ttl_segundos: float = 300,
+        max_staleness_segundos: float = 3600,
+        detectar_cambio: Optional[Callable[[], Optional[str]]] = None
+    ):
+        self._cargar = cargar
+        self._indice = _INDICE_VACIO
+        self.cache = SWRCache(
+            "catalogo",
+            self._cargar_indice,
+            refresco_segundos=ttl_segundos,
+            max_staleness_segundos=max_staleness_segundos,
+            detectar_cambio=detectar_cambio
+        )
+
+    @staticmethod
+    def calcular_version(carteles: List[Dict[str, Any]]) -> str:
+        contenido = json.dumps(carteles, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(contenido.encode("utf-8")).hexdigest()[:12]
+
+    def _cargar_indice(self) -> Optional[_Indice]:
+        carteles = self._cargar()
+        if not carteles:
+            # obtener_carteles_ecogas devuelve [] ante errores: conservar la copia anterior
+            print("⚠️ Catálogo vacío al refrescar, se mantiene la versión anterior")
+            return None
+
+        version = self.calcular_version(carteles)
+        if version == self._indice.version:
+            return self._indice
+
+        por_numero = {}
+        for cartel in carteles:
+            numero = normalizar_numero_item(cartel.get('numero', ''))
+            if numero is not None:
+                por_numero.setdefault(numero, cartel)
+
+        self._indice = _Indice(carteles, por_numero, version)
+        print(f"📚 Catálogo de carteles cargado: {len(carteles)} carteles (versión {version})")
+        return self._indice
+
+    def _vigente(self) -> _Indice:
+        return self.cache.obtener() or _INDICE_VACIO
+
+    def refrescar(self) -> bool:
+        """Relee la planilla ya. Devuelve True si el contenido cambió."""
+        version_anterior = self._indice.version
+        self.cache.refrescar()
+        return self._indice.version != version_anterior
+
+    def invalidar(self):
+        self.cache.invalidar()
+
+    def snapshot(self) -> _Indice:
+        """
+        Carteles, índice por número y versión de una misma lectura. Usarlo cuando
+        se necesitan carteles() y version juntos: leídos por separado, un refresco
+        en segundo plano entre las dos llamadas los mezclaría.
+        """
+        return self._vigente()
+
+    @property
+    def version(self) -> str:
+        return self._vigente().version
+
+    def carteles(self) -> List[Dict[str, Any]]:
+        return self._vigente().carteles
+
+    def obtener(self, item_number: Any) -> Optional[Dict[str, Any]]:
+        """Cartel por número de ítem (copia), o None si no está en el catálogo."""
+        numero = normalizar_numero_item(item_number)
+        if numero is None:
+            return None
+        cartel = self._vigente().por_numero.get(numero)
+        return dict(cartel) if cartel is not None else None
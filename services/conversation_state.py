@@ -0,0 +1,158 @@
+"""
+Esquema compacto del estado de conversación de WhatsApp.
+
+El estado guarda solo lo que no se puede recalcular: números de ítem, la
+versión del catálogo con la que se inició la sesión, contadores de fotos ya
+subidas y las URLs de Twilio de las fotos que todavía no se subieron a Drive.
+La información completa de cada cartel se resuelve del catálogo
+(services/catalogo.py) cuando se la necesita.
+
+Modo simple:
+    estado, numero_item, catalogo_version, fotos_pendientes, fotos_antes,
+    distancia_km (solo si el ítem se identificó por ubicación),
+    observacion_registrada,
+    ubicacion_operario [lat, lon, timestamp] (última ubicación compartida,
+    origen del recorrido de una sesión de varios ítems),
+    media_antes (URLs de Twilio de las fotos ANTES, para la verificación
+    ANTES/DESPUÉS al terminar el trabajo)
+
+Modo múltiple:
+    modo='multiple', catalogo_version, items_activos {numero: EstadoItem},
+    item_actual_antes, item_actual_despues, fotos_pendientes,
+    estado_confirmacion, item_confirmacion_pendiente,
+    estado_observacion, item_observacion
+
+Cada guardado mide el tamaño serializado; si supera CONVERSATION_STATE_MAX_BYTES
+se avisa en el log (el presupuesto no trunca nada).
+"""
+
+import json
+import os
+from typing import Any, Dict, List, TypedDict
+
+from services import metrics
+
+PRESUPUESTO_BYTES = int(os.getenv("CONVERSATION_STATE_MAX_BYTES", "4096"))
+
+# Claves del esquema anterior que copiaban el cartel o guardaban las imágenes en bytes
+_CLAVES_LEGACY = ('cartel_info', 'imagenes_antes', 'imagenes_despues', 'imagenes_temp',
+                  'urls_imagenes_antes', 'urls_imagenes_despues')
+
+
+class EstadoItem(TypedDict, total=False):
+    """Estado de un ítem en modo múltiple."""
+    estado: str  # pendiente_confirmacion | recibiendo_antes | en_espera | recibiendo_despues | completado | observado
+    fotos_antes: int
+    fotos_despues: int
+    observacion: str
+    media_antes: List[str]  # URLs de Twilio de las fotos ANTES (verificación ANTES/DESPUÉS)
+
+
+def nuevo_item() -> EstadoItem:
+    return {'estado': 'pendiente_confirmacion', 'fotos_antes': 0, 'fotos_despues': 0}
+
+
+def estado_simple(estado: str, numero_item: Any, catalogo_version: str, **extra) -> Dict[str, Any]:
+    """Estado de una sesión de un solo ítem."""
+    datos = {
+        'estado': estado,
+        'numero_item': str(numero_item),
+        'catalogo_version': catalogo_version,
+        'fotos_pendientes': [],
+        'fotos_antes': 0,
+    }
+    datos.update(extra)
+    return datos
+
+
+def estado_multiple(numeros: List[str], catalogo_version: str) -> Dict[str, Any]:
+    """Estado de una sesión de varios ítems, esperando la llegada al primero."""
+    primer_item = numeros[0]
+    return {
+        'modo': 'multiple',
+        'catalogo_version': catalogo_version,
+        'items_activos': {str(numero): nuevo_item() for numero in numeros},
+        'item_actual_antes': primer_item,
+        'item_actual_despues': None,
+        'fotos_pendientes': [],
+        'estado_confirmacion': 'esperando',
+        'item_confirmacion_pendiente': primer_item,
+    }
+
+
+def resolver_cartel(catalogo, estado: Dict[str, Any], numero_item: Any) -> Dict[str, Any]:
+    """
+    Información completa del ítem desde el catálogo. Si la planilla cambió
+    desde que empezó la sesión se usan los datos actuales.
+    """
+    cartel = catalogo.obtener(numero_item)
+    if cartel is None:
+        print(f"⚠️ Ítem {numero_item} ya no está en el catálogo (sesión con versión {estado.get('catalogo_version')})")
+        cartel = {'numero': str(numero_item)}
+    elif estado.get('catalogo_version') and estado['catalogo_version'] != catalogo.version:
+        print(f"ℹ️ Catálogo actualizado durante la sesión: ítem {numero_item} resuelto con la versión {catalogo.version}")
+
+    if 'distancia_km' in estado and str(estado.get('numero_item')) == str(numero_item):
+        cartel['distancia_km'] = estado['distancia_km']
+    return cartel
+
+
+def tamanio_bytes(estado: Dict[str, Any]) -> int:
+    return len(json.dumps(estado, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def medir_estado(numero: str, tamanio: int):
+    """Registra el tamaño del estado guardado y avisa si supera el presupuesto."""
+    metrics.ESTADO_CONVERSACION_BYTES.observe(tamanio)
+    if tamanio > PRESUPUESTO_BYTES:
+        print(f"⚠️ Estado de conversación de {numero} ocupa {tamanio} bytes (presupuesto {PRESUPUESTO_BYTES})")
+
+
+def _migrar_fotos(datos: Dict[str, Any]):
+    if 'urls_imagenes_antes' in datos:
+        datos['fotos_antes'] = len(datos.pop('urls_imagenes_antes') or [])
+    if 'urls_imagenes_despues' in datos:
+        datos['fotos_despues'] = len(datos.pop('urls_imagenes_despues') or [])
+    for clave in ('imagenes_antes', 'imagenes_despues', 'imagenes_temp'):
+        datos.pop(clave, None)
+
+
+def migrar_estado(estado: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convierte un estado guardado con el esquema anterior (cartel completo e
+    imágenes en bytes) al esquema compacto. Las fotos que quedaron sin subir
+    no se pueden recuperar: el operario las vuelve a enviar.
+    """
+    contenedores = [estado, *estado.get('items_activos', {}).values()]
+    if not any(clave in datos for datos in contenedores for clave in _CLAVES_LEGACY):
+        return estado
+
+    cartel_info = estado.pop('cartel_info', None) or {}
+    if 'distancia_km' in cartel_info:
+        estado['distancia_km'] = cartel_info['distancia_km']
+    _migrar_fotos(estado)
+    estado.setdefault('fotos_pendientes', [])
+
+    for item in estado.get('items_activos', {}).values():
+        item.pop('cartel_info', None)
+        _migrar_fotos(item)
+    return estado
+
+
+def fotos_pendientes(estado: Dict[str, Any]) -> List[str]:
+    return estado.get('fotos_pendientes') or []
+
+
+def agregar_foto_pendiente(media_url: str):
+    """Función para ConversationStore.actualizar que agrega una foto (sin duplicar reintentos de Twilio)."""
+    def agregar(estado: Dict[str, Any]):
+        pendientes = estado.setdefault('fotos_pendientes', [])
+        if media_url not in pendientes:
+            pendientes.append(media_url)
+    return agregar
+
+
+def quitar_fotos_pendientes(media_urls: List[str]):
+    def quitar(estado: Dict[str, Any]):
+        estado['fotos_pendientes'] = [url for url in fotos_pendientes(estado) if url not in media_urls]
+    return quitar
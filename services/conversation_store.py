@@ -0,0 +1,310 @@
+"""
+Almacenamiento del estado de conversación de WhatsApp.
+
+El webhook lee y escribe el estado de cada operario solo a través de un
+ConversationStore. Hay dos implementaciones:
+
+- MemoryConversationStore: en memoria, LRU con TTL (desarrollo / un proceso).
+- SQLiteConversationStore: archivo SQLite local en modo WAL; el estado
+  sobrevive a reinicios y deploys.
+
+Cada estado lleva una versión que se incrementa en cada escritura. guardar()
+y eliminar() aceptan la versión leída para hacer compare-and-set: si otro
+mensaje del mismo operario escribió en el medio, la operación devuelve False
+y el llamador debe releer.
+
+Se elige con CONVERSATION_STORE=sqlite|memory (por defecto sqlite).
+
+El contenido del estado sigue el esquema compacto de
+services/conversation_state.py; cada guardado registra su tamaño.
+"""
+
+import base64
+import copy
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from services.conversation_state import medir_estado, migrar_estado, tamanio_bytes
+from services.shared_state import conectar_sqlite, modo_multiworker
+
+
+class ConversationStore(ABC):
+    """Interfaz del almacenamiento de estados de conversación."""
+
+    def __init__(self, ttl_segundos: float):
+        self.ttl_segundos = ttl_segundos
+
+    @abstractmethod
+    def obtener_con_version(self, numero: str) -> Tuple[Dict[str, Any], int]:
+        """
+        Devuelve (estado, version). Si no hay estado (o expiró) devuelve ({}, 0).
+        El estado es una copia: modificarlo no afecta al store hasta guardar().
+        """
+
+    @abstractmethod
+    def guardar(self, numero: str, estado: Dict[str, Any], version_esperada: Optional[int] = None) -> bool:
+        """
+        Guarda el estado. Con version_esperada solo escribe si la versión actual
+        coincide (0 = no debe existir). Devuelve False si hubo conflicto.
+        """
+
+    @abstractmethod
+    def eliminar(self, numero: str, version_esperada: Optional[int] = None) -> bool:
+        """Elimina el estado (con compare-and-set opcional)."""
+
+    @abstractmethod
+    def purgar_expirados(self) -> int:
+        """Elimina los estados sin actividad por más de ttl_segundos. Devuelve cuántos."""
+
+    @abstractmethod
+    def cantidad(self) -> int:
+        """Cantidad de conversaciones con estado vigente."""
+
+    def obtener(self, numero: str) -> Dict[str, Any]:
+        """Estado actual de la conversación ({} si no hay)."""
+        return self.obtener_con_version(numero)[0]
+
+    def existe(self, numero: str) -> bool:
+        return self.obtener_con_version(numero)[1] > 0
+
+    def actualizar(
+        self,
+        numero: str,
+        funcion: Callable[[Dict[str, Any]], Any],
+        intentos: int = 10
+    ) -> Dict[str, Any]:
+        """
+        Lectura-modificación-escritura con compare-and-set: aplica funcion(estado)
+        sobre el estado vigente y reintenta si otro mensaje escribió en el medio.
+        Devuelve el estado guardado.
+        """
+        for _ in range(intentos):
+            estado, version = self.obtener_con_version(numero)
+            funcion(estado)
+            if self.guardar(numero, estado, version_esperada=version):
+                return estado
+        raise RuntimeError(f"Conflicto persistente al actualizar la conversación de {numero}")
+
+
+class MemoryConversationStore(ConversationStore):
+    """Estados en memoria con expulsión LRU y TTL."""
+
+    def __init__(self, ttl_segundos: float = 24 * 3600, max_conversaciones: int = 1000):
+        super().__init__(ttl_segundos)
+        self.max_conversaciones = max_conversaciones
+        # numero -> (estado, version, actualizado_en)
+        self._estados: "OrderedDict[str, Tuple[Dict[str, Any], int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _vigente(self, numero: str, ahora: float) -> Optional[Tuple[Dict[str, Any], int, float]]:
+        entrada = self._estados.get(numero)
+        if entrada is None:
+            return None
+        if ahora - entrada[2] > self.ttl_segundos:
+            del self._estados[numero]
+            return None
+        return entrada
+
+    def obtener_con_version(self, numero: str) -> Tuple[Dict[str, Any], int]:
+        with self._lock:
+            entrada = self._vigente(numero, time.time())
+            if entrada is None:
+                return {}, 0
+            self._estados.move_to_end(numero)
+            return copy.deepcopy(entrada[0]), entrada[1]
+
+    def guardar(self, numero: str, estado: Dict[str, Any], version_esperada: Optional[int] = None) -> bool:
+        with self._lock:
+            ahora = time.time()
+            entrada = self._vigente(numero, ahora)
+            version_actual = entrada[1] if entrada else 0
+            if version_esperada is not None and version_esperada != version_actual:
+                return False
+
+            medir_estado(numero, tamanio_bytes(estado))
+            self._estados[numero] = (copy.deepcopy(estado), version_actual + 1, ahora)
+            self._estados.move_to_end(numero)
+            while len(self._estados) > self.max_conversaciones:
+                self._estados.popitem(last=False)
+            return True
+
+    def eliminar(self, numero: str, version_esperada: Optional[int] = None) -> bool:
+        with self._lock:
+            entrada = self._vigente(numero, time.time())
+            version_actual = entrada[1] if entrada else 0
+            if version_esperada is not None and version_esperada != version_actual:
+                return False
+            self._estados.pop(numero, None)
+            return True
+
+    def purgar_expirados(self) -> int:
+        with self._lock:
+            limite = time.time() - self.ttl_segundos
+            expirados = [numero for numero, entrada in self._estados.items() if entrada[2] < limite]
+            for numero in expirados:
+                del self._estados[numero]
+            return len(expirados)
+
+    def cantidad(self) -> int:
+        with self._lock:
+            return len(self._estados)
+
+
+def _codificar(valor: Any) -> Any:
+    """JSON no soporta bytes: se guardan en base64 (el esquema anterior guardaba imágenes)."""
+    if isinstance(valor, bytes):
+        return {"__bytes__": base64.b64encode(valor).decode("ascii")}
+    if isinstance(valor, dict):
+        return {str(k): _codificar(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_codificar(v) for v in valor]
+    return valor
+
+
+def _decodificar(valor: Any) -> Any:
+    if isinstance(valor, dict):
+        if set(valor) == {"__bytes__"}:
+            return base64.b64decode(valor["__bytes__"])
+        return {k: _decodificar(v) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [_decodificar(v) for v in valor]
+    return valor
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Estados persistidos en un archivo SQLite local (WAL)."""
+
+    def __init__(
+        self,
+        ruta: str = "./conversaciones.db",
+        ttl_segundos: float = 24 * 3600,
+        intervalo_purga: float = 600
+    ):
+        super().__init__(ttl_segundos)
+        self.ruta = ruta
+        self.intervalo_purga = intervalo_purga
+        self._ultima_purga = 0.0
+        self._lock = threading.Lock()
+
+        self._conn = conectar_sqlite(ruta)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversaciones (
+                numero TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                actualizado_en REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversaciones_actualizado ON conversaciones (actualizado_en)"
+        )
+        self.purgar_expirados()
+
+    def _limite_vigencia(self) -> float:
+        return time.time() - self.ttl_segundos
+
+    def obtener_con_version(self, numero: str) -> Tuple[Dict[str, Any], int]:
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT estado, version FROM conversaciones WHERE numero = ? AND actualizado_en >= ?",
+                (numero, self._limite_vigencia())
+            ).fetchone()
+        if fila is None:
+            return {}, 0
+        return migrar_estado(_decodificar(json.loads(fila[0]))), fila[1]
+
+    def guardar(self, numero: str, estado: Dict[str, Any], version_esperada: Optional[int] = None) -> bool:
+        datos = json.dumps(_codificar(estado), ensure_ascii=False)
+        medir_estado(numero, len(datos.encode("utf-8")))
+        ahora = time.time()
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._conn.execute(
+                    "SELECT version, actualizado_en FROM conversaciones WHERE numero = ?",
+                    (numero,)
+                ).fetchone()
+                # Un estado expirado cuenta como inexistente
+                version_actual = fila[0] if fila and fila[1] >= self._limite_vigencia() else 0
+                if version_esperada is not None and version_esperada != version_actual:
+                    self._conn.execute("ROLLBACK")
+                    return False
+
+                self._conn.execute(
+                    """
+                    INSERT INTO conversaciones (numero, estado, version, actualizado_en)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(numero) DO UPDATE SET
+                        estado = excluded.estado,
+                        version = excluded.version,
+                        actualizado_en = excluded.actualizado_en
+                    """,
+                    (numero, datos, version_actual + 1, ahora)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if ahora - self._ultima_purga > self.intervalo_purga:
+            self.purgar_expirados()
+        return True
+
+    def eliminar(self, numero: str, version_esperada: Optional[int] = None) -> bool:
+        with self._lock:
+            if version_esperada is None:
+                self._conn.execute("DELETE FROM conversaciones WHERE numero = ?", (numero,))
+                return True
+            cursor = self._conn.execute(
+                "DELETE FROM conversaciones WHERE numero = ? AND version = ?",
+                (numero, version_esperada)
+            )
+            return cursor.rowcount > 0
+
+    def purgar_expirados(self) -> int:
+        with self._lock:
+            self._ultima_purga = time.time()
+            cursor = self._conn.execute(
+                "DELETE FROM conversaciones WHERE actualizado_en < ?",
+                (self._limite_vigencia(),)
+            )
+            eliminados = cursor.rowcount
+        if eliminados:
+            print(f"🧹 {eliminados} conversación(es) expirada(s) eliminada(s)")
+        return eliminados
+
+    def cantidad(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM conversaciones WHERE actualizado_en >= ?",
+                (self._limite_vigencia(),)
+            ).fetchone()[0]
+
+
+def crear_conversation_store() -> ConversationStore:
+    """Crea el store configurado por variables de entorno."""
+    tipo = os.getenv("CONVERSATION_STORE", "sqlite").lower()
+    ttl_segundos = float(os.getenv("CONVERSATION_TTL_HOURS", "24")) * 3600
+
+    if tipo == "memory" and modo_multiworker():
+        print("⚠️ CONVERSATION_STORE=memory no se comparte entre workers, usando SQLite")
+        tipo = "sqlite"
+    
+    if tipo == "memory":
+        print("💬 Estado de conversaciones en memoria (se pierde al reiniciar)")
+        return MemoryConversationStore(
+            ttl_segundos=ttl_segundos,
+            max_conversaciones=int(os.getenv("CONVERSATION_MAX_ENTRIES", "1000"))
+        )
+
+    ruta = os.getenv("CONVERSATION_DB_PATH", "./conversaciones.db")
+    print(f"💬 Estado de conversaciones en SQLite: {ruta}")
+    return SQLiteConversationStore(ruta=ruta, ttl_segundos=ttl_segundos)
@@ -0,0 +1,108 @@
+"""
+Nomenclador offline: describe un punto con los carteles del catálogo.
+
+Casi todas las ubicaciones que comparten los operarios están junto a carteles
+conocidos, cuya ubicación, gasoducto/ramal y zona ya están en el INPUT. En
+vez de preguntarle a Nominatim, la descripción se arma con los carteles más
+cercanos (del índice espacial, sin red):
+
+- "Junto al cartel #277 (Ramal Norte - Cruce RP 5) - Zona Centro"
+- "Ramal Norte, entre los carteles #277 y #278 (a 0.3 km de #277) - Zona Centro"
+  cuando el punto cae sobre el tramo del ramal entre dos carteles
+- "A 0.8 km al NE del cartel #277 (Ramal Norte - Cruce RP 5) - Zona Centro"
+
+Nominatim queda como respaldo para puntos lejos de todo cartel.
+"""
+
+import math
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from services.geolocation import KM_POR_GRADO
+
+# Distancia por debajo de la cual el punto se considera "junto al" cartel
+JUNTO_KM = 0.05
+# Distancia máxima del punto a la recta entre dos carteles del mismo ramal
+DESVIO_MAX_TRAMO_KM = 0.3
+
+_RUMBOS = ["N", "NE", "E", "SE", "S", "SO", "O", "NO"]
+
+
+def _texto(valor: Any) -> str:
+    texto = str(valor or "").strip()
+    return "" if texto in ("-", "") else texto
+
+
+def rumbo(desde_lat: float, desde_lon: float, hacia_lat: float, hacia_lon: float) -> str:
+    """Rumbo aproximado (8 puntos cardinales) de un punto a otro."""
+    lat1, lat2 = math.radians(desde_lat), math.radians(hacia_lat)
+    delta_lon = math.radians(hacia_lon - desde_lon)
+    x = math.sin(delta_lon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta_lon)
+    grados = (math.degrees(math.atan2(x, y)) + 360) % 360
+    return _RUMBOS[int((grados + 22.5) // 45) % 8]
+
+
+def _en_km(lat: float, lon: float, lat0: float, lon0: float) -> Tuple[float, float]:
+    """Proyección equirectangular local (km) alrededor de (lat0, lon0)."""
+    return (lon - lon0) * KM_POR_GRADO * math.cos(math.radians(lat0)), (lat - lat0) * KM_POR_GRADO
+
+
+class ReferenciaUbicacion(NamedTuple):
+    cartel: Dict[str, Any]             # cartel más cercano
+    distancia_km: float
+    rumbo: str                         # del cartel hacia el punto
+    siguiente: Optional[Dict[str, Any]] = None   # otro cartel del ramal si el punto está entre ambos
+    avance_km: float = 0.0             # distancia sobre el tramo desde `cartel`
+
+    def descripcion(self) -> str:
+        numero = self.cartel.get('numero', '?')
+        ramal = _texto(self.cartel.get('gasoducto_ramal'))
+        ubicacion = _texto(self.cartel.get('ubicacion'))
+        zona = _texto(self.cartel.get('zona'))
+        detalle = " - ".join(p for p in (ramal, ubicacion) if p)
+
+        if self.siguiente is not None:
+            texto = (
+                f"{ramal}, entre los carteles #{numero} y #{self.siguiente.get('numero', '?')} "
+                f"(a {self.avance_km:.1f} km de #{numero})"
+            )
+        elif self.distancia_km < JUNTO_KM:
+            texto = f"Junto al cartel #{numero}" + (f" ({detalle})" if detalle else "")
+        else:
+            texto = f"A {self.distancia_km:.1f} km al {self.rumbo} del cartel #{numero}" + (f" ({detalle})" if detalle else "")
+
+        return f"{texto} - Zona {zona}" if zona else texto
+
+
+def referencia_ubicacion(
+    latitud: float,
+    longitud: float,
+    cercanos: List[Tuple[float, Dict[str, Any]]]
+) -> Optional[ReferenciaUbicacion]:
+    """
+    Referencia del punto a partir de los carteles cercanos [(distancia_km, cartel)]
+    ordenados por distancia (IndiceEspacial.cercanos). None si no hay ninguno.
+    """
+    if not cercanos:
+        return None
+
+    distancia, cartel = cercanos[0]
+    ramal = _texto(cartel.get('gasoducto_ramal'))
+    lat_a, lon_a = float(cartel['latitud']), float(cartel['longitud'])
+
+    if ramal and distancia >= JUNTO_KM:
+        # ¿El punto cae sobre el tramo entre el más cercano y otro cartel del mismo ramal?
+        px, py = _en_km(latitud, longitud, lat_a, lon_a)
+        for _, otro in cercanos[1:]:
+            if _texto(otro.get('gasoducto_ramal')) != ramal:
+                continue
+            bx, by = _en_km(float(otro['latitud']), float(otro['longitud']), lat_a, lon_a)
+            largo2 = bx * bx + by * by
+            if largo2 == 0:
+                continue
+            t = (px * bx + py * by) / largo2
+            desvio = abs(px * by - py * bx) / math.sqrt(largo2)
+            if 0 < t < 1 and desvio <= DESVIO_MAX_TRAMO_KM:
+                return ReferenciaUbicacion(cartel, distancia, "", otro, t * math.sqrt(largo2))
+
+    return ReferenciaUbicacion(cartel, distancia, rumbo(lat_a, lon_a, latitud, longitud))
@@ -0,0 +1,121 @@
+"""
+Cache local y límite de tasa para la geocodificación con Nominatim.
+
+Los operarios vuelven una y otra vez a los mismos predios, y cada registro
+consultaba Nominatim (hasta 10 s de timeout) sin cache ni respetar su
+política de uso (máximo 1 request por segundo).
+
+- CacheGeocodificacion: direcciones por "tile" (coordenadas redondeadas a
+  GEOCODE_TILE_DECIMALS decimales; 3 decimales son ~110 m) en un SQLite
+  local, con desalojo LRU al superar GEOCODE_CACHE_MAX_ENTRIES. También
+  guarda los puntos sin dirección, para no volver a consultarlos.
+- LimitadorTasa: una consulta cada `intervalo` segundos para todo el proceso,
+  tanto desde threads (esperar) como desde el event loop (esperar_async).
+  Con varios workers el intervalo se multiplica por la cantidad de workers,
+  así el host completo respeta el límite.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+from services.shared_state import cantidad_workers, conectar_sqlite
+
+
+def clave_tile(latitud: float, longitud: float, decimales: int) -> str:
+    return f"{round(latitud, decimales):.{decimales}f},{round(longitud, decimales):.{decimales}f}"
+
+
+class LimitadorTasa:
+    """Reparte turnos separados por `intervalo` segundos entre todos los llamadores."""
+
+    def __init__(self, intervalo: float):
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._proximo = 0.0
+
+    def _reservar(self) -> float:
+        """Reserva el próximo turno libre y devuelve cuántos segundos faltan para él."""
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._proximo)
+            self._proximo = turno + self.intervalo
+            return turno - ahora
+
+    def esperar(self):
+        espera = self._reservar()
+        if espera > 0:
+            time.sleep(espera)
+
+    async def esperar_async(self):
+        espera = self._reservar()
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+
+# Nominatim: 1 request por segundo por IP
+LIMITADOR_NOMINATIM = LimitadorTasa(float(os.getenv("NOMINATIM_MIN_INTERVAL_SECONDS", "1")) * cantidad_workers())
+
+
+class CacheGeocodificacion:
+    """Direcciones por tile de coordenadas en SQLite, con desalojo LRU."""
+
+    def __init__(self, ruta: str = "./geocodificacion.db", decimales: int = 3, max_entradas: int = 20000):
+        self.ruta = ruta
+        self.decimales = decimales
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+
+        self._conn = conectar_sqlite(ruta)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS direcciones (
+                tile TEXT PRIMARY KEY,
+                direccion TEXT NOT NULL,
+                creado_en REAL NOT NULL,
+                usado_en REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_direcciones_usado ON direcciones (usado_en)")
+
+    def obtener(self, latitud: float, longitud: float) -> Optional[str]:
+        """
+        Dirección del tile, "" si se consultó y no tiene dirección, o None si
+        no está en cache.
+        """
+        tile = clave_tile(latitud, longitud, self.decimales)
+        with self._lock:
+            fila = self._conn.execute("SELECT direccion FROM direcciones WHERE tile = ?", (tile,)).fetchone()
+            if fila is not None:
+                self._conn.execute("UPDATE direcciones SET usado_en = ? WHERE tile = ?", (time.time(), tile))
+        return fila[0] if fila is not None else None
+
+    def guardar(self, latitud: float, longitud: float, direccion: Optional[str]):
+        tile = clave_tile(latitud, longitud, self.decimales)
+        ahora = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO direcciones (tile, direccion, creado_en, usado_en)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(tile) DO UPDATE SET
+                    direccion = excluded.direccion,
+                    creado_en = excluded.creado_en,
+                    usado_en = excluded.usado_en
+                """,
+                (tile, direccion or "", ahora, ahora)
+            )
+            sobrantes = self._conn.execute("SELECT COUNT(*) FROM direcciones").fetchone()[0] - self.max_entradas
+            if sobrantes > 0:
+                self._conn.execute(
+                    "DELETE FROM direcciones WHERE tile IN "
+                    "(SELECT tile FROM direcciones ORDER BY usado_en ASC LIMIT ?)",
+                    (sobrantes,)
+                )
+
+    def cantidad(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM direcciones").fetchone()[0]
@@ -1,38 +1,221 @@
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
-from typing import Optional, Dict
+from typing import Any, Optional, Dict, List
+import asyncio
+import math
+import os
+import threading
 import time
 
+import numpy as np
+
+from services import metrics
+from services.catalogo import CatalogoCarteles
+from services.geocoding_cache import LIMITADOR_NOMINATIM, CacheGeocodificacion, clave_tile
+from services.single_flight import SingleFlight
+
+RADIO_TIERRA_KM = 6371.0
+KM_POR_GRADO = math.pi * RADIO_TIERRA_KM / 180
+
+
+# ===== DISTANCIAS =====
+# Haversine escalar para un par de puntos y versiones vectorizadas con NumPy
+# para uno-a-muchos, matriz de distancias y pares elemento a elemento.
+# Coordenadas en grados, distancias en kilómetros.
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia en kilómetros entre dos puntos."""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = lat2_rad - lat1_rad
+    delta_lon = math.radians(lon2 - lon1)
+    a = math.sin(delta_lat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _haversine_np(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Haversine con broadcasting de NumPy (argumentos en radianes)."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distancias_desde(latitud: float, longitud: float, lats, lons) -> np.ndarray:
+    """Distancias de un punto a cada uno de los puntos (lats[i], lons[i])."""
+    return _haversine_np(
+        np.radians(latitud), np.radians(longitud),
+        np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    )
+
+
+def distancias_pares(lats_a, lons_a, lats_b, lons_b) -> np.ndarray:
+    """Distancia entre (lats_a[i], lons_a[i]) y (lats_b[i], lons_b[i]) para cada i."""
+    return _haversine_np(
+        np.radians(np.asarray(lats_a, dtype=float)), np.radians(np.asarray(lons_a, dtype=float)),
+        np.radians(np.asarray(lats_b, dtype=float)), np.radians(np.asarray(lons_b, dtype=float))
+    )
+
+
+def matriz_distancias(lats_a, lons_a, lats_b=None, lons_b=None) -> np.ndarray:
+    """
+    Matriz len(a) x len(b) de distancias (sin b, la matriz de a contra sí mismo).
+    Ocupa 8 bytes por celda: 10k x 10k son 800 MB.
+    """
+    lat_a = np.radians(np.asarray(lats_a, dtype=float))[:, np.newaxis]
+    lon_a = np.radians(np.asarray(lons_a, dtype=float))[:, np.newaxis]
+    if lats_b is None:
+        lat_b, lon_b = lat_a.T, lon_a.T
+    else:
+        lat_b = np.radians(np.asarray(lats_b, dtype=float))[np.newaxis, :]
+        lon_b = np.radians(np.asarray(lons_b, dtype=float))[np.newaxis, :]
+    return _haversine_np(lat_a, lon_a, lat_b, lon_b)
+
 
 class GeolocationService:
     def __init__(self):
         self.geolocator = Nominatim(user_agent="ecogas_vialparking")
+        
+        # Direcciones ya resueltas por tile de coordenadas (ver services/geocoding_cache.py)
+        self.cache_direcciones = CacheGeocodificacion(
+            os.getenv("GEOCODE_CACHE_PATH", "./geocodificacion.db"),
+            decimales=int(os.getenv("GEOCODE_TILE_DECIMALS", "3")),
+            max_entradas=int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "20000"))
+        )
+        self.limitador = LIMITADOR_NOMINATIM
+        self._vuelo = SingleFlight()
+        
+        # Índice espacial del catálogo, reconstruido solo cuando cambia su versión
+        self.celda_km = float(os.getenv("GEO_GRID_CELL_KM", "2"))
+        self._indice: Optional["IndiceEspacial"] = None
+        self._indice_clave: Any = None
+        self._indice_lock = threading.Lock()
+        
+        # Zonas de los polígonos de la planilla, reconstruidas cuando cambia el snapshot
+        self._zonas: Optional["IndiceZonas"] = None
+        self._zonas_clave: Any = None
+        
+        # Radio dentro del cual una ubicación se describe con los carteles del catálogo
+        self.radio_nomenclador_km = float(os.getenv("GAZETTEER_MAX_KM", "2"))
     
-    def obtener_direccion(self, latitud: float, longitud: float) -> Optional[str]:
+    def _buscar_en_cache(self, latitud: float, longitud: float) -> Optional[str]:
+        """Valor del cache del tile: dirección, "" (sin dirección) o None (no está)."""
+        direccion = self.cache_direcciones.obtener(latitud, longitud)
+        metrics.registrar_cache("geocodificacion", direccion is not None)
+        return direccion
+    
+    def direccion_en_cache(self, latitud: float, longitud: float) -> Optional[str]:
+        """Dirección ya resuelta para el tile de las coordenadas, sin consultar la red."""
+        return self._buscar_en_cache(latitud, longitud) or None
+    
+    def referencia_en_catalogo(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: List[Dict],
+        version: Optional[str] = None
+    ) -> Optional["ReferenciaUbicacion"]:
+        """
+        Ubicación descrita con los carteles cercanos del catálogo (ver
+        services/gazetteer.py), sin consultar la red. None si no hay carteles
+        a menos de GAZETTEER_MAX_KM.
+        """
+        from services.gazetteer import referencia_ubicacion
+        
+        cercanos = self.indice_carteles(carteles, version).cercanos(latitud, longitud, 4, self.radio_nomenclador_km)
+        referencia = referencia_ubicacion(latitud, longitud, cercanos)
+        metrics.registrar_cache("nomenclador", referencia is not None)
+        return referencia
+    
+    def direccion_local(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: Optional[List[Dict]] = None,
+        version: Optional[str] = None
+    ) -> Optional[str]:
+        """Dirección sin usar la red: del catálogo (si se pasa) o del cache de Nominatim."""
+        if carteles:
+            referencia = self.referencia_en_catalogo(latitud, longitud, carteles, version)
+            if referencia is not None:
+                return referencia.descripcion()
+        return self.direccion_en_cache(latitud, longitud)
+    
+    def _consultar_nominatim(self, latitud: float, longitud: float) -> Optional[str]:
+        """Geocodificación inversa sin cache (el llamador ya esperó su turno en el limitador)."""
+        try:
+            with metrics.medir_llamada("nominatim", "reverse"):
+                location = self.geolocator.reverse(
+                    f"{latitud}, {longitud}",
+                    language="es",
+                    timeout=10
+                )
+        except (GeocoderTimedOut, GeocoderServiceError) as e:
+            # Los errores no se guardan en cache: se reintenta en la próxima visita
+            print(f"Error de geolocalización: {e}")
+            return None
+        
+        direccion = location.address if location else None
+        self.cache_direcciones.guardar(latitud, longitud, direccion)
+        return direccion
+    
+    def obtener_direccion(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: Optional[List[Dict]] = None,
+        version: Optional[str] = None
+    ) -> Optional[str]:
         """
         Convierte coordenadas a dirección.
         
+        Con el catálogo, describe el punto por los carteles cercanos. Si no
+        hay ninguno cerca, busca en el cache local por tile y recién después
+        consulta Nominatim respetando 1 request/s (puede bloquear hasta su turno).
+        
         Args:
             latitud: Latitud en formato decimal
             longitud: Longitud en formato decimal
+            carteles: Catálogo de carteles (opcional)
+            version: Versión del catálogo (reutiliza el índice espacial)
         
         Returns:
             Dirección como string o None
         """
-        try:
-            location = self.geolocator.reverse(
-                f"{latitud}, {longitud}",
-                language="es",
-                timeout=10
-            )
-            
-            if location:
-                return location.address
-            return None
-            
-        except (GeocoderTimedOut, GeocoderServiceError) as e:
-            print(f"Error de geolocalización: {e}")
-            return None
+        if carteles:
+            referencia = self.referencia_en_catalogo(latitud, longitud, carteles, version)
+            if referencia is not None:
+                return referencia.descripcion()
+        
+        direccion = self._buscar_en_cache(latitud, longitud)
+        if direccion is not None:
+            return direccion or None
+        
+        def consultar():
+            self.limitador.esperar()
+            return self._consultar_nominatim(latitud, longitud)
+        
+        # Varias consultas simultáneas del mismo tile hacen una sola request
+        clave = f"geocodificacion:{clave_tile(latitud, longitud, self.cache_direcciones.decimales)}"
+        return self._vuelo.ejecutar(clave, consultar)
+    
+    async def obtener_direccion_async(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: Optional[List[Dict]] = None,
+        version: Optional[str] = None
+    ) -> Optional[str]:
+        """Como obtener_direccion(), esperando el turno del limitador sin bloquear el event loop."""
+        if carteles:
+            referencia = self.referencia_en_catalogo(latitud, longitud, carteles, version)
+            if referencia is not None:
+                return referencia.descripcion()
+        
+        direccion = self._buscar_en_cache(latitud, longitud)
+        if direccion is not None:
+            return direccion or None
+        
+        await self.limitador.esperar_async()
+        return await asyncio.to_thread(self._consultar_nominatim, latitud, longitud)
     
     def geocodificar_direccion(self, direccion: str, region: str = "Argentina") -> Optional[Dict[str, float]]:
         """
@@ -50,7 +233,9 @@ class GeolocationService:
             if region not in direccion and "Argentina" not in direccion:
                 direccion = f"{direccion}, {region}"
             
-            location = self.geolocator.geocode(direccion, timeout=10)
+            self.limitador.esperar()
+            with metrics.medir_llamada("nominatim", "geocode"):
+                location = self.geolocator.geocode(direccion, timeout=10)
             
             if location:
                 return {
@@ -76,18 +261,76 @@ class GeolocationService:
             -73.5 <= longitud <= -53.0
         )
     
-    def validar_en_region_ecogas(self, latitud: float, longitud: float) -> bool:
+    def indice_zonas(self, poligonos: List[Dict], version: Optional[str] = None) -> "IndiceZonas":
+        """
+        Índice de zonas de las filas de la pestaña de polígonos. Se reconstruye
+        solo si cambió la versión recibida (GoogleSheetsService.obtener_poligonos_con_version).
+        Sin versión se hashea el contenido de las filas en cada llamada: solo
+        como respaldo para listas que no vienen del snapshot.
+        """
+        from services.zonas import indice_de_registros
+        
+        clave = version or CatalogoCarteles.calcular_version(poligonos)
+        zonas = self._zonas
+        if zonas is not None and self._zonas_clave == clave:
+            return zonas
+        
+        with self._indice_lock:
+            if self._zonas is None or self._zonas_clave != clave:
+                self._zonas = indice_de_registros(poligonos)
+                self._zonas_clave = clave
+                print(f"🗺️ Índice de zonas: {len(self._zonas)} polígonos")
+            return self._zonas
+    
+    def zona_de(
+        self,
+        latitud: float,
+        longitud: float,
+        poligonos: List[Dict],
+        version: Optional[str] = None
+    ) -> Optional[str]:
+        """Nombre de la zona que contiene el punto, o None."""
+        zona = self.indice_zonas(poligonos, version).zona_de(latitud, longitud)
+        return zona.nombre if zona else None
+    
+    def asignar_zonas(
+        self,
+        carteles: List[Dict],
+        poligonos: List[Dict],
+        version: Optional[str] = None
+    ) -> Dict[str, Optional[str]]:
+        """Zona de cada cartel con coordenadas (número de ítem -> zona o None), en una pasada."""
+        from services.indice_espacial import coordenadas_validas
+        
+        numeros, lats, lons = [], [], []
+        for cartel in carteles:
+            coordenadas = coordenadas_validas(cartel.get('latitud'), cartel.get('longitud'))
+            if coordenadas is not None:
+                numeros.append(str(cartel.get('numero')))
+                lats.append(coordenadas[0])
+                lons.append(coordenadas[1])
+        return dict(zip(numeros, self.indice_zonas(poligonos, version).zonas_de(lats, lons)))
+    
+    def validar_en_region_ecogas(
+        self,
+        latitud: float,
+        longitud: float,
+        poligonos: Optional[List[Dict]] = None,
+        version: Optional[str] = None
+    ) -> bool:
         """
         Verifica si las coordenadas están en la zona de cobertura de ECOGAS.
-        ECOGAS opera principalmente en Buenos Aires y alrededores.
         
-        Zona aproximada de cobertura:
+        Con polígonos (GoogleSheetsService.obtener_poligonos) el punto debe
+        caer dentro de alguno. Sin polígonos se usa la zona aproximada de
+        cobertura:
         Latitud: -35.5 a -33.5 (Gran Buenos Aires y zona de influencia)
         Longitud: -59.5 a -57.5
-        
-        Esta es una validación amplia. Para validación precisa se debería 
-        usar polígonos específicos de las zonas de concesión.
         """
+        if poligonos:
+            zonas = self.indice_zonas(poligonos, version)
+            if len(zonas):
+                return zonas.zona_de(latitud, longitud) is not None
         return (
             -35.5 <= latitud <= -33.5 and
             -59.5 <= longitud <= -57.5
@@ -97,26 +340,70 @@ class GeolocationService:
         """
         Calcula la distancia en kilómetros entre dos puntos.
         """
-        from math import radians, sin, cos, sqrt, atan2
-        
-        R = 6371  # Radio de la Tierra en km
-        
-        lat1_rad = radians(lat1)
-        lat2_rad = radians(lat2)
-        delta_lat = radians(lat2 - lat1)
-        delta_lon = radians(lon2 - lon1)
+        return haversine_km(lat1, lon1, lat2, lon2)
+    
+    def indice_carteles(self, carteles: List[Dict], version: Optional[str] = None) -> "IndiceEspacial":
+        """
+        Índice espacial de los carteles. Se reconstruye solo si cambió la versión
+        del catálogo (sin versión, si cambió el contenido de la lista: hash).
+        """
+        clave = version or CatalogoCarteles.calcular_version(carteles)
+        indice = self._indice
+        if indice is not None and self._indice_clave == clave:
+            return indice
         
-        a = sin(delta_lat / 2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(delta_lon / 2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
+        from services.indice_espacial import indice_de_carteles
         
-        return R * c
+        with self._indice_lock:
+            if self._indice is None or self._indice_clave != clave:
+                inicio = time.perf_counter()
+                self._indice = indice_de_carteles(carteles, self.celda_km)
+                self._indice_clave = clave
+                print(f"🗺️ Índice espacial: {len(self._indice)} carteles en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+            return self._indice
+    
+    def carteles_cercanos(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: List[Dict],
+        k: int = 5,
+        radio_max_km: Optional[float] = None,
+        version: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Los k carteles más cercanos (copias con 'distancia_km'), del más cercano al más lejano.
+        """
+        indice = self.indice_carteles(carteles, version)
+        return [
+            {**cartel, 'distancia_km': round(distancia, 2)}
+            for distancia, cartel in indice.cercanos(latitud, longitud, k, radio_max_km)
+        ]
+    
+    def carteles_en_radio(
+        self,
+        latitud: float,
+        longitud: float,
+        carteles: List[Dict],
+        radio_km: float,
+        version: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Carteles a radio_km o menos (copias con 'distancia_km'), ordenados por distancia.
+        """
+        indice = self.indice_carteles(carteles, version)
+        return [
+            {**cartel, 'distancia_km': round(distancia, 2)}
+            for distancia, cartel in indice.en_radio(latitud, longitud, radio_km)
+        ]
     
     def encontrar_cartel_mas_cercano(
         self, 
         latitud: float, 
         longitud: float, 
         carteles: list,
-        radio_max_km: float = 5.0
+        radio_max_km: float = 5.0,
+        version: Optional[str] = None
     ) -> Optional[Dict]:
         """
         Encuentra el cartel más cercano a una ubicación dada.
@@ -126,39 +413,10 @@ class GeolocationService:
             longitud: Longitud del punto de búsqueda
             carteles: Lista de carteles con 'latitud' y 'longitud'
             radio_max_km: Radio máximo de búsqueda en kilómetros (default 5 km)
+            version: Versión del catálogo (reutiliza el índice espacial mientras no cambie)
         
         Returns:
             Dict con el cartel más cercano y la distancia, o None si no hay ninguno cerca
         """
-        cartel_mas_cercano = None
-        distancia_minima = float('inf')
-        
-        for cartel in carteles:
-            # Validar que el cartel tenga coordenadas válidas
-            lat_cartel = cartel.get('latitud')
-            lon_cartel = cartel.get('longitud')
-            
-            if lat_cartel is None or lon_cartel is None:
-                continue
-            
-            try:
-                # Calcular distancia
-                distancia = self.calcular_distancia(
-                    latitud, 
-                    longitud, 
-                    float(lat_cartel), 
-                    float(lon_cartel)
-                )
-                
-                # Verificar si está dentro del radio y es más cercano
-                if distancia < distancia_minima and distancia <= radio_max_km:
-                    distancia_minima = distancia
-                    cartel_mas_cercano = cartel.copy()
-                    cartel_mas_cercano['distancia_km'] = round(distancia, 2)
-                    
-            except (ValueError, TypeError) as e:
-                print(f"Error calculando distancia para cartel {cartel.get('numero', 'desconocido')}: {e}")
-                continue
-        
-        return cartel_mas_cercano
-
+        cercanos = self.carteles_cercanos(latitud, longitud, carteles, k=1, radio_max_km=radio_max_km, version=version)
+        return cercanos[0] if cercanos else None
@@ -1,26 +1,107 @@
-import gspread
-from google.oauth2.service_account import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaInMemoryUpload
 import os
 import pickle
-from typing import List, Dict, Optional, Any
+import sys
+import threading
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
 from dotenv import load_dotenv
 import io
 import json
 
+from services.acciones import ACCIONES_POR_DEFECTO, ReglasAutorizacion, crear_reglas, extraer_acciones
+from services.catalogo import CatalogoCarteles
+from services.output_index import OutputRowIndex
+from services.quota_gateway import CuotaExcedida, QuotaGateway, crear_http_client_sheets, crear_request_builder_drive
+from services.stock_balance import StockBalance
+from services import metrics
+from services.shared_state import AvisosCompartidos, CacheInvalidationBus, ProcessLock, modo_multiworker
+from services.single_flight import SingleFlight
+from services.swr_cache import SWRCache
+
 load_dotenv()
 
+# Bloque de stock en la pestaña 2 de ECOGAS: columnas por tipo (índices base-0)
+STOCK_COLUMNAS = {
+    # CARTELES
+    'Cartel Tipo D Gasoducto': 11,      # Col 12 (L)
+    'Cartel Tipo D Cañería': 12,         # Col 13 (M)
+    'Cartel Tipo D Gasoductos (alt)': 13,  # Col 14 (N)
+    'Cartel Tipo D Cañerías (alt)': 14,    # Col 15 (O)
+    
+    # MOJONES
+    'Mojón de Metal': 15,                # Col 16 (P)
+    'Mojón de Hormigón': 16,             # Col 17 (Q)
+    'Mojón de Polietileno': 17,          # Col 18 (R)
+    
+    # POSTES
+    'Poste Alto (Met. 2")': 18,          # Col 19 (S)
+    'Poste Bajo (Mad. 3")': 19,          # Col 20 (T)
+}
+STOCK_PRIMERA_COLUMNA = 11  # Col L, inicio del rango L:T
+
+
+def _secretos_streamlit():
+    """
+    st.secrets si el proceso ya es una app de Streamlit (dashboard), o None.
+    El API nunca importa streamlit: solo se consulta si alguien ya lo cargó.
+    """
+    if "streamlit" not in sys.modules:
+        return None
+    try:
+        secretos = sys.modules["streamlit"].secrets
+        # Fuera de `streamlit run` o sin secrets.toml, el primer acceso falla
+        "GOOGLE_SHEETS_CREDENTIALS_JSON" in secretos
+        return secretos
+    except Exception as e:
+        print(f"ℹ️  Secrets de Streamlit no disponibles: {type(e).__name__}")
+        return None
+
+
+def _config(nombre: str, defecto: Optional[str] = None) -> Optional[str]:
+    """Variable de entorno; si no está, st.secrets (solo en el dashboard)."""
+    valor = os.getenv(nombre)
+    if not valor:
+        secretos = _secretos_streamlit()
+        if secretos is not None:
+            try:
+                valor = secretos.get(nombre)
+            except Exception:
+                valor = None
+    return valor or defecto
+
+
+def construir_drive_service(credentials, request_builder):
+    """
+    Cliente de Drive v3 desde el documento de discovery incluido en
+    google-api-python-client: sin request a googleapis.com al construirlo y
+    sin el cache de discovery en disco (que además avisa en cada arranque).
+    """
+    from googleapiclient.discovery import build
+    return build(
+        'drive', 'v3',
+        credentials=credentials,
+        requestBuilder=request_builder,
+        static_discovery=True,
+        cache_discovery=False
+    )
+
 
 class GoogleSheetsService:
     def __init__(self):
+        # gspread y los clientes de Google se importan acá: importar el módulo no los carga
+        import gspread
+        from google.oauth2.service_account import Credentials
+
         scopes = [
             'https://www.googleapis.com/auth/spreadsheets',
             'https://www.googleapis.com/auth/drive'
         ]
         
+        # Toda request a Sheets/Drive pasa por el gateway de cuota (ventana por minuto, prioridades, backoff en 429)
+        self.quota = QuotaGateway()
+        sheets_http_client = crear_http_client_sheets(self.quota)
+        drive_request_builder = crear_request_builder_drive(self.quota)
+        
         # PRIORIDAD 1: Intentar OAuth (mejor opción - sin límites y permisos del usuario)
         oauth_creds = self._load_oauth_credentials()
         
@@ -32,38 +113,27 @@ class GoogleSheetsService:
             print(f"📅 Válido hasta: {oauth_creds.expiry if hasattr(oauth_creds, 'expiry') else 'N/A'}")
             print(f"🔄 Refresh token: {'Sí' if hasattr(oauth_creds, 'refresh_token') and oauth_creds.refresh_token else 'No'}")
             print("=" * 70)
-            self.client = gspread.authorize(oauth_creds)
-            self.drive_service = build('drive', 'v3', credentials=oauth_creds)
+            self.client = gspread.authorize(oauth_creds, http_client=sheets_http_client)
+            self.drive_service = construir_drive_service(oauth_creds, drive_request_builder)
         else:
             # FALLBACK: Service Account (requiere permisos explícitos en cada planilla)
             print("⚠️  OAuth no disponible, usando Service Account")
             print("   NOTA: La Service Account debe tener permisos de editor en las planillas")
             
             creds = None
-            try:
-                import streamlit as st
-                # Verificar si realmente estamos en un entorno Streamlit con secrets configurados
+            secretos = _secretos_streamlit()
+            if secretos is not None and 'GOOGLE_SHEETS_CREDENTIALS_JSON' in secretos:
+                print("🔍 Intentando cargar credenciales desde Streamlit secrets...")
                 try:
-                    if hasattr(st, 'secrets') and 'GOOGLE_SHEETS_CREDENTIALS_JSON' in st.secrets:
-                        print("🔍 Intentando cargar credenciales desde Streamlit secrets...")
-                        creds_json = st.secrets['GOOGLE_SHEETS_CREDENTIALS_JSON']
-                        print(f"📄 Tipo de secret: {type(creds_json)}")
-                        
-                        # Si ya es un dict, usarlo directamente
-                        if isinstance(creds_json, dict):
-                            creds_dict = creds_json
-                        else:
-                            # Si es string, parsearlo
-                            creds_dict = json.loads(creds_json)
-                        
-                        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-                        print("✅ Credenciales cargadas desde Streamlit secrets")
+                    creds_json = secretos['GOOGLE_SHEETS_CREDENTIALS_JSON']
+                    print(f"📄 Tipo de secret: {type(creds_json)}")
+                    
+                    # Si ya es un dict, usarlo directamente; si es string, parsearlo
+                    creds_dict = creds_json if isinstance(creds_json, dict) else json.loads(creds_json)
+                    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+                    print("✅ Credenciales cargadas desde Streamlit secrets")
                 except Exception as e:
-                    # Puede ser StreamlitSecretNotFoundError o cualquier otro error de secrets
-                    print(f"ℹ️  Secrets no disponibles en este entorno: {type(e).__name__}")
-            except ImportError:
-                # No está en Streamlit
-                print("ℹ️  No está en entorno Streamlit")
+                    print(f"⚠️  Credenciales inválidas en Streamlit secrets: {type(e).__name__}")
             
             # Si no hay credenciales desde secrets, usar archivo local
             if creds is None:
@@ -78,49 +148,112 @@ class GoogleSheetsService:
                 print("✅ Usando credenciales Service Account desde archivo local")
                 creds = Credentials.from_service_account_file(credentials_path, scopes=scopes)
             
-            self.client = gspread.authorize(creds)
-            self.drive_service = build('drive', 'v3', credentials=creds)
+            self.client = gspread.authorize(creds, http_client=sheets_http_client)
+            self.drive_service = construir_drive_service(creds, drive_request_builder)
         
-        # IDs de las hojas - leer desde secrets o env
-        try:
-            import streamlit as st
-            if hasattr(st, 'secrets'):
-                try:
-                    # Intentar acceder a secrets (puede fallar si no está en entorno Streamlit)
-                    self.acciones_sheet_id = st.secrets.get("ACCIONES_SHEET_ID", os.getenv("ACCIONES_SHEET_ID"))
-                    self.database_sheet_id = st.secrets.get("DATABASE_SHEET_ID", os.getenv("DATABASE_SHEET_ID"))
-                    self.stock_folder_id = st.secrets.get("STOCK_DRIVE_FOLDER_ID", os.getenv("STOCK_DRIVE_FOLDER_ID"))
-                    self.ecogas_sheet_id = st.secrets.get("ECOGAS_SHEET_ID", os.getenv("ECOGAS_SHEET_ID"))
-                    self.output_sheet_id = st.secrets.get("OUTPUT_SHEET_ID", os.getenv("OUTPUT_SHEET_ID"))
-                    self.whatsapp_log_sheet_id = st.secrets.get("WHATSAPP_LOG_SHEET_ID", os.getenv("WHATSAPP_LOG_SHEET_ID", self.output_sheet_id))
-                    self.imagenes_carteles_folder_id = st.secrets.get("IMAGENES_CARTELES_FOLDER_ID", os.getenv("IMAGENES_CARTELES_FOLDER_ID"))
-                    self.output_imagenes_folder_id = st.secrets.get("OUTPUT_IMAGENES_FOLDER_ID", os.getenv("OUTPUT_IMAGENES_FOLDER_ID"))
-                except Exception:
-                    # Secrets no disponibles, usar env vars
-                    raise ImportError
-            else:
-                raise ImportError
-        except (ImportError, Exception):
-            # Usar variables de entorno (desarrollo local o Render)
-            self.acciones_sheet_id = os.getenv("ACCIONES_SHEET_ID")
-            self.database_sheet_id = os.getenv("DATABASE_SHEET_ID")
-            self.stock_folder_id = os.getenv("STOCK_DRIVE_FOLDER_ID")
-            self.ecogas_sheet_id = os.getenv("ECOGAS_SHEET_ID")
-            self.output_sheet_id = os.getenv("OUTPUT_SHEET_ID")
-            self.whatsapp_log_sheet_id = os.getenv("WHATSAPP_LOG_SHEET_ID", self.output_sheet_id)
-            self.imagenes_carteles_folder_id = os.getenv("IMAGENES_CARTELES_FOLDER_ID")
-            self.output_imagenes_folder_id = os.getenv("OUTPUT_IMAGENES_FOLDER_ID")
+        # IDs de las hojas: variables de entorno (API, Render) o st.secrets (dashboard)
+        self.acciones_sheet_id = _config("ACCIONES_SHEET_ID")
+        self.database_sheet_id = _config("DATABASE_SHEET_ID")
+        self.stock_folder_id = _config("STOCK_DRIVE_FOLDER_ID")
+        self.ecogas_sheet_id = _config("ECOGAS_SHEET_ID")
+        self.output_sheet_id = _config("OUTPUT_SHEET_ID")
+        self.whatsapp_log_sheet_id = _config("WHATSAPP_LOG_SHEET_ID", self.output_sheet_id)
+        self.imagenes_carteles_folder_id = _config("IMAGENES_CARTELES_FOLDER_ID")
+        self.output_imagenes_folder_id = _config("OUTPUT_IMAGENES_FOLDER_ID")
         
         # Cache de las hojas de base de datos
         self._db_sheet = None
         self._ecogas_sheet = None
         self._output_sheet = None
         self._whatsapp_log_sheet = None
+        
+        # Índice N° de item -> fila de la planilla OUTPUT
+        self._output_index = OutputRowIndex()
+        # Registros de trabajos esperando escritura: se agrupan en un solo batchUpdate
+        self._registros_pendientes: List[Dict[str, Any]] = []
+        self._registros_lock = threading.Lock()
+        self._registro_escritor = threading.Lock()
+        # Cursor de próxima fila libre de LOG_Streamlit (headers en fila 1)
+        self._log_streamlit_cursor = OutputRowIndex(columna='A', primera_fila=2)
+        
+        # Snapshot de stock compartido por /stock, /stock/alertas y verificar_stock_bajo
+        # (stale-while-revalidate: vencido se sirve y se relee en segundo plano)
+        self.stock_snapshot_ttl = float(os.getenv("STOCK_SNAPSHOT_TTL", "30"))
+        self._stock_cache = SWRCache(
+            "stock",
+            self._cargar_snapshot_stock,
+            refresco_segundos=self.stock_snapshot_ttl,
+            max_staleness_segundos=float(os.getenv("STOCK_MAX_STALENESS", "300")),
+            detectar_cambio=lambda: self.fecha_modificacion_drive(self.ecogas_sheet_id)
+        )
+        
+        # Snapshot de la hoja OUTPUT para los tableros de estado
+        self._output_cache = SWRCache(
+            "output",
+            self.leer_valores_output,
+            refresco_segundos=float(os.getenv("OUTPUT_SNAPSHOT_TTL", "60")),
+            max_staleness_segundos=float(os.getenv("OUTPUT_MAX_STALENESS", "600")),
+            detectar_cambio=lambda: self.fecha_modificacion_drive(self.output_sheet_id)
+        )
+        
+        # Polígonos de zonas (pestaña "poligonos"); cambian muy poco
+        self._poligonos_cache = SWRCache(
+            "poligonos",
+            self._leer_poligonos,
+            refresco_segundos=float(os.getenv("POLYGONS_TTL", "600")),
+            max_staleness_segundos=float(os.getenv("POLYGONS_MAX_STALENESS", "86400"))
+        )
+        
+        # Acciones autorizadas (planilla ACCIONES): se relee solo si venció o cambió en Drive
+        self._acciones_cache = SWRCache(
+            "acciones",
+            self._leer_acciones_autorizadas,
+            refresco_segundos=float(os.getenv("ACCIONES_TTL", "600")),
+            max_staleness_segundos=float(os.getenv("ACCIONES_MAX_STALENESS", "86400")),
+            detectar_cambio=lambda: self.fecha_modificacion_drive(self.acciones_sheet_id)
+        )
+        self._reglas: Optional[ReglasAutorizacion] = None
+        self._reglas_origen: tuple = (None, None)
+        
+        # Libro local de movimientos y ubicación (fila, columna) de cada tipo en la pestaña de stock
+        self._stock_ledger = None
+        self._stock_layout: Dict[str, Optional[tuple]] = {}
+        
+        # Saldo materializado por tipo (snapshot + movimientos locales) con alertas incrementales
+        self.stock_balance = StockBalance(
+            threshold=int(os.getenv("STOCK_ALERT_THRESHOLD", "10")),
+            avisos=self._avisos_stock()
+        )
+        self.stock_balance_max_edad = float(os.getenv("STOCK_BALANCE_MAX_AGE", "300"))
+        
+        # Con varios workers, las invalidaciones de cache se propagan por un SQLite compartido
+        self.cache_bus = CacheInvalidationBus() if modo_multiworker() else None
+        
+        # Lecturas concurrentes de la misma hoja o carpeta comparten una sola request
+        self._single_flight = SingleFlight()
+        
+        # Catálogo INPUT indexado por número de ítem (las conversaciones guardan solo el número)
+        self.catalogo = CatalogoCarteles(
+            self._leer_carteles_compartido,
+            ttl_segundos=float(os.getenv("CATALOG_TTL", "300")),
+            max_staleness_segundos=float(os.getenv("CATALOG_MAX_STALENESS", "3600")),
+            detectar_cambio=lambda: self.fecha_modificacion_drive(self.ecogas_sheet_id)
+        )
+    
+    @staticmethod
+    def _avisos_stock():
+        """Marcas compartidas de alertas de stock ya enviadas (None si el SQLite no está disponible)."""
+        try:
+            return AvisosCompartidos("stock_bajo")
+        except Exception as e:
+            print(f"⚠️ Marcas compartidas de alertas no disponibles: {e}")
+            return None
     
     def _load_oauth_credentials(self):
         """Carga credenciales OAuth desde archivo o variable de entorno."""
         try:
             from google.oauth2.credentials import Credentials
+            from google.auth.transport.requests import Request
             import base64
             
             creds = None
@@ -215,38 +348,46 @@ class GoogleSheetsService:
             return None
     
     # ===== ACCIONES AUTORIZADAS =====
-    def obtener_acciones_autorizadas(self) -> List[str]:
-        """
-        Obtiene la lista de acciones viales autorizadas desde la hoja de acciones.
-        """
+    def _leer_acciones_autorizadas(self) -> Optional[List[str]]:
+        """Lee la hoja de acciones. None si falla (el snapshot conserva la copia anterior)."""
         try:
-            sheet = self.client.open_by_key(self.acciones_sheet_id)
-            worksheet = sheet.get_worksheet(0)
-            records = worksheet.get_all_records()
-            
-            acciones = []
-            for record in records:
-                accion = (
-                    record.get('Acción') or 
-                    record.get('Accion') or 
-                    record.get('ACCION') or
-                    record.get('accion') or
-                    record.get('Descripción') or
-                    record.get('Descripcion')
-                )
-                if accion and accion.strip():
-                    acciones.append(accion.strip())
-            
-            return acciones
-            
+            with metrics.medir_llamada("sheets", "leer_acciones"):
+                sheet = self.client.open_by_key(self.acciones_sheet_id)
+                records = sheet.get_worksheet(0).get_all_records()
+            return extraer_acciones(records)
         except Exception as e:
             print(f"Error al obtener acciones autorizadas: {e}")
-            return [
-                "Reemplazo de señal de tránsito deteriorada",
-                "Instalación de señal de prohibido estacionar",
-                "Reemplazo de señal de zona de carga",
-                "Instalación de señal de velocidad máxima"
-            ]
+            return None
+    
+    def obtener_acciones_autorizadas(self) -> List[str]:
+        """
+        Obtiene la lista de acciones viales autorizadas (snapshot en memoria de
+        la hoja de acciones; lista por defecto si nunca se pudo leer).
+        """
+        acciones = self._acciones_cache.obtener()
+        return acciones if acciones is not None else list(ACCIONES_POR_DEFECTO)
+    
+    def reglas_autorizacion(self) -> ReglasAutorizacion:
+        """
+        Acciones autorizadas y tipos de cartel con su versión. Se recalcula solo
+        si se releyó la hoja de acciones o cambió la versión del catálogo.
+        """
+        acciones = self._acciones_cache.obtener()
+        catalogo = self.catalogo.snapshot()
+        version_catalogo = catalogo.version
+        origen = self._reglas_origen
+        if self._reglas is not None and origen[0] is acciones and origen[1] == version_catalogo:
+            return self._reglas
+        
+        reglas = crear_reglas(
+            acciones if acciones is not None else ACCIONES_POR_DEFECTO,
+            self.obtener_tipos_carteles_ecogas(catalogo.carteles)
+        )
+        if self._reglas is None or reglas.version != self._reglas.version:
+            print(f"📜 Reglas de autorización: {len(reglas.acciones)} acciones, {len(reglas.tipos)} tipos (versión {reglas.version})")
+        # Se guarda la lista del snapshot (no una copia) para comparar por identidad
+        self._reglas, self._reglas_origen = reglas, (acciones, version_catalogo)
+        return reglas
     
     # ===== EMPLEADOS =====
     def obtener_empleados(self) -> List[Dict[str, Any]]:
@@ -355,69 +496,125 @@ class GoogleSheetsService:
     
     # ===== STOCK =====
     def obtener_stock(self) -> Dict[str, int]:
-        """Obtiene el stock actual desde la planilla ECOGAS (pestaña 2, filas 92+)."""
+        """
+        Obtiene el stock actual desde la planilla ECOGAS (pestaña 2, filas 92+).
+        
+        Usa un snapshot compartido (STOCK_SNAPSHOT_TTL, segundos) para que /stock,
+        /stock/alertas y verificar_stock_bajo no descarguen la hoja cada uno. Vencido,
+        se sirve igual y se relee en segundo plano, hasta STOCK_MAX_STALENESS.
+        """
+        self._sincronizar_cache_stock()
+        stock = self._stock_cache.obtener()
+        return dict(stock) if stock is not None else {}
+    
+    def _cargar_snapshot_stock(self) -> Optional[Dict[str, int]]:
+        """Lee el bloque de stock y recarga el saldo materializado con los movimientos pendientes."""
+        stock = self._single_flight.ejecutar("stock", self._leer_bloque_stock)
+        if stock is None:
+            return None
+        ledger = self._get_stock_ledger()
+        self.stock_balance.cargar_snapshot(stock, ledger.deltas_pendientes() if ledger else {})
+        return stock
+    
+    def _sincronizar_cache_stock(self) -> bool:
+        """
+        Descarta el snapshot y el saldo locales si otro worker movió stock.
+        Devuelve True si hubo que descartarlos.
+        """
+        if self.cache_bus is None or not self.cache_bus.invalidado_externamente("stock"):
+            return False
+        self.invalidar_snapshot_stock(propagar=False)
+        return True
+    
+    def _refrescar_balance_stock(self):
+        """Recarga el saldo materializado si nunca se cargó, superó STOCK_BALANCE_MAX_AGE o cambió en otro worker."""
+        if (self._sincronizar_cache_stock() or
+                self.stock_balance.edad_segundos() > self.stock_balance_max_edad):
+            self.invalidar_snapshot_stock(propagar=False)
+            self.obtener_stock()
+    
+    def obtener_balance_stock(self) -> Dict[str, int]:
+        """Saldo de stock por tipo desde memoria (snapshot de planilla + movimientos locales)."""
+        self._refrescar_balance_stock()
+        return {k: v for k, v in self.stock_balance.saldos().items() if v > 0}
+    
+    def invalidar_snapshot_stock(self, propagar: bool = True):
+        """
+        Descarta el snapshot de stock para que la próxima lectura vaya a la planilla.
+        Con propagar=True también lo invalida en los demás workers.
+        """
+        self._stock_cache.invalidar()
+        if propagar and self.cache_bus is not None:
+            self.cache_bus.publicar("stock")
+    
+    @staticmethod
+    def _a_entero_stock(valor) -> Optional[int]:
+        """Convierte una celda UNFORMATTED_VALUE a entero no negativo (o None)."""
+        if isinstance(valor, bool):
+            return None
+        if isinstance(valor, int):
+            return valor if valor >= 0 else None
+        if isinstance(valor, float):
+            return int(valor) if valor.is_integer() and valor >= 0 else None
+        valor = str(valor).strip()
+        return int(valor) if valor.isdigit() else None
+    
+    def _leer_bloque_stock(self) -> Optional[Dict[str, int]]:
+        """
+        Lee solo el bloque de stock con lecturas por rango y sin formato:
+        columna E (N° / TOTALES) y columnas L:T (cantidades) desde la fila 92.
+        Devuelve None si no se pudo leer.
+        """
+        from gspread.utils import ValueRenderOption
+        
         try:
             sheet = self._get_ecogas_sheet()
-            if not sheet or len(sheet.worksheets()) < 2:
+            if not sheet:
                 print("No se encontró planilla de stock")
-                return {}
-            
-            worksheet = sheet.get_worksheet(1)
-            all_values = worksheet.get_all_values()
-            
-            # Headers están en fila 89 (índice 88)
-            # Datos empiezan en fila 92 (índice 91)
-            if len(all_values) < 92:
-                return {}
+                return None
             
-            headers = all_values[88]  # Fila 89
+            try:
+                worksheet = sheet.get_worksheet(1)
+            except Exception:
+                worksheet = None
+            if not worksheet:
+                print("No se encontró planilla de stock")
+                return None
             
-            # Mapeo detallado de columnas (índices base-0)
-            stock_mapping = {
-                # CARTELES
-                'Cartel Tipo D Gasoducto': 11,      # Col 12
-                'Cartel Tipo D Cañería': 12,         # Col 13
-                'Cartel Tipo D Gasoductos (alt)': 13,  # Col 14
-                'Cartel Tipo D Cañerías (alt)': 14,    # Col 15
-                
-                # MOJONES
-                'Mojón de Metal': 15,                # Col 16
-                'Mojón de Hormigón': 16,             # Col 17
-                'Mojón de Polietileno': 17,          # Col 18
-                
-                # POSTES
-                'Poste Alto (Met. 2")': 18,          # Col 19
-                'Poste Bajo (Mad. 3")': 19,          # Col 20
-            }
+            # Datos empiezan en fila 92; col E = N°, cols L:T = cantidades por tipo
+            fila_inicio = 92
+            numeros, cantidades = worksheet.batch_get(
+                [f"E{fila_inicio}:E", f"L{fila_inicio}:T"],
+                value_render_option=ValueRenderOption.unformatted
+            )
             
             # Inicializar stock
-            stock = {nombre: 0 for nombre in stock_mapping.keys()}
+            stock = {nombre: 0 for nombre in STOCK_COLUMNAS}
             
             # Leer datos desde fila 92 hasta encontrar TOTALES
-            found_total = False
-            for row in all_values[91:]:  # Desde fila 92
-                if len(row) < 21:
-                    continue
-                
-                numero = str(row[4]).strip()  # Col 5
+            for idx in range(max(len(numeros), len(cantidades))):
+                celda_numero = numeros[idx] if idx < len(numeros) else []
+                fila = cantidades[idx] if idx < len(cantidades) else []
+                numero = str(celda_numero[0]).strip() if celda_numero else ''
                 
                 # Si encontramos TOTALES, usar esa fila y terminar
                 if 'TOTAL' in numero.upper():
-                    for nombre, col_idx in stock_mapping.items():
-                        if col_idx < len(row):
-                            val = str(row[col_idx]).strip()
-                            if val and val.isdigit():
-                                stock[nombre] = int(val)
-                    found_total = True
+                    for nombre, col_idx in STOCK_COLUMNAS.items():
+                        pos = col_idx - STOCK_PRIMERA_COLUMNA
+                        if pos < len(fila):
+                            val = self._a_entero_stock(fila[pos])
+                            if val is not None:
+                                stock[nombre] = val
                     break
                 
                 # Si no hay TOTALES todavía, sumar fila por fila
-                if numero and numero.isdigit():
-                    for nombre, col_idx in stock_mapping.items():
-                        if col_idx < len(row):
-                            val = str(row[col_idx]).strip()
-                            if val and val.isdigit():
-                                stock[nombre] += int(val)
+                if celda_numero and self._a_entero_stock(celda_numero[0]) is not None:
+                    for nombre, col_idx in STOCK_COLUMNAS.items():
+                        pos = col_idx - STOCK_PRIMERA_COLUMNA
+                        if pos < len(fila):
+                            val = self._a_entero_stock(fila[pos])
+                            if val is not None:
+                                stock[nombre] += val
             
             # Filtrar items con stock > 0
             stock = {k: v for k, v in stock.items() if v > 0}
@@ -428,7 +625,7 @@ class GoogleSheetsService:
             print(f"Error al obtener stock: {e}")
             import traceback
             traceback.print_exc()
-            return {}
+            return None
             
             # Fallback: intentar desde la pestaña stock de DATABASE_SHEET
             worksheet = self._get_worksheet_by_name("stock")
@@ -465,7 +662,138 @@ class GoogleSheetsService:
             return {}
     
     def actualizar_stock(self, tipo_cartel: str, cantidad: int) -> bool:
-        """Actualiza el stock de un tipo de cartel (resta cantidad)."""
+        """
+        Actualiza el stock de un tipo de cartel (resta cantidad).
+        
+        El descuento se registra en el libro local (movimientos_stock) y se vuelca a la
+        planilla con un flush serializado que agrega los deltas por tipo. Si el libro
+        local no está disponible se actualiza la celda directamente.
+        """
+        # Saldo cargado antes de registrar: la recarga ya incluye los movimientos pendientes
+        self._refrescar_balance_stock()
+        
+        ledger = self._get_stock_ledger()
+        movimiento_id = ledger.registrar_movimiento(tipo_cartel, cantidad, "salida") if ledger is not None else None
+        if movimiento_id is None:
+            return self._actualizar_stock_directo(tipo_cartel, cantidad)
+        
+        self.stock_balance.aplicar_movimiento(tipo_cartel, -cantidad)
+        if self.cache_bus is not None:
+            # Los demás workers recargan su saldo con el movimiento pendiente
+            self.cache_bus.publicar("stock")
+        
+        ledger.flush()
+        # Un flush concurrente pudo haberlo aplicado antes: consultar el movimiento
+        return ledger.aplicado(movimiento_id)
+    
+    def _get_stock_ledger(self):
+        """Libro local de movimientos de stock (se crea al primer uso)."""
+        if self._stock_ledger is None:
+            try:
+                from services.stock_ledger import StockLedger
+                self._stock_ledger = StockLedger(self)
+            except Exception as e:
+                print(f"⚠️ Libro local de stock no disponible: {e}")
+                return None
+        return self._stock_ledger
+    
+    def _get_worksheet_stock(self):
+        """Pestaña de materiales/stock de la planilla ECOGAS."""
+        sheet = self._get_ecogas_sheet()
+        if not sheet:
+            return None
+        worksheets = sheet.worksheets()
+        for ws in worksheets:
+            if 'material' in ws.title.lower() or 'stock' in ws.title.lower():
+                return ws
+        return worksheets[1] if len(worksheets) > 1 else None
+    
+    def _ubicar_celdas_stock(self, worksheet, tipos: List[str]) -> Dict[str, Optional[tuple]]:
+        """
+        Devuelve {tipo: (fila, columna)} de la celda de cantidad de cada tipo.
+        
+        La disposición de la pestaña es estática: se descubre una vez (fila del tipo
+        desde la 85, columna 'cantidad/stock/total' del header en fila 85) y se cachea.
+        """
+        faltantes = [tipo for tipo in tipos if tipo not in self._stock_layout]
+        if faltantes:
+            all_values = worksheet.get_all_values()
+            headers = all_values[84] if len(all_values) > 84 else []  # fila 85
+            
+            cantidad_col = None
+            for idx, header in enumerate(headers, 1):
+                header_lower = str(header).lower().strip()
+                if any(word in header_lower for word in ['cantidad', 'stock', 'total']):
+                    cantidad_col = idx
+                    break
+            
+            for tipo in faltantes:
+                fila_tipo = None
+                # Primera coincidencia exacta recorriendo por filas (como worksheet.find)
+                for num_fila, fila in enumerate(all_values, start=1):
+                    if tipo in fila:
+                        fila_tipo = num_fila
+                        break
+                
+                if fila_tipo and fila_tipo >= 85 and cantidad_col:
+                    self._stock_layout[tipo] = (fila_tipo, cantidad_col)
+                else:
+                    self._stock_layout[tipo] = None
+        
+        return {tipo: self._stock_layout.get(tipo) for tipo in tipos}
+    
+    def aplicar_deltas_stock(self, deltas: Dict[str, int]) -> Dict[str, bool]:
+        """
+        Aplica deltas netos de stock por tipo con una lectura y una escritura por lote.
+        
+        Args:
+            deltas: Dict tipo -> delta (negativo para salidas)
+        
+        Returns:
+            Dict tipo -> True si se aplicó, False si la planilla no lo acepta (sin
+            celda de stock). Ante un error de la API devuelve {}: todo queda
+            pendiente para el próximo flush sin contar como intento fallido.
+        """
+        from gspread.utils import ValueRenderOption, rowcol_to_a1
+        
+        resultados = {tipo: False for tipo in deltas}
+        try:
+            worksheet = self._get_worksheet_stock()
+            ubicaciones = self._ubicar_celdas_stock(worksheet, list(deltas)) if worksheet else {}
+            
+            ubicados = [tipo for tipo in deltas if ubicaciones.get(tipo)]
+            if ubicados:
+                celdas = [rowcol_to_a1(*ubicaciones[tipo]) for tipo in ubicados]
+                actuales = worksheet.batch_get(celdas, value_render_option=ValueRenderOption.unformatted)
+                
+                data = []
+                for tipo, celda, valor in zip(ubicados, celdas, actuales):
+                    stock_actual = self._a_entero_stock(valor[0][0]) if valor and valor[0] else 0
+                    nuevo_stock = max(0, (stock_actual or 0) + deltas[tipo])
+                    data.append({'range': celda, 'values': [[nuevo_stock]]})
+                
+                worksheet.batch_update(data)
+                for tipo in ubicados:
+                    resultados[tipo] = True
+                print(f"✅ Stock actualizado en ECOGAS ({len(data)} celda(s) en un batch_update)")
+            
+            # Tipos que no están en la pestaña de ECOGAS: camino individual (DATABASE_SHEET)
+            for tipo in deltas:
+                if not ubicaciones.get(tipo) and deltas[tipo] <= 0:
+                    resultados[tipo] = self._actualizar_stock_directo(tipo, -deltas[tipo])
+            
+            if any(resultados.values()):
+                self.invalidar_snapshot_stock()
+            return resultados
+            
+        except Exception as e:
+            print(f"Error al aplicar deltas de stock: {e}")
+            # La disposición pudo cambiar: se vuelve a descubrir en el próximo flush
+            self._stock_layout = {}
+            return {tipo: True for tipo, ok in resultados.items() if ok}
+    
+    def _actualizar_stock_directo(self, tipo_cartel: str, cantidad: int) -> bool:
+        """Resta cantidad leyendo y escribiendo la celda del tipo directamente."""
         try:
             # Intentar actualizar en la planilla ECOGAS primero
             sheet = self._get_ecogas_sheet()
@@ -500,6 +828,7 @@ class GoogleSheetsService:
                                 stock_actual = int(worksheet.cell(cell.row, cantidad_col).value or 0)
                                 nuevo_stock = max(0, stock_actual - cantidad)
                                 worksheet.update_cell(cell.row, cantidad_col, nuevo_stock)
+                                self.invalidar_snapshot_stock()
                                 return True
                 except Exception as e:
                     print(f"Error al actualizar stock en ECOGAS: {e}")
@@ -523,6 +852,7 @@ class GoogleSheetsService:
                     stock_actual = int(worksheet.cell(cell.row, cantidad_col).value or 0)
                     nuevo_stock = max(0, stock_actual - cantidad)
                     worksheet.update_cell(cell.row, cantidad_col, nuevo_stock)
+                    self.invalidar_snapshot_stock()
                     return True
             return False
             
@@ -531,20 +861,12 @@ class GoogleSheetsService:
             return False
     
     def verificar_stock_bajo(self, threshold: int = 10) -> List[Dict[str, Any]]:
-        """Verifica si hay items con stock bajo."""
-        stock = self.obtener_stock()
-        alertas = []
-        
-        for tipo, cantidad in stock.items():
-            if cantidad <= threshold:
-                alertas.append({
-                    "tipo_cartel": tipo,
-                    "cantidad_actual": cantidad,
-                    "threshold": threshold,
-                    "mensaje": f"⚠️ Stock bajo: {tipo} - Quedan solo {cantidad} unidades"
-                })
-        
-        return alertas
+        """
+        Verifica si hay items con stock bajo.
+        Lee las alertas mantenidas por el saldo materializado, sin recorrer la planilla.
+        """
+        self._refrescar_balance_stock()
+        return self.stock_balance.alertas(threshold)
     
     # ===== MOVIMIENTOS STOCK =====
     def registrar_movimiento_stock(self, datos: Dict[str, Any]) -> bool:
@@ -578,16 +900,33 @@ class GoogleSheetsService:
             return []
     
     # ===== POLÍGONOS =====
+    def _leer_poligonos(self) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Lee la pestaña de polígonos y calcula su versión (hash del contenido, una
+        vez por lectura). Los errores se propagan para conservar el snapshot anterior.
+        """
+        worksheet = self._get_worksheet_by_name("poligonos")
+        poligonos = worksheet.get_all_records() if worksheet else []
+        return poligonos, CatalogoCarteles.calcular_version(poligonos)
+    
+    def obtener_poligonos_con_version(self) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Polígonos y su versión de una misma lectura. La versión es la clave del
+        índice de zonas (GeolocationService.indice_zonas): pasarla evita hashear
+        las filas en cada consulta.
+        """
+        return self._poligonos_cache.obtener() or ([], "")
+    
     def obtener_poligonos(self) -> List[Dict[str, Any]]:
-        """Obtiene todos los polígonos definidos."""
-        try:
-            worksheet = self._get_worksheet_by_name("poligonos")
-            if worksheet:
-                return worksheet.get_all_records()
-            return []
-        except Exception as e:
-            print(f"Error al obtener polígonos: {e}")
-            return []
+        """
+        Obtiene todos los polígonos definidos (snapshot en memoria; la misma
+        lista mientras no se relea la pestaña).
+        """
+        return self.obtener_poligonos_con_version()[0]
+    
+    def obtener_poligonos_version(self) -> str:
+        """Versión del snapshot de polígonos vigente ("" si nunca se pudo leer)."""
+        return self.obtener_poligonos_con_version()[1]
     
     def agregar_poligono(self, datos: Dict[str, Any]) -> bool:
         """Agrega un nuevo polígono."""
@@ -595,6 +934,7 @@ class GoogleSheetsService:
             worksheet = self._get_worksheet_by_name("poligonos")
             if worksheet:
                 worksheet.append_row(list(datos.values()))
+                self._poligonos_cache.invalidar()
                 return True
             return False
         except Exception as e:
@@ -624,9 +964,67 @@ class GoogleSheetsService:
                 return None
         return self._output_sheet
     
+    def leer_valores_output(self, rango: Optional[str] = None) -> List[List[str]]:
+        """
+        Valores de la primera pestaña de OUTPUT (toda la hoja o el rango dado).
+        Las llamadas concurrentes para el mismo rango comparten una sola lectura.
+        """
+        def leer():
+            output_sheet = self._get_output_sheet()
+            if not output_sheet:
+                return []
+            worksheet = output_sheet.get_worksheet(0)
+            return worksheet.get_values(rango) if rango else worksheet.get_all_values()
+        
+        return self._single_flight.ejecutar(f"output:{rango or 'todo'}", leer)
+    
+    def obtener_output(self) -> List[List[str]]:
+        """Snapshot de la hoja OUTPUT (stale-while-revalidate, ver OUTPUT_SNAPSHOT_TTL)."""
+        return self._output_cache.obtener() or []
+    
+    def fecha_modificacion_drive(self, file_id: Optional[str]) -> Optional[str]:
+        """modifiedTime de un archivo de Drive (una planilla cambia su fecha con cada edición)."""
+        if not file_id:
+            return None
+        archivo = self.drive_service.files().get(
+            fileId=file_id,
+            fields='modifiedTime',
+            supportsAllDrives=True
+        ).execute()
+        return archivo.get('modifiedTime')
+    
+    def snapshots(self) -> Dict[str, SWRCache]:
+        """Caches stale-while-revalidate que mantiene el refresco programado."""
+        return {
+            "catalogo": self.catalogo.cache,
+            "stock": self._stock_cache,
+            "output": self._output_cache,
+            "poligonos": self._poligonos_cache,
+            "acciones": self._acciones_cache,
+        }
+    
     def obtener_carteles_ecogas(self) -> List[Dict[str, Any]]:
         """
         Obtiene todos los carteles de la planilla de ECOGAS.
+        Las llamadas concurrentes comparten una sola lectura de la hoja.
+        Si el gateway descarta la lectura por cuota devuelve [] como ante cualquier error.
+        """
+        try:
+            return self._leer_carteles_compartido()
+        except CuotaExcedida as e:
+            print(f"⏳ Lectura de carteles de ECOGAS descartada por cuota: {e}")
+            return []
+    
+    def _leer_carteles_compartido(self) -> List[Dict[str, Any]]:
+        """
+        Como obtener_carteles_ecogas pero propaga CuotaExcedida: el catálogo la
+        necesita para distinguir "sistema saturado" de "ítem inexistente".
+        """
+        return self._single_flight.ejecutar("input_carteles", self._leer_carteles_ecogas)
+    
+    def _leer_carteles_ecogas(self) -> List[Dict[str, Any]]:
+        """
+        Lee todos los carteles de la planilla de ECOGAS.
         Los datos empiezan en la fila 7 (índice 6).
         Columnas: 
         - Col B (índice 1): N°
@@ -897,6 +1295,8 @@ class GoogleSheetsService:
             
             return carteles
             
+        except CuotaExcedida:
+            raise
         except Exception as e:
             print(f"Error al obtener carteles de ECOGAS: {e}")
             import traceback
@@ -916,10 +1316,11 @@ class GoogleSheetsService:
         except (ValueError, TypeError):
             return None
     
-    def obtener_tipos_carteles_ecogas(self) -> List[str]:
-        """Obtiene lista única de tipos de carteles de ECOGAS."""
+    def obtener_tipos_carteles_ecogas(self, carteles: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        """Obtiene lista única de tipos de carteles de ECOGAS (del catálogo en memoria)."""
         try:
-            carteles = self.obtener_carteles_ecogas()
+            if carteles is None:
+                carteles = self.catalogo.carteles()
             tipos = set()
             for cartel in carteles:
                 if cartel.get('tipo_cartel'):
@@ -964,6 +1365,115 @@ class GoogleSheetsService:
             print(f"Error al actualizar estado: {e}")
             return False
     
+    def _localizar_fila_output(self, worksheet, numero_item) -> tuple:
+        """
+        Devuelve (fila, existente) para un item en OUTPUT usando el índice en memoria.
+        
+        El índice se construye con la columna F la primera vez (o al vencer su TTL).
+        En los demás casos se revalida con una sola lectura acotada: la fila conocida
+        del item y una ventana después del cursor. Si la planilla cambió por fuera,
+        se reconstruye.
+        """
+        return self._localizar_filas_output(worksheet, [numero_item])[0]
+    
+    def _localizar_filas_output(self, worksheet, numeros_items: List[str]) -> List[tuple]:
+        """
+        Versión por lote de _localizar_fila_output: revalida el índice con un único
+        batch_get para todos los items y devuelve [(fila, existente), ...] en orden.
+        """
+        index = self._output_index
+        
+        if index.necesita_reconstruir():
+            metrics.registrar_cache("output_index", False)
+            print("🔄 Construyendo índice de filas OUTPUT (columna F)...")
+            index.construir(worksheet.col_values(6))
+        else:
+            valores = worksheet.batch_get(index.rangos_validacion(numeros_items))
+            valido = index.validar(numeros_items, valores)
+            metrics.registrar_cache("output_index", valido)
+            if not valido:
+                print("🔄 Planilla OUTPUT modificada externamente, reconstruyendo índice...")
+                index.construir(worksheet.col_values(6))
+        
+        return [index.localizar(numero_item) for numero_item in numeros_items]
+    
+    def _construir_fila_output(self, datos: Dict[str, Any]) -> List[str]:
+        """
+        Arma la fila A:AA de OUTPUT para un trabajo a partir de cartel_info (datos del INPUT).
+        También obtiene o crea las carpetas ANTES/DESPUÉS en Drive para los enlaces.
+        """
+        cartel_info = datos.get('cartel_info', {})
+        numero_item = datos.get('numero_item', cartel_info.get('numero', ''))
+        
+        # Formato fecha: DD/MM/YYYY con ceros (ejemplo: 04/02/2026, 10/02/2026) para ordenamiento correcto
+        fecha_ejecucion = datetime.now().strftime("%d/%m/%Y")
+        
+        # Preparar valor de distancia (puede no existir si se buscó por número directamente)
+        distancia_valor = cartel_info.get('distancia_km', '')
+        if distancia_valor:
+            distancia_str = str(distancia_valor).replace('.', ',')  # Formato español
+        else:
+            distancia_str = '-'  # Guión cuando no hay valor, igual que en ejemplos
+        
+        # Obtener o crear la estructura de carpetas en Drive y generar enlaces separados
+        carpetas = self.crear_estructura_carpetas_output(numero_item)
+        enlace_antes_formula = ''
+        enlace_despues_formula = ''
+        
+        if carpetas:
+            # Generar fórmulas separadas para ANTES y DESPUÉS
+            item_num = str(numero_item).zfill(3)
+            
+            if carpetas.get('antes'):
+                url_antes = f"https://drive.google.com/drive/folders/{carpetas['antes']}"
+                texto_antes = f"Fotos {item_num}-001 al 003"
+                enlace_antes_formula = f'=HYPERLINK("{url_antes}"; "{texto_antes}")'
+            
+            if carpetas.get('despues'):
+                url_despues = f"https://drive.google.com/drive/folders/{carpetas['despues']}"
+                texto_despues = f"Fotos {item_num}-004 al 006"
+                enlace_despues_formula = f'=HYPERLINK("{url_despues}"; "{texto_despues}")'
+            
+            if enlace_antes_formula or enlace_despues_formula:
+                print(f"📁 Fórmulas enlaces generadas:")
+                if enlace_antes_formula:
+                    print(f"   - ANTES: Fotos {item_num}-001 al 003")
+                if enlace_despues_formula:
+                    print(f"   - DESPUÉS: Fotos {item_num}-004 al 006")
+        
+        return [
+            '',  # A: vacío
+            '',  # B: Fecha Certificacion (vacío por ahora)
+            '',  # C: N° Certificacion (vacío por ahora)
+            fecha_ejecucion,  # D: Fecha Ejecucion
+            '',  # E: vacío
+            str(numero_item),  # F: N°
+            cartel_info.get('gasoducto_ramal', ''),  # G: Gasoducto / Ramal
+            '',  # H: Progresiva P.C.O
+            cartel_info.get('ubicacion', ''),  # I: Ubicación / Descripción
+            cartel_info.get('coordenadas', ''),  # J: Georreferencias (Ubicación Señalización)
+            distancia_str,  # K: Dist. LM (número con coma o "-")
+            cartel_info.get('alto', '-'),  # L: Dist. Al eje (usar alto del INPUT)
+            datos.get('observacion', 'Instalación EJECUTADA.-'),  # M: Observaciones (usar observación personalizada o por defecto)
+            '',  # N: vacío
+            cartel_info.get('tipo_raw', ''),  # O: Tipo - valor completo del INPUT (ej: "D\ncañeria")
+            # TRABAJO 10 - Colocación o remplazo de cartel con mantenimiento de Poste
+            cartel_info.get('poste_alto_met_10', ''),  # P: POSTE ALTO (MET. 2")
+            cartel_info.get('poste_bajo_met_10', ''),  # Q: POSTE BAJO (MET.)
+            cartel_info.get('poste_bajo_mad_10', ''),  # R: POSTE BAJO (MAD.)
+            # TRABAJO 20 - Colocación de cartel con instalación de Poste o mojón
+            cartel_info.get('poste_alto_met_20', ''),  # S: POSTE ALTO (MET. 2")
+            cartel_info.get('poste_bajo_mad_20', ''),  # T: POSTE BAJO (MAD. 3")
+            cartel_info.get('mojon_met4_20', ''),  # U: MOJON (Met. 4")
+            # TRABAJO 30 - Remoción y colocación con instalación de Poste o Mojón
+            cartel_info.get('poste_alto_met_30', ''),  # V: POSTE ALTO (MET. 2")
+            cartel_info.get('poste_bajo_mad_30', ''),  # W: POSTE BAJO (MAD. / MET.)
+            cartel_info.get('mojon_met_30', ''),  # X: MOJON METALICO
+            cartel_info.get('mojon_horm_30', ''),  # Y: MOJON HORMIGON
+            enlace_antes_formula,  # Z: FOTOS ANTES
+            enlace_despues_formula  # AA: FOTOS DESPUÉS
+        ]
+    
     def registrar_trabajo_ecogas(self, datos: Dict[str, Any]) -> bool:
         """
         Registra un trabajo completado en la planilla OUTPUT.
@@ -978,193 +1488,240 @@ class GoogleSheetsService:
         J: Dist. LM (distancia calculada)
         L: Observaciones ("Instalación EJECUTADA.-")
         N: Tipo (del INPUT)
+        
+        Los registros concurrentes (varios operarios, o transiciones de distintas
+        conversaciones en threads) se agrupan: mientras un lote se escribe, los
+        que llegan esperan y el siguiente escritor los manda juntos en un solo
+        registrar_trabajos_ecogas. Sin concurrencia es un lote de un item.
         """
-        try:
-            # Obtener datos del cartel desde cartel_info
+        pendiente = {'datos': datos, 'resultado': None, 'listo': threading.Event()}
+        with self._registros_lock:
+            self._registros_pendientes.append(pendiente)
+        
+        with self._registro_escritor:
+            # Otro escritor pudo haberlo incluido en su lote mientras se esperaba el lock
+            if not pendiente['listo'].is_set():
+                with self._registros_lock:
+                    lote, self._registros_pendientes = self._registros_pendientes, []
+                if len(lote) > 1:
+                    print(f"📦 Registrando {len(lote)} trabajos en OUTPUT en un solo lote")
+                resultados = []
+                try:
+                    resultados = self.registrar_trabajos_ecogas([p['datos'] for p in lote])
+                finally:
+                    for posicion, p in enumerate(lote):
+                        p['resultado'] = resultados[posicion] if posicion < len(resultados) else None
+                        p['listo'].set()
+        
+        resultado = pendiente['resultado']
+        return bool(resultado) and resultado['exito']
+    
+    def registrar_trabajos_ecogas(self, lista_datos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Registra varios trabajos en la planilla OUTPUT con una sola escritura.
+        
+        Cada elemento de lista_datos tiene el mismo formato que en registrar_trabajo_ecogas.
+        Las filas de OUTPUT y sus filas de LOG_Streamlit se envían en un único
+        values.batchUpdate (dos si la planilla LOG es otra distinta de OUTPUT).
+        
+        Args:
+            lista_datos: Lista de dicts con 'numero_item', 'cartel_info' y opcionalmente 'observacion'
+        
+        Returns:
+            Lista en el mismo orden con {'numero_item', 'exito', 'fila', 'error'} por item
+        """
+        from gspread.utils import absolute_range_name
+        
+        resultados = []
+        filas_output = []  # (posición en resultados, numero_item, fila de valores)
+        
+        for datos in lista_datos:
             cartel_info = datos.get('cartel_info', {})
-            numero_item = datos.get('numero_item', cartel_info.get('numero', ''))
+            numero_item = str(datos.get('numero_item', cartel_info.get('numero', '')) or '')
+            resultado = {'numero_item': numero_item, 'exito': False, 'fila': None, 'error': None}
+            resultados.append(resultado)
             
             if not numero_item:
                 print("❌ No se proporcionó número de item")
-                return False
+                resultado['error'] = "Sin número de item"
+                continue
             
+            try:
+                filas_output.append((len(resultados) - 1, numero_item, self._construir_fila_output(datos)))
+            except Exception as e:
+                print(f"❌ Error al preparar registro del item {numero_item}: {e}")
+                resultado['error'] = str(e)[:200]
+        
+        if not filas_output:
+            self._registrar_logs_registro(lista_datos, resultados)
+            return resultados
+        
+        try:
             # Abrir planilla OUTPUT
             output_sheet = self._get_output_sheet()
             if not output_sheet:
-                print("❌ No se pudo acceder a la planilla OUTPUT")
-                return False
+                raise RuntimeError("No se pudo acceder a la planilla OUTPUT")
             
             # Primera pestaña de OUTPUT
             worksheet = output_sheet.get_worksheet(0)
             
-            # Preparar nueva fila con datos del INPUT
-            # Formato fecha: DD/MM/YYYY con ceros (ejemplo: 04/02/2026, 10/02/2026) para ordenamiento correcto
-            fecha_ejecucion = datetime.now().strftime("%d/%m/%Y")
-            
-            # Preparar valor de distancia (puede no existir si se buscó por número directamente)
-            distancia_valor = cartel_info.get('distancia_km', '')
-            if distancia_valor:
-                distancia_str = str(distancia_valor).replace('.', ',')  # Formato español
-            else:
-                distancia_str = '-'  # Guión cuando no hay valor, igual que en ejemplos
-            
-            # Obtener o crear la estructura de carpetas en Drive y generar enlaces separados
-            carpetas = self.crear_estructura_carpetas_output(numero_item)
-            enlace_antes_formula = ''
-            enlace_despues_formula = ''
-            
-            if carpetas:
-                # Generar fórmulas separadas para ANTES y DESPUÉS
-                item_num = str(numero_item).zfill(3)
-                
-                if carpetas.get('antes'):
-                    url_antes = f"https://drive.google.com/drive/folders/{carpetas['antes']}"
-                    texto_antes = f"Fotos {item_num}-001 al 003"
-                    enlace_antes_formula = f'=HYPERLINK("{url_antes}"; "{texto_antes}")'
-                
-                if carpetas.get('despues'):
-                    url_despues = f"https://drive.google.com/drive/folders/{carpetas['despues']}"
-                    texto_despues = f"Fotos {item_num}-004 al 006"
-                    enlace_despues_formula = f'=HYPERLINK("{url_despues}"; "{texto_despues}")'
-                
-                if enlace_antes_formula or enlace_despues_formula:
-                    print(f"📁 Fórmulas enlaces generadas:")
-                    if enlace_antes_formula:
-                        print(f"   - ANTES: Fotos {item_num}-001 al 003")
-                    if enlace_despues_formula:
-                        print(f"   - DESPUÉS: Fotos {item_num}-004 al 006")
-            
-            # Extraer solo la letra del tipo de cartel (D, no "Cartel Tipo D")
-            tipo_cartel_raw = cartel_info.get('tipo_cartel', '')
-            tipo_cartel_letra = tipo_cartel_raw
-            if 'Tipo' in tipo_cartel_raw:
-                # Extraer la letra después de "Tipo "
-                import re
-                match = re.search(r'Tipo ([A-E])', tipo_cartel_raw)
-                if match:
-                    tipo_cartel_letra = match.group(1)
-            
-            nueva_fila = [
-                '',  # A: vacío
-                '',  # B: Fecha Certificacion (vacío por ahora)
-                '',  # C: N° Certificacion (vacío por ahora)
-                fecha_ejecucion,  # D: Fecha Ejecucion
-                '',  # E: vacío
-                str(numero_item),  # F: N°
-                cartel_info.get('gasoducto_ramal', ''),  # G: Gasoducto / Ramal
-                '',  # H: Progresiva P.C.O
-                cartel_info.get('ubicacion', ''),  # I: Ubicación / Descripción
-                cartel_info.get('coordenadas', ''),  # J: Georreferencias (Ubicación Señalización)
-                distancia_str,  # K: Dist. LM (número con coma o "-")
-                cartel_info.get('alto', '-'),  # L: Dist. Al eje (usar alto del INPUT)
-                datos.get('observacion', 'Instalación EJECUTADA.-'),  # M: Observaciones (usar observación personalizada o por defecto)
-                '',  # N: vacío
-                cartel_info.get('tipo_raw', ''),  # O: Tipo - valor completo del INPUT (ej: "D\ncañeria")
-                # TRABAJO 10 - Colocación o remplazo de cartel con mantenimiento de Poste
-                cartel_info.get('poste_alto_met_10', ''),  # P: POSTE ALTO (MET. 2")
-                cartel_info.get('poste_bajo_met_10', ''),  # Q: POSTE BAJO (MET.)
-                cartel_info.get('poste_bajo_mad_10', ''),  # R: POSTE BAJO (MAD.)
-                # TRABAJO 20 - Colocación de cartel con instalación de Poste o mojón
-                cartel_info.get('poste_alto_met_20', ''),  # S: POSTE ALTO (MET. 2")
-                cartel_info.get('poste_bajo_mad_20', ''),  # T: POSTE BAJO (MAD. 3")
-                cartel_info.get('mojon_met4_20', ''),  # U: MOJON (Met. 4")
-                # TRABAJO 30 - Remoción y colocación con instalación de Poste o Mojón
-                cartel_info.get('poste_alto_met_30', ''),  # V: POSTE ALTO (MET. 2")
-                cartel_info.get('poste_bajo_mad_30', ''),  # W: POSTE BAJO (MAD. / MET.)
-                cartel_info.get('mojon_met_30', ''),  # X: MOJON METALICO
-                cartel_info.get('mojon_horm_30', ''),  # Y: MOJON HORMIGON
-                enlace_antes_formula,  # Z: FOTOS ANTES
-                enlace_despues_formula  # AA: FOTOS DESPUÉS
-            ]
-            
-            # Verificar si ya existe un registro para este item (por ejemplo, si se registró una observación antes)
-            col_f_values = worksheet.col_values(6)  # Columna F (N° de item)
-            fila_existente = None
-            
-            for i, valor in enumerate(col_f_values, start=1):
-                if i > 10 and str(valor).strip() == str(numero_item):
-                    fila_existente = i
-                    print(f"📝 Item {numero_item} ya existe en fila {i}, actualizando registro...")
-                    break
-            
-            if fila_existente:
-                # Actualizar registro existente
-                proxima_fila = fila_existente
-            else:
-                # Encontrar la próxima fila disponible para nuevo registro
-                # La planilla tiene headers en filas 9-10, datos empiezan en fila 11
-                # Buscar la última fila con datos en columna F (N° de item)
-                ultima_fila_con_datos = 10  # Mínimo es fila 10 (headers)
-                for i, valor in enumerate(col_f_values, start=1):
-                    if i > 10 and valor.strip():  # Después de headers y con valor
-                        ultima_fila_con_datos = i
-                
-                proxima_fila = ultima_fila_con_datos + 1
-                print(f"📝 Creando nuevo registro en fila {proxima_fila} de la planilla OUTPUT")
-            
-            # Escribir en la fila específica usando update (hasta columna AA para incluir FOTOS ANTES y DESPUÉS)
-            rango = f"A{proxima_fila}:AA{proxima_fila}"
-            print(f"📝 Intentando escribir en rango: {rango}")
-            print(f"   Worksheet: {worksheet.title}")
-            print(f"   Datos a escribir: {len(nueva_fila)} columnas")
-            print(f"   Item: {numero_item}, Fecha: {fecha_ejecucion}")
-            
-            try:
-                resultado = worksheet.update(rango, [nueva_fila], value_input_option='USER_ENTERED')
-                print(f"✅ Update ejecutado exitosamente")
-                print(f"   Respuesta: {resultado}")
-            except Exception as update_error:
-                print(f"❌ Error en worksheet.update(): {update_error}")
-                import traceback
-                traceback.print_exc()
-                raise
-            
-            accion_realizada = "actualizado" if fila_existente else "registrado"
-            print(f"✅ Trabajo {accion_realizada} en planilla OUTPUT: Item {numero_item}")
-            print(f"   ✓ Fecha Ejecucion: {fecha_ejecucion}")
-            print(f"   ✓ Gasoducto/Ramal: {cartel_info.get('gasoducto_ramal', '')}")
-            print(f"   ✓ Ubicación: {cartel_info.get('ubicacion', '')}")
-            print(f"   ✓ Tipo: {cartel_info.get('tipo_cartel', '')}")
-            
-            # Mostrar tipo de trabajo si existe
-            tipo_trabajo = cartel_info.get('tipo_trabajo', '')
-            if tipo_trabajo:
-                print(f"   ✓ Tipo de trabajo: {tipo_trabajo}")
-            
-            if enlace_antes_formula or enlace_despues_formula:
-                print(f"   ✓ Enlaces fotos: Fotos {str(numero_item).zfill(3)}-001 al 003 y -004 al 006")
+            # El lock cubre localizar + escribir para no asignar la misma fila dos veces
+            # (ProcessLock extiende la exclusión a los demás workers del host)
+            with self._output_index.lock, ProcessLock("output_registro"):
+                ubicaciones = self._localizar_filas_output(
+                    worksheet, [numero_item for _, numero_item, _ in filas_output]
+                )
                 
-            observacion_final = datos.get('observacion', 'Instalación EJECUTADA.-')
-            print(f"   ✓ Observaciones: {observacion_final}")
-            
-            # Registrar log en pestaña LOG_Streamlit
-            self.registrar_log_streamlit(
-                usuario="Dashboard Streamlit",
-                accion="registro_trabajo",
-                numero_item=str(numero_item),
-                detalles=f"Gasoducto: {cartel_info.get('gasoducto_ramal', '')} | Ubicación: {cartel_info.get('ubicacion', '')} | Tipo: {cartel_info.get('tipo_cartel', '')}",
-                resultado="✅ Éxito",
-                fotos_antes=3,
-                fotos_despues=3
-            )
-            
-            return True
+                # Si LOG_Streamlit vive en la misma planilla, va en el mismo batchUpdate
+                misma_planilla_log = self.whatsapp_log_sheet_id == self.output_sheet_id
+                try:
+                    data = []
+                    for (posicion, numero_item, nueva_fila), (fila, existente) in zip(filas_output, ubicaciones):
+                        resultados[posicion]['fila'] = fila
+                        accion = "actualizando" if existente else "nuevo registro en"
+                        print(f"📝 Item {numero_item}: {accion} fila {fila} de la planilla OUTPUT")
+                        data.append({
+                            'range': absolute_range_name(worksheet.title, f"A{fila}:AA{fila}"),
+                            'values': [nueva_fila]
+                        })
+                    
+                    max_fila = max(fila for fila, _ in ubicaciones)
+                    if max_fila > worksheet.row_count:
+                        worksheet.add_rows(max_fila - worksheet.row_count)
+                    
+                    for posicion, _, _ in filas_output:
+                        resultados[posicion]['exito'] = True
+                    data_log = self._preparar_logs_registro(lista_datos, resultados) if misma_planilla_log else []
+                    
+                    respuesta = output_sheet.values_batch_update(body={
+                        'valueInputOption': 'USER_ENTERED',
+                        'data': data + data_log
+                    })
+                    print(f"✅ batchUpdate OUTPUT ejecutado: {respuesta.get('totalUpdatedRows', '?')} filas")
+                except Exception as update_error:
+                    print(f"❌ Error al escribir en OUTPUT: {update_error}")
+                    # Liberar de la última a la primera: liberar() solo retrocede el cursor
+                    # si la fila es la última reservada
+                    reservas = list(zip(filas_output, ubicaciones))
+                    for (posicion, numero_item, _), (fila, existente) in reversed(reservas):
+                        resultados[posicion]['exito'] = False
+                        resultados[posicion]['error'] = str(update_error)[:200]
+                        if not existente:
+                            self._output_index.liberar(numero_item, fila)
+                    if misma_planilla_log:
+                        # Pudo haber reservado filas de log antes de fallar
+                        self._log_streamlit_cursor.invalidar()
+                    raise
+            
+            # El snapshot de OUTPUT se sigue sirviendo y se relee en segundo plano
+            self._output_cache.marcar_vencido()
+            
+            for posicion, numero_item, _ in filas_output:
+                cartel_info = lista_datos[posicion].get('cartel_info', {})
+                print(f"✅ Trabajo registrado en planilla OUTPUT: Item {numero_item} (fila {resultados[posicion]['fila']})")
+                print(f"   ✓ Gasoducto/Ramal: {cartel_info.get('gasoducto_ramal', '')}")
+                print(f"   ✓ Tipo: {cartel_info.get('tipo_cartel', '')}")
+                print(f"   ✓ Observaciones: {lista_datos[posicion].get('observacion', 'Instalación EJECUTADA.-')}")
+            
+            if not misma_planilla_log:
+                self._registrar_logs_registro(lista_datos, resultados)
+            
+            return resultados
             
         except Exception as e:
-            print(f"❌ Error al registrar trabajo en planilla OUTPUT: {e}")
+            print(f"❌ Error al registrar trabajos en planilla OUTPUT: {e}")
             import traceback
             traceback.print_exc()
             
-            # Registrar error en log
-            numero_item = datos.get('numero_item', datos.get('cartel_info', {}).get('numero', 'N/A'))
-            self.registrar_log_streamlit(
-                usuario="Dashboard Streamlit",
-                accion="registro_trabajo",
-                numero_item=str(numero_item),
-                detalles=f"Error: {str(e)[:200]}",
-                resultado="❌ Error"
-            )
+            for resultado in resultados:
+                if not resultado['error']:
+                    resultado['exito'] = False
+                    resultado['error'] = str(e)[:200]
+            
+            # Registrar errores en log
+            self._registrar_logs_registro(lista_datos, resultados)
+            return resultados
+    
+    def _preparar_logs_registro(
+        self,
+        lista_datos: List[Dict[str, Any]],
+        resultados: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Arma los rangos de LOG_Streamlit (uno por item) para un values.batchUpdate,
+        reservando filas con el cursor de la pestaña.
+        """
+        from gspread.utils import absolute_range_name
+        
+        worksheet = self._get_log_streamlit_worksheet()
+        if not worksheet:
+            return []
+        
+        cursor = self._log_streamlit_cursor
+        with cursor.lock:
+            # Otros procesos (API / dashboard) también escriben en LOG_Streamlit:
+            # se revalida la ventana tras el cursor antes de reservar filas
+            if cursor.necesita_reconstruir():
+                cursor.construir(worksheet.col_values(1))
+            elif not cursor.validar([], worksheet.batch_get(cursor.rangos_validacion([]))):
+                cursor.construir(worksheet.col_values(1))
+            
+            data = []
+            for datos, resultado in zip(lista_datos, resultados):
+                cartel_info = datos.get('cartel_info', {})
+                if resultado['exito']:
+                    detalles = (
+                        f"Gasoducto: {cartel_info.get('gasoducto_ramal', '')} | "
+                        f"Ubicación: {cartel_info.get('ubicacion', '')} | "
+                        f"Tipo: {cartel_info.get('tipo_cartel', '')}"
+                    )
+                    fila_log = self._construir_fila_log_streamlit(
+                        usuario="Dashboard Streamlit",
+                        accion="registro_trabajo",
+                        numero_item=resultado['numero_item'] or 'N/A',
+                        detalles=detalles,
+                        resultado="✅ Éxito",
+                        fotos_antes=3,
+                        fotos_despues=3
+                    )
+                else:
+                    fila_log = self._construir_fila_log_streamlit(
+                        usuario="Dashboard Streamlit",
+                        accion="registro_trabajo",
+                        numero_item=resultado['numero_item'] or 'N/A',
+                        detalles=f"Error: {resultado['error'] or ''}",
+                        resultado="❌ Error"
+                    )
+                fila = cursor.reservar_fila()
+                data.append({
+                    'range': absolute_range_name(worksheet.title, f"A{fila}:J{fila}"),
+                    'values': [fila_log]
+                })
             
+            if data and cursor.proxima_fila - 1 > worksheet.row_count:
+                worksheet.add_rows(cursor.proxima_fila - 1 - worksheet.row_count)
+        
+        return data
+    
+    def _registrar_logs_registro(
+        self,
+        lista_datos: List[Dict[str, Any]],
+        resultados: List[Dict[str, Any]]
+    ) -> bool:
+        """Escribe en LOG_Streamlit el resultado de cada registro con un único batchUpdate."""
+        try:
+            data = self._preparar_logs_registro(lista_datos, resultados)
+            if not data:
+                return False
+            self._get_whatsapp_log_sheet().values_batch_update(body={
+                'valueInputOption': 'USER_ENTERED',
+                'data': data
+            })
+            print(f"📋 Log Streamlit registrado: {len(data)} fila(s)")
+            return True
+        except Exception as e:
+            print(f"⚠️ Error al registrar log Streamlit: {e}")
+            self._log_streamlit_cursor.invalidar()
             return False
     
     def actualizar_enlace_carpeta_item(self, numero_item: str) -> bool:
@@ -1268,6 +1825,8 @@ class GoogleSheetsService:
                 'parents': [item_folder_id]
             }
             
+            from googleapiclient.http import MediaInMemoryUpload
+
             # Crear media upload desde bytes directamente
             media = MediaInMemoryUpload(
                 image_data,  # image_data ya es bytes, no necesita io.BytesIO
@@ -1511,6 +2070,8 @@ class GoogleSheetsService:
                 'parents': [folder_id]
             }
             
+            from googleapiclient.http import MediaInMemoryUpload
+
             # Crear media upload
             media = MediaInMemoryUpload(
                 image_data,
@@ -1562,35 +2123,64 @@ class GoogleSheetsService:
         """
         Busca un cartel por su número de ítem.
         Acepta formatos: "2", "02", "002", "item 2", etc.
+        
+        Raises:
+            CuotaExcedida: si el catálogo nunca se cargó y el gateway descartó la lectura
         """
         try:
-            # Normalizar el número de ítem
-            import re
-            # Extraer números del texto
-            match = re.search(r'\d+', str(item_number))
-            if not match:
-                return None
-            
-            item_num = int(match.group())
-            
-            # Obtener todos los carteles
-            carteles = self.obtener_carteles_ecogas()
-            
-            # Buscar por número de ítem
-            for cartel in carteles:
-                cartel_num = cartel.get('numero', '')
-                if cartel_num and int(cartel_num) == item_num:
-                    return cartel
-            
-            return None
+            return self.catalogo.obtener(item_number)
+        except CuotaExcedida:
+            raise
         except Exception as e:
             print(f"Error al buscar cartel por ítem: {e}")
             return None
     
+    def listar_carpetas_drive(self, parent_id: str) -> List[Dict[str, str]]:
+        """
+        Subcarpetas (id, name) de una carpeta de Drive, ordenadas por nombre.
+        Las llamadas concurrentes para la misma carpeta comparten una sola request.
+        """
+        def listar():
+            results = self.drive_service.files().list(
+                q=f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false",
+                spaces='drive',
+                fields='files(id, name)',
+                pageSize=1000,  # Aumentar límite para obtener todas las carpetas
+                orderBy='name',  # Ordenar por nombre para obtener carpetas numéricas primero
+                supportsAllDrives=True,  # 🔥 Soporte para Shared Drives
+                includeItemsFromAllDrives=True,  # 🔥 Incluir items de Shared Drives
+                corpora='allDrives'  # 🔥 Buscar en todos los drives
+            ).execute()
+            return results.get('files', [])
+        
+        return self._single_flight.ejecutar(f"drive_carpetas:{parent_id}", listar)
+    
+    def listar_archivos_drive(self, parent_id: str) -> List[Dict[str, str]]:
+        """
+        Archivos (no carpetas) de una carpeta de Drive.
+        Las llamadas concurrentes para la misma carpeta comparten una sola request.
+        """
+        def listar():
+            results = self.drive_service.files().list(
+                q=f"'{parent_id}' in parents and mimeType != 'application/vnd.google-apps.folder' and trashed=false",
+                spaces='drive',
+                fields='files(id, name, mimeType, webViewLink, webContentLink)',
+                pageSize=500,  # Aumentar límite para fotos en carpeta
+                supportsAllDrives=True,  # 🔥 Soporte para Shared Drives
+                includeItemsFromAllDrives=True,  # 🔥 Incluir items de Shared Drives
+                corpora='allDrives'  # 🔥 Buscar en todos los drives
+            ).execute()
+            return results.get('files', [])
+        
+        return self._single_flight.ejecutar(f"drive_archivos:{parent_id}", listar)
+    
     def obtener_imagenes_cartel(self, item_number: str) -> List[Dict[str, str]]:
         """
         Obtiene las imágenes de un cartel desde Google Drive.
         Busca en la carpeta principal de imágenes usando el número de ítem.
+        
+        Raises:
+            CuotaExcedida: si el gateway descartó la consulta a Drive
         """
         try:
             if not self.imagenes_carteles_folder_id:
@@ -1611,22 +2201,9 @@ class GoogleSheetsService:
             print(f"📂 Carpeta base configurada: {self.imagenes_carteles_folder_id}")
             
             # Buscar carpeta con el nombre del ítem dentro de la carpeta principal
-            # Primero buscar todas las carpetas que contengan el número
-            query = f"'{self.imagenes_carteles_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-            
+            # Primero listar todas las carpetas y quedarse con las que contengan el número
             print(f"🔍 Ejecutando búsqueda en Drive...")
-            results = self.drive_service.files().list(
-                q=query,
-                spaces='drive',
-                fields='files(id, name)',
-                pageSize=1000,  # Aumentar límite para obtener todas las carpetas
-                orderBy='name',  # Ordenar por nombre para obtener carpetas numéricas primero
-                supportsAllDrives=True,  # 🔥 Soporte para Shared Drives
-                includeItemsFromAllDrives=True,  # 🔥 Incluir items de Shared Drives
-                corpora='allDrives'  # 🔥 Buscar en todos los drives
-            ).execute()
-            
-            all_folders = results.get('files', [])
+            all_folders = self.listar_carpetas_drive(self.imagenes_carteles_folder_id)
             
             # Filtrar para encontrar coincidencia exacta del número
             folders = []
@@ -1671,36 +2248,12 @@ class GoogleSheetsService:
                 print(f"{indent}🔍 Buscando en carpeta ID: {parent_id}")
                 
                 # Obtener TODOS los archivos (no carpetas) de esta carpeta
-                query_files = f"'{parent_id}' in parents and mimeType != 'application/vnd.google-apps.folder' and trashed=false"
-                
-                results_files = self.drive_service.files().list(
-                    q=query_files,
-                    spaces='drive',
-                    fields='files(id, name, mimeType, webViewLink, webContentLink)',
-                    pageSize=500,  # Aumentar límite para fotos en carpeta
-                    supportsAllDrives=True,  # 🔥 Soporte para Shared Drives
-                    includeItemsFromAllDrives=True,  # 🔥 Incluir items de Shared Drives
-                    corpora='allDrives'  # 🔥 Buscar en todos los drives
-                ).execute()
-                
-                files = results_files.get('files', [])
+                files = self.listar_archivos_drive(parent_id)
                 print(f"{indent}📄 Encontrados {len(files)} archivos en este nivel")
                 all_images.extend(files)
                 
                 # Buscar subcarpetas
-                query_folders = f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-                
-                results_folders = self.drive_service.files().list(
-                    q=query_folders,
-                    spaces='drive',
-                    fields='files(id, name)',
-                    pageSize=500,  # Aumentar límite para subcarpetas
-                    supportsAllDrives=True,  # 🔥 Soporte para Shared Drives
-                    includeItemsFromAllDrives=True,  # 🔥 Incluir items de Shared Drives
-                    corpora='allDrives'  # 🔥 Buscar en todos los drives
-                ).execute()
-                
-                subfolders = results_folders.get('files', [])
+                subfolders = self.listar_carpetas_drive(parent_id)
                 if subfolders:
                     print(f"{indent}📁 Encontradas {len(subfolders)} subcarpetas")
                     for subfolder in subfolders:
@@ -1740,6 +2293,9 @@ class GoogleSheetsService:
             print(f"🖼️ Encontradas {len(imagenes_list)} imágenes para ítem {item_formatted}")
             return imagenes_list
             
+        except CuotaExcedida:
+            # No es "sin imágenes": el llamador avisa que reintente
+            raise
         except Exception as e:
             print(f"Error al obtener imágenes del cartel: {e}")
             import traceback
@@ -1842,6 +2398,69 @@ class GoogleSheetsService:
             import traceback
             traceback.print_exc()
             return False    
+    def _get_log_streamlit_worksheet(self):
+        """Obtiene (o crea con encabezados) la pestaña LOG_Streamlit de la planilla LOG."""
+        log_sheet = self._get_whatsapp_log_sheet()  # Usa la misma planilla LOG
+        if not log_sheet:
+            print("No se configuró hoja LOG")
+            return None
+        
+        # Buscar o crear pestaña LOG_Streamlit
+        try:
+            return log_sheet.worksheet("LOG_Streamlit")
+        except:
+            # Crear pestaña si no existe
+            worksheet = log_sheet.add_worksheet(
+                title="LOG_Streamlit",
+                rows=1000,
+                cols=10
+            )
+            # Agregar encabezados
+            headers = [
+                "Timestamp",
+                "Fecha",
+                "Hora",
+                "Usuario",
+                "Acción",
+                "Item",
+                "Detalles",
+                "Fotos ANTES",
+                "Fotos DESPUÉS",
+                "Resultado"
+            ]
+            worksheet.append_row(headers)
+            self._log_streamlit_cursor.invalidar()
+            return worksheet
+    
+    def _construir_fila_log_streamlit(
+        self,
+        usuario: str,
+        accion: str,
+        numero_item: str = "",
+        detalles: str = "",
+        resultado: str = "",
+        fotos_antes: int = 0,
+        fotos_despues: int = 0
+    ) -> List[str]:
+        """Arma una fila de LOG_Streamlit (columnas A:J)."""
+        now = datetime.now()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        fecha = now.strftime("%d/%m/%Y")
+        hora = now.strftime("%H:%M:%S")
+        
+        return [
+            timestamp,
+            fecha,
+            hora,
+            usuario,
+            accion,
+            str(numero_item) if numero_item else "",
+            detalles[:500] if detalles else "",
+            str(fotos_antes) if fotos_antes else "0",
+            str(fotos_despues) if fotos_despues else "0",
+            resultado[:200] if resultado else ""
+        ]
+    
     def registrar_log_streamlit(
         self,
         usuario: str,
@@ -1868,54 +2487,19 @@ class GoogleSheetsService:
             True si se registró correctamente
         """
         try:
-            log_sheet = self._get_whatsapp_log_sheet()  # Usa la misma planilla LOG
-            if not log_sheet:
-                print("No se configuró hoja LOG")
+            worksheet = self._get_log_streamlit_worksheet()
+            if not worksheet:
                 return False
             
-            # Buscar o crear pestaña LOG_Streamlit
-            try:
-                worksheet = log_sheet.worksheet("LOG_Streamlit")
-            except:
-                # Crear pestaña si no existe
-                worksheet = log_sheet.add_worksheet(
-                    title="LOG_Streamlit",
-                    rows=1000,
-                    cols=10
-                )
-                # Agregar encabezados
-                headers = [
-                    "Timestamp",
-                    "Fecha",
-                    "Hora",
-                    "Usuario",
-                    "Acción",
-                    "Item",
-                    "Detalles",
-                    "Fotos ANTES",
-                    "Fotos DESPUÉS",
-                    "Resultado"
-                ]
-                worksheet.append_row(headers)
-            
-            # Preparar datos
-            now = datetime.now()
-            timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-            fecha = now.strftime("%d/%m/%Y")
-            hora = now.strftime("%H:%M:%S")
-            
-            fila = [
-                timestamp,
-                fecha,
-                hora,
-                usuario,
-                accion,
-                str(numero_item) if numero_item else "",
-                detalles[:500] if detalles else "",
-                str(fotos_antes) if fotos_antes else "0",
-                str(fotos_despues) if fotos_despues else "0",
-                resultado[:200] if resultado else ""
-            ]
+            fila = self._construir_fila_log_streamlit(
+                usuario=usuario,
+                accion=accion,
+                numero_item=numero_item,
+                detalles=detalles,
+                resultado=resultado,
+                fotos_antes=fotos_antes,
+                fotos_despues=fotos_despues
+            )
             
             # Agregar fila
             worksheet.append_row(fila)
@@ -1926,4 +2510,4 @@ class GoogleSheetsService:
             print(f"⚠️ Error al registrar log Streamlit: {e}")
             import traceback
             traceback.print_exc()
-            return False
\ No newline at end of file
+            return False
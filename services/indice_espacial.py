@@ -0,0 +1,169 @@
+"""
+Índice espacial en grilla para buscar carteles cercanos.
+
+Los carteles se agrupan en celdas de aproximadamente `celda_km` de lado
+(grados de latitud/longitud, con el ancho en longitud ajustado a la latitud
+más alejada del ecuador del catálogo, así ninguna celda mide menos de
+`celda_km` en ninguna dirección). Una consulta recorre anillos de celdas
+alrededor del punto y corta cuando ningún cartel de los anillos siguientes
+puede estar más cerca que los encontrados; cada candidato se mide con
+haversine exacto (vectorizado por anillo, ver services/geolocation.py).
+
+Con carteles repartidos a lo largo de gasoductos, una búsqueda del más
+cercano revisa unas pocas celdas aunque el catálogo tenga 100k+ puntos.
+"""
+
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from services.geolocation import KM_POR_GRADO, distancias_desde
+
+# La distancia por la superficie entre dos celdas es apenas menor que la medida
+# sobre el paralelo; el margen cubre esa diferencia para celdas de decenas de km.
+_MARGEN_COTA = 0.995
+
+_SIN_INDICES = np.empty(0, dtype=np.intp)
+_SIN_DISTANCIAS = np.empty(0, dtype=float)
+
+
+def coordenadas_validas(latitud: Any, longitud: Any) -> Optional[Tuple[float, float]]:
+    """(lat, lon) como float si son interpretables y están en rango, o None."""
+    try:
+        lat, lon = float(latitud), float(longitud)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(lat) or math.isnan(lon) or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+class IndiceEspacial:
+    """Grilla lat/lon con búsqueda de los k más cercanos y por radio."""
+
+    def __init__(self, puntos: Iterable[Tuple[float, float, Any]], celda_km: float = 2.0):
+        self.celda_km = celda_km
+        puntos = list(puntos)
+        self._lats = np.array([p[0] for p in puntos], dtype=float)
+        self._lons = np.array([p[1] for p in puntos], dtype=float)
+        self._valores: List[Any] = [p[2] for p in puntos]
+
+        # Ancho en longitud calculado para la latitud más alejada del ecuador
+        self._lat_ref = min(float(np.abs(self._lats).max()) if len(puntos) else 0.0, 89.0)
+        self._grados_lat = celda_km / KM_POR_GRADO
+        self._grados_lon = celda_km / (KM_POR_GRADO * math.cos(math.radians(self._lat_ref)))
+
+        # Celda de cada punto; los índices de cada celda se guardan como array
+        filas = np.floor(self._lats / self._grados_lat).astype(np.int64)
+        columnas = np.floor(self._lons / self._grados_lon).astype(np.int64)
+        agrupados: Dict[Tuple[int, int], List[int]] = {}
+        for indice, celda in enumerate(zip(filas.tolist(), columnas.tolist())):
+            agrupados.setdefault(celda, []).append(indice)
+        self._celdas: Dict[Tuple[int, int], np.ndarray] = {
+            celda: np.array(indices, dtype=np.intp) for celda, indices in agrupados.items()
+        }
+
+        if self._celdas:
+            self._limites = (int(filas.min()), int(filas.max()), int(columnas.min()), int(columnas.max()))
+
+    def __len__(self) -> int:
+        return len(self._valores)
+
+    def _celda(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self._grados_lat), math.floor(lon / self._grados_lon)
+
+    def _ancho_minimo_km(self, lat: float) -> float:
+        """Cota inferior del lado de una celda entre el punto consultado y el catálogo."""
+        lat_max = min(max(abs(lat), self._lat_ref), 89.0)
+        factor = math.cos(math.radians(lat_max)) / math.cos(math.radians(self._lat_ref))
+        return self.celda_km * min(1.0, factor) * _MARGEN_COTA
+
+    def _anillo(self, fila: int, columna: int, r: int) -> Iterable[Tuple[int, int]]:
+        if r == 0:
+            yield fila, columna
+            return
+        for c in range(columna - r, columna + r + 1):
+            yield fila - r, c
+            yield fila + r, c
+        for f in range(fila - r + 1, fila + r):
+            yield f, columna - r
+            yield f, columna + r
+
+    def _recorrer(self, lat: float, lon: float, hasta_km: Optional[float]):
+        """
+        Genera (cota_km, indices, distancias) por anillo: ningún punto de los
+        anillos siguientes está a menos de cota_km. Si un anillo tiene más
+        celdas que las ocupadas, recorre de una vez las ocupadas restantes.
+        """
+        if not self._celdas:
+            return
+        fila, columna = self._celda(lat, lon)
+        ancho = self._ancho_minimo_km(lat)
+        fila_min, fila_max, columna_min, columna_max = self._limites
+        r_max = max(abs(fila - fila_min), abs(fila - fila_max), abs(columna - columna_min), abs(columna - columna_max))
+
+        r = 0
+        while r <= r_max:
+            if hasta_km is not None and (r - 1) * ancho > hasta_km:
+                return
+            resto = 8 * r > len(self._celdas)
+            if resto:
+                bloques = [
+                    indices for (f, c), indices in self._celdas.items()
+                    if max(abs(f - fila), abs(c - columna)) >= r
+                ]
+            else:
+                bloques = [self._celdas[celda] for celda in self._anillo(fila, columna, r) if celda in self._celdas]
+
+            if bloques:
+                indices = np.concatenate(bloques)
+                distancias = distancias_desde(lat, lon, self._lats[indices], self._lons[indices])
+            else:
+                indices, distancias = _SIN_INDICES, _SIN_DISTANCIAS
+            yield (float("inf") if resto else r * ancho), indices, distancias
+            if resto:
+                return
+            r += 1
+
+    def cercanos(
+        self,
+        latitud: float,
+        longitud: float,
+        k: int = 1,
+        radio_max_km: Optional[float] = None
+    ) -> List[Tuple[float, Any]]:
+        """Los k puntos más cercanos como (distancia_km, valor), del más cercano al más lejano."""
+        if k <= 0:
+            return []
+        indices, distancias = _SIN_INDICES, _SIN_DISTANCIAS
+        for cota_km, nuevos, distancias_nuevas in self._recorrer(latitud, longitud, radio_max_km):
+            if radio_max_km is not None:
+                dentro = distancias_nuevas <= radio_max_km
+                nuevos, distancias_nuevas = nuevos[dentro], distancias_nuevas[dentro]
+            if len(nuevos):
+                indices = np.concatenate((indices, nuevos))
+                distancias = np.concatenate((distancias, distancias_nuevas))
+            if len(distancias) >= k and np.partition(distancias, k - 1)[k - 1] <= cota_km:
+                break
+        orden = np.argsort(distancias, kind="stable")[:k]
+        return [(float(distancias[i]), self._valores[indices[i]]) for i in orden]
+
+    def en_radio(self, latitud: float, longitud: float, radio_km: float) -> List[Tuple[float, Any]]:
+        """Todos los puntos a radio_km o menos, ordenados por distancia."""
+        encontrados = []
+        for _, indices, distancias in self._recorrer(latitud, longitud, radio_km):
+            dentro = distancias <= radio_km
+            encontrados.extend(zip(distancias[dentro].tolist(), indices[dentro].tolist()))
+        encontrados.sort()
+        return [(d, self._valores[i]) for d, i in encontrados]
+
+
+def indice_de_carteles(carteles: List[Dict[str, Any]], celda_km: float = 2.0) -> IndiceEspacial:
+    """Índice de los carteles con coordenadas válidas (el valor de cada punto es el cartel)."""
+    puntos = []
+    for cartel in carteles:
+        coordenadas = coordenadas_validas(cartel.get('latitud'), cartel.get('longitud'))
+        if coordenadas is not None:
+            puntos.append((coordenadas[0], coordenadas[1], cartel))
+    return IndiceEspacial(puntos, celda_km)
@@ -0,0 +1,230 @@
+"""
+Cola de mensajes entrantes de WhatsApp particionada por remitente.
+
+Con varios workers, Twilio puede entregar dos mensajes seguidos del mismo
+operario a workers distintos y procesarlos en paralelo (o fuera de orden).
+El webhook encola el mensaje en un SQLite compartido y responde enseguida; la
+partición es crc32(From) % particiones, y cada partición la consume un único
+worker a la vez (lease renovable). Así los mensajes de un mismo operario se
+procesan en orden y las particiones se reparten entre los workers.
+
+Si un worker muere, su lease vence y otro toma la partición; los mensajes que
+quedaron 'procesando' vuelven a 'pendiente'.
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from services.shared_state import conectar_sqlite, ruta_estado_compartido
+
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+HECHO = "hecho"
+FALLIDO = "fallido"
+
+
+class MessageQueue:
+    """Cola persistente y ordenada por remitente, repartida entre workers."""
+
+    def __init__(
+        self,
+        particiones: int,
+        ruta: Optional[str] = None,
+        lease_segundos: float = 30,
+        max_intentos: int = 3
+    ):
+        self.particiones = max(1, particiones)
+        self.ruta = ruta or ruta_estado_compartido()
+        self.lease_segundos = lease_segundos
+        self.max_intentos = max_intentos
+        self.worker_id = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        # Particiones con un mensaje en proceso: no se ceden hasta terminarlo
+        self._en_proceso: Dict[int, int] = {}
+        self._conn = conectar_sqlite(self.ruta)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS mensajes_entrantes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                particion INTEGER NOT NULL,
+                remitente TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                creado_en REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_mensajes_particion
+                ON mensajes_entrantes (particion, estado, id);
+            CREATE TABLE IF NOT EXISTS particiones_cola (
+                particion INTEGER PRIMARY KEY,
+                worker TEXT,
+                vence_en REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS workers_cola (
+                worker TEXT PRIMARY KEY,
+                vence_en REAL NOT NULL
+            );
+            """
+        )
+
+    def particion_de(self, remitente: str) -> int:
+        return zlib.crc32(remitente.encode("utf-8")) % self.particiones
+
+    def encolar(self, remitente: str, payload: Dict[str, Any]) -> int:
+        """Encola un mensaje y devuelve su id."""
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                INSERT INTO mensajes_entrantes (particion, remitente, payload, estado, creado_en)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (self.particion_de(remitente), remitente, json.dumps(payload), PENDIENTE, time.time())
+            )
+            return cursor.lastrowid
+
+    def reclamar_particiones(self) -> List[int]:
+        """
+        Renueva los leases propios y reparte las particiones: toma libres o
+        vencidas hasta la parte justa de este worker y cede las que le sobran
+        cuando aparecen otros workers. Devuelve las particiones que posee.
+        """
+        ahora = time.time()
+        vence_en = ahora + self.lease_segundos
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for particion in range(self.particiones):
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO particiones_cola (particion, worker, vence_en) VALUES (?, NULL, 0)",
+                        (particion,)
+                    )
+                self._conn.execute(
+                    "UPDATE particiones_cola SET vence_en = ? WHERE worker = ?",
+                    (vence_en, self.worker_id)
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO workers_cola (worker, vence_en) VALUES (?, ?)",
+                    (self.worker_id, vence_en)
+                )
+                self._conn.execute("DELETE FROM workers_cola WHERE vence_en <= ?", (ahora,))
+
+                vivos = self._conn.execute("SELECT COUNT(*) FROM workers_cola").fetchone()[0]
+                parte_justa = -(-self.particiones // max(1, vivos))  # ceil
+
+                filas = self._conn.execute("SELECT particion, worker, vence_en FROM particiones_cola").fetchall()
+                propias = [p for p, worker, _ in filas if worker == self.worker_id]
+
+                # Ceder el excedente (nunca una partición con un mensaje en proceso)
+                sobrantes = [p for p in reversed(propias) if p not in self._en_proceso]
+                for particion in sobrantes[:max(0, len(propias) - parte_justa)]:
+                    self._conn.execute(
+                        "UPDATE particiones_cola SET worker = NULL, vence_en = 0 WHERE particion = ?",
+                        (particion,)
+                    )
+                    propias.remove(particion)
+
+                libres = [p for p, worker, vence in filas if worker != self.worker_id and (not worker or vence <= ahora)]
+                for particion in libres[:max(0, parte_justa - len(propias))]:
+                    self._conn.execute(
+                        "UPDATE particiones_cola SET worker = ?, vence_en = ? WHERE particion = ?",
+                        (self.worker_id, vence_en, particion)
+                    )
+                    # Lo que quedó a medio procesar por el dueño anterior se reintenta
+                    self._conn.execute(
+                        "UPDATE mensajes_entrantes SET estado = ? WHERE particion = ? AND estado = ?",
+                        (PENDIENTE, particion, PROCESANDO)
+                    )
+                    propias.append(particion)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return sorted(propias)
+
+    def liberar_particiones(self):
+        """Suelta los leases de este worker (al apagarse) para que otro los tome ya."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE particiones_cola SET worker = NULL, vence_en = 0 WHERE worker = ?",
+                (self.worker_id,)
+            )
+            self._conn.execute("DELETE FROM workers_cola WHERE worker = ?", (self.worker_id,))
+
+    def siguiente(self, particion: int) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """
+        Toma el mensaje pendiente más antiguo de la partición (en orden de llegada).
+        Devuelve None si no hay mensajes o si la partición ya no es de este worker.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                dueno = self._conn.execute(
+                    "SELECT worker FROM particiones_cola WHERE particion = ?", (particion,)
+                ).fetchone()
+                if not dueno or dueno[0] != self.worker_id:
+                    self._conn.execute("COMMIT")
+                    return None
+                fila = self._conn.execute(
+                    """
+                    SELECT id, payload FROM mensajes_entrantes
+                    WHERE particion = ? AND estado IN (?, ?)
+                    ORDER BY id LIMIT 1
+                    """,
+                    (particion, PENDIENTE, PROCESANDO)
+                ).fetchone()
+                if fila is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE mensajes_entrantes SET estado = ?, intentos = intentos + 1 WHERE id = ?",
+                    (PROCESANDO, fila[0])
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._en_proceso[particion] = fila[0]
+        return fila[0], json.loads(fila[1])
+
+    def _terminar(self, mensaje_id: int):
+        for particion, en_proceso in list(self._en_proceso.items()):
+            if en_proceso == mensaje_id:
+                del self._en_proceso[particion]
+
+    def marcar_hecho(self, mensaje_id: int):
+        with self._lock:
+            self._terminar(mensaje_id)
+            self._conn.execute(
+                "UPDATE mensajes_entrantes SET estado = ? WHERE id = ?", (HECHO, mensaje_id)
+            )
+
+    def marcar_error(self, mensaje_id: int):
+        """Devuelve el mensaje a la cola, o lo descarta si agotó los intentos."""
+        with self._lock:
+            self._terminar(mensaje_id)
+            self._conn.execute(
+                "UPDATE mensajes_entrantes SET estado = CASE WHEN intentos >= ? THEN ? ELSE ? END WHERE id = ?",
+                (self.max_intentos, FALLIDO, PENDIENTE, mensaje_id)
+            )
+
+    def pendientes(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM mensajes_entrantes WHERE estado IN (?, ?)",
+                (PENDIENTE, PROCESANDO)
+            ).fetchone()[0]
+
+    def purgar(self, antiguedad_segundos: float = 24 * 3600) -> int:
+        """Elimina mensajes ya resueltos (hechos o fallidos) más viejos que la antigüedad dada."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM mensajes_entrantes WHERE estado IN (?, ?) AND creado_en < ?",
+                (HECHO, FALLIDO, time.time() - antiguedad_segundos)
+            )
+            return cursor.rowcount
@@ -0,0 +1,187 @@
+"""
+Registro unificado de métricas (Prometheus).
+
+Un solo lugar para los contadores, gauges e histogramas del sistema:
+latencia del webhook, de cada llamada a Sheets/Drive/Twilio/Gemini, aciertos
+de cache y profundidad de colas. Se exponen en /metrics en formato de texto
+de Prometheus.
+
+Con varios workers de uvicorn, definir PROMETHEUS_MULTIPROC_DIR (un directorio
+vacío al arrancar) para que cada proceso escriba sus valores ahí y /metrics
+agregue los de todos los workers.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+
+MULTIPROCESO = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Buckets pensados para APIs externas (de decenas de ms a ~1 min)
+BUCKETS_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# ===== HTTP / WEBHOOK =====
+HTTP_REQUESTS = Counter(
+    "ecogas_http_requests_total",
+    "Requests HTTP atendidas por el API",
+    ["metodo", "ruta", "estado"],
+)
+HTTP_LATENCIA = Histogram(
+    "ecogas_http_request_seconds",
+    "Latencia de las requests HTTP del API",
+    ["metodo", "ruta"],
+    buckets=BUCKETS_LATENCIA,
+)
+WEBHOOK_MENSAJES = Counter(
+    "ecogas_webhook_mensajes_total",
+    "Mensajes de WhatsApp recibidos por el webhook",
+    ["tipo"],
+)
+TRANSICIONES = Counter(
+    "ecogas_conversacion_transiciones_total",
+    "Transiciones ejecutadas por la máquina de estados del webhook (sin_transicion: mensaje ignorado)",
+    ["transicion"],
+)
+TRANSICION_LATENCIA = Histogram(
+    "ecogas_conversacion_transicion_seconds",
+    "Latencia de cada transición de la conversación (incluye envíos a Twilio y subidas a Drive)",
+    ["transicion"],
+    buckets=BUCKETS_LATENCIA,
+)
+
+RUTA_KM_AHORRADOS = Counter(
+    "ecogas_ruta_km_ahorrados_total",
+    "Kilómetros estimados ahorrados al ordenar el recorrido de sesiones de varios ítems",
+)
+
+VERIFICACIONES_TRABAJO = Counter(
+    "ecogas_verificaciones_trabajo_total",
+    "Comparaciones ANTES/DESPUÉS de trabajos por veredicto (aprobado/revisar/rechazado/error)",
+    ["veredicto"],
+)
+
+# ===== APIS EXTERNAS =====
+LLAMADAS_EXTERNAS = Counter(
+    "ecogas_llamadas_externas_total",
+    "Llamadas a servicios externos por resultado",
+    ["servicio", "operacion", "resultado"],
+)
+LATENCIA_EXTERNA = Histogram(
+    "ecogas_llamada_externa_seconds",
+    "Latencia de llamadas a servicios externos (sheets, drive, twilio, gemini)",
+    ["servicio", "operacion"],
+    buckets=BUCKETS_LATENCIA,
+)
+TOKENS_GEMINI = Counter(
+    "ecogas_gemini_tokens_total",
+    "Tokens consumidos en Gemini por operación y tipo (prompt/respuesta)",
+    ["operacion", "tipo"],
+)
+CUOTA_EVENTOS = Counter(
+    "ecogas_cuota_google_eventos_total",
+    "Eventos del gateway de cuota de Google (espera, descarte, 429)",
+    ["api", "clase", "evento"],
+)
+
+# ===== CACHES =====
+CACHE_CONSULTAS = Counter(
+    "ecogas_cache_consultas_total",
+    "Consultas a caches internos por resultado (hit/miss)",
+    ["cache", "resultado"],
+)
+SNAPSHOT_EDAD = Gauge(
+    "ecogas_snapshot_edad_segundos",
+    "Antigüedad del snapshot servido por cada cache stale-while-revalidate",
+    ["snapshot"],
+    multiprocess_mode="livemax",
+)
+SINGLE_FLIGHT = Counter(
+    "ecogas_single_flight_total",
+    "Lecturas coalescidas por recurso: lider (hizo la request) o compartida (esperó su resultado)",
+    ["recurso", "rol"],
+)
+
+# ===== COLAS Y ESTADO =====
+PROFUNDIDAD_COLA = Gauge(
+    "ecogas_cola_profundidad",
+    "Elementos pendientes en colas internas",
+    ["cola"],
+    # Las colas (mensajes, movimientos de stock) viven en SQLite compartido y cada
+    # worker publica el total: sumarlos lo multiplicaría por la cantidad de workers
+    multiprocess_mode="livemax",
+)
+CONVERSACIONES_ACTIVAS = Gauge(
+    "ecogas_conversaciones_activas",
+    "Conversaciones de WhatsApp con estado en curso",
+    # Cada worker lee el total del store compartido: sumarlos lo multiplicaría
+    multiprocess_mode="livemax",
+)
+ESTADO_CONVERSACION_BYTES = Histogram(
+    "ecogas_conversacion_estado_bytes",
+    "Tamaño serializado del estado de una conversación al guardarlo",
+    buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 65536),
+)
+
+
+@contextmanager
+def medir_llamada(servicio: str, operacion: str):
+    """Mide latencia y resultado de una llamada externa."""
+    inicio = time.perf_counter()
+    resultado = "ok"
+    try:
+        yield
+    except Exception:
+        resultado = "error"
+        raise
+    finally:
+        LATENCIA_EXTERNA.labels(servicio, operacion).observe(time.perf_counter() - inicio)
+        LLAMADAS_EXTERNAS.labels(servicio, operacion, resultado).inc()
+
+
+def registrar_llamada(servicio: str, operacion: str, exito: bool):
+    """Cuenta una llamada externa cuyo resultado se conoce sin excepción (ej: retorno bool)."""
+    LLAMADAS_EXTERNAS.labels(servicio, operacion, "ok" if exito else "error").inc()
+
+
+def registrar_tokens_gemini(operacion: str, uso):
+    """Tokens de una respuesta de Gemini (usage_metadata); se ignora si no viene."""
+    if uso is None:
+        return
+    TOKENS_GEMINI.labels(operacion, "prompt").inc(getattr(uso, "prompt_token_count", 0) or 0)
+    TOKENS_GEMINI.labels(operacion, "respuesta").inc(getattr(uso, "candidates_token_count", 0) or 0)
+
+
+def registrar_cache(cache: str, hit: bool):
+    CACHE_CONSULTAS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def exportar() -> Tuple[bytes, str]:
+    """Métricas en formato texto de Prometheus, agregadas entre workers si corresponde."""
+    if MULTIPROCESO:
+        from prometheus_client import multiprocess
+
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = REGISTRY
+    return generate_latest(registro), CONTENT_TYPE_LATEST
+
+
+def marcar_proceso_terminado():
+    """Libera los archivos de gauges 'live' del worker al apagarse."""
+    if MULTIPROCESO:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(os.getpid())
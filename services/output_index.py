@@ -0,0 +1,150 @@
+"""
+Índice de filas de la planilla OUTPUT.
+
+Mantiene en memoria el mapa N° de item -> fila de OUTPUT y un cursor a la
+próxima fila libre, para no descargar la columna F completa en cada registro.
+El índice se construye una vez con la columna F y luego se revalida con una
+lectura acotada (la fila conocida del item y una ventana después del cursor).
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# La planilla OUTPUT tiene headers en filas 9-10, los datos empiezan en la fila 11
+PRIMERA_FILA_DATOS = 11
+COLUMNA_ITEM = 'F'
+
+
+class OutputRowIndex:
+    """Índice N° de item -> fila con cursor de próxima fila libre."""
+
+    def __init__(
+        self,
+        columna: str = COLUMNA_ITEM,
+        primera_fila: int = PRIMERA_FILA_DATOS,
+        ttl_segundos: float = 600,
+        ventana_validacion: int = 20
+    ):
+        self.columna = columna
+        self.primera_fila = primera_fila
+        self.ttl_segundos = ttl_segundos
+        self.ventana_validacion = ventana_validacion
+
+        self._filas: Dict[str, int] = {}
+        self._proxima_fila = primera_fila
+        self._construido_en: Optional[float] = None
+
+        # Serializa localizar + escribir para que dos registros no tomen la misma fila
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _clave(numero_item) -> str:
+        return str(numero_item).strip()
+
+    @property
+    def proxima_fila(self) -> int:
+        return self._proxima_fila
+
+    def necesita_reconstruir(self) -> bool:
+        """Indica si el índice nunca se construyó o ya venció su TTL."""
+        if self._construido_en is None:
+            return True
+        return (time.monotonic() - self._construido_en) > self.ttl_segundos
+
+    def invalidar(self):
+        """Fuerza la reconstrucción en el próximo uso."""
+        with self.lock:
+            self._construido_en = None
+
+    def construir(self, valores_columna: List[str]):
+        """
+        Construye el índice a partir de los valores de la columna completa
+        (resultado de worksheet.col_values).
+        """
+        with self.lock:
+            filas: Dict[str, int] = {}
+            ultima_fila_con_datos = self.primera_fila - 1
+
+            for i, valor in enumerate(valores_columna, start=1):
+                if i < self.primera_fila:
+                    continue
+                clave = self._clave(valor)
+                if not clave:
+                    continue
+                # Se conserva la primera aparición, igual que la búsqueda lineal original
+                filas.setdefault(clave, i)
+                ultima_fila_con_datos = i
+
+            self._filas = filas
+            self._proxima_fila = ultima_fila_con_datos + 1
+            self._construido_en = time.monotonic()
+
+    def rangos_validacion(self, numeros_items: List[str]) -> List[str]:
+        """
+        Rangos A1 a leer (en un solo batch_get) para revalidar el índice antes
+        de escribir: la fila conocida de cada item y la ventana tras el cursor.
+        """
+        rangos = []
+        for numero_item in numeros_items:
+            fila = self._filas.get(self._clave(numero_item))
+            if fila:
+                rangos.append(f"{self.columna}{fila}")
+        inicio = self._proxima_fila
+        fin = inicio + self.ventana_validacion - 1
+        rangos.append(f"{self.columna}{inicio}:{self.columna}{fin}")
+        return rangos
+
+    def validar(self, numeros_items: List[str], valores: List[List[List[str]]]) -> bool:
+        """
+        Comprueba los valores leídos con rangos_validacion() (mismo orden).
+        Devuelve False si la planilla cambió por fuera del índice.
+        """
+        posicion = 0
+        for numero_item in numeros_items:
+            clave = self._clave(numero_item)
+            if clave not in self._filas:
+                continue
+            celda = valores[posicion] if len(valores) > posicion else []
+            posicion += 1
+            actual = celda[0][0] if celda and celda[0] else ''
+            if self._clave(actual) != clave:
+                return False
+
+        ventana = valores[posicion] if len(valores) > posicion else []
+        for fila in ventana:
+            if any(self._clave(v) for v in fila):
+                # Alguien escribió después del cursor (otro proceso o edición manual)
+                return False
+        return True
+
+    def reservar_fila(self) -> int:
+        """Reserva la próxima fila libre sin asociarla a un item (filas de log)."""
+        with self.lock:
+            fila = self._proxima_fila
+            self._proxima_fila = fila + 1
+            return fila
+
+    def localizar(self, numero_item) -> Tuple[int, bool]:
+        """
+        Devuelve (fila, existente) para el item.
+        Si el item no existe se reserva la próxima fila libre.
+        """
+        with self.lock:
+            clave = self._clave(numero_item)
+            fila = self._filas.get(clave)
+            if fila:
+                return fila, True
+            fila = self._proxima_fila
+            self._filas[clave] = fila
+            self._proxima_fila = fila + 1
+            return fila, False
+
+    def liberar(self, numero_item, fila: int):
+        """Deshace una reserva de fila cuando la escritura falló."""
+        with self.lock:
+            clave = self._clave(numero_item)
+            if self._filas.get(clave) == fila:
+                del self._filas[clave]
+                if self._proxima_fila == fila + 1:
+                    self._proxima_fila = fila
@@ -0,0 +1,162 @@
+"""
+Orden de recorrido para sesiones de varios ítems.
+
+Cuando el operario envía "277, 278, 279" los ítems se atendían en el orden
+del mensaje, aunque eso implique ir y volver a lo largo del ramal. El
+planificador ordena los ítems con coordenadas para minimizar el recorrido:
+
+1. Matriz de distancias haversine (services/geolocation.py).
+2. Vecino más cercano desde el origen (la ubicación compartida por el
+   operario) o, sin origen, desde cada ítem, quedándose con el más corto.
+3. 2-opt sobre el camino abierto (no se vuelve al origen), partiendo tanto
+   del resultado anterior como del orden original, y se toma el mejor.
+
+Los ítems sin coordenadas van al final en el orden en que se enviaron. Para
+50 ítems el cálculo tarda pocos milisegundos.
+"""
+
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services.geolocation import distancias_desde, matriz_distancias
+from services.indice_espacial import coordenadas_validas
+
+# Mejoras de 2-opt menores que esto (km) se ignoran para evitar ciclos por redondeo
+_TOLERANCIA_KM = 1e-9
+
+
+class PlanRuta(NamedTuple):
+    orden: List[int]             # índices de los puntos en el orden a recorrer
+    km_original: float           # recorrido en el orden recibido
+    km_optimizado: float         # recorrido en el orden planificado
+
+    @property
+    def km_ahorrados(self) -> float:
+        return max(0.0, self.km_original - self.km_optimizado)
+
+
+def _matriz_con_extremos(
+    lats: np.ndarray,
+    lons: np.ndarray,
+    origen: Optional[Tuple[float, float]]
+) -> np.ndarray:
+    """
+    Matriz (n+2)x(n+2): los puntos en 0..n-1, el inicio en n y un final ficticio
+    en n+1 a distancia 0 de todos. Sin origen el inicio también está a distancia
+    0, así el camino puede empezar en cualquier punto.
+    """
+    n = len(lats)
+    matriz = np.zeros((n + 2, n + 2))
+    matriz[:n, :n] = matriz_distancias(lats, lons)
+    if origen is not None:
+        desde_origen = distancias_desde(origen[0], origen[1], lats, lons)
+        matriz[n, :n] = desde_origen
+        matriz[:n, n] = desde_origen
+    return matriz
+
+
+def _largo(matriz: np.ndarray, secuencia: np.ndarray) -> float:
+    return float(matriz[secuencia[:-1], secuencia[1:]].sum())
+
+
+def _vecino_mas_cercano(matriz: np.ndarray, inicio: int, n: int) -> List[int]:
+    """
+    Orden de los n puntos eligiendo siempre el más cercano al último visitado.
+    `inicio` es un punto (que queda primero) o el origen (índice n).
+    """
+    visitados = np.zeros(n, dtype=bool)
+    actual = inicio
+    orden = []
+    if inicio < n:
+        visitados[inicio] = True
+        orden.append(inicio)
+    while len(orden) < n:
+        distancias = np.where(visitados, np.inf, matriz[actual, :n])
+        actual = int(distancias.argmin())
+        visitados[actual] = True
+        orden.append(actual)
+    return orden
+
+
+def _dos_opt(matriz: np.ndarray, secuencia: np.ndarray) -> np.ndarray:
+    """
+    Invierte tramos de la secuencia mientras acorten el camino. El primer y el
+    último elemento (inicio y final ficticio) quedan fijos.
+    """
+    secuencia = secuencia.copy()
+    m = len(secuencia)
+    mejoro = True
+    while mejoro:
+        mejoro = False
+        for i in range(1, m - 2):
+            a, b = secuencia[i - 1], secuencia[i]
+            c, d = secuencia[i + 1:m - 1], secuencia[i + 2:m]
+            # Reemplazar las aristas (a,b) y (c,d) por (a,c) y (b,d), para todos los j a la vez
+            delta = matriz[a, c] + matriz[b, d] - matriz[a, b] - matriz[c, d]
+            k = int(delta.argmin())
+            if delta[k] < -_TOLERANCIA_KM:
+                j = i + 1 + k
+                secuencia[i:j + 1] = secuencia[i:j + 1][::-1]
+                mejoro = True
+    return secuencia
+
+
+def planificar_ruta(
+    puntos: Sequence[Tuple[float, float]],
+    origen: Optional[Tuple[float, float]] = None
+) -> PlanRuta:
+    """
+    Orden de recorrido de los puntos (lat, lon), empezando en `origen` si se
+    indica. km_original mide el orden recibido desde el mismo origen.
+    """
+    n = len(puntos)
+    if n == 0:
+        return PlanRuta([], 0.0, 0.0)
+
+    lats = np.array([p[0] for p in puntos], dtype=float)
+    lons = np.array([p[1] for p in puntos], dtype=float)
+    matriz = _matriz_con_extremos(lats, lons, origen)
+    inicio, final = n, n + 1
+
+    def secuencia(orden: List[int]) -> np.ndarray:
+        return np.array([inicio, *orden, final])
+
+    original = secuencia(list(range(n)))
+    km_original = _largo(matriz, original)
+
+    # Sin origen el camino puede empezar en cualquier ítem: probar todos
+    inicios = [inicio] if origen is not None else range(n)
+    vecino = min((secuencia(_vecino_mas_cercano(matriz, i, n)) for i in inicios), key=lambda s: _largo(matriz, s))
+
+    mejor_km = km_original
+    mejor = original
+    for candidato in (_dos_opt(matriz, vecino), _dos_opt(matriz, original)):
+        km = _largo(matriz, candidato)
+        if km < mejor_km - _TOLERANCIA_KM:
+            mejor_km, mejor = km, candidato
+
+    return PlanRuta([int(i) for i in mejor[1:-1]], km_original, mejor_km)
+
+
+def ordenar_items(
+    items: List[Dict[str, Any]],
+    origen: Optional[Tuple[float, float]] = None
+) -> Tuple[List[Dict[str, Any]], PlanRuta]:
+    """
+    Ordena items [{'numero', 'info': cartel}] para el recorrido. Los que no
+    tienen coordenadas válidas quedan al final en su orden original.
+    """
+    con_coordenadas = []
+    puntos = []
+    sin_coordenadas = []
+    for item in items:
+        coordenadas = coordenadas_validas(item['info'].get('latitud'), item['info'].get('longitud'))
+        if coordenadas is None:
+            sin_coordenadas.append(item)
+        else:
+            con_coordenadas.append(item)
+            puntos.append(coordenadas)
+
+    plan = planificar_ruta(puntos, origen)
+    return [con_coordenadas[i] for i in plan.orden] + sin_coordenadas, plan
@@ -0,0 +1,332 @@
+"""
+Gateway de cuota para las APIs de Google (Sheets y Drive).
+
+Lleva la cuenta de requests por minuto por API y por clase de operación
+(lectura / escritura) en una ventana deslizante de 60 s, y decide antes de
+cada request si puede salir ya, si debe esperar o si se descarta:
+
+- ALTA (escrituras, p. ej. registro en OUTPUT): puede usar todo el cupo.
+- NORMAL (lecturas del API): deja libre una reserva para las escrituras.
+- BAJA (refrescos de dashboards): usa solo una parte del cupo y se descarta
+  si no hay lugar en poco tiempo.
+
+Ante un 429 el límite efectivo se reduce a la mitad y se bloquea la API con
+backoff exponencial; cada request exitosa lo recupera de a poco (AIMD).
+
+Las esperas bloquean el thread que llama: desde código async las llamadas a
+Sheets/Drive van con asyncio.to_thread. Si igual llega una request desde el
+thread del event loop, no espera: se descarta con CuotaExcedida en lugar de
+congelar todas las conversaciones del worker.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from services import metrics
+
+
+class Prioridad:
+    BAJA = 0
+    NORMAL = 1
+    ALTA = 2
+
+    NOMBRES = {0: "baja", 1: "normal", 2: "alta"}
+
+
+LECTURA = "lectura"
+ESCRITURA = "escritura"
+
+# Fracción del límite que puede usar cada prioridad
+FRACCION_POR_PRIORIDAD = {
+    Prioridad.BAJA: 0.5,
+    Prioridad.NORMAL: 0.85,
+    Prioridad.ALTA: 1.0,
+}
+
+# Segundos máximos en cola antes de descartar la request
+ESPERA_MAXIMA_POR_PRIORIDAD = {
+    Prioridad.BAJA: 2.0,
+    Prioridad.NORMAL: 20.0,
+    Prioridad.ALTA: 60.0,
+}
+
+# Reintentos ante 429
+REINTENTOS_POR_PRIORIDAD = {
+    Prioridad.BAJA: 0,
+    Prioridad.NORMAL: 2,
+    Prioridad.ALTA: 5,
+}
+
+VENTANA_SEGUNDOS = 60.0
+
+_prioridad_actual: ContextVar[Optional[int]] = ContextVar("prioridad_google_api", default=None)
+
+
+class CuotaExcedida(Exception):
+    """La request se descartó para no exceder la cuota de la API."""
+
+
+def _en_event_loop() -> bool:
+    """True si se llama desde el thread que corre un event loop de asyncio."""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def es_error_cuota(error: Exception) -> bool:
+    """Detecta un 429 / rateLimitExceeded en errores de gspread o googleapiclient."""
+    # gspread.exceptions.APIError
+    response = getattr(error, "response", None)
+    if response is not None and getattr(response, "status_code", None) == 429:
+        return True
+    # googleapiclient.errors.HttpError
+    resp = getattr(error, "resp", None)
+    if resp is not None:
+        status = getattr(resp, "status", None)
+        if str(status) == "429":
+            return True
+        if str(status) == "403" and "rateLimitExceeded" in str(error):
+            return True
+    return False
+
+
+class _Cubeta:
+    """Ventana deslizante de requests para una API y clase de operación."""
+
+    def __init__(self, limite_por_minuto: int):
+        self.limite_base = max(1, int(limite_por_minuto))
+        self.factor = 1.0  # reducido por AIMD ante 429
+        self.marcas = deque()
+
+        self.total = 0
+        self.esperas = 0
+        self.descartadas = 0
+        self.errores_429 = 0
+
+    @property
+    def limite(self) -> int:
+        return max(1, int(self.limite_base * self.factor))
+
+    def purgar(self, ahora: float):
+        limite_ventana = ahora - VENTANA_SEGUNDOS
+        while self.marcas and self.marcas[0] <= limite_ventana:
+            self.marcas.popleft()
+
+    def cupo(self, prioridad: int) -> int:
+        return max(1, int(self.limite * FRACCION_POR_PRIORIDAD[prioridad]))
+
+    def segundos_hasta_lugar(self, ahora: float, prioridad: int) -> float:
+        """0 si hay lugar para la prioridad; si no, cuánto falta para que se libere."""
+        exceso = len(self.marcas) - self.cupo(prioridad)
+        if exceso < 0:
+            return 0.0
+        return max(0.0, self.marcas[exceso] + VENTANA_SEGUNDOS - ahora)
+
+
+class QuotaGateway:
+    """Control de cuota del lado cliente para las APIs de Google."""
+
+    def __init__(
+        self,
+        limites: Optional[Dict[str, Dict[str, int]]] = None,
+        fraccion: Optional[float] = None
+    ):
+        if limites is None:
+            limites = {
+                "sheets": {
+                    LECTURA: int(os.getenv("GOOGLE_SHEETS_READ_QPM", "60")),
+                    ESCRITURA: int(os.getenv("GOOGLE_SHEETS_WRITE_QPM", "60")),
+                },
+                "drive": {
+                    LECTURA: int(os.getenv("GOOGLE_DRIVE_READ_QPM", "600")),
+                    ESCRITURA: int(os.getenv("GOOGLE_DRIVE_WRITE_QPM", "300")),
+                },
+            }
+        # Parte de la cuota del proyecto que le toca a este proceso (API + dashboards comparten cuota)
+        if fraccion is None:
+            fraccion = float(os.getenv("GOOGLE_QUOTA_FRACTION", "1.0"))
+
+        self._cubetas: Dict[str, Dict[str, _Cubeta]] = {
+            api: {clase: _Cubeta(limite * fraccion) for clase, limite in clases.items()}
+            for api, clases in limites.items()
+        }
+        self._bloqueado_hasta: Dict[str, float] = {api: 0.0 for api in limites}
+        self._backoff: Dict[str, float] = {api: 0.0 for api in limites}
+
+        # Prioridad de las lecturas sin contexto explícito (los dashboards la bajan a BAJA)
+        self.prioridad_lecturas = Prioridad.NORMAL
+
+        self._condicion = threading.Condition()
+
+    @contextmanager
+    def prioridad(self, prioridad: int):
+        """Fija la prioridad de las requests hechas dentro del bloque."""
+        token = _prioridad_actual.set(prioridad)
+        try:
+            yield
+        finally:
+            _prioridad_actual.reset(token)
+
+    def _resolver_prioridad(self, clase: str, prioridad: Optional[int]) -> int:
+        if prioridad is not None:
+            return prioridad
+        actual = _prioridad_actual.get()
+        if actual is not None:
+            return actual
+        return Prioridad.ALTA if clase == ESCRITURA else self.prioridad_lecturas
+
+    def adquirir(self, api: str, clase: str, prioridad: Optional[int] = None):
+        """
+        Reserva un lugar en la ventana de la API. Espera si no hay cupo y
+        lanza CuotaExcedida si la espera superaría el máximo de la prioridad
+        (desde el event loop, en cuanto haría falta esperar).
+        """
+        prioridad = self._resolver_prioridad(clase, prioridad)
+        cubeta = self._cubetas[api][clase]
+        # En el event loop no se espera: bloquearía a todas las requests del worker
+        espera_maxima = 0.0 if _en_event_loop() else ESPERA_MAXIMA_POR_PRIORIDAD[prioridad]
+        limite_espera = time.monotonic() + espera_maxima
+        espero = False
+
+        with self._condicion:
+            while True:
+                ahora = time.monotonic()
+                cubeta.purgar(ahora)
+                espera = max(
+                    self._bloqueado_hasta[api] - ahora,
+                    cubeta.segundos_hasta_lugar(ahora, prioridad)
+                )
+                if espera <= 0:
+                    cubeta.marcas.append(ahora)
+                    cubeta.total += 1
+                    if espero:
+                        cubeta.esperas += 1
+                        metrics.CUOTA_EVENTOS.labels(api, clase, "espera").inc()
+                    return
+                if ahora + espera > limite_espera:
+                    cubeta.descartadas += 1
+                    metrics.CUOTA_EVENTOS.labels(api, clase, "descarte").inc()
+                    raise CuotaExcedida(
+                        f"Cuota de {api} ({clase}) agotada: request de prioridad "
+                        f"{Prioridad.NOMBRES[prioridad]} descartada (lugar en {espera:.1f}s)"
+                    )
+                espero = True
+                self._condicion.wait(timeout=min(espera, 1.0))
+
+    def registrar_exito(self, api: str, clase: str):
+        """Aumento aditivo del límite efectivo tras una request exitosa."""
+        with self._condicion:
+            cubeta = self._cubetas[api][clase]
+            if cubeta.factor < 1.0:
+                cubeta.factor = min(1.0, cubeta.factor + 0.05)
+            self._backoff[api] = 0.0
+            self._condicion.notify_all()
+
+    def registrar_429(self, api: str, clase: str) -> float:
+        """Reducción multiplicativa y bloqueo con backoff exponencial. Devuelve la espera."""
+        with self._condicion:
+            cubeta = self._cubetas[api][clase]
+            cubeta.errores_429 += 1
+            metrics.CUOTA_EVENTOS.labels(api, clase, "429").inc()
+            cubeta.factor = max(0.1, cubeta.factor * 0.5)
+
+            backoff = min(64.0, max(1.0, self._backoff[api] * 2))
+            self._backoff[api] = backoff
+            espera = backoff + random.uniform(0, 1)
+            self._bloqueado_hasta[api] = max(self._bloqueado_hasta[api], time.monotonic() + espera)
+            print(f"⚠️ 429 de {api} ({clase}): límite efectivo {cubeta.limite}/min, backoff {espera:.1f}s")
+            return espera
+
+    def ejecutar(
+        self,
+        api: str,
+        clase: str,
+        funcion: Callable[[], Any],
+        prioridad: Optional[int] = None
+    ) -> Any:
+        """Ejecuta la request respetando la cuota y reintentando ante 429 según la prioridad."""
+        prioridad = self._resolver_prioridad(clase, prioridad)
+        intento = 0
+        while True:
+            self.adquirir(api, clase, prioridad)
+            try:
+                with metrics.medir_llamada(api, clase):
+                    resultado = funcion()
+            except Exception as e:
+                if not es_error_cuota(e):
+                    raise
+                self.registrar_429(api, clase)
+                if intento >= REINTENTOS_POR_PRIORIDAD[prioridad]:
+                    raise
+                intento += 1
+                continue
+            self.registrar_exito(api, clase)
+            return resultado
+
+    def headroom(self) -> Dict[str, Any]:
+        """Estado de la cuota por API y clase: usado, disponible, factor AIMD y descartes."""
+        ahora = time.monotonic()
+        estado: Dict[str, Any] = {}
+        with self._condicion:
+            for api, clases in self._cubetas.items():
+                bloqueo = max(0.0, self._bloqueado_hasta[api] - ahora)
+                estado[api] = {"bloqueado_segundos": round(bloqueo, 1)}
+                for clase, cubeta in clases.items():
+                    cubeta.purgar(ahora)
+                    usadas = len(cubeta.marcas)
+                    estado[api][clase] = {
+                        "limite_por_minuto": cubeta.limite,
+                        "limite_base": cubeta.limite_base,
+                        "usadas_ultimo_minuto": usadas,
+                        "disponibles": max(0, cubeta.limite - usadas),
+                        "disponibles_baja_prioridad": max(0, cubeta.cupo(Prioridad.BAJA) - usadas),
+                        "requests_totales": cubeta.total,
+                        "requests_en_espera": cubeta.esperas,
+                        "requests_descartadas": cubeta.descartadas,
+                        "errores_429": cubeta.errores_429,
+                    }
+        return estado
+
+
+def clase_por_metodo(metodo: str) -> str:
+    """GET es lectura; cualquier otro verbo HTTP cuenta como escritura."""
+    return LECTURA if str(metodo).upper() == "GET" else ESCRITURA
+
+
+def crear_http_client_sheets(gateway: QuotaGateway):
+    """Clase HTTPClient de gspread que pasa cada request por el gateway."""
+    from gspread.http_client import HTTPClient
+
+    class QuotaHTTPClient(HTTPClient):
+        def request(self, method, endpoint, *args, **kwargs):
+            return gateway.ejecutar(
+                "sheets",
+                clase_por_metodo(method),
+                lambda: super(QuotaHTTPClient, self).request(method, endpoint, *args, **kwargs)
+            )
+
+    return QuotaHTTPClient
+
+
+def crear_request_builder_drive(gateway: QuotaGateway):
+    """Clase HttpRequest de googleapiclient que pasa cada execute() por el gateway."""
+    from googleapiclient.http import HttpRequest
+
+    class QuotaHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            return gateway.ejecutar(
+                "drive",
+                clase_por_metodo(self.method),
+                lambda: super(QuotaHttpRequest, self).execute(http=http, num_retries=num_retries)
+            )
+
+    return QuotaHttpRequest
@@ -0,0 +1,186 @@
+"""
+Coordinación entre workers de uvicorn en el mismo host.
+
+Con WEB_CONCURRENCY > 1 cada worker es un proceso con sus propios singletons
+y caches. Este módulo provee lo mínimo para que sigan siendo consistentes:
+
+- ProcessLock: lock exclusivo entre procesos (flock sobre un archivo) para las
+  secciones que asignan filas en OUTPUT o vuelcan el stock a la planilla.
+- CacheInvalidationBus: versiones por cache en un SQLite compartido. Quien
+  invalida un cache incrementa su versión; los demás workers la comparan en la
+  próxima lectura y descartan su copia local.
+- AvisosCompartidos: avisos ya enviados (p. ej. alertas de stock bajo), para
+  que un mismo aviso lo envíe un solo proceso.
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local con un solo proceso)
+    fcntl = None
+
+
+def cantidad_workers() -> int:
+    """Workers configurados (uvicorn usa WEB_CONCURRENCY como valor de --workers)."""
+    try:
+        return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+
+def modo_multiworker() -> bool:
+    return cantidad_workers() > 1
+
+
+def ruta_estado_compartido() -> str:
+    """Archivo SQLite compartido por los workers (cola de mensajes y versiones de cache)."""
+    return os.getenv("SHARED_STATE_DB_PATH", "./estado_compartido.db")
+
+
+def conectar_sqlite(ruta: str) -> sqlite3.Connection:
+    """Conexión SQLite en modo WAL apta para varios procesos y threads."""
+    conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class ProcessLock:
+    """
+    Lock exclusivo entre procesos del mismo host (y entre threads del proceso).
+    No es reentrante.
+
+    Uso:
+        with ProcessLock("output_registro"):
+            ...
+    """
+
+    _locks_locales: Dict[str, threading.Lock] = {}
+    _registro_lock = threading.Lock()
+
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        directorio = os.getenv("LOCK_DIR", os.path.join(tempfile.gettempdir(), "ecogas_locks"))
+        os.makedirs(directorio, exist_ok=True)
+        self.ruta = os.path.join(directorio, f"{nombre}.lock")
+
+        with ProcessLock._registro_lock:
+            self._lock_local = ProcessLock._locks_locales.setdefault(nombre, threading.Lock())
+        self._archivo = None
+
+    def __enter__(self):
+        self._lock_local.acquire()
+        if fcntl is not None:
+            try:
+                self._archivo = open(self.ruta, "a+")
+                fcntl.flock(self._archivo.fileno(), fcntl.LOCK_EX)
+            except Exception:
+                self._lock_local.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._archivo is not None:
+                fcntl.flock(self._archivo.fileno(), fcntl.LOCK_UN)
+                self._archivo.close()
+                self._archivo = None
+        finally:
+            self._lock_local.release()
+        return False
+
+
+class CacheInvalidationBus:
+    """Versiones de cache compartidas entre procesos a través de SQLite."""
+
+    def __init__(self, ruta: str = None):
+        self.ruta = ruta or ruta_estado_compartido()
+        self._lock = threading.Lock()
+        self._conn = conectar_sqlite(self.ruta)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS versiones_cache (nombre TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+        # Última versión que este proceso ya tuvo en cuenta, por cache
+        self._vistas: Dict[str, int] = {}
+
+    def version(self, nombre: str) -> int:
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT version FROM versiones_cache WHERE nombre = ?", (nombre,)
+            ).fetchone()
+        return fila[0] if fila else 0
+
+    def publicar(self, nombre: str) -> int:
+        """Marca el cache como invalidado para todos los procesos."""
+        with self._lock:
+            # Incremento y lectura en la misma transacción para no tapar la versión de otro proceso
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    """
+                    INSERT INTO versiones_cache (nombre, version) VALUES (?, 1)
+                    ON CONFLICT(nombre) DO UPDATE SET version = version + 1
+                    """,
+                    (nombre,)
+                )
+                version = self._conn.execute(
+                    "SELECT version FROM versiones_cache WHERE nombre = ?", (nombre,)
+                ).fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            # La invalidación propia ya se aplicó localmente
+            self._vistas[nombre] = version
+        return version
+
+    def invalidado_externamente(self, nombre: str) -> bool:
+        """True si otro proceso invalidó el cache desde la última consulta de este proceso."""
+        version = self.version(nombre)
+        with self._lock:
+            vista = self._vistas.get(nombre)
+            self._vistas[nombre] = version
+        return vista is not None and vista != version
+
+
+class AvisosCompartidos:
+    """
+    Marcas de avisos ya enviados, compartidas entre procesos. El primer
+    proceso que reclama una clave envía el aviso; los demás lo saltean hasta
+    que alguien la libera (p. ej. el stock volvió sobre el umbral).
+    """
+
+    def __init__(self, grupo: str, ruta: str = None):
+        self.grupo = grupo
+        self.ruta = ruta or ruta_estado_compartido()
+        self._lock = threading.Lock()
+        self._conn = conectar_sqlite(self.ruta)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS avisos_enviados (
+                grupo TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                creado_en REAL NOT NULL,
+                PRIMARY KEY (grupo, clave)
+            )
+            """
+        )
+
+    def reclamar(self, clave: str) -> bool:
+        """True si este proceso marcó el aviso (y debe enviarlo); False si ya estaba marcado."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO avisos_enviados (grupo, clave, creado_en) VALUES (?, ?, ?)",
+                (self.grupo, clave, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def liberar(self, clave: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM avisos_enviados WHERE grupo = ? AND clave = ?", (self.grupo, clave))
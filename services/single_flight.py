@@ -0,0 +1,73 @@
+"""
+Coalescencia de lecturas concurrentes (single-flight).
+
+Con el cache frío, varios webhooks o sesiones del dashboard piden a la vez
+la misma hoja. SingleFlight deja que solo el primero haga la lectura; los que
+llegan mientras está en curso esperan y reciben el mismo resultado (o la
+misma excepción). No es un cache: al terminar la lectura la clave se libera
+y la siguiente llamada vuelve a leer.
+
+Uso:
+    vuelo = SingleFlight()
+    carteles = vuelo.ejecutar("input_carteles", leer_planilla)
+
+El resultado se comparte entre todos los que esperaban: no modificarlo.
+"""
+
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from services import metrics
+
+
+class _Llamada:
+    def __init__(self):
+        self.terminada = threading.Event()
+        self.resultado: Any = None
+        self.error: Optional[BaseException] = None
+        self.esperando = 0
+
+
+class SingleFlight:
+    """Una sola lectura en curso por clave; los demás llamadores comparten su resultado."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_curso: Dict[str, _Llamada] = {}
+
+    def ejecutar(self, clave: str, funcion: Callable[[], Any]) -> Any:
+        # La etiqueta de la métrica es el tipo de recurso, no la clave completa (ids de carpeta, rangos)
+        recurso = clave.split(":", 1)[0]
+
+        with self._lock:
+            llamada = self._en_curso.get(clave)
+            lider = llamada is None
+            if lider:
+                llamada = self._en_curso[clave] = _Llamada()
+            else:
+                llamada.esperando += 1
+
+        if not lider:
+            metrics.SINGLE_FLIGHT.labels(recurso, "compartida").inc()
+            llamada.terminada.wait()
+            if llamada.error is not None:
+                raise llamada.error
+            return llamada.resultado
+
+        metrics.SINGLE_FLIGHT.labels(recurso, "lider").inc()
+        try:
+            llamada.resultado = funcion()
+            return llamada.resultado
+        except BaseException as e:
+            llamada.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
+            if llamada.esperando:
+                print(f"🔗 {clave}: {llamada.esperando} lectura(s) concurrente(s) resueltas con una sola request")
+            llamada.terminada.set()
+
+    def en_curso(self) -> int:
+        with self._lock:
+            return len(self._en_curso)
@@ -0,0 +1,160 @@
+"""
+Saldo de stock materializado por tipo.
+
+Se alimenta del snapshot de la planilla más los movimientos locales todavía no
+aplicados, y evalúa el umbral de alerta solo para el tipo que cambió. Las alertas
+al administrador se envían una vez por cruce del umbral (no en cada consulta):
+
+- En la primera carga, los tipos que ya están bajo el umbral se marcan como
+  notificados sin avisar (no se re-alerta en cada arranque).
+- Con `avisos` (AvisosCompartidos) la marca de "ya notificado" vive en el
+  SQLite compartido: con varios workers solo uno envía cada alerta.
+- Los movimientos de tipos que no están en el saldo (nunca cargado, o tipo
+  que no existe en la planilla) no generan alertas.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class StockBalance:
+    """Saldos de stock en memoria con alertas de stock bajo incrementales."""
+
+    def __init__(
+        self,
+        threshold: int = 10,
+        on_alerta: Optional[Callable[[Dict[str, Any]], Any]] = None,
+        avisos=None
+    ):
+        self.threshold = threshold
+        self.on_alerta = on_alerta
+        # Marcas compartidas entre procesos (reclamar/liberar); None = solo este proceso
+        self.avisos = avisos
+
+        self._saldos: Dict[str, int] = {}
+        self._alertas: Dict[str, Dict[str, Any]] = {}
+        # Tipos ya notificados al admin mientras siguen bajo el umbral
+        self._notificados = set()
+        self._actualizado_en: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def cargado(self) -> bool:
+        return self._actualizado_en is not None
+
+    def edad_segundos(self) -> float:
+        """Segundos desde la última carga desde la planilla (inf si nunca se cargó)."""
+        if self._actualizado_en is None:
+            return float('inf')
+        return time.monotonic() - self._actualizado_en
+
+    def _alerta(self, tipo: str, cantidad: int, threshold: int) -> Dict[str, Any]:
+        return {
+            "tipo_cartel": tipo,
+            "cantidad_actual": cantidad,
+            "threshold": threshold,
+            "mensaje": f"⚠️ Stock bajo: {tipo} - Quedan solo {cantidad} unidades"
+        }
+
+    def _evaluar(self, tipo: str, por_liberar: List[str]) -> Optional[Dict[str, Any]]:
+        """Actualiza la alerta de un tipo. Devuelve la alerta si hay que notificarla."""
+        cantidad = self._saldos.get(tipo, 0)
+        if cantidad <= self.threshold:
+            alerta = self._alerta(tipo, cantidad, self.threshold)
+            self._alertas[tipo] = alerta
+            if tipo not in self._notificados:
+                self._notificados.add(tipo)
+                return alerta
+        elif tipo in self._notificados:
+            # Volvió sobre el umbral: se rearma la notificación
+            self._alertas.pop(tipo, None)
+            self._notificados.discard(tipo)
+            por_liberar.append(tipo)
+        return None
+
+    def _notificar(self, alertas: List[Dict[str, Any]], por_liberar: List[str]):
+        try:
+            for tipo in por_liberar:
+                if self.avisos is not None:
+                    self.avisos.liberar(tipo)
+            # Solo el proceso que marca el aviso lo envía
+            alertas = [a for a in alertas if self.avisos is None or self.avisos.reclamar(a["tipo_cartel"])]
+        except Exception as e:
+            print(f"⚠️ Marcas de alertas de stock no disponibles: {e}")
+
+        if not self.on_alerta:
+            return
+        for alerta in alertas:
+            try:
+                self.on_alerta(alerta)
+            except Exception as e:
+                print(f"⚠️ Error al notificar alerta de stock: {e}")
+
+    def cargar_snapshot(self, stock: Dict[str, int], pendientes: Optional[Dict[str, int]] = None):
+        """
+        Recalcula los saldos desde un snapshot de la planilla más los deltas locales
+        pendientes. Solo se evalúan los tipos cuyo saldo cambió.
+        """
+        pendientes = pendientes or {}
+        nuevos: Dict[str, int] = {}
+        # Un tipo que desaparece del snapshot (filtrado por stock 0) queda en 0
+        for tipo in set(self._saldos) | set(stock):
+            nuevos[tipo] = max(0, stock.get(tipo, 0) + pendientes.get(tipo, 0))
+
+        por_notificar, por_liberar, ya_bajos = [], [], []
+        with self._lock:
+            primera_carga = self._actualizado_en is None
+            for tipo, cantidad in nuevos.items():
+                if primera_carga or self._saldos.get(tipo) != cantidad:
+                    self._saldos[tipo] = cantidad
+                    alerta = self._evaluar(tipo, por_liberar)
+                    if alerta:
+                        por_notificar.append(alerta)
+            self._actualizado_en = time.monotonic()
+
+        if primera_carga:
+            # Lo que ya estaba bajo el umbral al arrancar no es un cruce nuevo:
+            # se marca (también en el estado compartido) sin avisar
+            ya_bajos, por_notificar = por_notificar, []
+            try:
+                for alerta in ya_bajos:
+                    if self.avisos is not None:
+                        self.avisos.reclamar(alerta["tipo_cartel"])
+            except Exception as e:
+                print(f"⚠️ Marcas de alertas de stock no disponibles: {e}")
+
+        self._notificar(por_notificar, por_liberar)
+
+    def aplicar_movimiento(self, tipo: str, delta: int):
+        """
+        Aplica un movimiento local (negativo para salidas) y evalúa su umbral.
+        Se ignoran los tipos que no están en el saldo cargado desde la planilla.
+        """
+        por_liberar: List[str] = []
+        with self._lock:
+            if tipo not in self._saldos:
+                return
+            self._saldos[tipo] = max(0, self._saldos[tipo] + delta)
+            alerta = self._evaluar(tipo, por_liberar)
+
+        self._notificar([alerta] if alerta else [], por_liberar)
+
+    def saldos(self) -> Dict[str, int]:
+        """Copia de los saldos actuales."""
+        with self._lock:
+            return dict(self._saldos)
+
+    def alertas(self, threshold: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Alertas de stock bajo. Con el umbral configurado es una lectura directa;
+        con otro umbral se filtran los saldos en memoria.
+        """
+        with self._lock:
+            if threshold is None or threshold == self.threshold:
+                return list(self._alertas.values())
+            return [
+                self._alerta(tipo, cantidad, threshold)
+                for tipo, cantidad in self._saldos.items()
+                if cantidad <= threshold
+            ]
@@ -0,0 +1,178 @@
+"""
+Libro local de movimientos de stock.
+
+Los descuentos se registran primero en la tabla movimientos_stock (SQLite) y un
+flusher serializado aplica a la planilla el delta agregado por tipo en una sola
+escritura por lote. Así dos descuentos concurrentes no leen el mismo stock_actual
+y se hace una escritura por flush en lugar de varias llamadas por item.
+
+Un movimiento que la planilla no acepta (tipo sin celda de stock) suma un
+intento por flush; al llegar a STOCK_FLUSH_MAX_ATTEMPTS queda descartado: ya no
+se reintenta ni cuenta en el saldo pendiente.
+"""
+
+import os
+import threading
+from typing import Dict, List, Optional
+
+from app.database import SessionLocal, MovimientoStock, init_db
+from services import metrics
+from services.shared_state import ProcessLock
+
+
+MAX_INTENTOS = int(os.getenv("STOCK_FLUSH_MAX_ATTEMPTS", "5"))
+
+_PENDIENTE = (MovimientoStock.aplicado == False) & (MovimientoStock.descartado == False)  # noqa: E712
+
+
+class StockLedger:
+    """Registra movimientos de stock localmente y los vuelca a la planilla por lotes."""
+
+    def __init__(self, sheets_service):
+        self.sheets_service = sheets_service
+        self._flush_lock = threading.Lock()
+
+        # El dashboard no pasa por el startup de la API: asegurar la tabla
+        init_db()
+
+    def registrar_movimiento(
+        self,
+        tipo_cartel: str,
+        cantidad: int,
+        tipo_movimiento: str = "salida",
+        operario: Optional[str] = None,
+        registro_cartel_id: Optional[int] = None,
+        notas: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Registra un movimiento pendiente de aplicar.
+
+        Args:
+            tipo_cartel: Tipo de cartel / material
+            cantidad: Cantidad positiva
+            tipo_movimiento: 'entrada' o 'salida'
+
+        Returns:
+            ID del movimiento o None si falló
+        """
+        db = SessionLocal()
+        try:
+            movimiento = MovimientoStock(
+                tipo_cartel=tipo_cartel,
+                cantidad=abs(int(cantidad)),
+                tipo_movimiento=tipo_movimiento,
+                operario=operario,
+                registro_cartel_id=registro_cartel_id,
+                notas=notas,
+                aplicado=False
+            )
+            db.add(movimiento)
+            db.commit()
+            return movimiento.id
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al registrar movimiento de stock local: {e}")
+            return None
+        finally:
+            db.close()
+
+    @staticmethod
+    def _delta(movimiento: MovimientoStock) -> int:
+        signo = 1 if movimiento.tipo_movimiento == "entrada" else -1
+        return signo * movimiento.cantidad
+
+    def deltas_pendientes(self) -> Dict[str, int]:
+        """Delta neto por tipo de los movimientos todavía no aplicados a la planilla."""
+        db = SessionLocal()
+        try:
+            deltas: Dict[str, int] = {}
+            for movimiento in db.query(MovimientoStock).filter(_PENDIENTE):
+                deltas[movimiento.tipo_cartel] = deltas.get(movimiento.tipo_cartel, 0) + self._delta(movimiento)
+            return deltas
+        finally:
+            db.close()
+
+    def aplicado(self, movimiento_id: int) -> bool:
+        """True si el movimiento ya se volcó a la planilla."""
+        db = SessionLocal()
+        try:
+            movimiento = db.query(MovimientoStock).filter(MovimientoStock.id == movimiento_id).first()
+            return bool(movimiento is not None and movimiento.aplicado)
+        finally:
+            db.close()
+
+    def flush(self) -> Dict[str, bool]:
+        """
+        Aplica a la planilla los movimientos pendientes, agregados por tipo.
+
+        Solo un flush corre a la vez: los demás esperan y, al entrar, aplican lo
+        que haya quedado pendiente (normalmente nada, porque el flush anterior
+        ya tomó sus movimientos). Para saber si un movimiento en particular se
+        aplicó, usar aplicado(movimiento_id).
+
+        Returns:
+            Dict tipo -> True si se aplicó en este flush
+        """
+        with self._flush_lock:
+            # Otro worker podría estar aplicando los mismos movimientos pendientes
+            with ProcessLock("stock_flush"):
+                return self._aplicar_pendientes()
+
+    def _aplicar_pendientes(self) -> Dict[str, bool]:
+        db = SessionLocal()
+        try:
+            movimientos = (
+                db.query(MovimientoStock)
+                .filter(_PENDIENTE)
+                .order_by(MovimientoStock.id)
+                .all()
+            )
+            metrics.PROFUNDIDAD_COLA.labels("stock_pendiente").set(len(movimientos))
+            if not movimientos:
+                return {}
+
+            deltas: Dict[str, int] = {}
+            ids_por_tipo: Dict[str, List[int]] = {}
+            for movimiento in movimientos:
+                deltas[movimiento.tipo_cartel] = deltas.get(movimiento.tipo_cartel, 0) + self._delta(movimiento)
+                ids_por_tipo.setdefault(movimiento.tipo_cartel, []).append(movimiento.id)
+
+            print(f"📦 Aplicando {len(movimientos)} movimiento(s) de stock: {deltas}")
+            resultados = self.sheets_service.aplicar_deltas_stock(deltas)
+
+            aplicados = [
+                mov_id
+                for tipo, ok in resultados.items() if ok
+                for mov_id in ids_por_tipo.get(tipo, [])
+            ]
+            if aplicados:
+                (
+                    db.query(MovimientoStock)
+                    .filter(MovimientoStock.id.in_(aplicados))
+                    .update({MovimientoStock.aplicado: True}, synchronize_session=False)
+                )
+
+            # Rechazados por la planilla (sin resultado = error transitorio, no cuenta)
+            rechazados = [tipo for tipo, ok in resultados.items() if not ok]
+            descartados = 0
+            for movimiento in movimientos:
+                if movimiento.tipo_cartel in rechazados:
+                    movimiento.intentos = (movimiento.intentos or 0) + 1
+                    if movimiento.intentos >= MAX_INTENTOS:
+                        movimiento.descartado = True
+                        descartados += 1
+            if descartados:
+                print(
+                    f"⚠️ {descartados} movimiento(s) de stock descartados tras {MAX_INTENTOS} intentos "
+                    f"(tipos sin celda de stock: {', '.join(rechazados)})"
+                )
+            db.commit()
+            metrics.PROFUNDIDAD_COLA.labels("stock_pendiente").set(len(movimientos) - len(aplicados) - descartados)
+
+            return resultados
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al aplicar movimientos de stock: {e}")
+            return {}
+        finally:
+            db.close()
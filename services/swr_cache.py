@@ -0,0 +1,170 @@
+"""
+Snapshots con stale-while-revalidate.
+
+Un SWRCache guarda el último resultado bueno de una lectura cara (catálogo
+INPUT, OUTPUT, stock) y lo devuelve siempre sin esperar:
+
+- edad < refresco: se sirve tal cual.
+- refresco <= edad <= max_staleness: se sirve el snapshot y se relee en un
+  thread en segundo plano (una sola relectura a la vez).
+- edad > max_staleness (o sin snapshot, o tras invalidar()): se relee en el
+  momento. Si la lectura falla y hay snapshot, se sirve igual con un aviso;
+  sin snapshot, una CuotaExcedida del gateway se propaga al que llamó (el
+  sistema está saturado, no es que la hoja esté vacía).
+
+Además el API corre un refresco programado (app/main.py) que llama a
+refrescar_si_corresponde(): relee los snapshots vencidos o aquellos cuyo
+archivo cambió según detectar_cambio (p. ej. modifiedTime de Drive), así las
+requests casi nunca encuentran un snapshot vencido.
+
+La edad de cada snapshot se publica en ecogas_snapshot_edad_segundos.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from services import metrics
+from services.quota_gateway import CuotaExcedida
+
+
+class SWRCache:
+    """Último snapshot bueno de una lectura, revalidado en segundo plano."""
+
+    def __init__(
+        self,
+        nombre: str,
+        cargar: Callable[[], Any],
+        refresco_segundos: float,
+        max_staleness_segundos: float,
+        detectar_cambio: Optional[Callable[[], Optional[str]]] = None
+    ):
+        self.nombre = nombre
+        self._cargar = cargar
+        self.refresco_segundos = refresco_segundos
+        self.max_staleness_segundos = max(max_staleness_segundos, refresco_segundos)
+        self._detectar_cambio = detectar_cambio
+
+        self._lock = threading.Lock()
+        self._valor: Any = None
+        self._cargado_en: Optional[float] = None
+        self._refrescando = False
+        self._marca_cambio: Optional[str] = None
+        self.errores = 0
+
+    def edad_segundos(self) -> float:
+        cargado_en = self._cargado_en
+        if cargado_en is None:
+            return float("inf")
+        return time.monotonic() - cargado_en
+
+    def _publicar_edad(self):
+        if self._valor is not None:
+            metrics.SNAPSHOT_EDAD.labels(self.nombre).set(min(self.edad_segundos(), 10 ** 9))
+
+    def obtener(self) -> Any:
+        """Snapshot vigente (None si nunca se pudo cargar)."""
+        edad = self.edad_segundos()
+        if self._valor is None or edad > self.max_staleness_segundos:
+            metrics.registrar_cache(self.nombre, False)
+            valor, error = self._releer()
+            if valor is None:
+                if self._valor is not None:
+                    print(f"⚠️ Snapshot {self.nombre}: relectura fallida, se sirve uno de {edad:.0f}s")
+                elif isinstance(error, CuotaExcedida):
+                    raise error
+            return self._valor
+
+        if edad > self.refresco_segundos:
+            metrics.CACHE_CONSULTAS.labels(self.nombre, "stale").inc()
+            self._revalidar_en_fondo()
+        else:
+            metrics.registrar_cache(self.nombre, True)
+        self._publicar_edad()
+        return self._valor
+
+    def refrescar(self) -> Any:
+        """Relee ya. Devuelve el valor nuevo, o None si la lectura falló (se conserva el anterior)."""
+        return self._releer()[0]
+
+    def _releer(self) -> Tuple[Any, Optional[Exception]]:
+        try:
+            valor = self._cargar()
+        except Exception as e:
+            self.errores += 1
+            print(f"❌ Error al refrescar snapshot {self.nombre}: {e}")
+            return None, e
+        if valor is None:
+            self.errores += 1
+            return None, None
+
+        with self._lock:
+            self._valor = valor
+            self._cargado_en = time.monotonic()
+        self._publicar_edad()
+        return valor, None
+
+    def _revalidar_en_fondo(self):
+        with self._lock:
+            if self._refrescando:
+                return
+            self._refrescando = True
+
+        def tarea():
+            try:
+                self.refrescar()
+            finally:
+                with self._lock:
+                    self._refrescando = False
+
+        threading.Thread(target=tarea, name=f"swr-{self.nombre}", daemon=True).start()
+
+    def invalidar(self):
+        """La próxima lectura relee en el momento (p. ej. tras escribir la planilla)."""
+        with self._lock:
+            self._cargado_en = None
+
+    def marcar_vencido(self):
+        """La próxima lectura sirve el snapshot actual y relee en segundo plano."""
+        with self._lock:
+            if self._cargado_en is not None:
+                self._cargado_en = min(self._cargado_en, time.monotonic() - self.refresco_segundos - 1)
+
+    def refrescar_si_corresponde(self) -> bool:
+        """
+        Para el refresco programado: relee si el snapshot venció o si detectar_cambio
+        indica que el origen cambió. Los snapshots que nadie pidió todavía no se leen.
+        Devuelve True si releyó.
+        """
+        if self._valor is None:
+            return False
+
+        cambio = False
+        if self._detectar_cambio is not None:
+            try:
+                marca = self._detectar_cambio()
+            except Exception as e:
+                print(f"⚠️ No se pudo verificar cambios de {self.nombre}: {e}")
+                marca = None
+            if marca:
+                cambio = self._marca_cambio is not None and marca != self._marca_cambio
+                self._marca_cambio = marca
+
+        if cambio or self.edad_segundos() >= self.refresco_segundos:
+            if cambio:
+                print(f"🔄 Snapshot {self.nombre}: el origen cambió, releyendo")
+            self.refrescar()
+            return True
+        self._publicar_edad()
+        return False
+
+    def estado(self) -> Dict[str, Any]:
+        edad = self.edad_segundos()
+        return {
+            "cargado": self._valor is not None,
+            "edad_segundos": round(edad, 1) if edad != float("inf") else None,
+            "refresco_segundos": self.refresco_segundos,
+            "max_staleness_segundos": self.max_staleness_segundos,
+            "refrescando": self._refrescando,
+            "errores": self.errores,
+        }
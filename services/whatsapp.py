@@ -3,13 +3,15 @@ from dotenv import load_dotenv
 from typing import Optional, Dict
 import httpx
 import json
-from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 import logging
 import time
+import threading
 from datetime import datetime
 from functools import wraps
 
+from services import metrics
+
 load_dotenv()
 
 # Configurar logging
@@ -54,12 +56,15 @@ class WhatsAppService:
             logger.error("❌ Credenciales de Twilio no configuradas")
             raise ValueError("Credenciales de Twilio no configuradas (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)")
         
+        # twilio.rest carga el cliente completo de la API: solo al construir el servicio
+        from twilio.rest import Client
         self.client = Client(self.account_sid, self.auth_token)
         
         # Métricas de uso
         self.mensajes_enviados = 0
         self.mensajes_fallidos = 0
         self.ultima_actividad = datetime.now()
+        self._metricas_lock = threading.Lock()
         
         logger.info(f"✅ WhatsAppService inicializado correctamente con número: {self.twilio_number}")
     
@@ -88,6 +93,16 @@ class WhatsAppService:
         logger.debug(f"📱 Número normalizado: {numero} -> {numero_formateado}")
         return numero_formateado
     
+    def _registrar_envio(self, tipo: str, exito: bool):
+        """Actualiza los contadores de envío (thread-safe) y las métricas."""
+        with self._metricas_lock:
+            if exito:
+                self.mensajes_enviados += 1
+                self.ultima_actividad = datetime.now()
+            else:
+                self.mensajes_fallidos += 1
+        metrics.registrar_llamada("twilio", tipo, exito)
+    
     @retry_on_failure(max_retries=3, delay=2)
     def enviar_mensaje(self, to_number: str, mensaje: str) -> bool:
         """
@@ -116,24 +131,27 @@ class WhatsAppService:
             # Enviar mensaje con Twilio
             logger.info(f"📤 Enviando mensaje a {to_number}: {mensaje[:50]}...")
             
-            message = self.client.messages.create(
-                from_=self.twilio_number,
-                body=mensaje,
-                to=to_number
-            )
+            inicio = time.perf_counter()
+            try:
+                message = self.client.messages.create(
+                    from_=self.twilio_number,
+                    body=mensaje,
+                    to=to_number
+                )
+            finally:
+                metrics.LATENCIA_EXTERNA.labels("twilio", "enviar_mensaje").observe(time.perf_counter() - inicio)
             
-            self.mensajes_enviados += 1
-            self.ultima_actividad = datetime.now()
+            self._registrar_envio("enviar_mensaje", True)
             
             logger.info(f"✅ Mensaje enviado exitosamente - SID: {message.sid} - Status: {message.status}")
             return True
             
         except TwilioRestException as e:
-            self.mensajes_fallidos += 1
+            self._registrar_envio("enviar_mensaje", False)
             logger.error(f"❌ Error de Twilio al enviar mensaje: {e.code} - {e.msg}")
             return False
         except Exception as e:
-            self.mensajes_fallidos += 1
+            self._registrar_envio("enviar_mensaje", False)
             logger.error(f"❌ Error inesperado al enviar mensaje: {type(e).__name__}: {e}")
             return False
     
@@ -272,25 +290,28 @@ class WhatsAppService:
             logger.info(f"📤 Enviando imagen a {to_number} - URL: {media_url[:50]}...")
             
             # Enviar imagen con Twilio
-            message = self.client.messages.create(
-                from_=self.twilio_number,
-                media_url=[media_url],
-                body=caption,
-                to=to_number
-            )
+            inicio = time.perf_counter()
+            try:
+                message = self.client.messages.create(
+                    from_=self.twilio_number,
+                    media_url=[media_url],
+                    body=caption,
+                    to=to_number
+                )
+            finally:
+                metrics.LATENCIA_EXTERNA.labels("twilio", "enviar_imagen").observe(time.perf_counter() - inicio)
             
-            self.mensajes_enviados += 1
-            self.ultima_actividad = datetime.now()
+            self._registrar_envio("enviar_imagen", True)
             
             logger.info(f"✅ Imagen enviada exitosamente - SID: {message.sid}")
             return True
             
         except TwilioRestException as e:
-            self.mensajes_fallidos += 1
+            self._registrar_envio("enviar_imagen", False)
             logger.error(f"❌ Error de Twilio al enviar imagen: {e.code} - {e.msg}")
             return False
         except Exception as e:
-            self.mensajes_fallidos += 1
+            self._registrar_envio("enviar_imagen", False)
             logger.error(f"❌ Error inesperado al enviar imagen: {type(e).__name__}: {e}")
             return False
     
@@ -301,13 +322,18 @@ class WhatsAppService:
         Returns:
             Diccionario con métricas
         """
-        tasa_exito = (self.mensajes_enviados / (self.mensajes_enviados + self.mensajes_fallidos) * 100) if (self.mensajes_enviados + self.mensajes_fallidos) > 0 else 0
+        with self._metricas_lock:
+            enviados = self.mensajes_enviados
+            fallidos = self.mensajes_fallidos
+            ultima_actividad = self.ultima_actividad
+        
+        tasa_exito = (enviados / (enviados + fallidos) * 100) if (enviados + fallidos) > 0 else 0
         
         return {
-            "mensajes_enviados": self.mensajes_enviados,
-            "mensajes_fallidos": self.mensajes_fallidos,
+            "mensajes_enviados": enviados,
+            "mensajes_fallidos": fallidos,
             "tasa_exito": f"{tasa_exito:.2f}%",
-            "ultima_actividad": self.ultima_actividad.strftime('%d/%m/%Y %H:%M:%S'),
+            "ultima_actividad": ultima_actividad.strftime('%d/%m/%Y %H:%M:%S'),
             "numero_twilio": self.twilio_number
         }
     
@@ -0,0 +1,256 @@
+"""
+Zonas definidas por polígonos (pestaña "poligonos" de la planilla).
+
+Cada fila de la pestaña es una zona: un nombre (columna nombre/zona) y su
+geometría (columna coordenadas/vertices/poligono/geometria/geojson/wkt) en
+alguno de estos formatos:
+- pares "lat, lon; lat, lon; ..." (mismo orden que las coordenadas del INPUT)
+- JSON con una lista de pares [lat, lon]
+- GeoJSON Polygon/MultiPolygon (o Feature), con coordenadas [lon, lat]
+- WKT POLYGON/MULTIPOLYGON, con pares "lon lat"
+
+Los anillos interiores (huecos) se respetan con la regla par-impar.
+
+IndiceZonas agrupa los rectángulos envolventes en un árbol empaquetado tipo
+R-tree (Sort-Tile-Recursive) para consultar un punto revisando solo las zonas
+cuyo rectángulo lo contiene; zonas_de() asigna un lote de puntos (por ejemplo
+todo el catálogo) con ray casting vectorizado en NumPy. Si un punto cae en
+varias zonas gana la primera de la planilla.
+"""
+
+import json
+import math
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+_CLAVES_NOMBRE = ('nombre', 'zona', 'name')
+_CLAVES_GEOMETRIA = ('coordenadas', 'vertices', 'poligono', 'geometria', 'geojson', 'wkt')
+
+_NUMERO = r'-?\d+(?:\.\d+)?'
+_PAR_WKT = re.compile(rf'({_NUMERO})\s+({_NUMERO})')
+_ANILLO_WKT = re.compile(r'\(([^()]+)\)')
+_NUMEROS = re.compile(_NUMERO)
+
+# Hijos por nodo del árbol de rectángulos
+_CAPACIDAD_NODO = 8
+# Celdas (bordes x puntos) evaluadas por bloque en el ray casting
+_BLOQUE_CELDAS = 1_000_000
+
+Anillo = List[Tuple[float, float]]   # vértices (lat, lon)
+
+
+class Zona(NamedTuple):
+    nombre: str
+    anillos: List[Anillo]
+    bordes: np.ndarray                  # (E, 4): lat1, lon1, lat2, lon2 de cada borde
+    caja: Tuple[float, float, float, float]   # lat_min, lon_min, lat_max, lon_max
+    datos: Dict[str, Any]               # fila original de la planilla
+
+
+def _anillos_geojson(geometria: Dict[str, Any]) -> List[Anillo]:
+    if geometria.get('type') == 'Feature':
+        geometria = geometria.get('geometry') or {}
+    tipo = geometria.get('type')
+    if tipo == 'Polygon':
+        poligonos = [geometria.get('coordinates', [])]
+    elif tipo == 'MultiPolygon':
+        poligonos = geometria.get('coordinates', [])
+    else:
+        return []
+    return [[(float(p[1]), float(p[0])) for p in anillo] for poligono in poligonos for anillo in poligono]
+
+
+def parsear_geometria(texto: Any) -> List[Anillo]:
+    """Anillos (listas de vértices lat/lon) de la geometría en cualquiera de los formatos aceptados."""
+    texto = str(texto or '').strip()
+    if not texto:
+        return []
+
+    if texto[0] in '{[':
+        datos = json.loads(texto)
+        if isinstance(datos, dict):
+            anillos = _anillos_geojson(datos)
+        else:
+            anillos = [[(float(p[0]), float(p[1])) for p in datos]]
+    elif texto.upper().startswith(('POLYGON', 'MULTIPOLYGON')):
+        anillos = [
+            [(float(lat), float(lon)) for lon, lat in _PAR_WKT.findall(grupo)]
+            for grupo in _ANILLO_WKT.findall(texto)
+        ]
+    else:
+        anillos = []
+        for par in re.split(r'[;\n]', texto):
+            numeros = _NUMEROS.findall(par)
+            if len(numeros) >= 2:
+                if not anillos:
+                    anillos.append([])
+                anillos[0].append((float(numeros[0]), float(numeros[1])))
+
+    return [anillo for anillo in anillos if len(anillo) >= 3]
+
+
+def _campo(registro: Dict[str, Any], claves: Sequence[str]) -> Any:
+    normalizado = {str(k).strip().lower(): v for k, v in registro.items()}
+    for clave in claves:
+        if normalizado.get(clave) not in (None, ''):
+            return normalizado[clave]
+    return None
+
+
+def crear_zona(registro: Dict[str, Any], posicion: int = 0) -> Optional[Zona]:
+    """Zona de una fila de la pestaña de polígonos, o None si la geometría no es válida."""
+    try:
+        anillos = parsear_geometria(_campo(registro, _CLAVES_GEOMETRIA))
+    except (ValueError, TypeError, IndexError, KeyError) as e:
+        print(f"⚠️ Polígono {posicion + 1}: geometría inválida ({e})")
+        return None
+    if not anillos:
+        return None
+
+    bordes = []
+    for anillo in anillos:
+        for i, (lat1, lon1) in enumerate(anillo):
+            lat2, lon2 = anillo[(i + 1) % len(anillo)]
+            if (lat1, lon1) != (lat2, lon2):
+                bordes.append((lat1, lon1, lat2, lon2))
+    vertices = np.array([v for anillo in anillos for v in anillo])
+    caja = (
+        float(vertices[:, 0].min()), float(vertices[:, 1].min()),
+        float(vertices[:, 0].max()), float(vertices[:, 1].max())
+    )
+    nombre = str(_campo(registro, _CLAVES_NOMBRE) or f"Zona {posicion + 1}")
+    return Zona(nombre, anillos, np.array(bordes, dtype=float), caja, registro)
+
+
+def contiene(bordes: np.ndarray, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """
+    Ray casting vectorizado: para cada punto, si cruza una cantidad impar de
+    bordes al trazar un rayo hacia el este.
+    """
+    dentro = np.zeros(len(lats), dtype=bool)
+    if len(bordes) == 0 or len(lats) == 0:
+        return dentro
+
+    lat1, lon1, lat2, lon2 = (columna[:, np.newaxis] for columna in bordes.T)
+    bloque = max(1, _BLOQUE_CELDAS // len(bordes))
+    for inicio in range(0, len(lats), bloque):
+        lat = lats[np.newaxis, inicio:inicio + bloque]
+        lon = lons[np.newaxis, inicio:inicio + bloque]
+        cruza_paralelo = (lat1 > lat) != (lat2 > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lon_cruce = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        cruces = cruza_paralelo & (lon < lon_cruce)
+        dentro[inicio:inicio + bloque] = np.count_nonzero(cruces, axis=0) % 2 == 1
+    return dentro
+
+
+class _Nodo(NamedTuple):
+    cajas: np.ndarray     # (k, 4) rectángulos de los hijos
+    hijos: List[Any]      # índices de zona (hoja) o nodos
+    hoja: bool
+
+
+def _empaquetar(cajas: np.ndarray, hijos: List[Any], hoja: bool) -> List[_Nodo]:
+    """Un nivel del árbol Sort-Tile-Recursive: franjas por longitud, grupos por latitud."""
+    n = len(hijos)
+    cantidad_nodos = math.ceil(n / _CAPACIDAD_NODO)
+    franjas = math.ceil(math.sqrt(cantidad_nodos))
+    por_franja = franjas * _CAPACIDAD_NODO
+
+    centros_lon = (cajas[:, 1] + cajas[:, 3]) / 2
+    centros_lat = (cajas[:, 0] + cajas[:, 2]) / 2
+    orden = np.argsort(centros_lon, kind='stable')
+    nodos = []
+    for inicio in range(0, n, por_franja):
+        franja = orden[inicio:inicio + por_franja]
+        franja = franja[np.argsort(centros_lat[franja], kind='stable')]
+        for desde in range(0, len(franja), _CAPACIDAD_NODO):
+            grupo = franja[desde:desde + _CAPACIDAD_NODO]
+            nodos.append(_Nodo(cajas[grupo], [hijos[i] for i in grupo], hoja))
+    return nodos
+
+
+def _caja_de(nodo: _Nodo) -> Tuple[float, float, float, float]:
+    return (
+        float(nodo.cajas[:, 0].min()), float(nodo.cajas[:, 1].min()),
+        float(nodo.cajas[:, 2].max()), float(nodo.cajas[:, 3].max())
+    )
+
+
+class IndiceZonas:
+    """Zonas con índice de rectángulos envolventes y consultas punto-en-polígono."""
+
+    def __init__(self, zonas: List[Zona]):
+        self.zonas = zonas
+        self._raiz: Optional[_Nodo] = None
+        if not zonas:
+            return
+
+        cajas = np.array([zona.caja for zona in zonas], dtype=float)
+        nodos = _empaquetar(cajas, list(range(len(zonas))), hoja=True)
+        while len(nodos) > 1:
+            nodos = _empaquetar(np.array([_caja_de(n) for n in nodos]), nodos, hoja=False)
+        self._raiz = nodos[0]
+
+    def __len__(self) -> int:
+        return len(self.zonas)
+
+    def candidatas(self, latitud: float, longitud: float) -> List[int]:
+        """Índices (en orden de planilla) de las zonas cuyo rectángulo contiene el punto."""
+        if self._raiz is None:
+            return []
+        encontradas = []
+        pila = [self._raiz]
+        while pila:
+            nodo = pila.pop()
+            cajas = nodo.cajas
+            dentro = (
+                (cajas[:, 0] <= latitud) & (latitud <= cajas[:, 2])
+                & (cajas[:, 1] <= longitud) & (longitud <= cajas[:, 3])
+            )
+            for i in np.flatnonzero(dentro):
+                if nodo.hoja:
+                    encontradas.append(nodo.hijos[i])
+                else:
+                    pila.append(nodo.hijos[i])
+        return sorted(encontradas)
+
+    def zona_de(self, latitud: float, longitud: float) -> Optional[Zona]:
+        """Primera zona (en orden de planilla) que contiene el punto."""
+        lat, lon = np.array([latitud], dtype=float), np.array([longitud], dtype=float)
+        for indice in self.candidatas(latitud, longitud):
+            zona = self.zonas[indice]
+            if contiene(zona.bordes, lat, lon)[0]:
+                return zona
+        return None
+
+    def zonas_de(self, lats: Sequence[float], lons: Sequence[float]) -> List[Optional[str]]:
+        """Nombre de la zona de cada punto (None si no cae en ninguna), en una pasada por zona."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        asignadas = np.full(len(lats), -1)
+        for indice, zona in enumerate(self.zonas):
+            lat_min, lon_min, lat_max, lon_max = zona.caja
+            candidatos = np.flatnonzero(
+                (asignadas < 0)
+                & (lats >= lat_min) & (lats <= lat_max)
+                & (lons >= lon_min) & (lons <= lon_max)
+            )
+            if len(candidatos):
+                dentro = contiene(zona.bordes, lats[candidatos], lons[candidatos])
+                asignadas[candidatos[dentro]] = indice
+        return [self.zonas[i].nombre if i >= 0 else None for i in asignadas.tolist()]
+
+
+def indice_de_registros(registros: List[Dict[str, Any]]) -> IndiceZonas:
+    """Índice de las zonas válidas de la pestaña de polígonos."""
+    zonas = []
+    for posicion, registro in enumerate(registros):
+        zona = crear_zona(registro, posicion)
+        if zona is not None:
+            zonas.append(zona)
+    if len(zonas) < len(registros):
+        print(f"⚠️ {len(registros) - len(zonas)} polígono(s) sin geometría válida")
+    return IndiceZonas(zonas)
@@ -0,0 +1,297 @@
+"""
+Tests de la máquina de estados de WhatsApp (app/state_machine.py) y de la
+tabla de transiciones que registra app/main.py.
+
+Los casos son tablas: cada fila es un estado de conversación y un mensaje, y
+la transición que debe resolverse. test_tabla_cubre_todas_las_transiciones
+falla si se registra una transición nueva sin agregar su caso.
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from app.state_machine import (  # noqa: E402
+    AFIRMATIVO,
+    ESTADO_CUALQUIERA,
+    LISTO,
+    LISTO_ITEM,
+    NEGATIVO,
+    OBSERVACION,
+    Intencion,
+    MaquinaEstados,
+    Transicion,
+    crear_mensaje,
+    estados_candidatos,
+)
+
+NUMERO = "whatsapp:+5491100000000"
+UBICACION = (-34.6, -58.4)
+
+
+# ===== INTENCIONES =====
+
+INTENCIONES = [AFIRMATIVO, NEGATIVO, OBSERVACION, LISTO, LISTO_ITEM]
+
+CASOS_INTENCION = [
+    # (intención, texto normalizado, coincide)
+    (AFIRMATIVO, "sí, llegué", True),
+    (AFIRMATIVO, "dale", True),
+    (AFIRMATIVO, "ya estoy", True),
+    (AFIRMATIVO, "todavia no", False),
+    (AFIRMATIVO, "", False),
+    (NEGATIVO, "no", True),
+    (NEGATIVO, "todavía no", True),
+    # Subcadena, no palabra completa: "bueno" contiene "no"
+    (NEGATIVO, "bueno", True),
+    (NEGATIVO, "sí", False),
+    (OBSERVACION, "obs 277", True),
+    (OBSERVACION, "queda pendiente", True),
+    (OBSERVACION, "listo", False),
+    (LISTO, "finalizado", True),
+    (LISTO, "ya terminado", True),
+    (LISTO, "complete", False),
+    (LISTO_ITEM, "complete 278", True),
+    (LISTO_ITEM, "listo 277", True),
+    (LISTO_ITEM, "termine", False),
+]
+
+
+@pytest.mark.parametrize("intencion, texto, esperado", CASOS_INTENCION)
+def test_intencion_coincide(intencion, texto, esperado):
+    assert intencion.coincide(texto) is esperado
+
+
+TEXTOS = [
+    "", "no", "bueno", "casi", "si", "sí", "ok", "okey", "llegue", "llegué",
+    "todavía no", "aun no llegue", "obs", "observación 12", "incompleto",
+    "listo", "finalizado 3", "terminé", "termine", "completado", "complete",
+    "negativo", "yes", "estoy llegando", "noventa", "hola",
+]
+
+
+@pytest.mark.parametrize("intencion", INTENCIONES, ids=lambda i: i.nombre)
+@pytest.mark.parametrize("texto", TEXTOS)
+def test_intencion_equivale_a_subcadena(intencion, texto):
+    """La regex compilada tiene la semántica de any(palabra in texto)."""
+    esperado = bool(texto) and any(palabra in texto for palabra in intencion.palabras)
+    assert intencion.coincide(texto) is esperado
+
+
+def test_intencion_prefiere_palabras_largas():
+    intencion = Intencion("prueba", ["no", "todavia no"])
+    assert intencion._patron.search("todavia no").group() == "todavia no"
+
+
+# ===== ESTADOS CANDIDATOS =====
+
+CASOS_CANDIDATOS = [
+    ({}, ("simple", ["inicial", ESTADO_CUALQUIERA])),
+    ({"estado": None}, ("simple", ["inicial", ESTADO_CUALQUIERA])),
+    ({"estado": "en_trabajo"}, ("simple", ["en_trabajo", ESTADO_CUALQUIERA])),
+    ({"modo": "simple", "estado": "observado"}, ("simple", ["observado", ESTADO_CUALQUIERA])),
+    ({"modo": "multiple"}, ("multiple", ["en_progreso", ESTADO_CUALQUIERA])),
+    (
+        {
+            "modo": "multiple",
+            "estado_confirmacion": "esperando",
+            "item_actual_antes": "1",
+            "item_actual_despues": "2",
+            "estado_observacion": "esperando_texto",
+            "items_activos": {"1": {"estado": "recibiendo_antes"}, "2": {"estado": "recibiendo_despues"}},
+        },
+        ("multiple", [
+            "esperando_confirmacion", "recibiendo_antes", "recibiendo_despues",
+            "en_progreso", "esperando_observacion", ESTADO_CUALQUIERA,
+        ]),
+    ),
+    (
+        # El ítem apuntado ya no está recibiendo fotos: ese sub-estado no está activo
+        {
+            "modo": "multiple",
+            "item_actual_antes": "1",
+            "item_actual_despues": "3",
+            "items_activos": {"1": {"estado": "en_espera"}, "2": {"estado": "recibiendo_despues"}},
+        },
+        ("multiple", ["en_progreso", ESTADO_CUALQUIERA]),
+    ),
+    (
+        {"modo": "multiple", "item_actual_antes": 7, "items_activos": {"7": {"estado": "recibiendo_antes"}}},
+        ("multiple", ["recibiendo_antes", "en_progreso", ESTADO_CUALQUIERA]),
+    ),
+]
+
+
+@pytest.mark.parametrize("estado, esperado", CASOS_CANDIDATOS)
+def test_estados_candidatos(estado, esperado):
+    assert estados_candidatos(estado) == esperado
+
+
+# ===== PRIORIDAD DE RESOLVER =====
+
+async def _nada(mensaje):
+    return None
+
+
+def _maquina_de_prueba() -> MaquinaEstados:
+    maquina = MaquinaEstados()
+    maquina.agregar(Transicion("foto", "simple", "esperando", "imagen", _nada))
+    maquina.agregar(Transicion("afirmativo", "simple", "esperando", "texto", _nada, intencion=AFIRMATIVO))
+    maquina.agregar(Transicion("negativo", "simple", "esperando", "texto", _nada, intencion=NEGATIVO))
+    maquina.agregar(Transicion("con_numero", "simple", ESTADO_CUALQUIERA, "texto", _nada, condicion=lambda m: m.tiene_numero))
+    maquina.agregar(Transicion("cualquiera", "simple", ESTADO_CUALQUIERA, "texto", _nada))
+    maquina.agregar(Transicion("confirmar", "multiple", "esperando_confirmacion", "texto", _nada, intencion=AFIRMATIVO))
+    maquina.agregar(Transicion("foto_item", "multiple", "recibiendo_antes", "imagen", _nada))
+    return maquina
+
+
+MULTIPLE_CONFIRMANDO_Y_RECIBIENDO = {
+    "modo": "multiple",
+    "estado_confirmacion": "esperando",
+    "item_actual_antes": "1",
+    "items_activos": {"1": {"estado": "recibiendo_antes"}},
+}
+
+CASOS_PRIORIDAD = [
+    # (estado, texto, media, transición esperada)
+    ({"estado": "esperando"}, "sí", None, "afirmativo"),
+    # Dentro de una clave, gana la primera registrada que aplica ("no estoy": 'estoy' y 'no')
+    ({"estado": "esperando"}, "no estoy", None, "afirmativo"),
+    ({"estado": "esperando"}, "bueno", None, "negativo"),
+    # El estado específico se prueba antes que ESTADO_CUALQUIERA
+    ({"estado": "esperando"}, "ok 12", None, "afirmativo"),
+    ({"estado": "esperando"}, "12", None, "con_numero"),
+    ({"estado": "esperando"}, "hola", None, "cualquiera"),
+    # Foto con texto: el evento imagen va primero
+    ({"estado": "esperando"}, "sí", "https://media/1", "foto"),
+    ({"estado": "otro"}, "12", None, "con_numero"),
+    ({"estado": "otro"}, "", "https://media/1", None),
+    # En modo múltiple el orden de los estados candidatos manda sobre el de los eventos
+    (MULTIPLE_CONFIRMANDO_Y_RECIBIENDO, "sí", "https://media/1", "confirmar"),
+    (MULTIPLE_CONFIRMANDO_Y_RECIBIENDO, "hola", "https://media/1", "foto_item"),
+    (MULTIPLE_CONFIRMANDO_Y_RECIBIENDO, "hola", None, None),
+]
+
+
+@pytest.mark.parametrize("estado, texto, media_url, esperado", CASOS_PRIORIDAD)
+def test_resolver_prioridad(estado, texto, media_url, esperado):
+    transicion = _maquina_de_prueba().resolver(crear_mensaje(NUMERO, texto, media_url, estado))
+    assert (transicion.nombre if transicion else None) == esperado
+
+
+def test_transicion_duplicada():
+    maquina = _maquina_de_prueba()
+    with pytest.raises(ValueError):
+        maquina.agregar(Transicion("foto", "simple", "otro", "imagen", _nada))
+
+
+def test_despachar_ejecuta_la_accion():
+    recibidos = []
+
+    async def accion(mensaje):
+        recibidos.append(mensaje.texto)
+
+    maquina = MaquinaEstados()
+    maquina.agregar(Transicion("eco", "simple", ESTADO_CUALQUIERA, "texto", accion))
+
+    assert asyncio.run(maquina.despachar(crear_mensaje(NUMERO, "Hola", None, {}))) == "eco"
+    assert asyncio.run(maquina.despachar(crear_mensaje(NUMERO, "", "https://media/1", {}))) is None
+    assert recibidos == ["Hola"]
+
+
+# ===== TABLA DE app/main.py =====
+
+def _simple(estado, **extra):
+    return {"estado": estado, "numero_item": "190", **extra}
+
+
+def _multiple(**extra):
+    estado = {
+        "modo": "multiple",
+        "items_activos": {
+            "277": {"estado": "en_espera"},
+            "278": {"estado": "pendiente_confirmacion"},
+            "279": {"estado": "completado"},
+        },
+    }
+    estado.update(extra)
+    return estado
+
+
+FOTO = "https://api.twilio.com/media/1"
+
+CASOS_APP = [
+    # (estado, texto, media, ubicación, transición esperada)
+    # --- simple: inicio de sesión ---
+    ({}, "190", None, None, "iniciar_simple"),
+    ({}, "item 190", None, None, "iniciar_simple"),
+    ({}, "277, 278, 279", None, None, "iniciar_multiple"),
+    ({}, "hola", None, None, "ayuda"),
+    ({}, "", None, UBICACION, "guardar_ubicacion"),
+    ({}, "", FOTO, None, None),
+    (_simple("observado", observacion_registrada="lluvia"), "190", None, None, "retomar_observado"),
+    (_simple("observado", observacion_registrada="lluvia"), "191", None, None, "iniciar_simple"),
+    (_simple("observado"), "190", None, None, "iniciar_simple"),
+    # --- simple: confirmación de llegada ---
+    (_simple("esperando_confirmacion_llegada"), "sí, llegué", None, None, "confirmar_llegada"),
+    (_simple("esperando_confirmacion_llegada"), "todavía no", None, None, "recordar_confirmacion"),
+    (_simple("esperando_confirmacion_llegada"), "bueno", None, None, "recordar_confirmacion"),
+    (_simple("esperando_confirmacion_llegada"), "191", None, None, "iniciar_simple"),
+    (_simple("esperando_confirmacion_llegada"), "", None, UBICACION, "guardar_ubicacion"),
+    # --- simple: fotos y cierre ---
+    (_simple("esperando_imagenes_antes"), "", FOTO, None, "foto_antes"),
+    (_simple("esperando_imagenes_antes"), "191", None, None, None),
+    (_simple("esperando_imagenes_despues"), "listo", FOTO, None, "foto_despues"),
+    (_simple("en_trabajo"), "obs", None, None, "pedir_observacion"),
+    (_simple("en_trabajo"), "listo", None, None, "pedir_fotos_despues"),
+    (_simple("en_trabajo"), "observación: quedó incompleto, listo", None, None, "pedir_observacion"),
+    (_simple("en_trabajo"), "191", None, None, None),
+    (_simple("en_trabajo"), "hola", None, None, "ayuda"),
+    (_simple("en_trabajo"), "", None, UBICACION, "guardar_ubicacion"),
+    (_simple("esperando_observacion"), "Tormenta, sin acceso", None, None, "registrar_observacion"),
+    (_simple("esperando_observacion"), "listo 190", None, None, "registrar_observacion"),
+    # --- múltiple ---
+    (_multiple(estado_confirmacion="esperando", item_confirmacion_pendiente="278"),
+     "llegué", None, None, "confirmar_llegada_item"),
+    (_multiple(estado_confirmacion="esperando", item_confirmacion_pendiente="278"),
+     "aun no", None, None, "recordar_confirmacion_item"),
+    (_multiple(item_actual_antes="278", items_activos={"278": {"estado": "recibiendo_antes"}}),
+     "", FOTO, None, "foto_antes_item"),
+    (_multiple(item_actual_despues="277", items_activos={"277": {"estado": "recibiendo_despues"}}),
+     "", FOTO, None, "foto_despues_item"),
+    (_multiple(), "obs 277", None, None, "pedir_observacion_item"),
+    (_multiple(), "listo 277", None, None, "pedir_fotos_despues_item"),
+    (_multiple(), "listo", None, None, None),
+    (_multiple(), "", FOTO, None, None),
+    (_multiple(estado_observacion="esperando_texto", item_observacion="277"),
+     "sin acceso al predio", None, None, "registrar_observacion_item"),
+    (_multiple(estado_observacion="esperando_texto", item_observacion="999"),
+     "sin acceso al predio", None, None, None),
+    # en_progreso va antes que esperando_observacion
+    (_multiple(estado_observacion="esperando_texto", item_observacion="277"),
+     "listo 277", None, None, "pedir_fotos_despues_item"),
+]
+
+
+@pytest.fixture(scope="module")
+def maquina_app():
+    pytest.importorskip("fastapi")
+    from app.main import maquina
+    return maquina
+
+
+@pytest.mark.parametrize("estado, texto, media_url, ubicacion, esperado", CASOS_APP)
+def test_resolver_tabla_app(maquina_app, estado, texto, media_url, ubicacion, esperado):
+    transicion = maquina_app.resolver(crear_mensaje(NUMERO, texto, media_url, estado, ubicacion))
+    assert (transicion.nombre if transicion else None) == esperado
+
+
+def test_tabla_cubre_todas_las_transiciones(maquina_app):
+    """Cada transición registrada (y por lo tanto cada clave modo, estado, evento) tiene un caso."""
+    cubiertas = {caso[-1] for caso in CASOS_APP}
+    registradas = {t.nombre: (t.modo, t.estado, t.evento) for t in maquina_app.transiciones()}
+    faltantes = {nombre: clave for nombre, clave in registradas.items() if nombre not in cubiertas}
+    assert not faltantes
+    assert cubiertas - {None} <= set(registradas)